@@ -0,0 +1,161 @@
+"""
+Limit how many requests can wait for Flickr at once.
+
+When Flickr is slow, every login ties up a worker thread while it waits
+for a reply.  If enough people try to log in, every thread is waiting
+for Flickr, and requests that don't need Flickr at all -- the homepage,
+or ``/secret`` -- queue up behind them.
+
+The :class:`AdmissionController` stops that happening.  Before the login
+views call Flickr, they ask to be admitted:
+
+*   Up to ``max_concurrent`` requests can call Flickr at once.
+*   Up to ``max_waiting`` more can wait for a turn, for at most
+    ``queue_timeout`` seconds.
+*   Anything else is turned away immediately, with the same friendly
+    503 page and ``Retry-After`` header we show when Flickr is down
+    (see ``flickr_calls.py``).
+
+This leaves the other threads free for everything else, and a user
+who's turned away can try again in a moment, rather than staring at
+a spinning browser tab.
+
+Only the sync login views use this.  The async views (see ``asgi.py``)
+wait for Flickr on the event loop, so they don't tie up a thread.
+Calls from background threads (e.g. filling the request token pool)
+aren't limited either, because no request is waiting for them.
+
+Each worker process has its own limits.
+"""
+
+from collections.abc import Iterator
+import contextlib
+import logging
+import threading
+import time
+import typing
+
+from flask import Flask
+
+from flickr_calls import FlickrUnavailable
+from metrics import Metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class FlickrOverloaded(FlickrUnavailable):
+    """
+    Raised when too many requests are already waiting for Flickr, so
+    we turn this one away rather than make it wait too.
+    """
+
+
+class AdmissionController:
+    """
+    Lets up to ``max_concurrent`` requests call Flickr at once, with up
+    to ``max_waiting`` more waiting up to ``queue_timeout`` seconds for
+    their turn.
+    """
+
+    def __init__(
+        self,
+        *,
+        metrics: Metrics,
+        max_concurrent: int,
+        max_waiting: int,
+        queue_timeout: float,
+    ) -> None:
+        self.metrics = metrics
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        self.queue_timeout = queue_timeout
+
+        self._condition = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+
+    @contextlib.contextmanager
+    def admit(self, step: str) -> Iterator[None]:
+        """
+        Wait for a turn to call Flickr, or raise :class:`FlickrOverloaded`
+        if there isn't one soon enough.
+
+        ``step`` is the step of the login flow, e.g. ``fetch_access_token``,
+        which we use to label the metrics.
+        """
+        start = time.perf_counter()
+
+        with self._condition:
+            if self._active >= self.max_concurrent:
+                if self._waiting >= self.max_waiting:
+                    self._shed(step, reason="queue_full")
+
+                self._waiting += 1
+
+                try:
+                    admitted = self._condition.wait_for(
+                        lambda: self._active < self.max_concurrent,
+                        timeout=self.queue_timeout,
+                    )
+                finally:
+                    self._waiting -= 1
+
+                if not admitted:
+                    self._shed(step, reason="timeout")
+
+            self._active += 1
+
+        self.metrics.observe(
+            "flickr_admission_wait_seconds",
+            (("step", step),),
+            time.perf_counter() - start,
+        )
+
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._active -= 1
+                self._condition.notify()
+
+    def _shed(self, step: str, *, reason: str) -> typing.NoReturn:
+        """
+        Turn away a request, and record why.
+        """
+        logger.warning(
+            "Too many requests waiting for Flickr; turning away %s (%s)", step, reason
+        )
+        self.metrics.increment(
+            "flickr_admission_shed_total", (("reason", reason), ("step", step))
+        )
+        raise FlickrOverloaded(retry_after=self.queue_timeout)
+
+
+def init_app(app: Flask) -> AdmissionController:
+    """
+    Create the admission controller for an app, using the settings in
+    the app config.
+
+    The controller is saved in ``app.extensions["flickr_admission"]``.
+    """
+    # How many requests can call Flickr at once.  This should be less
+    # than the number of threads in each worker, so there are always
+    # some left for requests which don't need Flickr.
+    app.config.setdefault("FLICKR_MAX_CONCURRENT_CALLS", 8)
+
+    # How many more requests can wait for a turn, and for how long
+    # (in seconds), before we turn them away.
+    app.config.setdefault("FLICKR_MAX_WAITING_CALLS", 16)
+    app.config.setdefault("FLICKR_ADMISSION_TIMEOUT", 2.0)
+
+    controller = AdmissionController(
+        metrics=app.extensions["metrics"],
+        max_concurrent=app.config["FLICKR_MAX_CONCURRENT_CALLS"],
+        max_waiting=app.config["FLICKR_MAX_WAITING_CALLS"],
+        queue_timeout=app.config["FLICKR_ADMISSION_TIMEOUT"],
+    )
+
+    app.extensions["flickr_admission"] = controller
+
+    return controller
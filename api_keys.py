@@ -0,0 +1,255 @@
+"""
+Share the load between several Flickr API keys.
+
+Flickr limits how many calls each API key can make (see ``rate_limit.py``),
+so if one key isn't enough, you can give the app several.  Put them in
+a JSON file, and set ``FLICKR_API_KEYS_FILE``:
+
+    [
+        {"key": "…", "secret": "…"},
+        {"key": "…", "secret": "…"}
+    ]
+
+*   Each new login uses the next key in turn.  If a key has used up its
+    share of the rate limit, or Flickr rejected it recently (e.g. because
+    it's been revoked), we skip it and try the next one.
+*   A login has to be finished with the same key that started it, so we
+    save the key with the request token (see ``token_store.py``), and
+    the callback uses the same key.
+*   Likewise, a user's access token only works with the key that got it,
+    so we save the key with the user (see ``users.py``), and sign their
+    API calls with it (see ``flickr_api.py``).
+
+You can add or remove keys without restarting the app: edit the file,
+and each worker will notice within ``FLICKR_API_KEYS_RELOAD_INTERVAL``
+seconds.  We keep using a removed key for a while, so logins which are
+already in progress can finish.
+
+If you don't set ``FLICKR_API_KEYS_FILE``, we use the single key from
+``credentials.py``.  That key is also the "default" key, which we use for
+request tokens and users that were saved before we knew which key they
+belonged to.
+"""
+
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import typing
+
+from flask import Flask
+
+
+logger = logging.getLogger(__name__)
+
+
+class ApiKey(typing.NamedTuple):
+    """
+    A Flickr API key and its secret.
+    """
+
+    client_id: str
+    client_secret: str
+
+
+def read_keys_file(path: str) -> list[ApiKey]:
+    """
+    Read a list of API keys from a JSON file.
+    """
+    with open(path) as in_file:
+        data = json.load(in_file)
+
+    keys = [ApiKey(entry["key"], entry["secret"]) for entry in data]
+
+    if not keys:
+        raise ValueError(f"No API keys in {path}")
+
+    return keys
+
+
+class ApiKeyRing:
+    """
+    The API keys we can use, and which of them are healthy.
+
+    ``default`` is the key from the app's credentials.  If ``path`` is set,
+    we also use the keys in that file, and reload it when it changes.
+    """
+
+    def __init__(
+        self,
+        default: ApiKey,
+        *,
+        path: str | None,
+        reload_interval: float,
+        cooldown: float,
+        retired_ttl: float,
+    ) -> None:
+        self.default = default
+        self.path = path
+        self.reload_interval = reload_interval
+        self.cooldown = cooldown
+        self.retired_ttl = retired_ttl
+
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+
+        # When each unhealthy key can be used again, and when each key
+        # we've removed should be forgotten
+        self._unhealthy_until: dict[str, float] = {}
+        self._retired: dict[str, tuple[float, ApiKey]] = {}
+
+        if path is None:
+            self._active = [default]
+            self._mtime: int | None = None
+        else:
+            self._mtime = os.stat(path).st_mtime_ns
+            self._active = read_keys_file(path)
+
+        self._checked_at = time.monotonic()
+
+    def candidates(self) -> list[ApiKey]:
+        """
+        Return the keys to try for a new login, in the order we should
+        try them.
+
+        We start with a different key each time, so the load is spread
+        evenly, and put any unhealthy keys at the end -- we'd rather try
+        them than fail the login without trying.
+        """
+        self.maybe_reload()
+
+        now = time.monotonic()
+
+        with self._lock:
+            start = next(self._counter) % len(self._active)
+            keys = self._active[start:] + self._active[:start]
+
+            healthy = [
+                key
+                for key in keys
+                if self._unhealthy_until.get(key.client_id, 0) <= now
+            ]
+
+        return healthy + [key for key in keys if key not in healthy]
+
+    def get(self, client_id: str | None) -> ApiKey | None:
+        """
+        Find the key with this ``client_id``, or return None if we
+        don't have it any more.
+
+        If ``client_id`` is None, this is something we saved before we
+        knew which key it belonged to, so we use the default key.
+        """
+        if client_id is None or client_id == self.default.client_id:
+            return self.default
+
+        with self._lock:
+            for key in self._active:
+                if key.client_id == client_id:
+                    return key
+
+            retired = self._retired.get(client_id)
+
+            if retired is not None and retired[0] > time.monotonic():
+                return retired[1]
+
+        return None
+
+    def mark_unhealthy(self, key: ApiKey) -> None:
+        """
+        Stop choosing a key for new logins for a while, e.g. because
+        Flickr rejected it.
+        """
+        logger.warning(
+            "Flickr rejected API key %s; skipping it for %ss",
+            key.client_id,
+            self.cooldown,
+        )
+
+        with self._lock:
+            self._unhealthy_until[key.client_id] = time.monotonic() + self.cooldown
+
+    def maybe_reload(self) -> None:
+        """
+        Reload the keys file if it's changed, checking at most once every
+        ``reload_interval`` seconds.
+
+        If we can't read the new file, we log a warning and keep using
+        the keys we have.
+        """
+        now = time.monotonic()
+
+        with self._lock:
+            if self.path is None or now < self._checked_at + self.reload_interval:
+                return
+
+            self._checked_at = now
+
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+
+            if mtime == self._mtime:
+                return
+
+            keys = read_keys_file(self.path)
+        except Exception:
+            logger.warning(
+                "Unable to reload API keys from %s", self.path, exc_info=True
+            )
+            return
+
+        with self._lock:
+            for key in self._active:
+                if key not in keys:
+                    self._retired[key.client_id] = (now + self.retired_ttl, key)
+
+            for key in keys:
+                self._retired.pop(key.client_id, None)
+
+            self._retired = {
+                client_id: retired
+                for client_id, retired in self._retired.items()
+                if retired[0] > now
+            }
+
+            self._active = keys
+            self._mtime = mtime
+
+        logger.info("Reloaded %d API keys from %s", len(keys), self.path)
+
+
+def init_app(app: Flask) -> ApiKeyRing:
+    """
+    Create the API key ring for an app, using the settings in the app
+    config, and the key in ``CLIENT_ID`` and ``CLIENT_SECRET``.
+
+    The key ring is saved in ``app.extensions["flickr_api_keys"]``.
+    """
+    # A JSON file with the API keys to use, or None to use the single
+    # key from the app's credentials
+    app.config.setdefault("FLICKR_API_KEYS_FILE", None)
+
+    # How often (in seconds) to check whether the keys file has changed
+    app.config.setdefault("FLICKR_API_KEYS_RELOAD_INTERVAL", 10.0)
+
+    # How long (in seconds) to skip a key after Flickr rejects it
+    app.config.setdefault("FLICKR_API_KEY_COOLDOWN", 60.0)
+
+    # How long (in seconds) to keep using a key after it's removed from
+    # the file, so logins in progress can finish.  This should be at
+    # least as long as we keep request tokens (``REQUEST_TOKEN_TTL``).
+    app.config.setdefault("FLICKR_API_KEY_RETIRED_TTL", 15 * 60)
+
+    keys = ApiKeyRing(
+        ApiKey(app.config["CLIENT_ID"], app.config["CLIENT_SECRET"]),
+        path=app.config["FLICKR_API_KEYS_FILE"],
+        reload_interval=app.config["FLICKR_API_KEYS_RELOAD_INTERVAL"],
+        cooldown=app.config["FLICKR_API_KEY_COOLDOWN"],
+        retired_ttl=app.config["FLICKR_API_KEY_RETIRED_TTL"],
+    )
+
+    app.extensions["flickr_api_keys"] = keys
+
+    return keys
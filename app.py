@@ -2,25 +2,60 @@
 A demo app that allows users to log in using Flickr and OAuth.
 """
 
+from collections.abc import Iterator
+import logging
 import sys
+import typing
 
-from authlib.integrations.httpx_client import OAuth1Client
-from flask import Flask, current_app, redirect, url_for, session, abort, request
+from flask import Flask, current_app, redirect, url_for, abort, request, session
 from flask_login import (
-    UserMixin,
     LoginManager,
     login_user,
     logout_user,
     current_user,
     login_required,
 )
-import keyring
 import werkzeug
 
+from admission import AdmissionController
+import admission
+from api_keys import ApiKey, ApiKeyRing
+import api_keys
+import background_jobs
+from credentials import load_credentials
+import flickr_api
+import flickr_calls
+import flickr_http
+import metrics
+import pages
+import pending_logins
+from pending_logins import PendingLogins
+import profiling
+import rate_limit
+import session_revocation
+import sessions
+from pages import render_page, stream_page
+import token_pool
+import token_store
+import token_validator
+import tracing
+import users
+from users import FlickrUser, UserStore
+import warm_up
 
-def create_app() -> Flask:
+# The OAuth libraries are slow to import, and most requests don't need
+# them -- only the login views do.  We import them when we first create
+# an OAuth client, so worker processes start faster.
+if typing.TYPE_CHECKING:
+    from authlib.integrations.httpx_client import AsyncOAuth1Client, OAuth1Client
+
+
+def create_app(config: dict[str, typing.Any] | None = None) -> Flask:
     """
     Create an instance of the Flask app.
+
+    Any values in ``config`` are added to the app config before the app
+    is set up, so you can use them to override the defaults.
     """
     app = Flask(__name__)
 
@@ -37,14 +72,41 @@ def create_app() -> Flask:
     # or delete.
     app.config["FLICKR_PERMISSIONS"] = "read"
 
-    # Get the Flickr API credentials from the system keychain.
+    # Where to find Flickr.  You can point this at a fake Flickr for
+    # load testing -- see ``fake_flickr.py``.
+    app.config["FLICKR_BASE_URL"] = "https://www.flickr.com"
+
+    # Where to look for the Flickr API credentials, and in what order.
+    # See ``credentials.py``.
+    app.config["FLICKR_CREDENTIAL_SOURCES"] = ["environment", "file", "keyring"]
+    app.config["FLICKR_CREDENTIALS_FILE"] = None
+
+    # Whether to fetch a user's Flickr profile in the background when
+    # they log in, so the first page they see doesn't wait for Flickr.
+    # This is an extra API call for every login, which counts towards
+    # the rate limit -- see ``rate_limit.py``.
+    app.config["WARM_PROFILE_ON_LOGIN"] = True
+
+    # Load any config from ``FLASK_``-prefixed environment variables,
+    # e.g. ``FLASK_FLICKR_BASE_URL=http://localhost:8009``.
     #
-    # If either of these are missing, print an error prompting the user
-    # to configure their credentials first.
-    client_id = keyring.get_password("flickr_flask_login_demo", "key")
-    client_secret = keyring.get_password("flickr_flask_login_demo", "secret")
+    # See https://flask.palletsprojects.com/en/stable/config/#configuring-from-environment-variables
+    app.config.from_prefixed_env()
+
+    if config is not None:
+        app.config.update(config)
+
+    # Get the Flickr API credentials.  We look in the environment, then
+    # in a credentials file (if there is one), then in the system keychain.
+    #
+    # If they're missing, print an error prompting the user to configure
+    # their credentials first.
+    credentials = load_credentials(
+        tuple(app.config["FLICKR_CREDENTIAL_SOURCES"]),
+        credentials_file=app.config["FLICKR_CREDENTIALS_FILE"],
+    )
 
-    if client_id is None or client_secret is None:
+    if credentials is None:
         sys.exit(
             "You need to save your Flickr API credentials to your keychain before\n"
             "you can run this app:\n"
@@ -54,10 +116,80 @@ def create_app() -> Flask:
             "\n"
             "    $ keyring set flickr_flask_login_demo key\n"
             "    $ keyring set flickr_flask_login_demo secret\n"
+            "\n"
+            "(Or set the FLICKR_API_KEY and FLICKR_API_SECRET environment variables.)\n"
         )
 
-    app.config["CLIENT_ID"] = client_id
-    app.config["CLIENT_SECRET"] = client_secret
+    app.config["CLIENT_ID"] = credentials.client_id
+    app.config["CLIENT_SECRET"] = credentials.client_secret
+
+    # Start recording metrics for every request -- see ``metrics.py``.
+    # We do this first, so we time everything else the app does.
+    metrics.init_app(app)
+
+    # Profile a sample of requests, if it's turned on in the config --
+    # see ``profiling.py``.
+    profiling.init_app(app)
+
+    # Trace a sample of logins from start to finish, if it's turned on
+    # in the config -- see ``tracing.py``.
+    tracing.init_app(app)
+
+    # Start a pool of threads for work that can happen after we've
+    # sent the response -- see ``background_jobs.py``.
+    background_jobs.init_app(app)
+
+    # Create a pooled HTTP transport for talking to Flickr, which is
+    # shared by all the OAuth clients we create in this process.
+    flickr_http.init_app(app)
+
+    # Find the Flickr API keys we can use -- usually just the one in
+    # our credentials, but you can have several -- see ``api_keys.py``.
+    api_keys.init_app(app)
+
+    # Create somewhere to keep the users who've logged in.  We do this
+    # before the rate limiter, because by default its bucket goes in
+    # the same database.
+    users.init_app(app)
+
+    # Set the rate limit, timeouts, retries and circuit breaker for
+    # those calls.
+    rate_limit.init_app(app)
+    flickr_calls.init_app(app)
+
+    # Limit how many logins can wait for Flickr at once, so a slow
+    # Flickr doesn't tie up every thread -- see ``admission.py``.
+    admission.init_app(app)
+
+    # Create a client for making Flickr API calls as a logged-in user,
+    # with a cache so page views don't wait for Flickr.
+    flickr_api.init_app(app)
+
+    # Create somewhere to keep request tokens between the /authorize
+    # and /callback steps.
+    token_store.init_app(app)
+
+    # Keep a pool of request tokens ready for /authorize, if it's
+    # turned on in the config.
+    token_pool.init_app(app, fetch=fetch_request_token)
+
+    # Reuse request tokens if somebody clicks "log in" more than once.
+    pending_logins.init_app(app)
+
+    # Check in the background whether users have revoked our access on
+    # Flickr, if it's turned on in the config -- see ``token_validator.py``.
+    token_validator.init_app(app)
+
+    # Keep a list of sessions which were logged out, so copies of
+    # their cookies don't work -- see ``session_revocation.py``.
+    session_revocation.init_app(app)
+
+    # Set up the cache for rendered pages.
+    pages.init_app(app)
+
+    # Don't do any work to open the session for visitors who don't
+    # have a session cookie -- see ``sessions.py``.
+    sessions.init_app(app)
 
     # Create a basic login manager using Flask-Login, which will
     # redirect logged-out users to the homepage.
@@ -74,36 +206,40 @@ def create_app() -> Flask:
     app.add_url_rule("/callback", view_func=callback)
     app.add_url_rule("/logout", view_func=logout)
     app.add_url_rule("/secret", view_func=secret)
+    app.add_url_rule("/photos", view_func=photos)
+    app.add_url_rule("/status/flickr", view_func=flickr_status)
+    app.add_url_rule("/metrics", view_func=prometheus_metrics)
+    app.add_url_rule("/debug/traces", view_func=debug_traces)
+    app.add_url_rule("/ready", view_func=ready)
+
+    # Warm up the connection to Flickr in the background, if it's
+    # turned on in the config -- see ``warm_up.py``.  We do this last,
+    # because it uses everything we've set up above.
+    warm_up.init_app(app, warm=warm_up_flickr)
 
     return app
 
 
-def homepage() -> str:
+def homepage() -> werkzeug.Response:
     """
     A basic homepage.
+
+    The pages are rendered from the templates in ``templates/`` -- see
+    ``pages.py`` for how we make them fast.
     """
-    if not current_user.is_authenticated:
-        return f"""
-            <p>This is a Flask app to demonstrate OAuth login using Flickr.</p>
-            
-            <p>You are <strong style="color: red;">logged out</strong>.</p>
-            
-            <p>You can <strong><a href="{url_for("authorize")}">log in</a></strong>.</p>
-        """
+    # Most visitors to the homepage aren't logged in.  If the browser
+    # didn't send a session or "remember me" cookie, they can't be, so
+    # we don't ask for ``current_user``, which would load the session
+    # and the user -- see ``sessions.py``.  A browser with a cookie
+    # might still be logged out, e.g. if the session was revoked.
+    if sessions.is_anonymous_request() or not current_user.is_authenticated:
+        return render_page("homepage_logged_out.html")
     else:
-        return f"""
-            <p>This is a Flask app to demonstrate OAuth login using Flickr.</p>
-            
-            <p>
-                You are <strong style="color: DarkGreen;">logged in</strong>
-                as <strong>{current_user.name} ({current_user.user_nsid})</strong>.
-            </p>
-            
-            <p>
-                You can visit the <strong><a href="{url_for("secret")}">secret page</a></strong> or
-                <strong><a href="{url_for("logout")}">log out</a></strong>.
-            </p>
-        """
+        return render_page(
+            "homepage_logged_in.html",
+            name=current_user.name,
+            user_nsid=current_user.user_nsid,
+        )
 
 
 def authorize() -> werkzeug.Response:
@@ -119,12 +255,9 @@ def authorize() -> werkzeug.Response:
     if current_user.is_authenticated:
         return redirect(url_for("homepage"))
 
-    # Create an OAuth1Client with the Flickr API key and secret
-    oauth_client = OAuth1Client(
-        client_id=current_app.config["CLIENT_ID"],
-        client_secret=current_app.config["CLIENT_SECRET"],
-        signature_type="QUERY",
-    )
+    # If we're tracing a sample of logins, this might be one of them --
+    # see ``tracing.py``.
+    tracing.start_trace()
 
     # Where will the user be redirected after they approve our app
     # on Flickr.com?
@@ -136,22 +269,21 @@ def authorize() -> werkzeug.Response:
 
     # Step 1: Get a Request Token
     #
-    # This will return an OAuth token and secret, in the form:
-    #
-    #     {'oauth_callback_confirmed': 'true',
-    #      'oauth_token': '721…b37',
-    #      'oauth_token_secret': '7e2…91a'}
-    #
-    # See https://www.flickr.com/services/api/auth.oauth.html#request_token
-    request_token = oauth_client.fetch_request_token(
-        url="https://www.flickr.com/services/oauth/request_token",
-        params={"oauth_callback": callback_url},
-    )
+    # If we sent this browser to Flickr a moment ago (e.g. the user
+    # double-clicked "log in"), we reuse the same request token, rather
+    # than ask Flickr for another one.  If the browser sends several
+    # requests at once, they share one call to Flickr -- see
+    # ``pending_logins.py``.
+    logins: PendingLogins = current_app.extensions["pending_logins"]
 
-    # Save the request token in the user session -- we'll need it in
-    # the Flickr callback when we exchange the request token for
-    # an access token.
-    session["request_token"] = request_token
+    request_token = logins.get(callback_url)
+
+    if request_token is None:
+        request_token = logins.flight.do(
+            logins.flight_key(callback_url),
+            lambda: new_request_token(callback_url),
+        )
+        logins.remember(request_token, callback_url)
 
     # Step 2: Getting the User Authorization
     #
@@ -159,15 +291,202 @@ def authorize() -> werkzeug.Response:
     # can choose to authorize the app (or not).
     #
     # See https://www.flickr.com/services/api/auth.oauth.html#request_token
-    authorization_url = oauth_client.create_authorization_url(
-        url=f"https://www.flickr.com/services/oauth/authorize?perms={current_app.config['FLICKR_PERMISSIONS']}"
-    )
+    authorization_url = create_authorization_url(request_token)
 
     # Redirect the user to the Flickr.com URL where they can log in
     # and approve our app.
     return redirect(authorization_url)
 
 
+def new_request_token(callback_url: str) -> dict[str, str]:
+    """
+    Get a new request token for a login, and save it so we can find it
+    again in the callback.
+    """
+    # If we're keeping a pool of request tokens, we take one we fetched
+    # earlier, so the user doesn't have to wait for Flickr -- see
+    # ``token_pool.py``.  Otherwise, we ask Flickr for a new one.
+    request_token = pop_pooled_request_token(callback_url)
+
+    # If we have to wait for Flickr, we wait our turn, so we don't tie
+    # up every thread if Flickr is slow -- see ``admission.py``.
+    if request_token is None:
+        with flickr_admission().admit("fetch_request_token"):
+            request_token = fetch_request_token(callback_url)
+
+    # Save the request token on the server -- we'll need it in the
+    # Flickr callback when we exchange the request token for
+    # an access token.
+    save_request_token(request_token)
+
+    return request_token
+
+
+def fetch_request_token(callback_url: str) -> dict[str, str]:
+    """
+    Get a new request token from Flickr.
+
+    This is used by /authorize, and by the background thread which
+    fills the request token pool.
+
+    If we have several API keys, we try them in turn, skipping any that
+    have used up their share of the rate limit, or that Flickr rejects
+    -- see ``api_keys.py``.  We save the key we used with the token, so
+    the callback can finish the login with the same key.
+    """
+    from authlib.integrations.base_client import OAuthError
+
+    keys: ApiKeyRing = current_app.extensions["flickr_api_keys"]
+    error: Exception | None = None
+
+    for key in keys.candidates():
+        try:
+            request_token = fetch_request_token_with_key(key, callback_url)
+        except flickr_calls.FlickrRateLimited as err:
+            error = err
+        except OAuthError as err:
+            keys.mark_unhealthy(key)
+            # If another key is only rate limited, we'd rather tell the
+            # user to try again later, so that error takes priority.
+            error = error or err
+        else:
+            return {**request_token, "client_id": key.client_id}
+
+    assert error is not None
+    raise error
+
+
+def fetch_request_token_with_key(key: ApiKey, callback_url: str) -> dict[str, str]:
+    """
+    Get a new request token from Flickr, using a particular API key.
+    """
+    # Create an OAuth1Client with the Flickr API key and secret
+    oauth_client = create_oauth_client(key, signature_type="QUERY")
+
+    # This will return an OAuth token and secret, in the form:
+    #
+    #     {'oauth_callback_confirmed': 'true',
+    #      'oauth_token': '721…b37',
+    #      'oauth_token_secret': '7e2…91a'}
+    #
+    # If Flickr is slow or returns an error, we try again a couple of
+    # times -- see ``flickr_calls.py``.  Each key has its own share of
+    # the rate limit -- see ``rate_limit.py``.
+    #
+    # See https://www.flickr.com/services/api/auth.oauth.html#request_token
+    with metrics.time_flickr_call("fetch_request_token"):
+        request_token: dict[str, str] = flickr_call_policy().call(
+            lambda timeout: oauth_client.fetch_request_token(
+                url=flickr_url("/services/oauth/request_token"),
+                params={"oauth_callback": callback_url},
+                timeout=timeout,
+            ),
+            retry=True,
+            bucket=key.client_id,
+        )
+
+    return request_token
+
+
+def pop_pooled_request_token(callback_url: str) -> dict[str, str] | None:
+    """
+    Take a request token from the app's request token pool, or return
+    None if the pool is turned off or empty.
+    """
+    pool: token_pool.RequestTokenPool | None = current_app.extensions[
+        "request_token_pool"
+    ]
+
+    if pool is None:
+        return None
+
+    return pool.pop(callback_url)
+
+
+def create_authorization_url(request_token: dict[str, str]) -> str:
+    """
+    Create the URL on Flickr.com where the user can approve our app.
+
+    The URL only includes the request token, not the API key, so we can
+    use any key to create it.
+    """
+    with metrics.time_flickr_call("create_authorization_url"):
+        authorization_url: str = create_oauth_client().create_authorization_url(
+            url=flickr_url(
+                f"/services/oauth/authorize?perms={current_app.config['FLICKR_PERMISSIONS']}"
+            ),
+            request_token=request_token["oauth_token"],
+        )
+
+    return authorization_url
+
+
+def flickr_url(path: str) -> str:
+    """
+    Return the URL of a page on Flickr, e.g. ``/services/oauth/authorize``.
+
+    This uses the ``FLICKR_BASE_URL`` setting, so we can send the app
+    to a fake Flickr instead of the real one.
+    """
+    base_url: str = current_app.config["FLICKR_BASE_URL"]
+    return base_url + path
+
+
+def flickr_call_policy() -> flickr_calls.FlickrCallPolicy:
+    """
+    Return the policy for calling Flickr, with its timeouts, retries
+    and circuit breaker.
+    """
+    policy: flickr_calls.FlickrCallPolicy = current_app.extensions["flickr_call_policy"]
+    return policy
+
+
+def flickr_admission() -> AdmissionController:
+    """
+    Return the admission controller, which limits how many requests
+    can wait for Flickr at once.
+    """
+    controller: AdmissionController = current_app.extensions["flickr_admission"]
+    return controller
+
+
+def create_oauth_client(
+    key: ApiKey | None = None, **kwargs: typing.Any
+) -> "OAuth1Client":
+    """
+    Create an OAuth1Client with a Flickr API key and secret -- either
+    ``key``, or the app's default key.
+
+    The client is cheap to create, because it reuses the app's shared
+    HTTP transport -- so we can make a new one for every request, but
+    still reuse open connections to Flickr.
+    """
+    from authlib.integrations.httpx_client import OAuth1Client
+
+    shared_transport: flickr_http.SharedTransport = current_app.extensions[
+        "flickr_http"
+    ]
+
+    if key is None:
+        key = default_api_key()
+
+    return OAuth1Client(
+        client_id=key.client_id,
+        client_secret=key.client_secret,
+        transport=shared_transport.get(),
+        event_hooks={"response": [flickr_calls.raise_for_server_error]},
+        **kwargs,
+    )
+
+
+def default_api_key() -> ApiKey:
+    """
+    Return the app's default Flickr API key.
+    """
+    keys: ApiKeyRing = current_app.extensions["flickr_api_keys"]
+    return keys.default
+
+
 def callback() -> werkzeug.Response:
     """
     Handle the authorization callback from Flickr.
@@ -186,28 +505,16 @@ def callback() -> werkzeug.Response:
     if current_user.is_authenticated:
         return redirect(url_for("homepage"))
 
-    # Get the request token from the Flask session, which we saved in
-    # the /authorize step.
-    #
-    # If we can't retrieve this token for some reason, we can't complete
-    # the login process, so we need to bail out.
-    try:
-        request_token = session.pop("request_token")
+    # Get the request token we saved in the /authorize step, and the
+    # API key we used to get it.
+    oauth_token, oauth_token_secret, key = pop_request_token()
 
-        oauth_token = request_token["oauth_token"]
-        oauth_token_secret = request_token["oauth_token_secret"]
-    except (KeyError, TypeError, ValueError):
-        abort(400)
-
-    # Create an OAuth1Client with the Flickr API key and secret.
+    # Create an OAuth1Client with the same Flickr API key and secret.
     #
     # We need to include the request token that we received in the
     # previous step.
-    oauth_client = OAuth1Client(
-        client_id=current_app.config["CLIENT_ID"],
-        client_secret=current_app.config["CLIENT_SECRET"],
-        token=oauth_token,
-        token_secret=oauth_token_secret,
+    oauth_client = create_oauth_client(
+        key, token=oauth_token, token_secret=oauth_token_secret
     )
 
     # Parse the authorization response from Flickr -- that is, extract
@@ -224,73 +531,568 @@ def callback() -> werkzeug.Response:
     #      'user_nsid': '123456789@N04',
     #      'username': 'flickruser'}
     #
+    # We can only use the request token once, so we don't retry this
+    # step if it fails -- see ``flickr_calls.py``.  The user has already
+    # approved the login on Flickr, so this call can use the reserve in
+    # the rate limiter -- see ``rate_limit.py``.
+    #
     # See https://www.flickr.com/services/api/auth.oauth.html#access_token
-    access_token = oauth_client.fetch_access_token(
-        url="https://www.flickr.com/services/oauth/access_token"
-    )
+    with (
+        flickr_admission().admit("fetch_access_token"),
+        metrics.time_flickr_call("fetch_access_token"),
+    ):
+        access_token = flickr_call_policy().call(
+            lambda timeout: oauth_client.fetch_access_token(
+                url=flickr_url("/services/oauth/access_token"), timeout=timeout
+            ),
+            retry=False,
+            urgent=True,
+            bucket=key.client_id,
+        )
+
+    # Log the user in, and redirect them to the homepage.
+    return log_in_flickr_user(access_token, key)
+
+
+def save_request_token(request_token: dict[str, str]) -> None:
+    """
+    Save a request token in the app's request token store, so we can
+    find it again in the callback.
+    """
+    store: token_store.RequestTokenStore = current_app.extensions["request_token_store"]
+
+    # We save which browser started the login, so we can check that the
+    # callback comes from the same browser -- see ``token_store.py``.
+    request_token = {**request_token, "login_id": session["login_id"]}
+
+    # If we're tracing this login, we save the trace ID with the token,
+    # so we can carry on the same trace in the callback.
+    store.put(tracing.with_trace_id(request_token))
+
+
+def pop_request_token() -> tuple[str, str, ApiKey]:
+    """
+    Get the request token which we saved in the /authorize step, and
+    return the token, its secret, and the API key we used to get it.
+
+    When Flickr redirects the user back to us, it includes the token
+    in the ``oauth_token`` query parameter, so we use that to look up
+    the rest of the request token.  Unless it's turned off, we check
+    that it was saved for this browser -- see ``token_store.py``.
+
+    If we can't retrieve this token for some reason, we can't complete
+    the login process, so we need to bail out.
+    """
+    store: token_store.RequestTokenStore = current_app.extensions["request_token_store"]
 
-    # Create a stub user, and log them in with Flask-Login.  Then we
-    # redirect to the homepage, where it will recognise them as
-    # being logged in.
+    oauth_token = request.args.get("oauth_token")
+
+    if oauth_token is None:
+        abort(400)
+
+    request_token = store.pop(oauth_token)
+
+    # If we traced the start of this login, carry on the same trace.
+    if request_token is not None:
+        tracing.resume_trace(request_token.get("trace_id"))
+
+    # A request token can only be used once, so if the user goes back
+    # to /authorize, they'll need a new one.
+    logins: PendingLogins = current_app.extensions["pending_logins"]
+    logins.forget()
+
+    if request_token is None or "oauth_token_secret" not in request_token:
+        abort(400)
+
+    if current_app.config["REQUEST_TOKEN_CHECK_SESSION"] and request_token.get(
+        "login_id"
+    ) != session.get("login_id"):
+        abort(400)
+
+    # We have to finish the login with the same API key we used to get
+    # the request token.  If we've stopped using that key, we can't.
+    keys: ApiKeyRing = current_app.extensions["flickr_api_keys"]
+    key = keys.get(request_token.get("client_id"))
+
+    if key is None:
+        abort(400)
+
+    return oauth_token, request_token["oauth_token_secret"], key
+
+
+def log_in_flickr_user(access_token: dict[str, str], key: ApiKey) -> werkzeug.Response:
+    """
+    Save the user and their access token, and log them in with Flask-Login.
+    Then we redirect to the homepage, where it will recognise them as
+    being logged in.
+
+    The access token only works with the API key we used to get it, so
+    we save that too.
+    """
     user = FlickrUser(
-        user_nsid=access_token["user_nsid"], name=access_token["username"]
+        user_nsid=access_token["user_nsid"],
+        name=access_token["username"],
+        oauth_token=access_token["oauth_token"],
+        oauth_token_secret=access_token["oauth_token_secret"],
+        client_id=key.client_id,
     )
+
+    user_store: UserStore = current_app.extensions["user_store"]
+    user_store.save(user)
+
     login_user(user)
 
+    # Give this login its own ID, so we can revoke it when the user
+    # logs out -- see ``session_revocation.py``.
+    session_revocation.new_session_id()
+
+    # Anything else can happen after we've redirected the user, so they
+    # don't wait for it -- see ``background_jobs.py``.  We save the user
+    # first, because the next request (maybe in another worker) needs it.
+    jobs: background_jobs.JobRunner = current_app.extensions["background_jobs"]
+
+    jobs.submit("audit_login", audit_login, user.user_nsid, request.remote_addr)
+
+    if current_app.config["WARM_PROFILE_ON_LOGIN"]:
+        jobs.submit("warm_profile", warm_profile, user)
+
     return redirect(url_for("homepage"))
 
 
+def audit_login(user_nsid: str, remote_addr: str | None) -> None:
+    """
+    Record that a user logged in.
+
+    In a real app, you might write this to a database or a separate
+    audit log, which could be slow -- so it runs in the background.
+    """
+    current_app.logger.info("User %s logged in from %s", user_nsid, remote_addr)
+
+
+async def authorize_async() -> werkzeug.Response:
+    """
+    An async version of :func:`authorize`, which is used when the app is
+    served by an ASGI server -- see ``asgi.py``.
+
+    It does exactly the same steps, but it doesn't block while it waits
+    for Flickr, so one process can have lots of logins in flight at once.
+
+    Anything which uses the database (e.g. loading the current user, or
+    saving the request token) runs in a thread, because it would block
+    every other login on the event loop while it waits for SQLite.
+    ``asyncio.to_thread`` copies the request context into the thread.
+    """
+    import asyncio
+
+    if await asyncio.to_thread(is_logged_in):
+        return redirect(url_for("homepage"))
+
+    tracing.start_trace()
+
+    # Step 1: Get a Request Token
+    callback_url = url_for("callback", _external=True)
+
+    logins: PendingLogins = current_app.extensions["pending_logins"]
+
+    request_token = logins.get(callback_url)
+
+    if request_token is None:
+        request_token = await logins.async_flight.do(
+            logins.flight_key(callback_url),
+            lambda: new_request_token_async(callback_url),
+        )
+        logins.remember(request_token, callback_url)
+
+    # Step 2: Getting the User Authorization
+    return redirect(create_authorization_url(request_token))
+
+
+async def new_request_token_async(callback_url: str) -> dict[str, str]:
+    """
+    An async version of :func:`new_request_token`.
+
+    This doesn't go through the admission controller, because waiting
+    for Flickr here doesn't tie up a thread -- see ``admission.py``.
+    """
+    import asyncio
+
+    request_token = pop_pooled_request_token(callback_url)
+
+    if request_token is None:
+        request_token = await fetch_request_token_async(callback_url)
+
+    await asyncio.to_thread(save_request_token, request_token)
+
+    return request_token
+
+
+async def fetch_request_token_async(callback_url: str) -> dict[str, str]:
+    """
+    An async version of :func:`fetch_request_token`.
+    """
+    from authlib.integrations.base_client import OAuthError
+
+    keys: ApiKeyRing = current_app.extensions["flickr_api_keys"]
+    error: Exception | None = None
+
+    for key in keys.candidates():
+        try:
+            request_token = await fetch_request_token_with_key_async(key, callback_url)
+        except flickr_calls.FlickrRateLimited as err:
+            error = err
+        except OAuthError as err:
+            keys.mark_unhealthy(key)
+            error = error or err
+        else:
+            return {**request_token, "client_id": key.client_id}
+
+    assert error is not None
+    raise error
+
+
+async def fetch_request_token_with_key_async(
+    key: ApiKey, callback_url: str
+) -> dict[str, str]:
+    """
+    An async version of :func:`fetch_request_token_with_key`.
+    """
+    oauth_client = create_async_oauth_client(key, signature_type="QUERY")
+
+    with metrics.time_flickr_call("fetch_request_token"):
+        request_token: dict[str, str] = await flickr_call_policy().call_async(
+            lambda timeout: oauth_client.fetch_request_token(
+                url=flickr_url("/services/oauth/request_token"),
+                params={"oauth_callback": callback_url},
+                timeout=timeout,
+            ),
+            retry=True,
+            bucket=key.client_id,
+        )
+
+    return request_token
+
+
+async def callback_async() -> werkzeug.Response:
+    """
+    An async version of :func:`callback`, which is used when the app is
+    served by an ASGI server -- see ``asgi.py``.
+
+    Like :func:`authorize_async`, this uses the database in a thread.
+    """
+    import asyncio
+
+    if await asyncio.to_thread(is_logged_in):
+        return redirect(url_for("homepage"))
+
+    oauth_token, oauth_token_secret, key = await asyncio.to_thread(pop_request_token)
+
+    oauth_client = create_async_oauth_client(
+        key, token=oauth_token, token_secret=oauth_token_secret
+    )
+    oauth_client.parse_authorization_response(request.url)
+
+    # Step 3: Exchanging the Request Token for an Access Token
+    with metrics.time_flickr_call("fetch_access_token"):
+        access_token = await flickr_call_policy().call_async(
+            lambda timeout: oauth_client.fetch_access_token(
+                url=flickr_url("/services/oauth/access_token"), timeout=timeout
+            ),
+            retry=False,
+            urgent=True,
+            bucket=key.client_id,
+        )
+
+    return await asyncio.to_thread(log_in_flickr_user, access_token, key)
+
+
+def is_logged_in() -> bool:
+    """
+    Returns True if the current user is logged in.
+
+    This may load the user from the database (see :func:`load_flickr_user`),
+    so the async views call it in a thread.
+    """
+    return bool(current_user.is_authenticated)
+
+
+def create_async_oauth_client(key: ApiKey, **kwargs: typing.Any) -> "AsyncOAuth1Client":
+    """
+    Create an AsyncOAuth1Client with a Flickr API key and secret.
+
+    Like :func:`create_oauth_client`, this reuses a shared transport,
+    so concurrent logins share a pool of open connections to Flickr.
+    """
+    from authlib.integrations.httpx_client import AsyncOAuth1Client
+
+    shared_transport: flickr_http.SharedAsyncTransport = current_app.extensions[
+        "flickr_http_async"
+    ]
+
+    return AsyncOAuth1Client(
+        client_id=key.client_id,
+        client_secret=key.client_secret,
+        transport=shared_transport.get(),
+        event_hooks={"response": [flickr_calls.raise_for_server_error_async]},
+        **kwargs,
+    )
+
+
 def logout() -> werkzeug.Response:
     """
     Log out the user.
+
+    We also remove them from the cache of users, so we don't keep them
+    in memory after they've gone, and revoke their session, so a copy
+    of their session cookie can't be used to log in again.
     """
+    if current_user.is_authenticated:
+        user_store: UserStore = current_app.extensions["user_store"]
+        user_store.invalidate(current_user.user_nsid)
+
+    session_revocation.revoke_current_session()
+
     logout_user()
     return redirect(url_for("homepage"))
 
 
 @login_required
-def secret() -> str:
+def secret() -> werkzeug.Response:
     """
     A secret page, which is only accessible to logged-in users.
+
+    If we have the user's access token, we also show how many photos
+    they have on Flickr.
+    """
+    # ``current_user`` only works inside the request context, so we
+    # need the real user object if we fetch their profile in the
+    # background.
+    user: FlickrUser = current_user._get_current_object()  # type: ignore[attr-defined]
+
+    return render_page("secret.html", **flickr_profile(user))
+
+
+def flickr_profile(user: FlickrUser) -> dict[str, str]:
     """
-    return f"""
-        <p>
-            This is a <strong>secret page</strong> which is only visible to logged-in users.
-        </p>
-        <p>
-            You can <strong><a href="{url_for("homepage")}">return to the homepage</a></strong> 
-            or <strong><a href="{url_for("logout")}">log out</a></strong>.
-        </p>
+    Get some information about a user from the Flickr API, to show
+    on their pages.
+
+    This only uses the cache (see ``flickr_api.py``), so a page never
+    waits for Flickr.  If the information isn't cached yet, we leave it
+    out of this page, and fetch it in the background for the next one.
     """
+    if user.oauth_token is None:
+        return {}
+
+    api: flickr_api.FlickrApi = current_app.extensions["flickr_api"]
+
+    resp = api.peek(user, "flickr.people.getInfo", user_id=user.user_nsid)
+
+    if resp is None:
+        return {}
+
+    return {"photo_count": str(resp["person"]["photos"]["count"]["_content"])}
 
 
-class FlickrUser(UserMixin):
+def warm_profile(user: FlickrUser) -> None:
     """
-    A basic user class to satisfy Flask-Login.
+    Fetch a user's information from the Flickr API into the cache, so
+    their pages can show it straight away.
+
+    This runs in the background after they log in.
+    """
+    api: flickr_api.FlickrApi = current_app.extensions["flickr_api"]
+
+    try:
+        api.get(user, "flickr.people.getInfo", user_id=user.user_nsid)
+    except (flickr_api.FlickrApiError, flickr_calls.FlickrUnavailable):
+        current_app.logger.warning(
+            "Unable to get Flickr profile for %s", user.user_nsid, exc_info=True
+        )
 
-    Usually this would be backed by a database or other storage;
-    for demo purposes it just stores basic details of the Flickr user.
 
-    See https://flask-login.readthedocs.io/en/latest/#your-user-class
+@login_required
+def photos() -> werkzeug.Response:
+    """
+    List all the user's photos on Flickr.
+
+    Some people have hundreds of thousands of photos, so rather than
+    fetch them all and then render the page, we stream the page to
+    the browser as we fetch each batch of photos.
     """
+    if current_user.oauth_token is None:
+        return redirect(url_for("secret"))
+
+    api: flickr_api.FlickrApi = current_app.extensions["flickr_api"]
+
+    # ``current_user`` only works inside the request context, so we
+    # need the real user object to take with us.
+    user: FlickrUser = current_user._get_current_object()  # type: ignore[attr-defined]
 
-    def __init__(self, user_nsid: str, name: str):
-        self.user_nsid = user_nsid
-        self.name = name
+    # The page is rendered after this function returns, outside the
+    # request context, so we can't change the status code if something
+    # goes wrong -- instead we stop the list, and the template shows
+    # an error at the bottom of the page.
+    errors: list[str] = []
+
+    return stream_page(
+        "photos.html",
+        photos=list_photos(api, user, errors, logger=current_app.logger),
+        errors=errors,
+    )
 
-        # This will store an ID like ``197130754@N07/Flickr Foundation``
-        self.id = f"{user_nsid}/{name}"
 
+def list_photos(
+    api: flickr_api.FlickrApi,
+    user: FlickrUser,
+    errors: list[str],
+    *,
+    logger: logging.Logger,
+) -> Iterator[dict[str, str]]:
+    """
+    Yield a link and a title for every photo a user has on Flickr.
 
-def load_flickr_user(id: str) -> FlickrUser:
+    If we can't get all the photos (e.g. Flickr is down, or we've used
+    up our rate limit), we log the error and record it in ``errors``,
+    so the page says that the list is incomplete.
     """
-    A basic user loader callback for Flask-Login.
+    count = 0
+
+    try:
+        for photo in api.paginate(
+            user,
+            "flickr.people.getPhotos",
+            container="photos",
+            item="photo",
+            user_id="me",
+        ):
+            yield {
+                "url": f"https://www.flickr.com/photos/{user.user_nsid}/{photo['id']}/",
+                "title": photo["title"],
+            }
+            count += 1
+    except (flickr_api.FlickrApiError, flickr_calls.FlickrUnavailable):
+        logger.warning("Unable to list photos for %s", user.user_nsid, exc_info=True)
+        errors.append(
+            f"We couldn't get all your photos from Flickr, so this list is "
+            f"incomplete -- it only has the first {count}. Please try again later."
+        )
+
+
+def flickr_status() -> dict[str, typing.Any]:
+    """
+    Report whether we can reach Flickr, for monitoring.
+
+    This returns the state of the circuit breaker, e.g.
+
+        {"state": "open", "consecutive_failures": 5, "retry_after": 12.3}
+
+    """
+    return flickr_call_policy().breaker.snapshot()
+
 
-    This doesn't do any checking about whether this user has logged in
+def ready() -> tuple[dict[str, typing.Any], int, dict[str, str]]:
+    """
+    Report whether this worker is ready for traffic, for a load
+    balancer's readiness check.
+
+    If warm-up is turned on, we return 503 Service Unavailable until
+    the worker has warmed up, e.g.
+
+        {"ready": false, "state": "warming", "duration": null}
+
+    See ``warm_up.py``.
+    """
+    app_warm_up: warm_up.WarmUp | None = current_app.extensions["warm_up"]
+
+    if app_warm_up is None:
+        return {"ready": True, "state": "disabled", "duration": None}, 200, {}
+
+    # If this worker was forked after the app was created, this is the
+    # first chance it gets to start warming up.
+    app_warm_up.start()
+
+    snapshot = app_warm_up.snapshot()
+
+    if snapshot["ready"]:
+        return snapshot, 200, {}
+    else:
+        return snapshot, 503, {"Retry-After": "1"}
+
+
+def warm_up_flickr() -> None:
+    """
+    Warm up everything the first login would otherwise have to wait for.
+
+    We make one signed request to Flickr's request token endpoint,
+    which imports the OAuth libraries, creates the shared transport,
+    signs a request, and opens a connection to Flickr that stays in the
+    pool.  Flickr rejects the request, because it doesn't have a
+    callback URL, but it doesn't matter what it says -- only that we
+    got a reply.
+    """
+    oauth_client = create_oauth_client(signature_type="QUERY")
+
+    with metrics.time_flickr_call("warm_up"):
+        flickr_call_policy().call(
+            lambda timeout: oauth_client.head(
+                flickr_url("/services/oauth/request_token"), timeout=timeout
+            ),
+            retry=True,
+            bucket=default_api_key().client_id,
+        )
+
+
+def prometheus_metrics() -> werkzeug.Response:
+    """
+    Report the app's metrics, in the Prometheus text format.
+
+    In a real app, you'd probably want to keep this page private, e.g.
+    by only serving it on an internal network.
+    """
+    app_metrics: metrics.Metrics = current_app.extensions["metrics"]
+
+    return werkzeug.Response(
+        metrics.render_prometheus(app_metrics.gather()),
+        content_type="text/plain; version=0.0.4; charset=utf-8",
+    )
+
+
+def debug_traces() -> werkzeug.Response:
+    """
+    Download the spans from recent traced logins, as JSON lines --
+    either all of them, or one trace with ``?trace_id=…``.
+
+    Like /metrics, you'd want to keep this page private in a real app.
+    """
+    tracer = tracing.current_tracer()
+
+    if tracer is None:
+        abort(404)
+
+    return werkzeug.Response(
+        tracer.export(trace_id=request.args.get("trace_id")),
+        content_type="application/x-ndjson",
+    )
+
+
+def load_flickr_user(id: str) -> FlickrUser | None:
+    """
+    A user loader callback for Flask-Login.
+
+    This is called on every request from a logged-in user, so it looks
+    in the app's cache of users before it goes to the database.
+
+    If the user has logged out of this session (see ``session_revocation.py``),
+    or revoked our access on Flickr (see ``token_validator.py``), this
+    returns None, and Flask-Login treats them as logged out.  Otherwise,
+    this doesn't do any checking about whether this user has logged in
     before, or their details, or anything.  You'll need to replace this
     in a real app.
 
     See https://flask-login.readthedocs.io/en/latest/#how-it-works
     """
-    user_nsid, name = id.split("/", 1)
-    return FlickrUser(user_nsid, name)
+    if session_revocation.is_current_session_revoked():
+        return None
+
+    user_store: UserStore = current_app.extensions["user_store"]
+    return user_store.load(id)
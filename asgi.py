@@ -0,0 +1,300 @@
+"""
+Serve the app with an ASGI server, using async views for the login flow.
+
+When the app runs under a WSGI server, every request ties up a worker
+while it runs -- including the round-trips to Flickr in ``/authorize``
+and ``/callback``, which spend most of their time waiting.
+
+This module wraps the app in an ASGI application.  The two login views
+are replaced by their async versions, which run on the server's event
+loop and share one pool of connections to Flickr, so a single process
+can have hundreds of logins in flight.  Every other route is handled
+by the normal (sync) Flask app, in a pool of threads.
+
+You can run it with any ASGI server, e.g.
+
+    $ uvicorn --factory asgi:create_asgi_app --port 8008
+
+"""
+
+import asyncio
+from collections.abc import (
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Iterable,
+    MutableMapping,
+)
+import concurrent.futures
+import inspect
+import io
+import sys
+import typing
+
+from flask import Flask, request, request_started
+import werkzeug
+from werkzeug.exceptions import HTTPException
+
+from app import authorize_async, callback_async, create_app
+
+
+Scope = MutableMapping[str, typing.Any]
+Message = MutableMapping[str, typing.Any]
+Receive = Callable[[], Awaitable[Message]]
+Send = Callable[[Message], Awaitable[None]]
+
+
+def create_asgi_app(config: dict[str, typing.Any] | None = None) -> "AsgiApp":
+    """
+    Create an instance of the app which can be served by an ASGI server.
+
+    This takes the same config as :func:`app.create_app`.
+    """
+    app = create_app(config)
+
+    app.view_functions["authorize"] = authorize_async
+    app.view_functions["callback"] = callback_async
+
+    return AsgiApp(app)
+
+
+class AsgiApp:
+    """
+    An ASGI application which runs a Flask app.
+
+    Requests for async views are handled directly on the event loop;
+    everything else is passed to the Flask app in a thread pool.
+    """
+
+    def __init__(self, app: Flask, *, max_threads: int | None = None) -> None:
+        self.app = app
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_threads, thread_name_prefix="flask"
+        )
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """
+        Handle a single ASGI connection.
+        """
+        if scope["type"] == "lifespan":
+            await self.handle_lifespan(receive, send)
+            return
+
+        if scope["type"] != "http":
+            raise ValueError(f"Unsupported ASGI scope type: {scope['type']!r}")
+
+        environ = await build_environ(scope, receive)
+
+        if self.is_async_view(environ):
+            response = await self.dispatch_async(environ)
+            app_iter, status, headers = response.get_wsgi_response(environ)
+            await send_response(send, status, headers, _iterate(app_iter))
+        else:
+            await self.dispatch_in_thread(environ, send)
+
+    async def handle_lifespan(self, receive: Receive, send: Send) -> None:
+        """
+        Handle the ASGI lifespan events -- in particular, close our
+        connections to Flickr when the server shuts down.
+        """
+        message = await receive()
+        assert message["type"] == "lifespan.startup"
+        await send({"type": "lifespan.startup.complete"})
+
+        message = await receive()
+        assert message["type"] == "lifespan.shutdown"
+        await self.app.extensions["flickr_http_async"].aclose()
+        self.executor.shutdown(wait=True)
+        await send({"type": "lifespan.shutdown.complete"})
+
+    def is_async_view(self, environ: dict[str, typing.Any]) -> bool:
+        """
+        Returns True if this request is routed to an async view.
+        """
+        adapter = self.app.url_map.bind_to_environ(
+            environ, server_name=self.app.config["SERVER_NAME"]
+        )
+
+        try:
+            endpoint, _ = adapter.match()
+        except HTTPException:
+            return False
+
+        return inspect.iscoroutinefunction(self.app.view_functions[endpoint])
+
+    async def dispatch_async(self, environ: dict[str, typing.Any]) -> werkzeug.Response:
+        """
+        Run a request for an async view on the event loop.
+
+        This follows the same steps as ``Flask.wsgi_app()`` and
+        ``Flask.full_dispatch_request()``, but awaits the view rather than
+        calling it.  The Flask request context lives in context variables,
+        so each request's context is private to its own task.
+        """
+        app = self.app
+        ctx = app.request_context(environ)
+        error: BaseException | None = None
+
+        try:
+            try:
+                ctx.push()
+
+                try:
+                    request_started.send(app, _async_wrapper=app.ensure_sync)
+                    rv = app.preprocess_request()
+                    if rv is None:
+                        assert request.url_rule is not None
+                        view = typing.cast(
+                            Callable[..., Awaitable[typing.Any]],
+                            app.view_functions[request.url_rule.endpoint],
+                        )
+                        rv = await view(**(request.view_args or {}))
+                except Exception as e:
+                    rv = app.handle_user_exception(e)
+
+                return app.finalize_request(rv)
+            except Exception as e:
+                error = e
+                return app.handle_exception(e)
+        finally:
+            ctx.pop(error)
+
+    async def dispatch_in_thread(
+        self, environ: dict[str, typing.Any], send: Send
+    ) -> None:
+        """
+        Run a request through the WSGI app in the thread pool, and send
+        the response as it's produced.
+        """
+        loop = asyncio.get_running_loop()
+        started: list[tuple[str, list[tuple[str, str]]]] = []
+
+        def start_response(
+            status: str,
+            headers: list[tuple[str, str]],
+            exc_info: typing.Any = None,
+        ) -> Callable[[bytes], object]:
+            """
+            Record the status and headers from the WSGI app.
+            """
+            started[:] = [(status, headers)]
+            return lambda _: None
+
+        app_iter = await loop.run_in_executor(
+            self.executor, self.app, environ, start_response
+        )
+
+        async def read_body() -> AsyncIterator[bytes]:
+            """
+            Pull the body one chunk at a time, so long (streamed) responses
+            don't hold up the event loop or get buffered in memory.
+            """
+            chunks = iter(app_iter)
+
+            while (
+                chunk := await loop.run_in_executor(self.executor, next, chunks, None)
+            ) is not None:
+                yield chunk
+
+        try:
+            status, headers = started[0]
+            await send_response(send, status, headers, read_body())
+        finally:
+            close = getattr(app_iter, "close", lambda: None)
+            await loop.run_in_executor(self.executor, close)
+
+
+async def _iterate(body: Iterable[bytes]) -> AsyncIterator[bytes]:
+    """
+    Iterate over a response body that's already in memory.
+    """
+    for chunk in body:
+        yield chunk
+
+
+async def send_response(
+    send: Send,
+    status: str,
+    headers: Iterable[tuple[str, str]],
+    body: AsyncIterator[bytes],
+) -> None:
+    """
+    Send a WSGI-style response to an ASGI server.
+    """
+    await send(
+        {
+            "type": "http.response.start",
+            "status": int(status.split(" ", 1)[0]),
+            "headers": [
+                (name.lower().encode("latin-1"), value.encode("latin-1"))
+                for name, value in headers
+            ],
+        }
+    )
+
+    async for chunk in body:
+        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+
+    await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+async def build_environ(scope: Scope, receive: Receive) -> dict[str, typing.Any]:
+    """
+    Build a WSGI environ dict for an ASGI HTTP request.
+
+    See https://peps.python.org/pep-3333/#environ-variables
+    """
+    body = io.BytesIO()
+
+    while True:
+        message = await receive()
+        body.write(message.get("body", b""))
+        if not message.get("more_body", False):
+            break
+
+    body.seek(0)
+
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    root_path = scope.get("root_path", "")
+    path = scope["path"]
+
+    if path.startswith(root_path):
+        path = path[len(root_path) :]
+
+    environ: dict[str, typing.Any] = {
+        "REQUEST_METHOD": scope["method"],
+        # WSGI wants the path as "bytes-in-unicode", i.e. UTF-8 bytes
+        # decoded as Latin-1.
+        "SCRIPT_NAME": root_path.encode("utf-8").decode("latin-1"),
+        "PATH_INFO": path.encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+
+    for raw_name, raw_value in scope.get("headers", []):
+        name = raw_name.decode("latin-1").upper().replace("-", "_")
+        value = raw_value.decode("latin-1")
+
+        if name in {"CONTENT_TYPE", "CONTENT_LENGTH"}:
+            key = name
+        else:
+            key = f"HTTP_{name}"
+
+        if key in environ:
+            environ[key] = f"{environ[key]},{value}"
+        else:
+            environ[key] = value
+
+    return environ
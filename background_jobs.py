@@ -0,0 +1,234 @@
+"""
+Run small jobs in the background, after we've sent the response.
+
+When somebody logs in, there are a few things we'd like to do which
+the user doesn't need to wait for -- e.g. fetching their Flickr profile
+so the next page is fast, or writing an audit log.  If we did them in
+/callback, every login would wait for them before it redirected.
+
+Instead, /callback hands them to a :class:`JobRunner`, which runs them
+on a small pool of threads in the same process:
+
+*   The queue of waiting jobs is bounded.  If the threads can't keep
+    up (e.g. Flickr is slow), new jobs are dropped with a warning,
+    rather than piling up in memory -- so only use this for work that's
+    safe to skip.
+*   Each job runs inside an app context, so it can use ``current_app``.
+*   When the process exits, we stop taking new jobs and give the ones
+    in the queue a few seconds to finish.
+*   We record how long each job waited in the queue, how long it took
+    to run, and how many we dropped -- see ``metrics.py``.
+
+The threads don't start until the first job is submitted, so they start
+in the worker process, not in a parent process that forks the workers
+(e.g. ``gunicorn --preload``), where they'd be lost in the fork.
+
+If you need jobs that survive a restart, or that run on another machine,
+you want a real task queue (e.g. Celery or RQ) instead.
+"""
+
+import atexit
+from collections.abc import Callable
+import logging
+import queue
+import threading
+import time
+import typing
+import weakref
+
+from flask import Flask
+
+from metrics import Metrics
+
+
+logger = logging.getLogger(__name__)
+
+# A job's name, when it was submitted, and the function to call
+Job = tuple[str, float, Callable[[], typing.Any]]
+
+
+class JobRunner:
+    """
+    Runs jobs on up to ``threads`` background threads, with at most
+    ``queue_size`` jobs waiting to start.
+    """
+
+    def __init__(
+        self,
+        app: Flask,
+        *,
+        metrics: Metrics,
+        threads: int,
+        queue_size: int,
+        drain_timeout: float,
+    ) -> None:
+        self.app = app
+        self.metrics = metrics
+        self.threads = threads
+        self.drain_timeout = drain_timeout
+
+        # The queue holds ``None`` for each thread when we're stopping,
+        # which tells the thread to exit.
+        self._queue: queue.Queue[Job | None] = queue.Queue(maxsize=queue_size)
+
+        self._lock = threading.Lock()
+        self._workers: list[threading.Thread] = []
+        self._stopped = False
+
+        _instances.add(self)
+
+    def submit(
+        self, name: str, fn: Callable[..., typing.Any], *args: typing.Any
+    ) -> bool:
+        """
+        Run ``fn(*args)`` in the background, and return True if the job
+        was queued.
+
+        If the queue is full, or the runner has been stopped, the job is
+        dropped, and we return False.  This never waits, so it's safe to
+        call from a request (or from the event loop).
+        """
+        with self._lock:
+            stopped = self._stopped
+
+            if not stopped and not self._workers:
+                self._start_workers()
+
+        if not stopped:
+            try:
+                self._queue.put_nowait((name, time.perf_counter(), lambda: fn(*args)))
+                return True
+            except queue.Full:
+                pass
+
+        logger.warning("Unable to queue background job %s; dropping it", name)
+        self.metrics.increment("background_jobs_dropped_total", (("job", name),))
+        return False
+
+    def stop(self, timeout: float | None = None) -> bool:
+        """
+        Stop taking new jobs, and wait up to ``timeout`` seconds (or
+        ``drain_timeout`` if it's None) for the queued jobs to finish.
+
+        Returns True if every job finished in time.  Any that didn't
+        are abandoned -- the threads are daemon threads, so they won't
+        stop the process from exiting.
+        """
+        with self._lock:
+            self._stopped = True
+            workers = self._workers
+
+        if timeout is None:
+            timeout = self.drain_timeout
+
+        deadline = time.monotonic() + timeout
+
+        try:
+            for _ in workers:
+                self._queue.put(None, timeout=max(deadline - time.monotonic(), 0))
+        except queue.Full:
+            pass
+
+        for worker in workers:
+            worker.join(timeout=max(deadline - time.monotonic(), 0))
+
+        running = sum(worker.is_alive() for worker in workers)
+
+        if running:
+            logger.warning(
+                "Abandoning background jobs after %.1fs: %d running, %d queued",
+                timeout,
+                running,
+                self._queue.qsize(),
+            )
+            return False
+
+        return True
+
+    def _start_workers(self) -> None:
+        """
+        Start the background threads.  The caller must hold the lock.
+        """
+        for i in range(self.threads):
+            worker = threading.Thread(
+                target=self._run, name=f"background-job-{i}", daemon=True
+            )
+            worker.start()
+            self._workers.append(worker)
+
+    def _run(self) -> None:
+        """
+        Run jobs from the queue until we're told to stop.
+        """
+        while True:
+            job = self._queue.get()
+
+            if job is None:
+                return
+
+            name, submitted_at, fn = job
+            started_at = time.perf_counter()
+
+            self.metrics.observe(
+                "background_job_wait_seconds",
+                (("job", name),),
+                started_at - submitted_at,
+            )
+
+            outcome = "error"
+
+            try:
+                with self.app.app_context():
+                    fn()
+                outcome = "success"
+            except Exception:
+                logger.exception("Background job %s failed", name)
+            finally:
+                self.metrics.observe(
+                    "background_job_duration_seconds",
+                    (("job", name), ("outcome", outcome)),
+                    time.perf_counter() - started_at,
+                )
+
+
+# Every JobRunner in this process, so we can drain them when it exits.
+_instances: "weakref.WeakSet[JobRunner]" = weakref.WeakSet()
+
+
+def stop_all() -> None:
+    """
+    Drain all the job runners in this process.
+    """
+    for runner in list(_instances):
+        runner.stop()
+
+
+atexit.register(stop_all)
+
+
+def init_app(app: Flask) -> JobRunner:
+    """
+    Create the background job runner for an app, using the settings in
+    the app config.
+
+    The runner is saved in ``app.extensions["background_jobs"]``.
+    """
+    # How many jobs can run at once, and how many can wait to start.
+    # Jobs which don't fit in the queue are dropped.
+    app.config.setdefault("BACKGROUND_JOB_THREADS", 4)
+    app.config.setdefault("BACKGROUND_JOB_QUEUE_SIZE", 1000)
+
+    # How long (in seconds) to wait for queued jobs when the process exits
+    app.config.setdefault("BACKGROUND_JOB_DRAIN_TIMEOUT", 5.0)
+
+    runner = JobRunner(
+        app,
+        metrics=app.extensions["metrics"],
+        threads=app.config["BACKGROUND_JOB_THREADS"],
+        queue_size=app.config["BACKGROUND_JOB_QUEUE_SIZE"],
+        drain_timeout=app.config["BACKGROUND_JOB_DRAIN_TIMEOUT"],
+    )
+
+    app.extensions["background_jobs"] = runner
+
+    return runner
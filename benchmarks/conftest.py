@@ -0,0 +1,102 @@
+"""
+Shared fixtures for the benchmarks.
+
+The benchmarks run entirely in-process, with a stub in place of Flickr,
+so they don't need OAuth credentials or a network connection.
+"""
+
+from collections.abc import Iterator
+import itertools
+import pathlib
+
+from flask import Flask
+from flask.testing import FlaskClient
+from flask_login import FlaskLoginClient
+import httpx
+from keyring.backend import KeyringBackend
+from nitrate.mock_keyring import *  # noqa: F403
+import pytest
+
+from app import create_app
+from users import FlickrUser
+
+
+class StubFlickr:
+    """
+    A stub for Flickr's OAuth endpoints, which returns a new token
+    for every request.
+    """
+
+    def __init__(self) -> None:
+        self.counter = itertools.count()
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        """
+        Handle a request to the OAuth endpoints.
+        """
+        token = f"token{next(self.counter)}"
+
+        if request.url.path == "/services/oauth/request_token":
+            body = f"oauth_callback_confirmed=true&oauth_token={token}&oauth_token_secret=secret"
+        else:
+            body = f"fullname=Father%20Sword&oauth_token={token}&oauth_token_secret=secret&user_nsid=test%40123&username=fathersword"
+
+        return httpx.Response(200, text=body)
+
+
+@pytest.fixture
+def app(
+    mock_keyring: KeyringBackend,
+    monkeypatch: pytest.MonkeyPatch,
+    tmp_path: pathlib.Path,
+) -> Flask:
+    """
+    Creates an instance of the app which talks to a stub Flickr.
+    """
+    mock_keyring.set_password("flickr_flask_login_demo", "key", "123")
+    mock_keyring.set_password("flickr_flask_login_demo", "secret", "456")
+
+    stub = StubFlickr()
+    monkeypatch.setattr(
+        "httpx.HTTPTransport", lambda **kwargs: httpx.MockTransport(stub)
+    )
+
+    # We make far more calls to the stub than Flickr would allow, so
+    # turn off the rate limit -- see ``rate_limit.py``.  The stub only
+    # knows about the OAuth endpoints, so we don't fetch the user's
+    # profile after they log in.
+    return create_app(
+        config={
+            "USER_STORE_PATH": str(tmp_path / "users.sqlite"),
+            "FLICKR_RATE_LIMIT": None,
+            "WARM_PROFILE_ON_LOGIN": False,
+        }
+    )
+
+
+@pytest.fixture
+def user() -> FlickrUser:
+    """
+    The user who logs in during the benchmarks.
+    """
+    return FlickrUser(user_nsid="test@123", name="fathersword")
+
+
+@pytest.fixture
+def logged_out_client(app: Flask) -> Iterator[FlaskClient]:
+    """
+    Creates a client which isn't logged in.
+    """
+    with app.test_client() as client:
+        yield client
+
+
+@pytest.fixture
+def logged_in_client(app: Flask, user: FlickrUser) -> Iterator[FlaskClient]:
+    """
+    Creates a client which is logged in.
+    """
+    app.test_client_class = FlaskLoginClient
+
+    with app.test_client(user=user) as client:
+        yield client
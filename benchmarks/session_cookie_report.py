@@ -0,0 +1,85 @@
+"""
+Compare the size of the session cookie, and how long it takes to encode
+and decode, with each of the session serializers (see ``sessions.py``).
+
+We measure a few typical sessions: a visitor who's been sent to Flickr
+to log in, and a user who's logged in.
+
+    $ python benchmarks/session_cookie_report.py
+
+"""
+
+import hashlib
+import os
+import sys
+import timeit
+import typing
+
+from flask import Flask
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sessions  # noqa: E402
+
+
+SESSIONS: dict[str, dict[str, typing.Any]] = {
+    "login in progress": {
+        "login_id": "k2Vd6PpVJ0s3vW3C2ub4AQ",
+        "pending_login": {
+            "oauth_token": "72157720912345678-0123456789abcdef",
+            "callback_url": "https://example.com/callback",
+            "fetched_at": 1740738448.123,
+        },
+    },
+    "logged in": {
+        "_fresh": True,
+        "_id": hashlib.sha512(b"session").hexdigest(),
+        "_user_id": "199258389@N04/Alex Chan",
+        "login_id": "k2Vd6PpVJ0s3vW3C2ub4AQ",
+    },
+}
+
+
+def measure(
+    serializer: str, session: dict[str, typing.Any]
+) -> tuple[int, float, float]:
+    """
+    Return the size of the signed cookie (in bytes), and how long it
+    takes to encode and decode (in microseconds).
+    """
+    app = Flask(__name__)
+    app.secret_key = "a" * 64
+    app.config["SESSION_SERIALIZER"] = serializer
+
+    signer = sessions.init_app(app).get_signing_serializer(app)
+    assert signer is not None
+
+    cookie = signer.dumps(session)
+    assert signer.loads(cookie) == session
+
+    number = 10_000
+    encode = timeit.timeit(lambda: signer.dumps(session), number=number)
+    decode = timeit.timeit(lambda: signer.loads(cookie), number=number)
+
+    return len(cookie), encode / number * 1e6, decode / number * 1e6
+
+
+def main() -> None:
+    """
+    Print the report.
+    """
+    print(
+        f"{'session':<20} {'serializer':<10} {'bytes':>6} {'encode':>10} {'decode':>10}"
+    )
+
+    for name, session in SESSIONS.items():
+        for serializer in ("json", "msgpack"):
+            size, encode, decode = measure(serializer, session)
+            print(
+                f"{name:<20} {serializer:<10} {size:>6} "
+                f"{encode:>8.1f}µs {decode:>8.1f}µs"
+            )
+
+
+if __name__ == "__main__":
+    main()
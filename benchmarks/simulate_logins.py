@@ -0,0 +1,105 @@
+"""
+Simulate lots of users logging in at once, to find out how many
+concurrent logins the app can handle.
+
+This drives a running copy of the app, which should be pointed at the
+fake Flickr in ``fake_flickr.py`` -- see the README for how to set
+that up.  Each simulated user goes through the whole login flow:
+
+    /authorize → Flickr → /callback → /
+
+and we report how long it took, and how many logins failed.
+
+    $ python benchmarks/simulate_logins.py http://localhost:5000 --logins 2000 --concurrency 500
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+
+async def simulate_login(app_url: str) -> float:
+    """
+    Log in to the app as a new user, and return how long it took.
+
+    This raises an exception if the login fails.
+    """
+    # Each user gets their own client, so they have their own cookies.
+    async with httpx.AsyncClient(
+        base_url=app_url, follow_redirects=True, timeout=60
+    ) as client:
+        start = time.perf_counter()
+
+        resp = await client.get("/authorize")
+        resp.raise_for_status()
+
+        if "logged in" not in resp.text:
+            raise ValueError(f"Login did not complete: ended up at {resp.url}")
+
+        return time.perf_counter() - start
+
+
+async def simulate_logins(
+    app_url: str, *, logins: int, concurrency: int
+) -> tuple[list[float], list[BaseException]]:
+    """
+    Run ``logins`` simulated logins, with at most ``concurrency`` in
+    flight at once.
+
+    Returns the time taken by each successful login, and the errors
+    from any logins which failed.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one() -> float:
+        """
+        Run a single login, once there's room.
+        """
+        async with semaphore:
+            return await simulate_login(app_url)
+
+    results = await asyncio.gather(
+        *(run_one() for _ in range(logins)), return_exceptions=True
+    )
+
+    timings = [r for r in results if isinstance(r, float)]
+    errors = [r for r in results if isinstance(r, BaseException)]
+
+    return timings, errors
+
+
+def main() -> None:
+    """
+    Run the simulation from the command line, and print a summary.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("app_url", help="e.g. http://localhost:5000")
+    parser.add_argument("--logins", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    timings, errors = asyncio.run(
+        simulate_logins(args.app_url, logins=args.logins, concurrency=args.concurrency)
+    )
+    elapsed = time.perf_counter() - start
+
+    print(f"{len(timings)} logins succeeded, {len(errors)} failed in {elapsed:.1f}s")
+    print(f"throughput: {len(timings) / elapsed:.1f} logins/s")
+
+    if len(timings) >= 2:
+        percentiles = statistics.quantiles(timings, n=100)
+        print(
+            f"latency: p50={percentiles[49]:.3f}s p90={percentiles[89]:.3f}s "
+            f"p99={percentiles[98]:.3f}s max={max(timings):.3f}s"
+        )
+
+    for error in errors[:5]:
+        print(f"error: {error!r}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Report how long it takes to start a worker process, so we can keep
+worker boot time under a target.
+
+This starts a fresh Python process, imports the app and creates it,
+and reports:
+
+*   how long each step took
+*   which credential source was used
+*   the slowest imports, from ``python -X importtime``
+*   how long the first login will spend importing the OAuth libraries,
+    which we don't load until we need them
+
+It exits with an error if the worker takes longer than the target.
+
+    $ python benchmarks/startup_report.py --target-ms 300
+
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+# This runs in the child process, and prints the timings as JSON.
+CHILD_CODE = """
+import json, sys, time
+
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+flask_app = app.create_app()
+created = time.perf_counter()
+
+# Mark where worker startup ends in the ``-X importtime`` output
+print("--- worker started ---", file=sys.stderr)
+
+import authlib.integrations.httpx_client, httpx
+oauth_imported = time.perf_counter()
+
+# This is cached, so it doesn't look for the credentials again.
+credentials = app.load_credentials(
+    tuple(flask_app.config["FLICKR_CREDENTIAL_SOURCES"]),
+    credentials_file=flask_app.config["FLICKR_CREDENTIALS_FILE"],
+)
+
+print(json.dumps({
+    "timings": {
+        "import app": imported - start,
+        "create_app()": created - imported,
+        "first login imports": oauth_imported - created,
+    },
+    "credential_source": credentials.source,
+}))
+"""
+
+
+def parse_importtime(stderr: str) -> list[tuple[float, str]]:
+    """
+    Parse the output of ``python -X importtime``, and return the total
+    time (in seconds) spent importing each top-level package, slowest
+    first.
+
+    Each line looks like this, where nested imports are indented:
+
+        import time: self [us] | cumulative | imported package
+        import time:       465 |     323281 | app
+
+    We add up the "self" time of every module in a package, so e.g.
+    the time for ``werkzeug`` includes ``werkzeug.routing``.
+    """
+    totals: dict[str, float] = {}
+
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+
+        self_time, _, name = line.removeprefix("import time:").split("|")
+        package = name.strip().split(".")[0]
+
+        totals[package] = totals.get(package, 0) + int(self_time) / 1_000_000
+
+    return sorted(((seconds, name) for name, seconds in totals.items()), reverse=True)
+
+
+def main() -> None:
+    """
+    Run the report from the command line.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--target-ms",
+        type=float,
+        default=300,
+        help="the maximum time to import and create the app (default: 300)",
+    )
+    parser.add_argument(
+        "--top", type=int, default=10, help="how many slow imports to show"
+    )
+    args = parser.parse_args()
+
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", CHILD_CODE],
+        cwd=repo_root,
+        capture_output=True,
+        text=True,
+    )
+
+    if result.returncode != 0:
+        sys.exit(f"Unable to start the app:\n{result.stderr[-2000:]}")
+
+    report = json.loads(result.stdout.splitlines()[-1])
+    timings = report["timings"]
+
+    print("Worker startup:")
+    for step, seconds in timings.items():
+        print(f"  {step:<22} {seconds * 1000:8.1f} ms")
+    print(f"  credentials from       {report['credential_source']}")
+
+    # Anything imported after ``create_app()`` is part of the first
+    # login, not worker startup.
+    startup_imports = parse_importtime(result.stderr.split("--- worker started ---")[0])
+
+    print("\nSlowest packages to import (during worker startup):")
+    for seconds, name in startup_imports[: args.top]:
+        print(f"  {name:<30} {seconds * 1000:8.1f} ms")
+
+    boot_ms = (timings["import app"] + timings["create_app()"]) * 1000
+
+    print(f"\nWorker boot: {boot_ms:.1f} ms (target: {args.target_ms:.0f} ms)")
+
+    if boot_ms > args.target_ms:
+        sys.exit("Worker boot is slower than the target!")
+
+
+if __name__ == "__main__":
+    main()
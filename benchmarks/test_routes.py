@@ -0,0 +1,220 @@
+"""
+Benchmarks for every route in the app, and for the complete login flow.
+
+Run them with:
+
+    $ pytest benchmarks --benchmark-json=bench_output.json
+
+See README.md for how to compare results between versions.
+"""
+
+from flask import Flask
+from flask.testing import FlaskClient
+from pytest_benchmark.fixture import BenchmarkFixture
+import werkzeug
+
+from users import FlickrUser
+
+
+def log_in(client: FlaskClient, user: FlickrUser) -> None:
+    """
+    Log a client in as the given user, without going through the
+    login flow.
+    """
+    with client.session_transaction() as session:
+        session["_user_id"] = user.id
+        session["_fresh"] = True
+
+
+def test_homepage_logged_out(
+    benchmark: BenchmarkFixture, logged_out_client: FlaskClient
+) -> None:
+    """
+    Load the homepage when logged out.
+    """
+    resp = benchmark(logged_out_client.get, "/")
+    assert resp.status_code == 200
+
+
+def test_homepage_logged_in(
+    benchmark: BenchmarkFixture, logged_in_client: FlaskClient
+) -> None:
+    """
+    Load the homepage when logged in.
+    """
+    resp = benchmark(logged_in_client.get, "/")
+    assert resp.status_code == 200
+    assert "logged in" in resp.text
+
+
+def test_homepage_not_modified(
+    benchmark: BenchmarkFixture, logged_in_client: FlaskClient
+) -> None:
+    """
+    Revalidate the homepage when the browser already has it.
+    """
+    etag = logged_in_client.get("/").headers["ETag"]
+
+    resp = benchmark(logged_in_client.get, "/", headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+
+
+def test_secret_logged_out(
+    benchmark: BenchmarkFixture, logged_out_client: FlaskClient
+) -> None:
+    """
+    Try to load the secret page when logged out.
+    """
+    resp = benchmark(logged_out_client.get, "/secret")
+    assert resp.status_code == 302
+
+
+def test_secret_logged_in(
+    benchmark: BenchmarkFixture, logged_in_client: FlaskClient
+) -> None:
+    """
+    Load the secret page when logged in.
+    """
+    resp = benchmark(logged_in_client.get, "/secret")
+    assert resp.status_code == 200
+
+
+def test_logout_logged_out(
+    benchmark: BenchmarkFixture, logged_out_client: FlaskClient
+) -> None:
+    """
+    Log out when already logged out.
+    """
+    resp = benchmark(logged_out_client.get, "/logout")
+    assert resp.status_code == 302
+
+
+def test_logout_logged_in(
+    benchmark: BenchmarkFixture, logged_out_client: FlaskClient, user: FlickrUser
+) -> None:
+    """
+    Log out when logged in.  We log back in before every round,
+    which isn't included in the timing.
+    """
+    resp = benchmark.pedantic(
+        logged_out_client.get,
+        args=("/logout",),
+        setup=lambda: log_in(logged_out_client, user),
+        rounds=500,
+    )
+    assert resp.status_code == 302
+
+
+def test_authorize_logged_out(
+    benchmark: BenchmarkFixture, logged_out_client: FlaskClient
+) -> None:
+    """
+    Start the login flow, including getting a request token from
+    (a stub of) Flickr.  Before every round, we forget the login we
+    started in the last round, which isn't included in the timing --
+    otherwise we'd reuse its request token (see ``pending_logins.py``).
+    """
+
+    def setup() -> None:
+        """
+        Forget the login in progress.
+        """
+        with logged_out_client.session_transaction() as session:
+            session.pop("pending_login", None)
+
+    resp = benchmark.pedantic(
+        logged_out_client.get, args=("/authorize",), setup=setup, rounds=500
+    )
+    assert resp.status_code == 302
+    assert resp.headers["location"].startswith("https://www.flickr.com/")
+
+
+def test_authorize_pending_login(
+    benchmark: BenchmarkFixture, logged_out_client: FlaskClient
+) -> None:
+    """
+    Go to /authorize again while a login is in progress, which reuses
+    the request token we already have, without calling Flickr.
+    """
+    location = logged_out_client.get("/authorize").headers["location"]
+
+    resp = benchmark(logged_out_client.get, "/authorize")
+    assert resp.status_code == 302
+    assert resp.headers["location"] == location
+
+
+def test_authorize_logged_in(
+    benchmark: BenchmarkFixture, logged_in_client: FlaskClient
+) -> None:
+    """
+    Start the login flow when already logged in.
+    """
+    resp = benchmark(logged_in_client.get, "/authorize")
+    assert resp.status_code == 302
+    assert resp.headers["location"] == "/"
+
+
+def test_callback_logged_out(
+    benchmark: BenchmarkFixture, app: Flask, logged_out_client: FlaskClient
+) -> None:
+    """
+    Finish the login flow, including getting an access token from
+    (a stub of) Flickr.  Before every round, we log out and save a new
+    request token, which isn't included in the timing.
+    """
+    tokens = iter(range(1_000_000))
+
+    def setup() -> tuple[tuple[str], dict[str, str]]:
+        """
+        Log out, and save a request token for the callback to use.
+        """
+        with logged_out_client.session_transaction() as session:
+            session.clear()
+
+        oauth_token = f"request{next(tokens)}"
+        app.extensions["request_token_store"].put(
+            {"oauth_token": oauth_token, "oauth_token_secret": "secret"}
+        )
+        return (f"/callback?oauth_token={oauth_token}&oauth_verifier=verifier",), {}
+
+    resp = benchmark.pedantic(logged_out_client.get, setup=setup, rounds=500)
+    assert resp.status_code == 302
+    assert resp.headers["location"] == "/"
+
+
+def test_callback_logged_in(
+    benchmark: BenchmarkFixture, logged_in_client: FlaskClient
+) -> None:
+    """
+    Visit the callback when already logged in.
+    """
+    resp = benchmark(logged_in_client.get, "/callback")
+    assert resp.status_code == 302
+
+
+def test_login_flow(
+    benchmark: BenchmarkFixture, logged_out_client: FlaskClient
+) -> None:
+    """
+    Go through the complete authorize -> callback flow, then log out
+    again so the next round starts from the same place.
+    """
+
+    def login_flow() -> werkzeug.Response:
+        """
+        Log in and out.
+        """
+        authorize_resp = logged_out_client.get("/authorize")
+        oauth_token = authorize_resp.headers["location"].split("oauth_token=")[1]
+
+        callback_resp = logged_out_client.get(
+            f"/callback?oauth_token={oauth_token}&oauth_verifier=verifier"
+        )
+
+        logged_out_client.get("/logout")
+
+        return callback_resp
+
+    resp = benchmark(login_flow)
+    assert resp.status_code == 302
+    assert resp.headers["location"] == "/"
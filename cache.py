@@ -0,0 +1,75 @@
+"""
+A small in-memory cache, for things we don't want to look up on
+every request.
+"""
+
+import collections
+import threading
+import time
+import typing
+
+
+K = typing.TypeVar("K")
+V = typing.TypeVar("V")
+
+
+class TTLCache(typing.Generic[K, V]):
+    """
+    A bounded cache where entries expire after a time-to-live (TTL).
+
+    If the cache is full, it discards the least recently used entry.
+    Every operation is O(1), and the cache is safe to share between
+    threads.
+    """
+
+    def __init__(self, *, max_size: int, ttl: float) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._entries: collections.OrderedDict[K, tuple[float, V]] = (
+            collections.OrderedDict()
+        )
+
+    def __len__(self) -> int:
+        """
+        Return the number of entries in the cache, including any which
+        have expired but haven't been cleared out yet.
+        """
+        return len(self._entries)
+
+    def get(self, key: K) -> V | None:
+        """
+        Return the cached value for ``key``, or None if it isn't cached
+        or it's expired.
+        """
+        with self._lock:
+            try:
+                expires_at, value = self._entries[key]
+            except KeyError:
+                return None
+
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: K, value: V) -> None:
+        """
+        Add a value to the cache, replacing any existing value.
+        """
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: K) -> None:
+        """
+        Remove a value from the cache, if it's there.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
@@ -0,0 +1,109 @@
+"""
+Find the Flickr API key and secret for the app.
+
+We look for credentials in several places, in order, and use the
+first ones we find:
+
+*   ``environment`` -- the ``FLICKR_API_KEY`` and ``FLICKR_API_SECRET``
+    environment variables
+*   ``file`` -- a JSON file like ``{"key": "…", "secret": "…"}``, if you
+    set ``FLICKR_CREDENTIALS_FILE`` in the app config
+*   ``keyring`` -- the system keychain
+
+Looking in the keychain can be slow.  On a Linux server, the keyring
+library has to probe D-Bus for a Secret Service, which can take hundreds
+of milliseconds -- so we only do it if we have to, and we only look once
+per process.  If the app is created before the server forks its workers
+(e.g. ``gunicorn --preload``), the workers inherit the credentials
+and never look at all.
+"""
+
+import functools
+import json
+import os
+import typing
+
+
+class Credentials(typing.NamedTuple):
+    """
+    A Flickr API key and secret, and where we found them.
+    """
+
+    client_id: str
+    client_secret: str
+    source: str
+
+
+@functools.cache
+def load_credentials(
+    sources: tuple[str, ...], *, credentials_file: str | None = None
+) -> Credentials | None:
+    """
+    Look for credentials in each of the ``sources`` in turn, and return
+    the first ones we find, or None if there aren't any.
+
+    The result is cached, so we only look once per process.
+    """
+    for source in sources:
+        credentials: Credentials | None
+
+        if source == "environment":
+            credentials = from_environment()
+        elif source == "file":
+            credentials = from_file(credentials_file)
+        elif source == "keyring":
+            credentials = from_keyring()
+        else:
+            raise ValueError(f"Unrecognised credential source: {source!r}")
+
+        if credentials is not None:
+            return credentials
+
+    return None
+
+
+def from_environment() -> Credentials | None:
+    """
+    Read credentials from the ``FLICKR_API_KEY`` and ``FLICKR_API_SECRET``
+    environment variables.
+    """
+    client_id = os.environ.get("FLICKR_API_KEY")
+    client_secret = os.environ.get("FLICKR_API_SECRET")
+
+    if client_id is None or client_secret is None:
+        return None
+
+    return Credentials(client_id, client_secret, source="environment")
+
+
+def from_file(path: str | None) -> Credentials | None:
+    """
+    Read credentials from a JSON file, if it exists.
+    """
+    if path is None or not os.path.exists(path):
+        return None
+
+    with open(path) as in_file:
+        data = json.load(in_file)
+
+    if "key" not in data or "secret" not in data:
+        return None
+
+    return Credentials(data["key"], data["secret"], source=f"file:{path}")
+
+
+def from_keyring() -> Credentials | None:
+    """
+    Read credentials from the system keychain.
+    """
+    # We import keyring here rather than at the top of the file, so
+    # we don't pay for it if we find credentials somewhere else.
+    import keyring
+
+    client_id = keyring.get_password("flickr_flask_login_demo", "key")
+    client_secret = keyring.get_password("flickr_flask_login_demo", "secret")
+
+    if client_id is None or client_secret is None:
+        return None
+
+    return Credentials(client_id, client_secret, source="keyring")
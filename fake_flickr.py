@@ -0,0 +1,589 @@
+"""
+A fake version of Flickr's OAuth 1.0a endpoints, for load testing.
+
+This is a standalone, threaded HTTP server which behaves like the
+parts of Flickr that the login flow talks to:
+
+*   ``/services/oauth/request_token`` gives out request tokens
+*   ``/services/oauth/authorize`` pretends the user has logged in and
+    approved the app, and redirects them straight back to the callback
+*   ``/services/oauth/access_token`` swaps a request token for an
+    access token, for a brand new user each time
+*   ``/services/rest/`` answers the API methods the app calls:
+    ``flickr.people.getInfo`` (when somebody logs in),
+    ``flickr.auth.oauth.checkToken`` (from the token validator) and
+    ``flickr.people.getPhotos`` (for the list of photos, a page at a
+    time).  Every user has the same number of photos.  Any other method
+    is an error, so if the app starts calling something new, you'll
+    find out here rather than getting made-up results.
+
+It checks the OAuth signatures on every request, just like Flickr
+does, so a bug in how we sign requests will show up here rather than
+in production.  You can also make it slower or less reliable, to see
+how the app copes when Flickr is having a bad day.
+
+To use it, start the server -- by default, it accepts the same API key
+and secret as the app:
+
+    $ python fake_flickr.py --port 8009 --latency 0.2 --jitter 0.05
+
+and then point the app at it by setting ``FLICKR_BASE_URL`` -- the app
+sends its API calls here too, unless you set ``FLICKR_API_URL``:
+
+    $ FLASK_FLICKR_BASE_URL=http://localhost:8009 flask run
+
+Note that you need to use ``localhost`` rather than ``127.0.0.1``,
+because Authlib won't send OAuth requests over plain HTTP to
+anywhere else.
+
+See https://www.flickr.com/services/api/auth.oauth.html
+"""
+
+import argparse
+import base64
+import hashlib
+import hmac
+import http.server
+import itertools
+import json
+import math
+import random
+import secrets
+import time
+import typing
+from urllib.parse import parse_qsl, quote, unquote, urlencode, urlsplit
+from urllib.request import parse_http_list, parse_keqv_list
+
+from cache import TTLCache
+from credentials import load_credentials
+
+
+Params = list[tuple[str, str]]
+
+# A response from the fake server: the status code, any extra headers,
+# and the body.
+Response = tuple[int, dict[str, str], str]
+
+# How many photos every fake user has.
+PHOTO_COUNT = 100
+
+# How many photos ``flickr.people.getPhotos`` returns on each page,
+# if the app doesn't ask for a number, and the most it'll return.
+#
+# See https://www.flickr.com/services/api/flickr.people.getPhotos.html
+DEFAULT_PER_PAGE = 100
+MAX_PER_PAGE = 500
+
+
+class FakeFlickr:
+    """
+    The state and behaviour of the fake Flickr server.
+
+    This is separate from the HTTP server, so it can be shared by every
+    thread that's handling a request.
+    """
+
+    def __init__(
+        self,
+        *,
+        consumer_key: str,
+        consumer_secret: str,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        seed: int | None = None,
+    ) -> None:
+        self.consumer_key = consumer_key
+        self.consumer_secret = consumer_secret
+
+        # Every request takes ``latency`` seconds, give or take up to
+        # ``jitter`` seconds, and a fraction ``error_rate`` of requests
+        # fail with a ``503 Service Unavailable``.
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+
+        # Request tokens we've given out, keyed by ``oauth_token``.
+        # Each entry is the token secret, the callback URL, and the
+        # verifier (once the user has approved the app).
+        #
+        # Lots of request tokens are never exchanged for an access
+        # token -- e.g. if a simulated user gives up half-way through
+        # -- so we only keep them for a while.
+        self.request_tokens: TTLCache[str, tuple[str, str, str | None]] = TTLCache(
+            max_size=100_000, ttl=15 * 60
+        )
+
+        # Access tokens we've given out, keyed by ``oauth_token``.
+        # Each entry is the token secret and the user's ID, so we can
+        # check the signature on API calls.
+        self.access_tokens: TTLCache[str, tuple[str, int]] = TTLCache(
+            max_size=100_000, ttl=24 * 60 * 60
+        )
+
+        # Every login gets a new user.
+        self.user_ids = itertools.count(1)
+
+    def handle(self, method: str, url: str, params: Params) -> Response:
+        """
+        Handle a request to the fake server, and return the response.
+
+        The ``params`` are all the parameters from the query string,
+        the form-encoded body and the ``Authorization`` header.
+        """
+        delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+        time.sleep(max(delay, 0))
+
+        if self.random.random() < self.error_rate:
+            return 503, {}, "oauth_problem=service_unavailable"
+
+        path = urlsplit(url).path
+
+        if path == "/services/oauth/request_token":
+            return self.request_token(method, url, params)
+        elif path == "/services/oauth/authorize":
+            return self.authorize(params)
+        elif path == "/services/oauth/access_token":
+            return self.access_token(method, url, params)
+        elif path == "/services/rest/":
+            return self.rest(method, url, params)
+        else:
+            return 404, {}, "Not Found"
+
+    def request_token(self, method: str, url: str, params: Params) -> Response:
+        """
+        Step 1: give the app a request token.
+        """
+        problem = self.check_signature(method, url, params, token_secret="")
+        if problem is not None:
+            return 401, {}, f"oauth_problem={problem}"
+
+        oauth_token = secrets.token_hex(16)
+        oauth_token_secret = secrets.token_hex(8)
+        callback_url = dict(params).get("oauth_callback", "oob")
+
+        self.request_tokens.set(oauth_token, (oauth_token_secret, callback_url, None))
+
+        return (
+            200,
+            {},
+            urlencode(
+                {
+                    "oauth_callback_confirmed": "true",
+                    "oauth_token": oauth_token,
+                    "oauth_token_secret": oauth_token_secret,
+                }
+            ),
+        )
+
+    def authorize(self, params: Params) -> Response:
+        """
+        Step 2: pretend the user has approved the app, and send them
+        back to the app's callback URL.
+        """
+        oauth_token = dict(params).get("oauth_token", "")
+        request_token = self.request_tokens.get(oauth_token)
+
+        if request_token is None:
+            return 400, {}, "Invalid oauth_token"
+
+        oauth_token_secret, callback_url, _ = request_token
+        oauth_verifier = secrets.token_hex(8)
+
+        self.request_tokens.set(
+            oauth_token, (oauth_token_secret, callback_url, oauth_verifier)
+        )
+
+        separator = "&" if "?" in callback_url else "?"
+        location = (
+            callback_url
+            + separator
+            + urlencode({"oauth_token": oauth_token, "oauth_verifier": oauth_verifier})
+        )
+
+        return 302, {"Location": location}, ""
+
+    def access_token(self, method: str, url: str, params: Params) -> Response:
+        """
+        Step 3: exchange an approved request token for an access token.
+        """
+        oauth_params = dict(params)
+        oauth_token = oauth_params.get("oauth_token", "")
+        request_token = self.request_tokens.get(oauth_token)
+
+        if request_token is None:
+            return 401, {}, "oauth_problem=token_rejected"
+
+        oauth_token_secret, _, oauth_verifier = request_token
+
+        problem = self.check_signature(
+            method, url, params, token_secret=oauth_token_secret
+        )
+        if problem is not None:
+            return 401, {}, f"oauth_problem={problem}"
+
+        # The verifier proves the user has approved the app.
+        verifier = oauth_params.get("oauth_verifier")
+
+        if oauth_verifier is None or verifier != oauth_verifier:
+            return 401, {}, "oauth_problem=verifier_invalid"
+
+        # A request token can only be used once.
+        self.request_tokens.invalidate(oauth_token)
+
+        user_id = next(self.user_ids)
+
+        access_token = secrets.token_hex(16)
+        access_token_secret = secrets.token_hex(8)
+
+        self.access_tokens.set(access_token, (access_token_secret, user_id))
+
+        return (
+            200,
+            {},
+            urlencode(
+                {
+                    "fullname": f"Fake User {user_id}",
+                    "oauth_token": access_token,
+                    "oauth_token_secret": access_token_secret,
+                    "user_nsid": f"{user_id}@N00",
+                    "username": f"fakeuser{user_id}",
+                }
+            ),
+        )
+
+    def rest(self, method: str, url: str, params: Params) -> Response:
+        """
+        Answer an API call, signed with an access token.
+
+        Like the real Flickr, we report errors in the JSON body, with
+        a ``200 OK``.
+
+        See https://www.flickr.com/services/api/response.json.html
+        """
+        oauth_params = dict(params)
+        access_token = self.access_tokens.get(oauth_params.get("oauth_token", ""))
+
+        if access_token is None:
+            return api_error(98, "Invalid auth token")
+
+        access_token_secret, user_id = access_token
+
+        problem = self.check_signature(
+            method, url, params, token_secret=access_token_secret
+        )
+        if problem is not None:
+            return api_error(96, "Invalid signature")
+
+        api_method = oauth_params.get("method")
+
+        if api_method == "flickr.people.getInfo":
+            result = self.get_info(user_id)
+        elif api_method == "flickr.auth.oauth.checkToken":
+            result = self.check_token(oauth_params["oauth_token"], user_id)
+        elif api_method == "flickr.people.getPhotos":
+            result = self.get_photos(user_id, oauth_params)
+        else:
+            return api_error(112, f'Method "{api_method}" not found')
+
+        return 200, {}, json.dumps({**result, "stat": "ok"})
+
+    def get_info(self, user_id: int) -> dict[str, typing.Any]:
+        """
+        Answer ``flickr.people.getInfo`` for the logged-in user.
+        """
+        return {
+            "person": {
+                "nsid": f"{user_id}@N00",
+                "username": {"_content": f"fakeuser{user_id}"},
+                "photos": {"count": {"_content": PHOTO_COUNT}},
+            }
+        }
+
+    def check_token(self, oauth_token: str, user_id: int) -> dict[str, typing.Any]:
+        """
+        Answer ``flickr.auth.oauth.checkToken``.  If we got this far,
+        the token is one we gave out, so it's valid.
+        """
+        return {
+            "oauth": {
+                "token": {"_content": oauth_token},
+                "perms": {"_content": "read"},
+                "user": {
+                    "nsid": f"{user_id}@N00",
+                    "username": f"fakeuser{user_id}",
+                    "fullname": f"Fake User {user_id}",
+                },
+            }
+        }
+
+    def get_photos(self, user_id: int, params: dict[str, str]) -> dict[str, typing.Any]:
+        """
+        Answer ``flickr.people.getPhotos``, one page at a time.
+
+        Like Flickr, a page past the end is empty rather than an error.
+        """
+        page = max(int(params.get("page", 1)), 1)
+        per_page = min(
+            max(int(params.get("per_page", DEFAULT_PER_PAGE)), 1), MAX_PER_PAGE
+        )
+
+        first = (page - 1) * per_page
+        last = min(first + per_page, PHOTO_COUNT)
+
+        return {
+            "photos": {
+                "page": page,
+                "pages": math.ceil(PHOTO_COUNT / per_page),
+                "perpage": per_page,
+                "total": PHOTO_COUNT,
+                "photo": [
+                    {
+                        "id": str(user_id * 1_000_000 + n),
+                        "owner": f"{user_id}@N00",
+                        "title": f"Photo {n}",
+                    }
+                    for n in range(first + 1, last + 1)
+                ],
+            }
+        }
+
+    def check_signature(
+        self, method: str, url: str, params: Params, *, token_secret: str
+    ) -> str | None:
+        """
+        Check the consumer key and HMAC-SHA1 signature on a request.
+
+        Returns None if the request is correctly signed, or the name of
+        the problem if not.
+
+        See https://www.flickr.com/services/api/auth.oauth.html#signing
+        """
+        # Some clients (including the version of Authlib we use) repeat
+        # the ``oauth_`` parameters in the query string.  Flickr accepts
+        # this, so we ignore any parameters which are exact duplicates.
+        params = list(dict.fromkeys(params))
+
+        oauth_params = dict(params)
+
+        if oauth_params.get("oauth_consumer_key") != self.consumer_key:
+            return "consumer_key_unknown"
+
+        expected = sign(
+            method,
+            url,
+            params,
+            consumer_secret=self.consumer_secret,
+            token_secret=token_secret,
+        )
+
+        if not secrets.compare_digest(
+            expected, oauth_params.get("oauth_signature", "")
+        ):
+            return "signature_invalid"
+
+        return None
+
+
+def api_error(code: int, message: str) -> Response:
+    """
+    Create a failed API response, in the same shape as Flickr's.
+    """
+    return 200, {}, json.dumps({"stat": "fail", "code": code, "message": message})
+
+
+def sign(
+    method: str, url: str, params: Params, *, consumer_secret: str, token_secret: str
+) -> str:
+    """
+    Create the HMAC-SHA1 signature for a request.
+
+    The signature covers the HTTP method, the URL (without the query
+    string), and all the parameters except the signature itself.
+
+    See https://datatracker.ietf.org/doc/html/rfc5849#section-3.4
+    """
+
+    def escape(s: str) -> str:
+        """
+        Percent-encode a string in the way that OAuth expects.
+        """
+        return quote(s, safe="~")
+
+    url_parts = urlsplit(url)
+    base_url = (
+        f"{url_parts.scheme.lower()}://{url_parts.netloc.lower()}{url_parts.path}"
+    )
+
+    normalized_params = "&".join(
+        f"{key}={value}"
+        for key, value in sorted(
+            (escape(key), escape(value))
+            for key, value in params
+            if key not in {"oauth_signature", "realm"}
+        )
+    )
+
+    base_string = "&".join(
+        escape(part) for part in (method.upper(), base_url, normalized_params)
+    )
+    key = f"{escape(consumer_secret)}&{escape(token_secret)}"
+
+    digest = hmac.new(key.encode("utf8"), base_string.encode("utf8"), hashlib.sha1)
+    return base64.b64encode(digest.digest()).decode("ascii")
+
+
+class FakeFlickrHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Turns HTTP requests into calls to :meth:`FakeFlickr.handle`.
+    """
+
+    server: "FakeFlickrServer"
+
+    # Use HTTP/1.1, so the app can keep connections open and reuse
+    # them, like it does with the real Flickr.
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self) -> None:
+        """
+        Handle a GET request.
+        """
+        self.handle_oauth()
+
+    def do_POST(self) -> None:
+        """
+        Handle a POST request.
+        """
+        self.handle_oauth()
+
+    def handle_oauth(self) -> None:
+        """
+        Gather up the parameters for a request, pass it to the fake
+        Flickr, and send back the response.
+        """
+        # Work out the URL the client used, which is part of the
+        # OAuth signature.
+        url = f"http://{self.headers['Host']}{self.path}"
+
+        params = parse_qsl(urlsplit(self.path).query, keep_blank_values=True)
+
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length).decode("utf8")
+
+        if self.headers.get("Content-Type") == "application/x-www-form-urlencoded":
+            params += parse_qsl(body, keep_blank_values=True)
+
+        authorization = self.headers.get("Authorization", "")
+
+        if authorization.startswith("OAuth "):
+            header_params = parse_keqv_list(parse_http_list(authorization[6:]))
+            params += [(unquote(k), unquote(v)) for k, v in header_params.items()]
+
+        status, headers, response_body = self.server.flickr.handle(
+            self.command, url, params
+        )
+
+        encoded_body = response_body.encode("utf8")
+
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(encoded_body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        self.wfile.write(encoded_body)
+
+    def log_message(self, format: str, *args: typing.Any) -> None:
+        """
+        Only log requests if the server is in verbose mode -- under load,
+        printing a line for every request would slow everything down.
+        """
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class FakeFlickrServer(http.server.ThreadingHTTPServer):
+    """
+    A threaded HTTP server for the fake Flickr, which handles each
+    request in a new thread.
+    """
+
+    # Let lots of connections queue up before they're accepted, so we
+    # don't refuse connections when the app sends a burst of requests.
+    request_queue_size = 1024
+
+    def __init__(
+        self, address: tuple[str, int], flickr: FakeFlickr, *, verbose: bool = False
+    ) -> None:
+        super().__init__(address, FakeFlickrHandler)
+        self.flickr = flickr
+        self.verbose = verbose
+
+
+def main(argv: list[str] | None = None) -> None:
+    """
+    Run the fake Flickr server from the command line.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8009)
+    parser.add_argument(
+        "--consumer-key",
+        help="the API key to accept (default: the same key as the app)",
+    )
+    parser.add_argument(
+        "--consumer-secret",
+        help="the API secret to accept (default: the same secret as the app)",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="how long each request takes (s)"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0.0, help="random variation in latency (s)"
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.0,
+        help="fraction of requests which fail with a 503",
+    )
+    parser.add_argument("--seed", type=int, help="seed for the random number generator")
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    args = parser.parse_args(argv)
+
+    # If the key and secret aren't passed explicitly, use the same
+    # credentials as the app.
+    if args.consumer_key is None or args.consumer_secret is None:
+        credentials = load_credentials(("environment", "keyring"))
+
+        if credentials is None:
+            parser.error(
+                "pass --consumer-key and --consumer-secret, or save them first"
+            )
+
+        args.consumer_key, args.consumer_secret, _ = credentials
+
+    flickr = FakeFlickr(
+        consumer_key=args.consumer_key,
+        consumer_secret=args.consumer_secret,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        seed=args.seed,
+    )
+
+    with FakeFlickrServer(
+        (args.host, args.port), flickr, verbose=args.verbose
+    ) as server:
+        print(f"Fake Flickr running at http://localhost:{server.server_port}")
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
@@ -0,0 +1,466 @@
+"""
+Make Flickr API calls on behalf of a logged-in user.
+
+When a user logs in, we save their OAuth access token (see ``users.py``),
+and we can use it to sign calls to the Flickr API as that user, e.g.
+``flickr.people.getInfo``.
+
+If we called Flickr on every page view, every page would be as slow as
+a round trip to Flickr.  Instead, :class:`FlickrApi`:
+
+*   reuses the app's pool of connections to Flickr (see ``flickr_http.py``)
+*   caches the response to each call, for each user.  Once a response is
+    older than ``FLICKR_API_CACHE_TTL``, it's "stale": we keep using it,
+    but we fetch a fresh copy in the background, so the user doesn't
+    wait ("stale-while-revalidate").  After ``FLICKR_API_STALE_TTL``
+    more seconds, we throw it away.
+*   lets pages use :meth:`FlickrApi.peek`, which never waits for Flickr:
+    if there's nothing in the cache, the page leaves the information
+    out, and we fetch it in the background for the next page view.
+*   collapses identical calls, so if lots of requests want the same
+    thing at once, we only ask Flickr once (see ``singleflight.py``)
+
+For long lists, e.g. all of a user's photos, :meth:`FlickrApi.paginate`
+fetches a few pages at once and yields the items as they arrive, so we
+can start sending them to the browser before we've fetched them all.
+Those calls aren't cached -- a user with 100k photos would fill the cache.
+A list that long takes more calls than the rate limiter allows in
+a burst, so the pages are background calls, which can't use up the
+calls we need for logins, and we wait for the bucket to refill between
+them (see ``rate_limit.py``).
+
+We only cache read-only calls -- you shouldn't use this for anything
+that changes data on Flickr.
+
+See https://www.flickr.com/services/api/
+"""
+
+import collections
+from collections.abc import Generator
+import concurrent.futures
+import logging
+import threading
+import time
+import typing
+
+from flask import Flask
+
+from api_keys import ApiKeyRing
+from cache import TTLCache
+from flickr_calls import FlickrCallPolicy, FlickrRateLimited, raise_for_server_error
+from flickr_http import SharedTransport
+from singleflight import SingleFlight
+from users import FlickrUser
+
+
+logger = logging.getLogger(__name__)
+
+Response = dict[str, typing.Any]
+
+# The user's NSID, the API method and its parameters
+CacheKey = tuple[str, str, tuple[tuple[str, str], ...]]
+
+
+class FlickrApiError(Exception):
+    """
+    Raised when the Flickr API returns an error, e.g. if a user
+    doesn't exist.
+
+    ``code`` is the Flickr error code, or the HTTP status code if
+    Flickr rejected the request outright.
+
+    See https://www.flickr.com/services/api/response.json.html
+    """
+
+    def __init__(self, code: int, message: str) -> None:
+        super().__init__(f"Flickr API error {code}: {message}")
+        self.code = code
+        self.message = message
+
+
+class FlickrApi:
+    """
+    A client for read-only Flickr API calls, with a per-user cache.
+    """
+
+    def __init__(
+        self,
+        *,
+        transport: SharedTransport,
+        policy: FlickrCallPolicy,
+        keys: ApiKeyRing,
+        api_url: str,
+        cache_size: int,
+        cache_ttl: float,
+        stale_ttl: float,
+        refresh_threads: int,
+        page_size: int,
+        page_concurrency: int,
+        page_max_wait: float,
+    ) -> None:
+        self.transport = transport
+        self.policy = policy
+        self.keys = keys
+        self.api_url = api_url
+        self.cache_ttl = cache_ttl
+        self.refresh_threads = refresh_threads
+        self.page_size = page_size
+        self.page_concurrency = page_concurrency
+        self.page_max_wait = page_max_wait
+
+        # We keep responses until they're too stale to use, and we
+        # record when we fetched them, so we know when they're stale.
+        self._cache: TTLCache[CacheKey, tuple[float, Response]] = TTLCache(
+            max_size=cache_size, ttl=cache_ttl + stale_ttl
+        )
+        self._in_flight: SingleFlight[CacheKey, Response] = SingleFlight()
+
+        # The threads which fetch responses in the background.  We don't create
+        # them until we need them, so they start in the worker process.
+        self._executor: concurrent.futures.ThreadPoolExecutor | None = None
+        self._executor_lock = threading.Lock()
+
+    def get(self, user: FlickrUser, method: str, **params: str) -> Response:
+        """
+        Call a Flickr API method as ``user``, e.g.
+
+            api.get(user, "flickr.people.getInfo", user_id=user.user_nsid)
+
+        and return the parsed JSON response.  This may be a cached
+        response, if we've made the same call for the same user recently.
+        """
+        key: CacheKey = (user.user_nsid, method, tuple(sorted(params.items())))
+
+        response = self._get_cached(key, user, method, params)
+
+        if response is not None:
+            return response
+
+        return self._in_flight.do(
+            key, lambda: self._fetch_and_cache(key, user, method, params)
+        )
+
+    def peek(self, user: FlickrUser, method: str, **params: str) -> Response | None:
+        """
+        Like :meth:`get`, but never waits for Flickr.
+
+        If we don't have a cached response, this starts fetching one in
+        the background and returns None, so a page can leave out the
+        information rather than make the user wait.  It'll be in the
+        cache for their next page view.
+        """
+        key: CacheKey = (user.user_nsid, method, tuple(sorted(params.items())))
+
+        response = self._get_cached(key, user, method, params)
+
+        if response is None:
+            self._fetch_in_background(key, user, method, params)
+
+        return response
+
+    def call(
+        self, user: FlickrUser, method: str, *, background: bool = False, **params: str
+    ) -> Response:
+        """
+        Call a Flickr API method as ``user``, without using the cache.
+
+        If nobody is waiting for the answer, pass ``background=True``,
+        so the call leaves more of the rate limit for logins -- see
+        ``rate_limit.py``.
+        """
+        return self._fetch(user, method, params, background=background)
+
+    def paginate(
+        self, user: FlickrUser, method: str, *, container: str, item: str, **params: str
+    ) -> Generator[dict[str, typing.Any], None, None]:
+        """
+        Call a paginated Flickr API method as ``user``, and yield every
+        item from every page, in order, e.g.
+
+            api.paginate(
+                user, "flickr.people.getPhotos",
+                container="photos", item="photo", user_id="me"
+            )
+
+        We get the first page to find out how many pages there are, then
+        fetch up to ``page_concurrency`` pages at once.  We only start
+        fetching another page when we yield the items from an earlier
+        one, so we never hold more than a few pages in memory, however
+        long the list is -- and if the caller stops early (e.g. the
+        browser goes away), we stop calling Flickr.
+
+        If we're rate limited for longer than ``page_max_wait`` seconds,
+        this raises :class:`FlickrRateLimited`, and the caller gets
+        a partial list.
+        """
+        per_page = str(self.page_size)
+
+        # This is set if the caller stops early, so any page which is
+        # waiting for the rate limiter gives up.
+        stopped = threading.Event()
+
+        first_page = self._fetch_page(
+            user, method, {"page": "1", "per_page": per_page, **params}, stopped
+        )
+        yield from first_page[container][item]
+
+        page_count = int(first_page[container]["pages"])
+
+        if page_count <= 1:
+            return
+
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.page_concurrency, thread_name_prefix="flickr-api-pages"
+        )
+        in_flight: collections.deque[concurrent.futures.Future[Response]] = (
+            collections.deque()
+        )
+        next_page = 2
+
+        try:
+            while in_flight or next_page <= page_count:
+                while (
+                    next_page <= page_count and len(in_flight) < self.page_concurrency
+                ):
+                    in_flight.append(
+                        executor.submit(
+                            self._fetch_page,
+                            user,
+                            method,
+                            {"page": str(next_page), "per_page": per_page, **params},
+                            stopped,
+                        )
+                    )
+                    next_page += 1
+
+                yield from in_flight.popleft().result()[container][item]
+        finally:
+            stopped.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _fetch_page(
+        self,
+        user: FlickrUser,
+        method: str,
+        params: dict[str, str],
+        stopped: threading.Event,
+    ) -> Response:
+        """
+        Fetch one page of a long list, as a background call.
+
+        If we're rate limited, we wait for the bucket to refill and try
+        again, for up to ``page_max_wait`` seconds, unless the caller
+        stops first.
+        """
+        deadline = time.monotonic() + self.page_max_wait
+
+        while True:
+            try:
+                return self._fetch(user, method, params, background=True)
+            except FlickrRateLimited as err:
+                if time.monotonic() + err.retry_after > deadline or stopped.wait(
+                    err.retry_after
+                ):
+                    raise
+
+    def close(self) -> None:
+        """
+        Wait for any background refreshes to finish.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    def _get_cached(
+        self, key: CacheKey, user: FlickrUser, method: str, params: dict[str, str]
+    ) -> Response | None:
+        """
+        Return the cached response for a call, or None if we don't have
+        one.  If it's stale, we fetch a fresh copy in the background.
+        """
+        cached = self._cache.get(key)
+
+        if cached is None:
+            return None
+
+        fetched_at, response = cached
+
+        if time.monotonic() - fetched_at >= self.cache_ttl:
+            self._fetch_in_background(key, user, method, params)
+
+        return response
+
+    def _fetch_in_background(
+        self, key: CacheKey, user: FlickrUser, method: str, params: dict[str, str]
+    ) -> None:
+        """
+        Fetch a response and cache it, in the background, unless we're
+        already fetching it.
+        """
+        self._in_flight.do_in_background(
+            key,
+            lambda: self._refresh(key, user, method, params),
+            self._refresh_executor(),
+        )
+
+    def _refresh_executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        """
+        Return the thread pool for background refreshes, creating it if
+        this is the first time we've needed it.
+        """
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.refresh_threads,
+                    thread_name_prefix="flickr-api-refresh",
+                )
+
+            return self._executor
+
+    def _refresh(
+        self, key: CacheKey, user: FlickrUser, method: str, params: dict[str, str]
+    ) -> Response:
+        """
+        Fetch a fresh copy of a response, in the background.
+
+        If this fails, we log it and carry on using the stale response
+        (if we have one) until it expires.
+        """
+        try:
+            return self._fetch_and_cache(key, user, method, params)
+        except Exception:
+            logger.warning(
+                "Unable to refresh %s for %s", method, user.user_nsid, exc_info=True
+            )
+            raise
+
+    def _fetch_and_cache(
+        self, key: CacheKey, user: FlickrUser, method: str, params: dict[str, str]
+    ) -> Response:
+        """
+        Call Flickr, and save the response in the cache.
+        """
+        response = self._fetch(user, method, params)
+        self._cache.set(key, (time.monotonic(), response))
+        return response
+
+    def _fetch(
+        self,
+        user: FlickrUser,
+        method: str,
+        params: dict[str, str],
+        *,
+        background: bool = False,
+    ) -> Response:
+        """
+        Call Flickr, signing the request with the user's access token,
+        and the API key it belongs to.
+        """
+        from authlib.integrations.httpx_client import OAuth1Client
+
+        # If we've stopped using the key, the access token is no good.
+        # Flickr uses error code 100 for an invalid API key.
+        key = self.keys.get(user.client_id)
+
+        if key is None:
+            raise FlickrApiError(100, "Invalid API Key (no longer in use)")
+
+        oauth_client = OAuth1Client(
+            client_id=key.client_id,
+            client_secret=key.client_secret,
+            token=user.oauth_token,
+            token_secret=user.oauth_token_secret,
+            transport=self.transport.get(),
+            event_hooks={"response": [raise_for_server_error]},
+        )
+
+        query = {"method": method, "format": "json", "nojsoncallback": "1", **params}
+
+        # These calls don't change anything, so it's safe to retry them.
+        http_response = self.policy.call(
+            lambda timeout: oauth_client.get(
+                self.api_url, params=query, timeout=timeout
+            ),
+            retry=True,
+            background=background,
+            bucket=key.client_id,
+        )
+
+        # Flickr usually reports errors in the JSON body, but it may
+        # reject the request before it gets that far, e.g. a 401 for
+        # a bad signature.
+        if http_response.is_error:
+            raise FlickrApiError(http_response.status_code, http_response.reason_phrase)
+
+        response: Response = http_response.json()
+
+        if response.get("stat") != "ok":
+            raise FlickrApiError(response.get("code", 0), response.get("message", ""))
+
+        return response
+
+
+def api_url_for(base_url: str) -> str:
+    """
+    Return the URL of the Flickr API, for Flickr at ``base_url``.
+
+    The real Flickr serves its API from a separate host.
+    """
+    if base_url == "https://www.flickr.com":
+        return "https://api.flickr.com/services/rest/"
+    else:
+        return base_url + "/services/rest/"
+
+
+def init_app(app: Flask) -> FlickrApi:
+    """
+    Create the Flickr API client for an app, using the settings in the
+    app config.
+
+    The client is saved in ``app.extensions["flickr_api"]``.
+    """
+    # Where to send Flickr API calls.  By default, this follows
+    # ``FLICKR_BASE_URL``, so if you point the app at a fake Flickr,
+    # API calls go there too, rather than to the real Flickr with
+    # tokens it's never seen.
+    app.config.setdefault(
+        "FLICKR_API_URL",
+        api_url_for(app.config.get("FLICKR_BASE_URL", "https://www.flickr.com")),
+    )
+
+    # How many responses to cache, how long (in seconds) they're fresh,
+    # and how much longer we'll use them while we fetch a fresh copy
+    app.config.setdefault("FLICKR_API_CACHE_SIZE", 10_000)
+    app.config.setdefault("FLICKR_API_CACHE_TTL", 60.0)
+    app.config.setdefault("FLICKR_API_STALE_TTL", 5 * 60.0)
+
+    # How many stale responses we can refresh at once
+    app.config.setdefault("FLICKR_API_REFRESH_THREADS", 2)
+
+    # How many items to ask for on each page of a long list (Flickr
+    # allows up to 500), and how many pages to fetch at once.  Every
+    # page is an API call, which counts towards Flickr's rate limit,
+    # so be gentle with the concurrency.
+    app.config.setdefault("FLICKR_API_PAGE_SIZE", 500)
+    app.config.setdefault("FLICKR_API_PAGE_CONCURRENCY", 4)
+
+    # How long (in seconds) to wait for the rate limiter before we give
+    # up on a page, and show a partial list
+    app.config.setdefault("FLICKR_API_PAGE_MAX_WAIT", 60.0)
+
+    api = FlickrApi(
+        transport=app.extensions["flickr_http"],
+        policy=app.extensions["flickr_call_policy"],
+        keys=app.extensions["flickr_api_keys"],
+        api_url=app.config["FLICKR_API_URL"],
+        cache_size=app.config["FLICKR_API_CACHE_SIZE"],
+        cache_ttl=app.config["FLICKR_API_CACHE_TTL"],
+        stale_ttl=app.config["FLICKR_API_STALE_TTL"],
+        refresh_threads=app.config["FLICKR_API_REFRESH_THREADS"],
+        page_size=app.config["FLICKR_API_PAGE_SIZE"],
+        page_concurrency=app.config["FLICKR_API_PAGE_CONCURRENCY"],
+        page_max_wait=app.config["FLICKR_API_PAGE_MAX_WAIT"],
+    )
+
+    app.extensions["flickr_api"] = api
+
+    return api
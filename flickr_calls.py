@@ -0,0 +1,463 @@
+"""
+Timeouts, retries and a circuit breaker for our calls to Flickr.
+
+If Flickr is slow or down, we don't want every login to hang until
+the HTTP library gives up -- that ties up our workers, and the user is
+left staring at a blank page.  Instead:
+
+*   every step of the login flow has a deadline, after which we give up
+*   if getting a request token fails, we retry a couple of times with
+    a random ("jittered") backoff.  We only do this for the request token,
+    because it's safe to ask for another one -- exchanging a request token
+    for an access token can only be done once, so we never retry that
+*   if lots of calls fail in a row, a circuit breaker "opens", and we stop
+    calling Flickr for a while.  Logins fail immediately with a friendly
+    error page, rather than waiting for a call we expect to fail.  After
+    a while, we let one call through to see if Flickr has recovered.
+
+Each worker process has its own circuit breaker.
+
+Every call also has to get past the rate limiter (see ``rate_limit.py``),
+so we don't use up our API key's quota.
+
+See https://martinfowler.com/bliki/CircuitBreaker.html
+and https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+"""
+
+from collections.abc import Awaitable, Callable
+import logging
+import math
+import random
+import threading
+import time
+import typing
+
+from flask import Flask, render_template
+
+from rate_limit import RateLimiter
+
+if typing.TYPE_CHECKING:
+    import httpx
+
+
+logger = logging.getLogger(__name__)
+
+T = typing.TypeVar("T")
+
+
+class FlickrUnavailable(Exception):
+    """
+    Raised when we can't reach Flickr, so we can't log anybody in.
+
+    ``retry_after`` is how long (in seconds) the user should wait before
+    they try again.
+    """
+
+    def __init__(self, retry_after: float) -> None:
+        super().__init__(f"Flickr is unavailable; retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+class FlickrRateLimited(FlickrUnavailable):
+    """
+    Raised when we've made too many calls to Flickr recently, so we
+    can't make another one yet.
+    """
+
+
+class FlickrServerError(Exception):
+    """
+    Raised when Flickr returns a 5xx error.
+    """
+
+    def __init__(self, status_code: int) -> None:
+        super().__init__(f"Flickr returned HTTP {status_code}")
+        self.status_code = status_code
+
+
+def raise_for_server_error(response: "httpx.Response") -> None:
+    """
+    An httpx event hook which turns a 5xx response from Flickr into
+    a :class:`FlickrServerError`, so we can retry it.
+
+    4xx errors (e.g. a bad signature) aren't Flickr's fault, and
+    retrying won't fix them, so we let them through as normal.
+    """
+    if response.status_code >= 500:
+        raise FlickrServerError(response.status_code)
+
+
+async def raise_for_server_error_async(response: "httpx.Response") -> None:
+    """
+    The async version of :func:`raise_for_server_error`.
+    """
+    raise_for_server_error(response)
+
+
+class CircuitBreaker:
+    """
+    A circuit breaker, which stops us calling Flickr if it keeps failing.
+
+    It has three states:
+
+    *   ``closed`` -- everything is fine, and calls go through as normal
+    *   ``open`` -- there have been ``failure_threshold`` failures in a
+        row, so we don't make any calls for ``reset_timeout`` seconds
+    *   ``half_open`` -- the timeout has passed, so we let a single call
+        through.  If it succeeds we close the breaker; if it fails we
+        open it again.
+    """
+
+    def __init__(self, *, failure_threshold: int, reset_timeout: float) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._lock = threading.Lock()
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._trial_in_progress = False
+
+    def allow(self) -> bool:
+        """
+        Returns True if we should go ahead and call Flickr.
+        """
+        with self._lock:
+            if self.state == "closed":
+                return True
+
+            if self.state == "open":
+                if time.monotonic() < self.opened_at + self.reset_timeout:
+                    return False
+
+                self.state = "half_open"
+                self._trial_in_progress = False
+
+            # We're half-open, so we let one call through to find out if
+            # Flickr has recovered, and everybody else waits for it.
+            if self._trial_in_progress:
+                return False
+
+            self._trial_in_progress = True
+            return True
+
+    def record_success(self) -> None:
+        """
+        Record a successful call, which closes the breaker.
+        """
+        with self._lock:
+            if self.state != "closed":
+                logger.warning("Flickr has recovered; closing the breaker")
+
+            self.state = "closed"
+            self.consecutive_failures = 0
+            self._trial_in_progress = False
+
+    def release_trial(self) -> None:
+        """
+        Give up the half-open trial without recording a result, e.g.
+        because the call was cancelled, so the next call can be the
+        trial instead.
+        """
+        with self._lock:
+            self._trial_in_progress = False
+
+    def record_failure(self) -> None:
+        """
+        Record a failed call, which may open the breaker.
+        """
+        with self._lock:
+            self.consecutive_failures += 1
+
+            if (
+                self.state == "half_open"
+                or self.consecutive_failures >= self.failure_threshold
+            ):
+                if self.state != "open":
+                    logger.warning(
+                        "Flickr calls are failing; opening the breaker for %ss",
+                        self.reset_timeout,
+                    )
+
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self._trial_in_progress = False
+
+    def retry_after(self) -> float:
+        """
+        How long (in seconds) until we'll try calling Flickr again.
+        """
+        if self.state != "open":
+            return 0
+
+        return max(self.opened_at + self.reset_timeout - time.monotonic(), 0)
+
+    def snapshot(self) -> dict[str, typing.Any]:
+        """
+        Return the state of the breaker, for monitoring.
+        """
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "retry_after": self.retry_after(),
+        }
+
+
+class FlickrCallPolicy:
+    """
+    Makes calls to Flickr with a deadline, retries and a circuit breaker.
+
+    Each call is a function which takes a timeout (in seconds), and
+    passes it to the HTTP client.
+
+    Calls which finish a login the user has already started should be
+    marked as ``urgent``, so they can use the rate limiter's reserve,
+    and calls which can wait should be marked as ``background``, so
+    they leave a bigger reserve (see ``rate_limit.py``).
+    Each call takes a token from the rate limiter's ``bucket`` for the
+    API key it uses.
+    """
+
+    def __init__(
+        self,
+        *,
+        breaker: CircuitBreaker,
+        limiter: RateLimiter | None,
+        deadline: float,
+        retries: int,
+        backoff: float,
+    ) -> None:
+        self.breaker = breaker
+        self.limiter = limiter
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+
+    def call(
+        self,
+        fn: Callable[[float], T],
+        *,
+        retry: bool,
+        urgent: bool = False,
+        background: bool = False,
+        bucket: str = "flickr",
+    ) -> T:
+        """
+        Call Flickr.  If ``retry`` is True, failed calls are retried
+        (if there's time before the deadline).
+        """
+        import httpx
+
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+
+        while True:
+            self.check_breaker()
+            self.check_rate_limit_or_release(
+                urgent=urgent, background=background, bucket=bucket
+            )
+
+            try:
+                result = fn(deadline - time.monotonic())
+            except (httpx.TransportError, FlickrServerError) as err:
+                self.breaker.record_failure()
+                delay = self.next_delay(attempt, deadline=deadline, retry=retry)
+
+                if delay is None:
+                    raise FlickrUnavailable(self.breaker.retry_after()) from err
+
+                time.sleep(delay)
+                attempt += 1
+            except Exception:
+                # Flickr replied, even if it wasn't the reply we wanted,
+                # so it's not down.
+                self.breaker.record_success()
+                raise
+            except BaseException:
+                # We gave up on the call (e.g. it was interrupted), so we
+                # don't know if Flickr is up.  If this was the half-open
+                # trial, we let the next call try instead -- otherwise
+                # the breaker would wait for this one forever.
+                self.breaker.release_trial()
+                raise
+            else:
+                self.breaker.record_success()
+                return result
+
+    async def call_async(
+        self,
+        fn: Callable[[float], Awaitable[T]],
+        *,
+        retry: bool,
+        urgent: bool = False,
+        background: bool = False,
+        bucket: str = "flickr",
+    ) -> T:
+        """
+        The async version of :meth:`call`.
+        """
+        import asyncio
+
+        import httpx
+
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+
+        while True:
+            self.check_breaker()
+            await self.check_rate_limit_or_release_async(
+                urgent=urgent, background=background, bucket=bucket
+            )
+
+            try:
+                result = await fn(deadline - time.monotonic())
+            except (httpx.TransportError, FlickrServerError) as err:
+                self.breaker.record_failure()
+                delay = self.next_delay(attempt, deadline=deadline, retry=retry)
+
+                if delay is None:
+                    raise FlickrUnavailable(self.breaker.retry_after()) from err
+
+                await asyncio.sleep(delay)
+                attempt += 1
+            except Exception:
+                self.breaker.record_success()
+                raise
+            except BaseException:
+                # e.g. the task was cancelled
+                self.breaker.release_trial()
+                raise
+            else:
+                self.breaker.record_success()
+                return result
+
+    def check_breaker(self) -> None:
+        """
+        Fail fast if the circuit breaker is open.
+        """
+        if not self.breaker.allow():
+            raise FlickrUnavailable(self.breaker.retry_after())
+
+    def check_rate_limit_or_release(
+        self, *, urgent: bool, background: bool, bucket: str
+    ) -> None:
+        """
+        Check the rate limit, after the breaker has let us through.
+
+        If we can't call Flickr after all (e.g. because we're rate
+        limited), that tells us nothing about whether Flickr is up, so
+        we give up our turn as the breaker's half-open trial.  Otherwise
+        the breaker would wait for the trial forever.
+        """
+        try:
+            self.check_rate_limit(urgent=urgent, background=background, bucket=bucket)
+        except BaseException:
+            self.breaker.release_trial()
+            raise
+
+    async def check_rate_limit_or_release_async(
+        self, *, urgent: bool, background: bool, bucket: str
+    ) -> None:
+        """
+        The async version of :meth:`check_rate_limit_or_release`.
+
+        The rate limiter may be shared through SQLite (see
+        ``rate_limit.py``), so we check it in a thread, rather than
+        block the event loop.
+        """
+        import asyncio
+
+        if self.limiter is None:
+            return
+
+        try:
+            await asyncio.to_thread(
+                self.check_rate_limit,
+                urgent=urgent,
+                background=background,
+                bucket=bucket,
+            )
+        except BaseException:
+            self.breaker.release_trial()
+            raise
+
+    def check_rate_limit(self, *, urgent: bool, background: bool, bucket: str) -> None:
+        """
+        Take a token from the rate limiter, or fail fast if there
+        aren't any left.
+        """
+        if self.limiter is None:
+            return
+
+        wait = self.limiter.acquire(urgent=urgent, background=background, bucket=bucket)
+
+        if wait > 0:
+            logger.warning("Rate limited: no calls to Flickr for %.1fs", wait)
+            raise FlickrRateLimited(wait)
+
+    def next_delay(self, attempt: int, *, deadline: float, retry: bool) -> float | None:
+        """
+        Return how long to wait before retrying a failed call, or None
+        if we should give up.
+
+        We wait for a random time between zero and an exponentially
+        increasing maximum ("full jitter"), so lots of failed logins
+        don't all retry at the same moment.
+        """
+        if not retry or attempt >= self.retries:
+            return None
+
+        delay = random.uniform(0, self.backoff * 2**attempt)
+
+        if time.monotonic() + delay >= deadline:
+            return None
+
+        return delay
+
+
+def handle_flickr_unavailable(
+    error: FlickrUnavailable,
+) -> tuple[str, int, dict[str, str]]:
+    """
+    Show a friendly error page if we can't reach Flickr.
+    """
+    headers = {"Retry-After": str(max(math.ceil(error.retry_after), 1))}
+    return render_template("flickr_unavailable.html"), 503, headers
+
+
+def init_app(app: Flask) -> FlickrCallPolicy:
+    """
+    Create the call policy for an app, using the settings in the app config,
+    and the rate limiter from ``rate_limit.init_app``.
+
+    The policy is saved in ``app.extensions["flickr_call_policy"]``.
+    """
+    # How long (in seconds) each step of the login flow can spend
+    # talking to Flickr, including any retries.
+    app.config.setdefault("FLICKR_DEADLINE", 10.0)
+
+    # How many times to retry getting a request token, and the base
+    # delay (in seconds) between retries, which doubles each time.
+    app.config.setdefault("FLICKR_REQUEST_TOKEN_RETRIES", 2)
+    app.config.setdefault("FLICKR_RETRY_BACKOFF", 0.1)
+
+    # How many failures in a row open the circuit breaker, and how long
+    # (in seconds) it stays open.
+    app.config.setdefault("FLICKR_BREAKER_FAILURE_THRESHOLD", 5)
+    app.config.setdefault("FLICKR_BREAKER_RESET_TIMEOUT", 30.0)
+
+    policy = FlickrCallPolicy(
+        breaker=CircuitBreaker(
+            failure_threshold=app.config["FLICKR_BREAKER_FAILURE_THRESHOLD"],
+            reset_timeout=app.config["FLICKR_BREAKER_RESET_TIMEOUT"],
+        ),
+        limiter=app.extensions["flickr_rate_limiter"],
+        deadline=app.config["FLICKR_DEADLINE"],
+        retries=app.config["FLICKR_REQUEST_TOKEN_RETRIES"],
+        backoff=app.config["FLICKR_RETRY_BACKOFF"],
+    )
+
+    app.extensions["flickr_call_policy"] = policy
+    app.register_error_handler(FlickrUnavailable, handle_flickr_unavailable)
+
+    return policy
@@ -0,0 +1,224 @@
+"""
+A shared, pooled HTTP transport for talking to Flickr.
+
+Every ``OAuth1Client`` is a thin wrapper around an httpx transport, and
+it's the transport that owns the connection pool.  If we create a new
+transport for every request, every login pays for a fresh TCP and TLS
+handshake with www.flickr.com -- which is slow, and gets slower when lots
+of people log in at once.
+
+Instead, we create one transport per worker process, and every OAuth
+client in that process reuses it.  Connections are kept alive between
+requests, so most logins can reuse a connection that's already open.
+
+We don't import httpx (or asyncio) until we first need a transport, so
+worker processes that never talk to Flickr don't pay for them.
+
+See https://www.python-httpx.org/advanced/transports/
+"""
+
+import atexit
+import os
+import threading
+import typing
+import weakref
+
+from flask import Flask
+
+if typing.TYPE_CHECKING:
+    import asyncio
+
+    import httpx
+
+
+class PoolSettings:
+    """
+    The connection pool settings for a shared transport.
+
+    The defaults are the same as httpx's.
+
+    See https://www.python-httpx.org/advanced/resource-limits/
+    """
+
+    def __init__(
+        self,
+        *,
+        max_connections: int | None = None,
+        max_keepalive_connections: int | None = None,
+        keepalive_expiry: float | None = 5.0,
+        http2: bool = False,
+    ) -> None:
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.http2 = http2
+
+    @property
+    def limits(self) -> "httpx.Limits":
+        """
+        The pool limits, as an httpx ``Limits`` object.
+        """
+        import httpx
+
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+
+
+class SharedTransport(PoolSettings):
+    """
+    An httpx transport which is created once per worker process, and
+    shared by every OAuth client in that process.
+
+    This is safe to use with pre-forking servers like gunicorn.  If the
+    app is created in a parent process and then forked, each child
+    notices that it's running in a new process and creates its own
+    transport, rather than sharing sockets with its parent.
+    """
+
+    def __init__(self, **settings: typing.Any) -> None:
+        super().__init__(**settings)
+
+        self._lock = threading.Lock()
+        self._transport: "httpx.HTTPTransport | None" = None
+        self._pid: int | None = None
+
+        _instances.add(self)
+
+    def get(self) -> "httpx.HTTPTransport":
+        """
+        Return the transport for the current process, creating it if
+        this is the first time we've needed it.
+        """
+        import httpx
+
+        pid = os.getpid()
+
+        with self._lock:
+            # If we've been forked, the transport belongs to our parent.
+            # Its connections are sockets we share with the parent, so we
+            # mustn't use or close them -- just forget about them, and
+            # open our own.
+            if self._transport is None or self._pid != pid:
+                self._transport = httpx.HTTPTransport(
+                    limits=self.limits, http2=self.http2
+                )
+                self._pid = pid
+
+            return self._transport
+
+    def close(self) -> None:
+        """
+        Close any open connections owned by this process.
+        """
+        with self._lock:
+            if self._transport is not None and self._pid == os.getpid():
+                self._transport.close()
+
+            self._transport = None
+            self._pid = None
+
+
+# Every SharedTransport in this process, so we can close them when it
+# exits.  This holds them weakly, so an app that's been thrown away
+# (e.g. in the tests) doesn't keep its transport alive.
+_instances: "weakref.WeakSet[SharedTransport]" = weakref.WeakSet()
+
+
+def close_all() -> None:
+    """
+    Close all the shared transports in this process.
+    """
+    for transport in list(_instances):
+        transport.close()
+
+
+atexit.register(close_all)
+
+
+class SharedAsyncTransport(PoolSettings):
+    """
+    The async equivalent of :class:`SharedTransport`, for the async
+    login views that run under an ASGI server.
+
+    Async connections belong to the event loop that opened them, so we
+    keep one transport per event loop.  An ASGI server runs a single loop
+    per worker process, so in practice this is one transport per worker.
+    """
+
+    def __init__(self, **settings: typing.Any) -> None:
+        super().__init__(**settings)
+
+        self._transports: weakref.WeakKeyDictionary[
+            "asyncio.AbstractEventLoop", "httpx.AsyncHTTPTransport"
+        ] = weakref.WeakKeyDictionary()
+
+    def get(self) -> "httpx.AsyncHTTPTransport":
+        """
+        Return the transport for the running event loop, creating it if
+        this is the first time we've needed it.
+        """
+        import asyncio
+
+        import httpx
+
+        loop = asyncio.get_running_loop()
+
+        try:
+            return self._transports[loop]
+        except KeyError:
+            transport = httpx.AsyncHTTPTransport(limits=self.limits, http2=self.http2)
+            self._transports[loop] = transport
+            return transport
+
+    async def aclose(self) -> None:
+        """
+        Close any open connections owned by the running event loop.
+        """
+        import asyncio
+
+        transport = self._transports.pop(asyncio.get_running_loop(), None)
+
+        if transport is not None:
+            await transport.aclose()
+
+
+def init_app(app: Flask) -> SharedTransport:
+    """
+    Create the shared transport for an app, using the pool settings in
+    the app config.
+
+    The transport is stored in ``app.extensions["flickr_http"]``, and
+    closed cleanly when the process exits.
+    """
+    # How many connections can be open to Flickr at once, how many of
+    # them we keep around when idle, and for how long (in seconds).
+    #
+    # See https://www.python-httpx.org/advanced/resource-limits/
+    app.config.setdefault("FLICKR_HTTP_MAX_CONNECTIONS", 20)
+    app.config.setdefault("FLICKR_HTTP_MAX_KEEPALIVE_CONNECTIONS", 10)
+    app.config.setdefault("FLICKR_HTTP_KEEPALIVE_EXPIRY", 30.0)
+
+    # HTTP/2 lets many requests share a single connection, but it needs
+    # an extra dependency -- install ``httpx[http2]`` to use it.
+    app.config.setdefault("FLICKR_HTTP2", False)
+
+    settings = {
+        "max_connections": app.config["FLICKR_HTTP_MAX_CONNECTIONS"],
+        "max_keepalive_connections": app.config[
+            "FLICKR_HTTP_MAX_KEEPALIVE_CONNECTIONS"
+        ],
+        "keepalive_expiry": app.config["FLICKR_HTTP_KEEPALIVE_EXPIRY"],
+        "http2": app.config["FLICKR_HTTP2"],
+    }
+
+    transport = SharedTransport(**settings)
+    app.extensions["flickr_http"] = transport
+
+    # The async transport is only used if the app is served by an ASGI
+    # server (see ``asgi.py``), and it's closed when that server shuts down.
+    app.extensions["flickr_http_async"] = SharedAsyncTransport(**settings)
+
+    return transport
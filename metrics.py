@@ -0,0 +1,479 @@
+"""
+Metrics for the app, in the Prometheus text format.
+
+We record:
+
+*   how long each request took, as a histogram for each route
+*   how many requests we've handled, by route and status code
+*   how long each step of the login flow spent talking to Flickr
+*   how long background jobs waited and ran (see ``background_jobs.py``)
+
+and serve them at ``/metrics``, where Prometheus can scrape them.
+
+Recording a metric happens on every request, so it needs to be cheap.
+Each thread keeps its own counts, so recording never waits for a lock --
+we only add them up when somebody asks for ``/metrics``.  (On the event
+loop, all the async views share one thread, which is fine because they
+don't record anything concurrently.)
+
+If you run several worker processes (e.g. with gunicorn), each worker
+only knows about the requests it handled itself.  To see the totals for
+every worker, set ``METRICS_DIR`` to a directory they share.  Every
+worker writes its counts to a file in that directory once a second,
+and ``/metrics`` adds up all the files.  You should empty the directory
+when you restart the app.
+
+See https://prometheus.io/docs/instrumenting/exposition_formats/
+"""
+
+from collections.abc import Iterator
+import bisect
+import contextlib
+import glob
+import json
+import os
+import threading
+import time
+import weakref
+
+from flask import Flask, Response, current_app, g, request
+
+import tracing
+
+
+# The upper bounds (in seconds) of the histogram buckets.  There's also
+# an implicit +Inf bucket for anything slower.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# The metrics we record, with their type and a description.
+METRICS = {
+    "http_requests_total": (
+        "counter",
+        "The number of HTTP requests, by route, method and status code.",
+    ),
+    "http_request_duration_seconds": (
+        "histogram",
+        "How long it took to handle an HTTP request.",
+    ),
+    "flickr_call_duration_seconds": (
+        "histogram",
+        "How long each step of the login flow spent talking to Flickr.",
+    ),
+    "background_job_wait_seconds": (
+        "histogram",
+        "How long a background job waited in the queue before it started.",
+    ),
+    "background_job_duration_seconds": (
+        "histogram",
+        "How long it took to run a background job.",
+    ),
+    "background_jobs_dropped_total": (
+        "counter",
+        "The number of background jobs we dropped because the queue was full.",
+    ),
+    "flickr_admission_wait_seconds": (
+        "histogram",
+        "How long a login waited for a turn to call Flickr.",
+    ),
+    "flickr_admission_shed_total": (
+        "counter",
+        "The number of logins we turned away because too many were waiting for Flickr.",
+    ),
+    "session_revocation_lookups_total": (
+        "counter",
+        "The number of sessions we looked up in the revocation database.",
+    ),
+}
+
+# The HTTP methods we label separately; anything else is "other", so
+# clients can't create an unlimited number of series.
+HTTP_METHODS = {"GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"}
+
+Labels = tuple[tuple[str, str], ...]
+
+# The values recorded for each series, keyed by metric name and labels.
+#
+# A counter has a single value.  A histogram has the number of values
+# in each bucket (not cumulative), then the sum and count.
+Samples = dict[tuple[str, Labels], list[float]]
+
+
+class Metrics:
+    """
+    Records metrics for one process, with a separate set of samples for
+    each thread.
+    """
+
+    def __init__(self, *, directory: str | None, flush_interval: float) -> None:
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.pid = os.getpid()
+
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._threads: list[tuple[threading.Thread, Samples]] = []
+
+        # The samples from threads which have finished
+        self._retired: Samples = {}
+
+        self._flusher: threading.Thread | None = None
+        self._stopped = threading.Event()
+
+        _instances.add(self)
+
+    def increment(self, name: str, labels: Labels) -> None:
+        """
+        Add one to a counter.
+        """
+        self._series(name, labels, size=1)[0] += 1
+
+    def observe(self, name: str, labels: Labels, value: float) -> None:
+        """
+        Record a value in a histogram.
+        """
+        series = self._series(name, labels, size=len(BUCKETS) + 3)
+
+        series[bisect.bisect_left(BUCKETS, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def _series(self, name: str, labels: Labels, *, size: int) -> list[float]:
+        """
+        Return the values for a series in the current thread's samples.
+        """
+        try:
+            samples: Samples = self._local.samples
+        except AttributeError:
+            samples = self._start_thread()
+
+        try:
+            return samples[(name, labels)]
+        except KeyError:
+            series = samples[(name, labels)] = [0.0] * size
+            return series
+
+    def _start_thread(self) -> Samples:
+        """
+        Create the samples for the current thread.
+
+        This is also where we start the thread that writes our samples
+        to ``METRICS_DIR``, so it starts in the worker process, after
+        any fork.
+        """
+        samples: Samples = {}
+
+        with self._lock:
+            self._threads.append((threading.current_thread(), samples))
+
+            if self.directory is not None and self._flusher is None:
+                self._flusher = threading.Thread(
+                    target=self._run_flusher, name="metrics-flusher", daemon=True
+                )
+                self._flusher.start()
+
+        self._local.samples = samples
+        return samples
+
+    def collect(self) -> Samples:
+        """
+        Add up the samples from every thread in this process.
+        """
+        totals: Samples = {}
+
+        with self._lock:
+            running = []
+
+            for thread, samples in self._threads:
+                if thread.is_alive():
+                    running.append((thread, samples))
+                else:
+                    merge_samples(self._retired, samples)
+
+            self._threads = running
+
+            merge_samples(totals, self._retired)
+            for _, samples in running:
+                merge_samples(totals, samples)
+
+        return totals
+
+    def gather(self) -> Samples:
+        """
+        Add up the samples from every worker process, if we have
+        a shared ``METRICS_DIR``, or just this process if not.
+        """
+        if self.directory is None:
+            return self.collect()
+
+        self.flush()
+
+        totals: Samples = {}
+
+        for path in glob.glob(os.path.join(self.directory, "metrics-*.json")):
+            with open(path) as in_file:
+                merge_samples(
+                    totals,
+                    {
+                        (name, tuple((k, v) for k, v in labels)): values
+                        for name, labels, values in json.load(in_file)
+                    },
+                )
+
+        return totals
+
+    def flush(self) -> None:
+        """
+        Write this process's samples to ``METRICS_DIR``.
+
+        We write to a temporary file and then rename it, so other workers
+        never see a half-written file.
+        """
+        assert self.directory is not None
+
+        path = os.path.join(self.directory, f"metrics-{self.pid}.json")
+        tmp_path = f"{path}.tmp"
+
+        with open(tmp_path, "w") as out_file:
+            json.dump(
+                [
+                    [name, labels, values]
+                    for (name, labels), values in self.collect().items()
+                ],
+                out_file,
+            )
+
+        os.replace(tmp_path, path)
+
+    def stop(self) -> None:
+        """
+        Stop the thread that writes samples to ``METRICS_DIR``.
+        """
+        self._stopped.set()
+
+        if self._flusher is not None:
+            self._flusher.join()
+
+    def _run_flusher(self) -> None:
+        """
+        Write our samples to ``METRICS_DIR`` every ``flush_interval``
+        seconds, until we're stopped.
+        """
+        while not self._stopped.wait(timeout=self.flush_interval):
+            self.flush()
+
+    def _after_fork(self) -> None:
+        """
+        Forget everything we've recorded, in a newly forked process.
+
+        The parent's samples belong to the parent -- if we kept them,
+        every worker would count them again.
+        """
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._threads = []
+        self._retired = {}
+        self._flusher = None
+
+
+# Every Metrics object in this process, so we can reset them after a fork.
+_instances: "weakref.WeakSet[Metrics]" = weakref.WeakSet()
+
+
+def reset_after_fork() -> None:
+    """
+    Reset all the metrics in a newly forked process.
+    """
+    for metrics in _instances:
+        metrics._after_fork()
+
+
+os.register_at_fork(after_in_child=reset_after_fork)
+
+
+def merge_samples(totals: Samples, samples: Samples) -> None:
+    """
+    Add the values in ``samples`` to ``totals``.
+    """
+    # We copy the items first, because another thread might add a new
+    # series while we're reading.
+    for key, values in list(samples.items()):
+        try:
+            total = totals[key]
+        except KeyError:
+            total = totals[key] = [0.0] * len(values)
+
+        for i, value in enumerate(values):
+            total[i] += value
+
+
+def render_prometheus(samples: Samples) -> str:
+    """
+    Render a set of samples in the Prometheus text format, e.g.
+
+        # HELP http_requests_total The number of HTTP requests, …
+        # TYPE http_requests_total counter
+        http_requests_total{method="GET",route="/",status="200"} 3
+
+    """
+    lines = []
+
+    for name, (kind, description) in METRICS.items():
+        series = sorted(
+            (labels, values) for (n, labels), values in samples.items() if n == name
+        )
+
+        if not series:
+            continue
+
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+
+        for labels, values in series:
+            if kind == "counter":
+                lines.append(
+                    f"{name}{format_labels(labels)} {format_number(values[0])}"
+                )
+                continue
+
+            # Prometheus buckets are cumulative -- each one counts every
+            # value less than or equal to its upper bound.
+            cumulative = 0.0
+
+            for bound, count in zip([*map(str, BUCKETS), "+Inf"], values):
+                cumulative += count
+                bucket_labels = format_labels(labels + (("le", bound),))
+                lines.append(
+                    f"{name}_bucket{bucket_labels} {format_number(cumulative)}"
+                )
+
+            lines.append(
+                f"{name}_sum{format_labels(labels)} {format_number(values[-2])}"
+            )
+            lines.append(
+                f"{name}_count{format_labels(labels)} {format_number(values[-1])}"
+            )
+
+    return "".join(line + "\n" for line in lines)
+
+
+def format_labels(labels: Labels) -> str:
+    """
+    Format a set of labels, e.g. ``{method="GET",route="/"}``.
+    """
+    if not labels:
+        return ""
+
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    )
+
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def format_number(value: float) -> str:
+    """
+    Format a sample value, without a trailing ``.0`` on whole numbers.
+    """
+    if value.is_integer():
+        return str(int(value))
+    else:
+        return repr(value)
+
+
+@contextlib.contextmanager
+def time_flickr_call(step: str) -> Iterator[None]:
+    """
+    Record how long a step of the login flow spent talking to Flickr,
+    e.g. ``fetch_request_token``, and whether it succeeded.
+
+    If we're tracing this login, we also record it as a span.
+    """
+    metrics: Metrics = current_app.extensions["metrics"]
+
+    start = time.perf_counter()
+    outcome = "error"
+
+    try:
+        yield
+        outcome = "success"
+    finally:
+        duration = time.perf_counter() - start
+
+        metrics.observe(
+            "flickr_call_duration_seconds",
+            (("outcome", outcome), ("step", step)),
+            duration,
+        )
+
+        # If we're tracing this login, it gets a span for this step,
+        # using the same timings -- see ``tracing.py``.
+        tracing.record_span(
+            f"flickr.{step}", started_at=start, duration=duration, outcome=outcome
+        )
+
+
+def start_timer() -> None:
+    """
+    Note when we started handling a request.
+    """
+    g._metrics_started_at = time.perf_counter()
+
+
+def record_request(response: Response) -> Response:
+    """
+    Record how long we took to handle a request, and its status code.
+    """
+    started_at = g.pop("_metrics_started_at", None)
+
+    # If another ``before_request`` function failed before ours ran,
+    # we don't know when the request started.
+    if started_at is None:
+        return response
+
+    metrics: Metrics = current_app.extensions["metrics"]
+
+    # We label requests with the URL rule (e.g. ``/callback``) rather
+    # than the path, so there's one series per route, not per URL.
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    method = request.method if request.method in HTTP_METHODS else "other"
+
+    metrics.observe(
+        "http_request_duration_seconds",
+        (("method", method), ("route", route)),
+        time.perf_counter() - started_at,
+    )
+    metrics.increment(
+        "http_requests_total",
+        (("method", method), ("route", route), ("status", str(response.status_code))),
+    )
+
+    return response
+
+
+def init_app(app: Flask) -> Metrics:
+    """
+    Start recording metrics for an app, using the settings in the
+    app config.
+
+    The metrics are saved in ``app.extensions["metrics"]``.
+    """
+    # A directory shared by all the worker processes, where they write
+    # their metrics so ``/metrics`` can add them up.  If this is None,
+    # ``/metrics`` only reports the process that handles the request.
+    app.config.setdefault("METRICS_DIR", None)
+
+    # How often (in seconds) each worker writes its metrics to METRICS_DIR
+    app.config.setdefault("METRICS_FLUSH_INTERVAL", 1.0)
+
+    metrics = Metrics(
+        directory=app.config["METRICS_DIR"],
+        flush_interval=app.config["METRICS_FLUSH_INTERVAL"],
+    )
+
+    app.extensions["metrics"] = metrics
+    app.before_request(start_timer)
+    app.after_request(record_request)
+
+    return metrics
@@ -0,0 +1,242 @@
+"""
+Fast rendering for the app's HTML pages.
+
+Most page views are the same page, shown to the same person, again and
+again.  Rather than build the HTML from scratch every time, we:
+
+*   compile each template once, and look up the page URLs once
+*   keep the rendered (and compressed) HTML in an in-memory cache
+*   tag each page with an ETag, so a browser which already has the
+    latest version gets a tiny ``304 Not Modified`` response instead
+
+Pages which are too long to build in memory, like a list of every photo
+a user has, can be streamed instead -- see :func:`stream_page`.
+
+See https://developer.mozilla.org/en-US/docs/Web/HTTP/Guides/Conditional_requests
+"""
+
+import gzip
+import hashlib
+import json
+import typing
+
+from flask import Flask, Response, current_app, request, url_for
+import jinja2
+
+from cache import TTLCache
+
+try:
+    import brotli  # type: ignore[import-untyped]
+except ImportError:  # pragma: no cover
+    brotli = None
+
+
+class PageRenderer:
+    """
+    Renders the app's pages from precompiled templates, with caching
+    and conditional GET support.
+    """
+
+    def __init__(
+        self, app: Flask, *, cache_size: int, cache_ttl: float, compress_min_size: int
+    ) -> None:
+        self.app = app
+        self.compress_min_size = compress_min_size
+
+        # The compiled templates and a hash of their source, which we
+        # use in the ETags -- so if the template changes, so does the ETag.
+        self._templates: dict[str, tuple[jinja2.Template, str]] = {}
+
+        # The URLs used in the pages, keyed by the app's script root.
+        self._urls: dict[str, dict[str, str]] = {}
+
+        # Rendered pages, keyed by ETag and content encoding.
+        self._bodies: TTLCache[tuple[str, str], bytes] = TTLCache(
+            max_size=cache_size, ttl=cache_ttl
+        )
+
+    def template(self, name: str) -> tuple[jinja2.Template, str]:
+        """
+        Return the compiled template with this name, and a hash of
+        its source.
+        """
+        try:
+            return self._templates[name]
+        except KeyError:
+            env = self.app.jinja_env
+            assert env.loader is not None
+
+            source, _, _ = env.loader.get_source(env, name)
+            version = hashlib.sha256(source.encode("utf8")).hexdigest()
+
+            self._templates[name] = (env.get_template(name), version)
+            return self._templates[name]
+
+    def urls(self) -> dict[str, str]:
+        """
+        Return the URLs of every page in the app.
+        """
+        try:
+            return self._urls[request.script_root]
+        except KeyError:
+            self._urls[request.script_root] = {
+                endpoint: url_for(endpoint)
+                for endpoint in ("homepage", "authorize", "logout", "secret", "photos")
+            }
+            return self._urls[request.script_root]
+
+    def render(self, template_name: str, /, **context: str) -> Response:
+        """
+        Render a page, or return ``304 Not Modified`` if the browser
+        already has the latest version.
+
+        The ETag depends on the template and its context, so we can
+        check it without rendering the page.
+        """
+        template, version = self.template(template_name)
+
+        key = json.dumps([template_name, version, request.script_root, context])
+        etag = hashlib.sha256(key.encode("utf8")).hexdigest()[:32]
+
+        response = current_app.response_class(mimetype="text/html")
+
+        # Browsers should check with us before reusing a page, and
+        # shared caches shouldn't store it -- the content depends on
+        # who's logged in.
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response.vary.update(["Cookie", "Accept-Encoding"])
+
+        # If the browser already has this page (in any encoding), we
+        # can tell it to reuse that copy.
+        for suffix in ("", "-gzip", "-br"):
+            if request.if_none_match.contains(etag + suffix):
+                response.set_etag(etag + suffix)
+                response.status_code = 304
+                return response
+
+        body = self._bodies.get((etag, "identity"))
+
+        if body is None:
+            body = template.render(urls=self.urls(), **context).encode("utf8")
+            self._bodies.set((etag, "identity"), body)
+
+        encoding = self.choose_encoding(body)
+
+        if encoding != "identity":
+            compressed = self._bodies.get((etag, encoding))
+
+            if compressed is None:
+                compressed = compress(body, encoding)
+                self._bodies.set((etag, encoding), compressed)
+
+            body = compressed
+            response.content_encoding = encoding
+            etag = f"{etag}-{encoding}"
+
+        response.set_etag(etag)
+        response.set_data(body)
+
+        return response
+
+    def stream(self, template_name: str, /, **context: typing.Any) -> Response:
+        """
+        Render a page bit by bit, sending each bit to the browser as
+        soon as it's ready.
+
+        The template can loop over an iterator in ``context``, and we
+        only pull items from it as we render them.  The page isn't
+        cached or compressed, because we never have all of it at once.
+
+        The template is rendered after the view returns, outside the
+        request context, so everything it needs must be in ``context``.
+        """
+        template, _ = self.template(template_name)
+
+        # Jinja yields lots of tiny strings; gather them into chunks of
+        # a few rows each, so we don't send a packet for every one.
+        stream = template.stream(urls=self.urls(), **context)
+        stream.enable_buffering(size=50)
+
+        response = current_app.response_class(
+            (chunk.encode("utf8") for chunk in stream), mimetype="text/html"
+        )
+
+        response.cache_control.private = True
+        response.cache_control.no_store = True
+        response.vary.add("Cookie")
+
+        return response
+
+    def choose_encoding(self, body: bytes) -> str:
+        """
+        Choose how to compress a page, based on its size and the
+        encodings that the browser accepts.
+        """
+        if len(body) < self.compress_min_size:
+            return "identity"
+
+        if brotli is not None and request.accept_encodings["br"]:
+            return "br"
+
+        if request.accept_encodings["gzip"]:
+            return "gzip"
+
+        return "identity"
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    """
+    Compress a page body with gzip or Brotli.
+    """
+    if encoding == "br":
+        compressed: bytes = brotli.compress(body)
+        return compressed
+
+    # Setting mtime=0 means we always get the same bytes for the
+    # same page, which is what a strong ETag promises.
+    return gzip.compress(body, mtime=0)
+
+
+def render_page(template_name: str, /, **context: str) -> Response:
+    """
+    Render one of the app's pages.
+    """
+    renderer: PageRenderer = current_app.extensions["pages"]
+    return renderer.render(template_name, **context)
+
+
+def stream_page(template_name: str, /, **context: typing.Any) -> Response:
+    """
+    Render one of the app's pages as a stream.
+    """
+    renderer: PageRenderer = current_app.extensions["pages"]
+    return renderer.stream(template_name, **context)
+
+
+def init_app(app: Flask) -> PageRenderer:
+    """
+    Create the page renderer for an app, using the settings in the
+    app config.
+
+    The renderer is saved in ``app.extensions["pages"]``.
+    """
+    # How many rendered pages to keep in memory, and for how long
+    # (in seconds)
+    app.config.setdefault("PAGE_CACHE_SIZE", 10_000)
+    app.config.setdefault("PAGE_CACHE_TTL", 60 * 60)
+
+    # Only compress pages that are at least this big (in bytes) -- for
+    # very small pages, it isn't worth the effort.
+    app.config.setdefault("COMPRESS_MIN_SIZE", 500)
+
+    renderer = PageRenderer(
+        app,
+        cache_size=app.config["PAGE_CACHE_SIZE"],
+        cache_ttl=app.config["PAGE_CACHE_TTL"],
+        compress_min_size=app.config["COMPRESS_MIN_SIZE"],
+    )
+
+    app.extensions["pages"] = renderer
+
+    return renderer
@@ -0,0 +1,111 @@
+"""
+Reuse the request token when somebody clicks "log in" more than once.
+
+People double-click the "log in" link, or go back and click it again,
+or refresh the page while they're being sent to Flickr.  Every click
+on /authorize used to get a new request token from Flickr -- a slow
+round trip, which also counts towards our rate limit (see
+``rate_limit.py``).
+
+Instead, once we've got a request token for a browser, we remember it
+in the session for a short while.  If the same browser comes back to
+/authorize in that time, we send it to Flickr with the same token,
+without calling Flickr again.  (The token is still in the request token
+store, so the callback works whichever tab the user approves it in.)
+
+If the same browser sends several requests at once, before any of
+them have finished, they share the same call to Flickr, using
+``singleflight.py``.  We can only recognise a browser that already
+has a session cookie -- two requests from a brand new visitor look
+like two different people, and we mustn't give two people the same
+request token.
+"""
+
+import secrets
+import time
+
+from flask import Flask, session
+
+from singleflight import AsyncSingleFlight, SingleFlight
+from token_store import RequestToken
+
+
+class PendingLogins:
+    """
+    Remembers the request token for each browser's login, for up to
+    ``window`` seconds.
+    """
+
+    def __init__(self, *, window: float) -> None:
+        self.window = window
+
+        self.flight: SingleFlight[tuple[str, str], RequestToken] = SingleFlight()
+        self.async_flight: AsyncSingleFlight[tuple[str, str], RequestToken] = (
+            AsyncSingleFlight()
+        )
+
+    def get(self, callback_url: str) -> RequestToken | None:
+        """
+        Return the request token we got for this browser recently, or
+        None if there isn't one.
+        """
+        pending = session.get("pending_login")
+
+        if (
+            pending is None
+            or pending["callback_url"] != callback_url
+            or pending["fetched_at"] + self.window <= time.time()
+        ):
+            return None
+
+        return {"oauth_token": pending["oauth_token"]}
+
+    def remember(self, request_token: RequestToken, callback_url: str) -> None:
+        """
+        Remember the request token we got for this browser.
+
+        We only keep the ``oauth_token`` -- which Flickr will show to
+        the user anyway -- and not its secret, which stays on the server.
+        """
+        session["pending_login"] = {
+            "oauth_token": request_token["oauth_token"],
+            "callback_url": callback_url,
+            "fetched_at": time.time(),
+        }
+
+    def forget(self) -> None:
+        """
+        Forget the request token for this browser, e.g. because it's
+        been used to log in, and can't be used again.
+        """
+        session.pop("pending_login", None)
+
+    def flight_key(self, callback_url: str) -> tuple[str, str]:
+        """
+        Return a key which identifies this browser's login, so we can
+        collapse concurrent requests from the same browser.
+
+        If the browser doesn't have a session yet, this is a new random
+        value, so its requests are never collapsed with anybody else's.
+        """
+        login_id: str = session.setdefault("login_id", secrets.token_urlsafe(16))
+        return (login_id, callback_url)
+
+
+def init_app(app: Flask) -> PendingLogins:
+    """
+    Create the pending logins tracker for an app, using the settings in
+    the app config.
+
+    It's saved in ``app.extensions["pending_logins"]``.
+    """
+    # How long (in seconds) to reuse a request token if the same browser
+    # comes back to /authorize.  This should be well below the time we
+    # keep request tokens in the store (``REQUEST_TOKEN_TTL``).
+    app.config.setdefault("PENDING_LOGIN_WINDOW", 60.0)
+
+    pending_logins = PendingLogins(window=app.config["PENDING_LOGIN_WINDOW"])
+
+    app.extensions["pending_logins"] = pending_logins
+
+    return pending_logins
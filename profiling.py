@@ -0,0 +1,174 @@
+"""
+Profile a sample of live requests, to see where the time goes.
+
+If a login suddenly gets slow, it helps to know whether the time is
+going into signing OAuth requests, loading the session, or our own
+views.  When profiling is turned on, we run a sample of requests under
+:mod:`cProfile`, and save a profile for each one, e.g.
+
+    profiles/20250101T120000.123456-GET-authorize-152ms.prof
+
+You can look at a profile with ``python -m pstats``, or a viewer like
+SnakeViz (https://jiffyclub.github.io/snakeviz/).
+
+There are two ways to choose which requests get profiled:
+
+*   set ``PROFILE_SAMPLE_RATE`` to profile a random fraction of requests
+*   set ``PROFILE_SECRET``, and send a request with the header
+    ``X-Profile-Request: <secret>`` to profile that request
+
+Profiling is off unless you set ``PROFILE_DIR``, and when it's off we
+don't add anything to the request path at all.
+
+Some caveats:
+
+*   Only one request is profiled at a time; if another request is being
+    profiled, we skip this one.  (From Python 3.12, only one profiler
+    can be running in a process.)
+*   The profiler sees everything the process is doing, so if other
+    requests are running at the same time -- in other threads, or on
+    the event loop with the async views -- they'll be in the profile too.
+"""
+
+import cProfile
+import datetime
+import hmac
+import os
+import random
+import re
+import threading
+import time
+
+from flask import Flask, current_app, g, request
+
+
+class RequestProfiler:
+    """
+    Decides which requests to profile, and saves their profiles.
+    """
+
+    def __init__(
+        self, *, directory: str, sample_rate: float, secret: str | None
+    ) -> None:
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.secret = secret
+
+        # Held while a request is being profiled
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+
+    def should_profile(self) -> bool:
+        """
+        Returns True if we should profile the current request.
+        """
+        header = request.headers.get("X-Profile-Request")
+
+        if header is not None and self.secret is not None:
+            # Use a constant-time comparison, so the time we take doesn't
+            # leak how much of the secret somebody guessed correctly.
+            if hmac.compare_digest(header.encode("utf8"), self.secret.encode("utf8")):
+                return True
+
+        return random.random() < self.sample_rate
+
+    def start(self) -> None:
+        """
+        Start profiling the current request, if we should and if no other
+        request is being profiled.
+        """
+        if not self.should_profile() or not self._lock.acquire(blocking=False):
+            return
+
+        profile = cProfile.Profile()
+
+        try:
+            profile.enable()
+        except ValueError:  # pragma: no cover
+            # Another profiler is running (e.g. you're already running
+            # the whole app under a profiler), so we leave it alone.
+            self._lock.release()
+            return
+
+        g._profile = (profile, time.perf_counter())
+
+    def stop(self) -> None:
+        """
+        Stop profiling the current request, and save its profile.
+        """
+        try:
+            profile, started_at = g.pop("_profile")
+        except KeyError:
+            return
+
+        try:
+            profile.disable()
+        finally:
+            self._lock.release()
+
+        elapsed_ms = (time.perf_counter() - started_at) * 1000
+        profile.dump_stats(os.path.join(self.directory, self.filename(elapsed_ms)))
+
+    def filename(self, elapsed_ms: float) -> str:
+        """
+        Choose a filename for the profile of the current request, which
+        includes the time, the route and how long it took.
+        """
+        timestamp = datetime.datetime.now().strftime("%Y%m%dT%H%M%S.%f")
+
+        # We use the name of the view (e.g. ``authorize``) rather than the
+        # path, so the filenames don't include anything from the URL.
+        route = re.sub(r"[^A-Za-z0-9_.]", "_", request.endpoint or "unmatched")
+
+        return f"{timestamp}-{request.method}-{route}-{elapsed_ms:.0f}ms.prof"
+
+
+def start_profiling() -> None:
+    """
+    Start profiling a request, if it's been chosen.
+    """
+    profiler: RequestProfiler = current_app.extensions["profiler"]
+    profiler.start()
+
+
+def stop_profiling(error: BaseException | None) -> None:
+    """
+    Stop profiling a request, if we were profiling it.
+    """
+    profiler: RequestProfiler = current_app.extensions["profiler"]
+    profiler.stop()
+
+
+def init_app(app: Flask) -> RequestProfiler | None:
+    """
+    Set up profiling for an app, using the settings in the app config,
+    or return None if profiling is turned off.
+
+    The profiler is saved in ``app.extensions["profiler"]``.
+    """
+    # Where to save the profiles.  If this is None, profiling is off.
+    app.config.setdefault("PROFILE_DIR", None)
+
+    # The fraction of requests to profile, from 0 (none) to 1 (all)
+    app.config.setdefault("PROFILE_SAMPLE_RATE", 0.01)
+
+    # If this is set, any request with an ``X-Profile-Request`` header
+    # that matches this secret will be profiled.
+    app.config.setdefault("PROFILE_SECRET", None)
+
+    if app.config["PROFILE_DIR"] is None:
+        app.extensions["profiler"] = None
+        return None
+
+    profiler = RequestProfiler(
+        directory=app.config["PROFILE_DIR"],
+        sample_rate=app.config["PROFILE_SAMPLE_RATE"],
+        secret=app.config["PROFILE_SECRET"],
+    )
+
+    app.extensions["profiler"] = profiler
+    app.before_request(start_profiling)
+    app.teardown_request(stop_profiling)
+
+    return profiler
@@ -0,0 +1,290 @@
+"""
+A rate limiter for our calls to Flickr, shared by all our workers.
+
+Flickr limits how many calls each API key can make in an hour, and
+every worker uses the same key.  If lots of people log in at once, we
+could use up the whole quota -- and then every call fails, including
+the logins that are halfway done.
+
+So every call to Flickr has to take a token from a "token bucket".
+There's a separate bucket for each API key (see ``api_keys.py``).
+The bucket holds up to ``capacity`` tokens, and refills at a steady
+``rate`` per second; if it's empty, we don't call Flickr, and the user
+gets an error page asking them to try again shortly.
+
+Some of the bucket is held in reserve for urgent calls -- finishing
+a login in /callback.  Starting a new login, or making an API call for
+a page, can only take a token if there's more than the reserve left.
+That way, when we're busy, we stop starting new logins before we start
+failing the ones the user has already approved on Flickr.
+
+Calls which can wait -- e.g. fetching the pages of a long list -- are
+"background" calls, and they have to leave a bigger reserve, so they
+can't crowd out new logins either.
+
+By default the bucket is kept in a SQLite database which every worker
+on the machine shares.  The memory backend keeps it in the current
+process instead, which is only right for tests or a single process.  If you run the app on several machines, divide the limit
+between them.
+
+See https://en.wikipedia.org/wiki/Token_bucket
+and https://www.flickr.com/services/developer/api/
+"""
+
+import abc
+import threading
+import time
+
+from flask import Flask
+
+from sqlite_db import SqliteDatabase
+
+
+class RateLimiter(abc.ABC):
+    """
+    A token bucket which holds up to ``capacity`` tokens, refills at
+    ``rate`` tokens per second, keeps ``reserve`` tokens back for
+    urgent calls, and keeps ``background_reserve`` tokens back from
+    background calls (by default, the same as ``reserve``).
+    """
+
+    def __init__(
+        self,
+        *,
+        rate: float,
+        capacity: float,
+        reserve: float,
+        background_reserve: float | None = None,
+    ) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.reserve = reserve
+        self.background_reserve = (
+            reserve if background_reserve is None else background_reserve
+        )
+
+    @abc.abstractmethod
+    def acquire(
+        self, *, urgent: bool, bucket: str = "flickr", background: bool = False
+    ) -> float:
+        """
+        Try to take a token from a bucket -- usually the bucket for the
+        API key we're about to use.
+
+        Returns 0 if we got a token, or otherwise how long (in seconds)
+        until there might be one for us.
+        """
+
+    def take(
+        self, tokens: float, elapsed: float, *, urgent: bool, background: bool = False
+    ) -> tuple[float, float]:
+        """
+        Work out the new state of the bucket, given how many tokens it
+        had ``elapsed`` seconds ago.
+
+        Returns the number of tokens left, and how long to wait (which
+        is 0 if we took a token).
+        """
+        # If the clock goes backwards, don't take tokens away.
+        tokens = min(self.capacity, tokens + max(elapsed, 0) * self.rate)
+
+        if urgent:
+            needed = 1.0
+        elif background:
+            needed = 1 + self.background_reserve
+        else:
+            needed = 1 + self.reserve
+
+        if tokens >= needed:
+            return tokens - 1, 0
+
+        return tokens, (needed - tokens) / self.rate
+
+
+class MemoryRateLimiter(RateLimiter):
+    """
+    Keep the token bucket in memory, in the current process.
+
+    Every worker process has its own bucket, so if you run more than
+    one worker, the real limit is the limit in the config multiplied
+    by the number of workers.
+    """
+
+    def __init__(
+        self,
+        *,
+        rate: float,
+        capacity: float,
+        reserve: float,
+        background_reserve: float | None = None,
+    ) -> None:
+        super().__init__(
+            rate=rate,
+            capacity=capacity,
+            reserve=reserve,
+            background_reserve=background_reserve,
+        )
+
+        # The number of tokens in each bucket, and when we last
+        # updated it.  A new bucket starts full.
+        self._lock = threading.Lock()
+        self._buckets: dict[str, tuple[float, float]] = {}
+
+    def acquire(
+        self, *, urgent: bool, bucket: str = "flickr", background: bool = False
+    ) -> float:
+        """
+        Try to take a token from a bucket.
+        """
+        with self._lock:
+            now = time.monotonic()
+
+            tokens, updated_at = self._buckets.get(bucket, (self.capacity, now))
+            tokens, wait = self.take(
+                tokens, now - updated_at, urgent=urgent, background=background
+            )
+            self._buckets[bucket] = (tokens, now)
+
+            return wait
+
+
+class SqliteRateLimiter(RateLimiter):
+    """
+    Keep the token bucket in a SQLite database.
+
+    Every worker process on the same machine can share the same
+    database file, so they share the same bucket.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        *,
+        rate: float,
+        capacity: float,
+        reserve: float,
+        background_reserve: float | None = None,
+    ) -> None:
+        super().__init__(
+            rate=rate,
+            capacity=capacity,
+            reserve=reserve,
+            background_reserve=background_reserve,
+        )
+
+        self.db = SqliteDatabase(
+            path,
+            schema="""
+                CREATE TABLE IF NOT EXISTS rate_limit (
+                    name TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+            """,
+        )
+
+    def acquire(
+        self, *, urgent: bool, bucket: str = "flickr", background: bool = False
+    ) -> float:
+        """
+        Try to take a token from a bucket.
+
+        We read and update the bucket in a single write transaction,
+        so two workers can't take the same token.  We use the wall
+        clock, because it's the same in every process.
+        """
+        conn = self.db.connection()
+
+        conn.execute("BEGIN IMMEDIATE")
+
+        try:
+            now = time.time()
+
+            row = conn.execute(
+                "SELECT tokens, updated_at FROM rate_limit WHERE name = ?", (bucket,)
+            ).fetchone()
+
+            tokens, updated_at = row if row is not None else (self.capacity, now)
+            tokens, wait = self.take(
+                tokens, now - updated_at, urgent=urgent, background=background
+            )
+
+            conn.execute(
+                "INSERT OR REPLACE INTO rate_limit VALUES (?, ?, ?)",
+                (bucket, tokens, now),
+            )
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+
+        return wait
+
+
+def init_app(app: Flask) -> RateLimiter | None:
+    """
+    Create the rate limiter for an app, using the settings in the
+    app config.
+
+    The limiter is saved in ``app.extensions["flickr_rate_limiter"]``,
+    or None if rate limiting is turned off.
+    """
+    # How many calls we can make to Flickr per hour, or None to turn
+    # off rate limiting.  Flickr allows 3600 per hour for each API key.
+    app.config.setdefault("FLICKR_RATE_LIMIT", 3600)
+
+    # How many calls we can make in a quick burst, and what fraction
+    # of those we keep back for logins that are halfway done
+    app.config.setdefault("FLICKR_RATE_LIMIT_BURST", 100)
+    app.config.setdefault("FLICKR_RATE_LIMIT_RESERVE", 0.2)
+
+    # What fraction we keep back from background calls, like fetching
+    # the pages of a long list, so they can't use up the calls we need
+    # for new logins
+    app.config.setdefault("FLICKR_RATE_LIMIT_BACKGROUND_RESERVE", 0.5)
+
+    # Which backend to use.  The default is "sqlite", so every worker
+    # on the machine shares one bucket; "memory" gives each process its
+    # own bucket, which is only right for tests or a single process.
+    app.config.setdefault("FLICKR_RATE_LIMITER", "sqlite")
+
+    # Where to put the database for the SQLite backend.  By default
+    # it's the same database as the users (see ``users.py``).
+    app.config.setdefault("FLICKR_RATE_LIMITER_PATH", app.config["USER_STORE_PATH"])
+
+    limiter: RateLimiter | None
+
+    if app.config["FLICKR_RATE_LIMIT"] is None:
+        limiter = None
+    else:
+        rate = app.config["FLICKR_RATE_LIMIT"] / 3600
+        capacity = app.config["FLICKR_RATE_LIMIT_BURST"]
+        reserve = capacity * app.config["FLICKR_RATE_LIMIT_RESERVE"]
+        background_reserve = (
+            capacity * app.config["FLICKR_RATE_LIMIT_BACKGROUND_RESERVE"]
+        )
+
+        if app.config["FLICKR_RATE_LIMITER"] == "memory":
+            limiter = MemoryRateLimiter(
+                rate=rate,
+                capacity=capacity,
+                reserve=reserve,
+                background_reserve=background_reserve,
+            )
+        elif app.config["FLICKR_RATE_LIMITER"] == "sqlite":
+            limiter = SqliteRateLimiter(
+                app.config["FLICKR_RATE_LIMITER_PATH"],
+                rate=rate,
+                capacity=capacity,
+                reserve=reserve,
+                background_reserve=background_reserve,
+            )
+        else:
+            raise ValueError(
+                f"Unrecognised rate limiter: {app.config['FLICKR_RATE_LIMITER']!r}"
+            )
+
+    app.extensions["flickr_rate_limiter"] = limiter
+
+    return limiter
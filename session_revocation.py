@@ -0,0 +1,359 @@
+"""
+Revoke a session when somebody logs out, so a copy of their session
+cookie stops working.
+
+The session lives entirely in a signed cookie (see ``sessions.py``), so
+logging out only removes the user from the cookie that the browser
+sends back next time.  If somebody had copied the cookie before then,
+it would still log them in until it expired.
+
+So each login gets a random session ID, which is saved in the session
+(``sid``).  When the user logs out, we add that ID to a revocation list
+in a database shared by all the workers, and the user loader refuses
+any session whose ID is on the list.
+
+But the user loader runs on every request from a logged-in user, and
+almost none of those sessions have been revoked -- we don't want to
+query the database every time to find that out.  Instead, each worker
+keeps a Bloom filter of the revoked IDs in memory:
+
+*   If the filter says an ID isn't there, it definitely isn't revoked,
+    and we don't touch the database.  This is almost every request.
+*   If the filter says an ID might be there, we check the database.
+    That's every revoked session, plus a small fraction of others
+    (about ``SESSION_REVOCATION_ERROR_RATE``) which are false positives.
+
+Every ``SESSION_REVOCATION_REFRESH_INTERVAL`` seconds, each worker adds
+any IDs revoked by the other workers to its filter, so a session that's
+revoked in one worker is refused by the others within a few seconds.
+
+Nobody can use a session cookie after ``PERMANENT_SESSION_LIFETIME``
+(Flask checks the signature's timestamp), so we only need to keep each
+ID on the list until then.  Once an hour, each worker deletes the
+expired IDs from the database, in the background (see ``background_jobs.py``),
+and rebuilds its filter from the IDs that are left -- you can't remove
+anything from a Bloom filter.
+
+Sessions which don't have an ID -- e.g. from before we added them --
+can't be revoked.
+
+See https://en.wikipedia.org/wiki/Bloom_filter
+"""
+
+import hashlib
+import math
+import secrets
+import threading
+import time
+
+from flask import Flask, current_app, session
+
+from background_jobs import JobRunner
+from metrics import Metrics
+from sqlite_db import SqliteDatabase
+
+
+class BloomFilter:
+    """
+    A Bloom filter with ``size`` bits and ``hashes`` hash functions.
+
+    We derive the hash functions from one BLAKE2b hash of the item,
+    using double hashing -- see https://doi.org/10.1007/11841036_42
+    """
+
+    def __init__(self, *, size: int, hashes: int) -> None:
+        self.size = size
+        self.hashes = hashes
+        self.bits = bytearray(math.ceil(size / 8))
+
+    @classmethod
+    def for_capacity(cls, capacity: int, *, error_rate: float) -> "BloomFilter":
+        """
+        Create a Bloom filter which can hold ``capacity`` items with a
+        false positive rate of about ``error_rate``.
+        """
+        size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        hashes = max(round(size / capacity * math.log(2)), 1)
+
+        return cls(size=size, hashes=hashes)
+
+    def _positions(self, item: str) -> list[int]:
+        """
+        Return the bits which represent an item.
+        """
+        digest = hashlib.blake2b(item.encode("utf8"), digest_size=16).digest()
+
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item: str) -> None:
+        """
+        Add an item to the filter.
+        """
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item: str) -> bool:
+        """
+        Returns False if the item is definitely not in the filter, or
+        True if it might be.
+        """
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
+
+
+class RevocationList:
+    """
+    The IDs of revoked sessions, saved in a SQLite database shared by
+    every worker, with a Bloom filter in front of it.
+
+    Revoked IDs are kept for ``ttl`` seconds.  Each worker picks up IDs
+    revoked by other workers every ``refresh_interval`` seconds, and
+    expired IDs are deleted every ``compact_interval`` seconds.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        *,
+        metrics: Metrics,
+        jobs: JobRunner,
+        ttl: float,
+        refresh_interval: float,
+        compact_interval: float,
+        capacity: int,
+        error_rate: float,
+    ) -> None:
+        # Each row gets an increasing ``id``, so we can ask for the
+        # sessions which were revoked since we last looked.  We use
+        # AUTOINCREMENT so SQLite never reuses an ``id``, even after
+        # compaction has deleted the newest rows -- otherwise a new
+        # row could get an ``id`` that other workers think they've
+        # already seen, and they'd miss it.
+        self.db = SqliteDatabase(
+            path,
+            schema="""
+                CREATE TABLE IF NOT EXISTS revoked_sessions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    sid TEXT NOT NULL UNIQUE,
+                    expires_at REAL NOT NULL
+                );
+            """,
+        )
+        self.metrics = metrics
+        self.jobs = jobs
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.compact_interval = compact_interval
+        self.capacity = capacity
+        self.error_rate = error_rate
+
+        self._lock = threading.Lock()
+        self._filter = BloomFilter.for_capacity(capacity, error_rate=error_rate)
+
+        # The last row we've added to the filter, and when we last
+        # looked for new rows and compacted the table.  We don't load
+        # anything until the first lookup, so we don't touch the
+        # database in a parent process that forks the workers.
+        self._last_id = 0
+        self._refreshed_at: float | None = None
+        self._compacted_at = time.monotonic()
+
+    def revoke(self, sid: str) -> None:
+        """
+        Revoke a session.
+        """
+        self.db.connection().execute(
+            "INSERT OR REPLACE INTO revoked_sessions (sid, expires_at) VALUES (?, ?)",
+            (sid, time.time() + self.ttl),
+        )
+
+        with self._lock:
+            self._filter.add(sid)
+
+    def is_revoked(self, sid: str) -> bool:
+        """
+        Returns True if a session has been revoked.
+
+        This usually answers from the Bloom filter, without touching
+        the database.
+        """
+        self.maybe_refresh()
+
+        if sid not in self._filter:
+            return False
+
+        row = (
+            self.db.connection()
+            .execute(
+                "SELECT 1 FROM revoked_sessions WHERE sid = ? AND expires_at > ?",
+                (sid, time.time()),
+            )
+            .fetchone()
+        )
+
+        revoked = row is not None
+
+        self.metrics.increment(
+            "session_revocation_lookups_total",
+            (("revoked", "true" if revoked else "false"),),
+        )
+
+        return revoked
+
+    def maybe_refresh(self) -> None:
+        """
+        Add any sessions revoked by other workers to the filter, if we
+        haven't looked for a while, and compact the table if it's due.
+        """
+        now = time.monotonic()
+
+        with self._lock:
+            if (
+                self._refreshed_at is not None
+                and now < self._refreshed_at + self.refresh_interval
+            ):
+                return
+
+            self._refreshed_at = now
+
+            rows = (
+                self.db.connection()
+                .execute(
+                    "SELECT id, sid FROM revoked_sessions WHERE id > ?",
+                    (self._last_id,),
+                )
+                .fetchall()
+            )
+
+            for row_id, sid in rows:
+                self._filter.add(sid)
+                self._last_id = max(self._last_id, row_id)
+
+            compact = now >= self._compacted_at + self.compact_interval
+
+            if compact:
+                self._compacted_at = now
+
+        if compact:
+            self.jobs.submit("compact_session_revocations", self.compact)
+
+    def compact(self) -> int:
+        """
+        Delete the sessions which have expired, rebuild the filter from
+        the ones that are left, and return how many we deleted.
+
+        Every worker rebuilds its own filter when it's due, but it's
+        harmless if several of them delete the expired rows.
+        """
+        deleted = (
+            self.db.connection()
+            .execute(
+                "DELETE FROM revoked_sessions WHERE expires_at <= ?", (time.time(),)
+            )
+            .rowcount
+        )
+
+        rows = (
+            self.db.connection()
+            .execute("SELECT id, sid FROM revoked_sessions")
+            .fetchall()
+        )
+
+        # If there are more revoked sessions than we planned for, we
+        # make the filter bigger, so it stays accurate.
+        new_filter = BloomFilter.for_capacity(
+            max(self.capacity, 2 * len(rows)), error_rate=self.error_rate
+        )
+
+        for _, sid in rows:
+            new_filter.add(sid)
+
+        with self._lock:
+            self._filter = new_filter
+            self._last_id = max((row_id for row_id, _ in rows), default=0)
+
+            # Pick up anything revoked while we were rebuilding.
+            self._refreshed_at = None
+
+        return deleted
+
+
+def new_session_id() -> str:
+    """
+    Give the current session a new, random ID.
+
+    This is called when a user logs in.
+    """
+    sid = secrets.token_urlsafe(16)
+    session["sid"] = sid
+    return sid
+
+
+def revoke_current_session() -> None:
+    """
+    Revoke the current session, if it has an ID.
+
+    This is called when a user logs out.
+    """
+    sid = session.get("sid")
+
+    if sid is not None:
+        revocations: RevocationList = current_app.extensions["session_revocations"]
+        revocations.revoke(sid)
+
+
+def is_current_session_revoked() -> bool:
+    """
+    Returns True if the current session has been revoked.
+    """
+    sid = session.get("sid")
+
+    if sid is None:
+        return False
+
+    revocations: RevocationList = current_app.extensions["session_revocations"]
+    return revocations.is_revoked(sid)
+
+
+def init_app(app: Flask) -> RevocationList:
+    """
+    Create the session revocation list for an app, using the settings
+    in the app config.
+
+    The list is saved in ``app.extensions["session_revocations"]``.
+    """
+    # Where to save the revoked sessions.  By default they go in the
+    # same database as the users (see ``users.py``).
+    app.config.setdefault("SESSION_REVOCATION_PATH", app.config["USER_STORE_PATH"])
+
+    # How often (in seconds) to look for sessions revoked by other
+    # workers, and to delete the ones which have expired
+    app.config.setdefault("SESSION_REVOCATION_REFRESH_INTERVAL", 5.0)
+    app.config.setdefault("SESSION_REVOCATION_COMPACT_INTERVAL", 60 * 60)
+
+    # How many revoked sessions we expect to keep at once, and how
+    # often the Bloom filter should send us to the database for a
+    # session which hasn't been revoked.  10,000 sessions at 1% is
+    # about 12KB of memory per worker.
+    app.config.setdefault("SESSION_REVOCATION_CAPACITY", 10_000)
+    app.config.setdefault("SESSION_REVOCATION_ERROR_RATE", 0.01)
+
+    revocations = RevocationList(
+        app.config["SESSION_REVOCATION_PATH"],
+        metrics=app.extensions["metrics"],
+        jobs=app.extensions["background_jobs"],
+        ttl=app.permanent_session_lifetime.total_seconds(),
+        refresh_interval=app.config["SESSION_REVOCATION_REFRESH_INTERVAL"],
+        compact_interval=app.config["SESSION_REVOCATION_COMPACT_INTERVAL"],
+        capacity=app.config["SESSION_REVOCATION_CAPACITY"],
+        error_rate=app.config["SESSION_REVOCATION_ERROR_RATE"],
+    )
+
+    app.extensions["session_revocations"] = revocations
+
+    return revocations
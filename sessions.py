@@ -0,0 +1,281 @@
+"""
+Cheaper sessions for visitors who aren't logged in.
+
+Most of the people who visit the app aren't logged in, and for them,
+every request still pays for setting up the session: Flask creates
+a signing serializer to decode the session cookie, and Flask-Login
+looks in the session and the "remember me" cookie for a user.
+
+But if the browser didn't send a session cookie or a remember cookie,
+there's nothing to find -- the visitor can't be logged in.  So:
+
+*   :class:`LazySessionInterface` skips creating the serializer when
+    there's no session cookie, and goes straight to an empty session
+*   :func:`is_anonymous_request` lets a view check for those cookies
+    before it asks Flask-Login for ``current_user``
+
+The session cookie is sent with every request, so it's worth keeping
+it small.  By default, Flask encodes the session as JSON; if you set
+``SESSION_SERIALIZER = "msgpack"``, we use :class:`CompactSessionSerializer`
+instead, which encodes it as MessagePack, with short codes for the keys
+we know about.  (The signing library already compresses the cookie with
+zlib when that makes it smaller.)
+
+Cookies encoded as JSON can still be read after you turn it on, so
+nobody gets logged out -- but if you turn it off again, cookies encoded
+as MessagePack can't be read, and those users will need to log in again.
+
+See https://msgpack.org/
+"""
+
+import re
+import typing
+
+from flask import Flask, Request, current_app, request
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SecureCookieSession, SecureCookieSessionInterface
+from flask_login import COOKIE_NAME
+from itsdangerous import URLSafeTimedSerializer
+from itsdangerous.encoding import want_bytes
+
+try:
+    import msgpack  # type: ignore[import-untyped]
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+
+# Short codes for the keys that appear in most sessions -- the keys
+# that Flask-Login uses, the keys for a login in progress (see
+# ``pending_logins.py``), and the session ID (see
+# ``session_revocation.py``).  We use integers, which take a single
+# byte in MessagePack, and can't be confused with a string key.
+#
+# Don't change the existing codes, or you won't be able to read the
+# cookies that are already out there!  You can add new codes at the end.
+KEY_CODES = {
+    "_user_id": 0,
+    "_fresh": 1,
+    "_id": 2,
+    "_remember": 3,
+    "_remember_seconds": 4,
+    "next": 5,
+    "_flashes": 6,
+    "login_id": 7,
+    "pending_login": 8,
+    "oauth_token": 9,
+    "callback_url": 10,
+    "fetched_at": 11,
+    "sid": 12,
+}
+
+KEY_NAMES = {code: name for name, code in KEY_CODES.items()}
+
+
+class LazySessionInterface(SecureCookieSessionInterface):
+    """
+    A signed cookie session, like Flask's default, which doesn't do any
+    work to open the session if there's no session cookie.
+    """
+
+    def open_session(self, app: Flask, request: Request) -> SecureCookieSession | None:
+        """
+        Open the session for a request.
+        """
+        if self.get_cookie_name(app) not in request.cookies:
+            return self.session_class()
+
+        return super().open_session(app, request)
+
+
+class CompactSessionSerializer:
+    """
+    Encodes the session as MessagePack, with short codes for the keys.
+
+    This is a drop-in replacement for Flask's ``TaggedJSONSerializer``,
+    with a few differences:
+
+    *   Flask-Login's session identifier (``_id``) is a 128-character hex
+        string; we store it as 64 raw bytes.  We only do this for the
+        top-level ``_id``, and only if it really is lowercase hex, so
+        we get back exactly the same string.
+    *   Tuples come back as lists.
+    *   If the session has a value that MessagePack can't encode, like
+        a ``datetime`` or a string that isn't valid Unicode, we fall
+        back to JSON for the whole session.
+
+    It can read sessions encoded as JSON, so existing cookies still work.
+    """
+
+    def __init__(self) -> None:
+        if msgpack is None:  # pragma: no cover
+            raise RuntimeError("You need to install msgpack to use this serializer")
+
+        self.json = TaggedJSONSerializer()
+
+    def dumps(self, value: dict[str, typing.Any]) -> bytes:
+        """
+        Encode a session as bytes.
+        """
+        try:
+            data: bytes = msgpack.packb(encode_session(value), use_bin_type=True)
+        except (TypeError, ValueError):
+            return self.json.dumps(value).encode("utf8")
+
+        return data
+
+    def loads(self, data: bytes) -> dict[str, typing.Any]:
+        """
+        Decode a session, from MessagePack or JSON.
+
+        A JSON session always starts with ``{``, which can't be the
+        first byte of a MessagePack map.
+        """
+        if data.startswith(b"{"):
+            json_session: dict[str, typing.Any] = self.json.loads(data.decode("utf8"))
+            return json_session
+
+        return decode_session(msgpack.unpackb(data, raw=False, strict_map_key=False))
+
+
+# Flask-Login's ``_id`` is a SHA-512 hex digest.  We only store it as
+# bytes if it's lowercase hex, because that's what ``bytes.hex()``
+# gives us back.
+HEX_ID = re.compile(r"(?:[0-9a-f]{2})*")
+
+
+def encode_session(session: dict[str, typing.Any]) -> dict[typing.Any, typing.Any]:
+    """
+    Replace the keys we know about with their short codes, and store
+    Flask-Login's ``_id`` as bytes.
+    """
+    encoded = encode_keys(session)
+    session_id = session.get("_id")
+
+    if isinstance(session_id, str) and HEX_ID.fullmatch(session_id):
+        encoded[KEY_CODES["_id"]] = bytes.fromhex(session_id)
+
+    return typing.cast(dict[typing.Any, typing.Any], encoded)
+
+
+def decode_session(data: dict[typing.Any, typing.Any]) -> dict[str, typing.Any]:
+    """
+    Undo :func:`encode_session`.
+    """
+    session: dict[str, typing.Any] = decode_keys(data)
+    session_id = session.get("_id")
+
+    if isinstance(session_id, bytes):
+        session["_id"] = session_id.hex()
+
+    return session
+
+
+def encode_keys(value: typing.Any) -> typing.Any:
+    """
+    Replace any keys we know about with their short codes.
+    """
+    if isinstance(value, dict):
+        return {KEY_CODES.get(k, k): encode_keys(v) for k, v in value.items()}
+
+    if isinstance(value, (list, tuple)):
+        return [encode_keys(v) for v in value]
+
+    return value
+
+
+def decode_keys(value: typing.Any) -> typing.Any:
+    """
+    Replace any short codes with the keys they stand for.
+    """
+    if isinstance(value, dict):
+        return {KEY_NAMES.get(k, k): decode_keys(v) for k, v in value.items()}
+
+    if isinstance(value, list):
+        return [decode_keys(v) for v in value]
+
+    return value
+
+
+class CompactSessionInterface(LazySessionInterface):
+    """
+    A lazy session interface which encodes the session with
+    :class:`CompactSessionSerializer`.
+    """
+
+    def __init__(self) -> None:
+        self.serializer = CompactSessionSerializer()  # type: ignore[assignment]
+
+    def get_signing_serializer(self, app: Flask) -> URLSafeTimedSerializer | None:
+        """
+        Return the serializer which encodes and signs the session cookie.
+        """
+        if not app.secret_key:
+            return None
+
+        # itsdangerous expects the current key to be last
+        keys = [*(app.config["SECRET_KEY_FALLBACKS"] or []), app.secret_key]
+
+        return BinaryCookieSerializer(
+            keys,
+            salt=self.salt,
+            serializer=self.serializer,
+            signer_kwargs={
+                "key_derivation": self.key_derivation,
+                "digest_method": self.digest_method,
+            },
+        )
+
+
+class BinaryCookieSerializer(URLSafeTimedSerializer):
+    """
+    Signs a session which is encoded as bytes.
+
+    itsdangerous returns bytes if the session is encoded as bytes (even
+    though its type hints say it's a string), but a cookie has to be
+    a string.  The signed value is URL-safe base64, so it's plain ASCII.
+    """
+
+    def dumps(self, obj: typing.Any, salt: str | bytes | None = None) -> str:
+        """
+        Encode and sign a session.
+        """
+        return want_bytes(super().dumps(obj, salt)).decode("ascii")
+
+
+def is_anonymous_request() -> bool:
+    """
+    Returns True if the current request can't be from a logged-in user,
+    because it doesn't have a session cookie or a "remember me" cookie.
+
+    This doesn't load the session or the user, so it's much cheaper
+    than checking ``current_user.is_authenticated``.
+    """
+    cookies = request.cookies
+
+    return (
+        current_app.config["SESSION_COOKIE_NAME"] not in cookies
+        and current_app.config.get("REMEMBER_COOKIE_NAME", COOKIE_NAME) not in cookies
+    )
+
+
+def init_app(app: Flask) -> LazySessionInterface:
+    """
+    Use the lazy session interface for an app, with the serializer
+    chosen in the app config.
+    """
+    # How to encode the session -- "json" (Flask's default) or "msgpack"
+    app.config.setdefault("SESSION_SERIALIZER", "json")
+
+    session_interface: LazySessionInterface
+
+    if app.config["SESSION_SERIALIZER"] == "json":
+        session_interface = LazySessionInterface()
+    elif app.config["SESSION_SERIALIZER"] == "msgpack":
+        session_interface = CompactSessionInterface()
+    else:
+        raise ValueError(
+            f"Unrecognised session serializer: {app.config['SESSION_SERIALIZER']!r}"
+        )
+
+    app.session_interface = session_interface
+    return session_interface
@@ -0,0 +1,140 @@
+"""
+Collapse identical calls that are in flight at the same time.
+
+If ten requests all need the same thing from Flickr at the same moment,
+there's no point asking Flickr ten times.  With :class:`SingleFlight`,
+the first caller makes the call, and everybody else who asks for the
+same key while it's running waits for that call and gets the same
+result (or the same exception).
+
+Once the call finishes, the key is forgotten -- this isn't a cache,
+it only joins up calls that overlap.
+
+:class:`AsyncSingleFlight` does the same for coroutines running on
+an event loop.
+
+This is based on Go's ``singleflight`` package.
+See https://pkg.go.dev/golang.org/x/sync/singleflight
+"""
+
+from collections.abc import Awaitable, Callable
+import concurrent.futures
+import threading
+import typing
+
+if typing.TYPE_CHECKING:
+    import asyncio
+
+
+K = typing.TypeVar("K")
+V = typing.TypeVar("V")
+
+
+class SingleFlight(typing.Generic[K, V]):
+    """
+    Makes sure there's only one call in flight for each key.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls: dict[K, concurrent.futures.Future[V]] = {}
+
+    def do(self, key: K, fn: Callable[[], V]) -> V:
+        """
+        Call ``fn`` and return its result -- unless there's already a call
+        in flight for ``key``, in which case wait for that one instead.
+        """
+        future, is_leader = self._join(key)
+
+        if is_leader:
+            self._run(key, future, fn)
+
+        return future.result()
+
+    def do_in_background(
+        self, key: K, fn: Callable[[], V], executor: concurrent.futures.Executor
+    ) -> None:
+        """
+        Call ``fn`` in the background on ``executor``, unless there's
+        already a call in flight for ``key``.
+        """
+        future, is_leader = self._join(key)
+
+        if is_leader:
+            executor.submit(self._run, key, future, fn)
+
+    def _join(self, key: K) -> tuple[concurrent.futures.Future[V], bool]:
+        """
+        Return the future for the call in flight for ``key``, and whether
+        we started it -- in which case it's our job to make the call.
+        """
+        with self._lock:
+            try:
+                return self._calls[key], False
+            except KeyError:
+                future: concurrent.futures.Future[V] = concurrent.futures.Future()
+                self._calls[key] = future
+                return future, True
+
+    def _run(
+        self, key: K, future: concurrent.futures.Future[V], fn: Callable[[], V]
+    ) -> None:
+        """
+        Make the call, and pass the result to everybody who's waiting.
+        """
+        try:
+            future.set_result(fn())
+        except BaseException as exc:
+            future.set_exception(exc)
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+class AsyncSingleFlight(typing.Generic[K, V]):
+    """
+    Makes sure there's only one coroutine in flight for each key.
+
+    This should only be used from a single event loop.
+    """
+
+    def __init__(self) -> None:
+        self._calls: dict[K, "asyncio.Future[V]"] = {}
+
+    async def do(self, key: K, fn: Callable[[], Awaitable[V]]) -> V:
+        """
+        Await ``fn()`` and return its result -- unless there's already
+        a call in flight for ``key``, in which case wait for that one.
+
+        If one of the waiting callers is cancelled (e.g. the browser goes
+        away), the call carries on for everybody else.  If the caller who
+        started the call is cancelled, so is everybody waiting for it.
+        """
+        import asyncio
+
+        try:
+            waiting_for = self._calls[key]
+        except KeyError:
+            pass
+        else:
+            return await asyncio.shield(waiting_for)
+
+        future: asyncio.Future[V] = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as exc:
+            # Pass the error on to anybody who's waiting, and mark it as
+            # seen, so asyncio doesn't complain if nobody was.
+            future.set_exception(exc)
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._calls[key]
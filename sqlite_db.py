@@ -0,0 +1,51 @@
+"""
+A helper for SQLite databases which are shared by several threads and
+worker processes.
+"""
+
+import os
+import sqlite3
+import threading
+
+
+class SqliteDatabase:
+    """
+    A SQLite database file, with one connection per thread.
+
+    SQLite connections can't be shared between threads, or between
+    processes after a fork, so each thread in each process opens its own
+    connection the first time it needs one.
+
+    The database uses write-ahead logging (WAL), so readers and writers
+    don't block each other, and autocommit mode, so each statement is
+    its own transaction.
+
+    The ``schema`` is run whenever we open a new connection, so it should
+    only contain idempotent statements like ``CREATE TABLE IF NOT EXISTS``.
+    We don't touch the file until the first time it's used.
+
+    See https://www.sqlite.org/wal.html
+    """
+
+    def __init__(self, path: str, *, schema: str = "") -> None:
+        self.path = path
+        self.schema = schema
+        self._local = threading.local()
+
+    def connection(self) -> sqlite3.Connection:
+        """
+        Return the database connection for the current thread.
+        """
+        if getattr(self._local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(
+                self.path, timeout=5, isolation_level=None, check_same_thread=False
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(self.schema)
+
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+
+        conn: sqlite3.Connection = self._local.connection
+        return conn
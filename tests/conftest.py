@@ -2,7 +2,7 @@
 Shared helpers and test fixtures.
 """
 
-from collections.abc import Iterator
+from collections.abc import Callable, Iterator
 
 from flask import Flask
 from flask.testing import FlaskClient
@@ -11,11 +11,29 @@ from keyring.backend import KeyringBackend
 from nitrate.cassettes import *  # noqa: F403
 from nitrate.mock_keyring import *  # noqa: F403
 import os
+import pathlib
 import pytest
+import typing
 import vcr
 from vcr.cassette import Cassette
 
-from app import create_app, FlickrUser
+from app import create_app
+from credentials import load_credentials
+from users import FlickrUser
+
+
+@pytest.fixture(autouse=True)
+def clear_credentials(monkeypatch: pytest.MonkeyPatch) -> Iterator[None]:
+    """
+    Make sure every test starts without any cached credentials, and
+    without any credentials in the environment.
+    """
+    monkeypatch.delenv("FLICKR_API_KEY", raising=False)
+    monkeypatch.delenv("FLICKR_API_SECRET", raising=False)
+
+    load_credentials.cache_clear()
+    yield
+    load_credentials.cache_clear()
 
 
 @pytest.fixture
@@ -27,9 +45,17 @@ def user() -> FlickrUser:
 
 
 @pytest.fixture
-def app(mock_keyring: KeyringBackend) -> Flask:
+def make_app(
+    mock_keyring: KeyringBackend, tmp_path: pathlib.Path
+) -> Iterator[Callable[..., Flask]]:
     """
-    Creates a Flask app for testing.
+    Returns a function that creates a Flask app for testing, with any
+    extra config you pass it, e.g. ``make_app(TRACE_SAMPLE_RATE=1)``.
+
+    We don't fetch the user's profile after they log in, because most
+    tests only fake Flickr's OAuth endpoints, not the API.  At the end
+    of the test, we stop any background threads the apps started, and
+    wait for their background jobs and API calls to finish.
     """
     # Add some placeholder Flickr API credentials to the keychain,
     # so the app can be created correctly.
@@ -39,10 +65,48 @@ def app(mock_keyring: KeyringBackend) -> Flask:
     mock_keyring.set_password("flickr_flask_login_demo", "key", client_id)
     mock_keyring.set_password("flickr_flask_login_demo", "secret", client_secret)
 
-    app = create_app()
-    app.config["TESTING"] = True
+    apps: list[Flask] = []
+
+    def make_app(**config: typing.Any) -> Flask:
+        """
+        Create the app.
+        """
+        app = create_app(
+            config={
+                "TESTING": True,
+                "USER_STORE_PATH": str(tmp_path / "users.sqlite"),
+                "WARM_PROFILE_ON_LOGIN": False,
+                **config,
+            }
+        )
+        apps.append(app)
+        return app
+
+    yield make_app
+
+    for app in apps:
+        if app.extensions["token_validator"] is not None:
+            app.extensions["token_validator"].stop()
+
+        app.extensions["background_jobs"].stop()
+        app.extensions["flickr_api"].close()
 
-    return app
+
+@pytest.fixture
+def app_config() -> dict[str, typing.Any]:
+    """
+    Any extra config for the ``app`` fixture.  A test can change it
+    with ``@pytest.mark.parametrize("app_config", [{...}])``.
+    """
+    return {}
+
+
+@pytest.fixture
+def app(make_app: Callable[..., Flask], app_config: dict[str, typing.Any]) -> Flask:
+    """
+    Creates a Flask app for testing -- see :func:`make_app`.
+    """
+    return make_app(**app_config)
 
 
 @pytest.fixture
@@ -2,7 +2,9 @@ from typing import Any, Optional, Protocol
 
 from flask.testing import FlaskClient
 
-from app import FlickrUser
+from users import FlickrUser
+
+COOKIE_NAME: str
 
 current_user: FlickrUser
 
@@ -15,6 +17,7 @@ class LoginManager:
     def init_app(self, app: Any) -> None: ...
     def user_loader(self, callback: Any) -> Any: ...
     login_view: str
+    def _load_user(self) -> None: ...
 
 def login_user(
     user: Any,
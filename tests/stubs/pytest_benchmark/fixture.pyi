@@ -0,0 +1,21 @@
+from typing import Any, Callable, TypeVar
+
+T = TypeVar("T")
+
+class BenchmarkFixture:
+    extra_info: dict[str, Any]
+
+    def __call__(
+        self, function_to_benchmark: Callable[..., T], *args: Any, **kwargs: Any
+    ) -> T: ...
+    def pedantic(
+        self,
+        target: Callable[..., T],
+        args: tuple[Any, ...] = (),
+        kwargs: dict[str, Any] | None = None,
+        setup: Callable[[], Any] | None = None,
+        teardown: Callable[..., Any] | None = None,
+        rounds: int = 1,
+        warmup_rounds: int = 0,
+        iterations: int = 1,
+    ) -> T: ...
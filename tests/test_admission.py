@@ -0,0 +1,122 @@
+"""
+Tests for ``admission.py``, which limits how many requests can wait
+for Flickr at once.
+"""
+
+import threading
+
+from flask import Flask
+from flask.testing import FlaskClient
+import pytest
+
+from admission import AdmissionController, FlickrOverloaded
+
+
+@pytest.fixture
+def controller(app: Flask) -> AdmissionController:
+    """
+    Creates an admission controller which lets one request call Flickr,
+    and one more wait for a turn.
+    """
+    return AdmissionController(
+        metrics=app.extensions["metrics"],
+        max_concurrent=1,
+        max_waiting=1,
+        queue_timeout=5,
+    )
+
+
+def shed_count(controller: AdmissionController, reason: str) -> float:
+    """
+    Return how many requests were turned away for ``reason``.
+    """
+    samples = controller.metrics.collect()
+    key = ("flickr_admission_shed_total", (("reason", reason), ("step", "test")))
+    return samples[key][0] if key in samples else 0
+
+
+def test_waiting_request_gets_the_next_turn(controller: AdmissionController) -> None:
+    """
+    If every turn is taken, a request waits until one is free.
+    """
+    admitted = threading.Event()
+
+    def wait_for_turn() -> None:
+        """
+        Wait for a turn, and record that we got one.
+        """
+        with controller.admit("test"):
+            admitted.set()
+
+    with controller.admit("test"):
+        waiter = threading.Thread(target=wait_for_turn)
+        waiter.start()
+
+        assert not admitted.wait(timeout=0.05)
+
+    waiter.join(timeout=5)
+    assert admitted.is_set()
+
+
+def test_requests_are_turned_away_when_the_queue_is_full(
+    controller: AdmissionController,
+) -> None:
+    """
+    If the queue is full, a request is turned away immediately.
+    """
+    controller.max_waiting = 0
+
+    with controller.admit("test"):
+        with pytest.raises(FlickrOverloaded):
+            with controller.admit("test"):
+                pass  # pragma: no cover
+
+    assert shed_count(controller, "queue_full") == 1
+
+
+def test_requests_are_turned_away_after_the_timeout(
+    controller: AdmissionController,
+) -> None:
+    """
+    If a request waits too long for a turn, it's turned away.
+    """
+    controller.queue_timeout = 0.01
+
+    with controller.admit("test"):
+        with pytest.raises(FlickrOverloaded) as exc:
+            with controller.admit("test"):
+                pass  # pragma: no cover
+
+    assert exc.value.retry_after == 0.01
+    assert shed_count(controller, "timeout") == 1
+
+    # The turn is free again, and nobody is waiting.
+    assert (controller._active, controller._waiting) == (0, 0)
+
+
+def test_overloaded_login_gets_a_fast_503(
+    app: Flask, logged_out_client: FlaskClient
+) -> None:
+    """
+    If too many logins are waiting for Flickr, /authorize and /callback
+    return a 503 with a ``Retry-After`` header, without calling Flickr,
+    and the rest of the site still works.
+    """
+    controller: AdmissionController = app.extensions["flickr_admission"]
+    controller.max_concurrent = 0
+    controller.max_waiting = 0
+
+    app.extensions["request_token_store"].put(
+        {"oauth_token": "123", "oauth_token_secret": "456"}
+    )
+
+    # We use a new client for each request, because a failed /authorize
+    # would tie the client to a different login from the one in the
+    # callback.
+    for url in ["/authorize", "/callback?oauth_token=123&oauth_verifier=789"]:
+        resp = app.test_client().get(url)
+        assert resp.status_code == 503
+        assert resp.headers["Retry-After"] == "2"
+
+    resp = logged_out_client.get("/")
+    assert resp.status_code == 200
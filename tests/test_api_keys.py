@@ -0,0 +1,434 @@
+"""
+Tests for ``api_keys.py``, which shares logins between several Flickr
+API keys.
+"""
+
+import asyncio
+from collections.abc import Callable
+import json
+import logging
+import os
+import pathlib
+
+from authlib.integrations.base_client import OAuthError
+from flask import Flask
+import httpx
+import pytest
+
+from api_keys import ApiKey, ApiKeyRing, read_keys_file
+from app import fetch_request_token_async
+from flickr_api import FlickrApi, FlickrApiError
+from flickr_calls import FlickrRateLimited
+from rate_limit import MemoryRateLimiter
+from users import FlickrUser
+
+
+def write_keys(path: pathlib.Path, *client_ids: str) -> None:
+    """
+    Write a keys file with the given keys, and move its modification
+    time forward, so the key ring notices it's changed.
+    """
+    path.write_text(
+        json.dumps([{"key": key, "secret": f"{key}-secret"} for key in client_ids])
+    )
+
+    mtime = path.stat().st_mtime_ns + 1_000_000_000
+    os.utime(path, ns=(mtime, mtime))
+
+
+@pytest.fixture
+def keys_file(tmp_path: pathlib.Path) -> pathlib.Path:
+    """
+    Creates a keys file with two API keys.
+    """
+    path = tmp_path / "api_keys.json"
+    write_keys(path, "aaa", "bbb")
+    return path
+
+
+class FakeFlickr:
+    """
+    A fake Flickr OAuth server, which records which API key signed each
+    request, and rejects any keys in ``rejected``.
+    """
+
+    def __init__(self) -> None:
+        self.client_ids: list[str] = []
+        self.rejected: set[str] = set()
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        """
+        Handle a request to the fake server.
+        """
+        client_id = request.url.params.get("oauth_consumer_key")
+
+        if client_id is None:
+            header = request.headers["Authorization"]
+            client_id = header.split('oauth_consumer_key="')[1].split('"')[0]
+
+        self.client_ids.append(client_id)
+
+        if client_id in self.rejected:
+            return httpx.Response(401, text="oauth_problem=consumer_key_rejected")
+
+        if request.url.path == "/services/oauth/request_token":
+            body = "oauth_callback_confirmed=true&oauth_token=req123&oauth_token_secret=reqsecret"
+        elif request.url.path == "/services/oauth/access_token":
+            body = "fullname=Father%20Sword&oauth_token=acc123&oauth_token_secret=accsecret&user_nsid=test%40123&username=fathersword"
+        else:
+            return httpx.Response(
+                200,
+                json={"person": {"photos": {"count": {"_content": 7}}}, "stat": "ok"},
+            )
+
+        return httpx.Response(200, text=body)
+
+    async def handle_async(self, request: httpx.Request) -> httpx.Response:
+        """
+        Handle a request from an async client.
+        """
+        return self(request)
+
+
+@pytest.fixture
+def fake_flickr(monkeypatch: pytest.MonkeyPatch) -> FakeFlickr:
+    """
+    Replace the transports used to talk to Flickr with a fake.
+    """
+    fake = FakeFlickr()
+
+    monkeypatch.setattr(
+        "httpx.HTTPTransport", lambda **kwargs: httpx.MockTransport(fake)
+    )
+    monkeypatch.setattr(
+        "httpx.AsyncHTTPTransport",
+        lambda **kwargs: httpx.MockTransport(fake.handle_async),
+    )
+
+    return fake
+
+
+@pytest.fixture
+def keyed_app(make_app: Callable[..., Flask], keys_file: pathlib.Path) -> Flask:
+    """
+    Creates an app which uses the keys in ``keys_file``, and checks for
+    changes to the file every time it picks a key.
+    """
+    return make_app(
+        FLICKR_API_KEYS_FILE=str(keys_file), FLICKR_API_KEYS_RELOAD_INTERVAL=0
+    )
+
+
+def log_in(app: Flask) -> None:
+    """
+    Go through the login flow.
+    """
+    with app.test_client() as client:
+        resp = client.get("/authorize")
+        assert resp.status_code == 302
+
+        resp = client.get("/callback?oauth_token=req123&oauth_verifier=ver456")
+        assert resp.status_code == 302
+
+
+def test_logins_take_turns_with_each_key(
+    keyed_app: Flask, fake_flickr: FakeFlickr
+) -> None:
+    """
+    Each login uses the next key in turn, and finishes with the same
+    key that started it.
+    """
+    log_in(keyed_app)
+    log_in(keyed_app)
+    log_in(keyed_app)
+
+    assert fake_flickr.client_ids == ["aaa", "aaa", "bbb", "bbb", "aaa", "aaa"]
+
+
+def test_rate_limited_keys_are_skipped(
+    keyed_app: Flask, fake_flickr: FakeFlickr
+) -> None:
+    """
+    If a key has used up its share of the rate limit, we use another key,
+    and the other key's share is unaffected.
+    """
+    limiter = MemoryRateLimiter(rate=0.001, capacity=1, reserve=0)
+    keyed_app.extensions["flickr_call_policy"].limiter = limiter
+
+    assert limiter.acquire(urgent=False, bucket="aaa") == 0
+
+    with keyed_app.test_client() as client:
+        resp = client.get("/authorize")
+        assert resp.status_code == 302
+
+    assert fake_flickr.client_ids == ["bbb"]
+
+    # Once every key has used up its share, the login fails.
+    with keyed_app.test_client() as client:
+        resp = client.get("/authorize")
+        assert resp.status_code == 503
+
+    assert fake_flickr.client_ids == ["bbb"]
+
+
+def test_rejected_keys_are_skipped(
+    keyed_app: Flask, fake_flickr: FakeFlickr, caplog: pytest.LogCaptureFixture
+) -> None:
+    """
+    If Flickr rejects a key, we try the next one, and we don't try the
+    rejected key again until the cooldown has passed.
+    """
+    fake_flickr.rejected = {"aaa"}
+
+    with caplog.at_level(logging.WARNING, logger="api_keys"):
+        log_in(keyed_app)
+
+    assert "Flickr rejected API key aaa" in caplog.text
+    assert fake_flickr.client_ids == ["aaa", "bbb", "bbb"]
+
+    # The next login would have started with "bbb" anyway, and the one
+    # after that skips "aaa".
+    log_in(keyed_app)
+    log_in(keyed_app)
+
+    assert fake_flickr.client_ids[3:] == ["bbb", "bbb", "bbb", "bbb"]
+
+
+def test_login_fails_if_every_key_is_rejected(
+    keyed_app: Flask, fake_flickr: FakeFlickr
+) -> None:
+    """
+    If Flickr rejects every key, we give up, but we still try each key
+    once in case it's been fixed.
+    """
+    fake_flickr.rejected = {"aaa", "bbb"}
+
+    with keyed_app.app_context(), keyed_app.test_request_context():
+        keys: ApiKeyRing = keyed_app.extensions["flickr_api_keys"]
+
+        with pytest.raises(OAuthError):
+            keyed_app.view_functions["authorize"]()
+
+        assert fake_flickr.client_ids == ["aaa", "bbb"]
+
+        # Both keys are unhealthy, but we still try them.
+        assert set(keys.candidates()) == {
+            ApiKey("aaa", "aaa-secret"),
+            ApiKey("bbb", "bbb-secret"),
+        }
+
+
+def test_async_logins_skip_unusable_keys(
+    keyed_app: Flask, fake_flickr: FakeFlickr
+) -> None:
+    """
+    The async views skip rate-limited and rejected keys in the same way.
+    If no key works, and any of them was rate limited, we ask the user
+    to try again later.
+    """
+    limiter = MemoryRateLimiter(rate=0.001, capacity=2, reserve=0)
+    keyed_app.extensions["flickr_call_policy"].limiter = limiter
+
+    for _ in range(2):
+        assert limiter.acquire(urgent=False, bucket="aaa") == 0
+
+    with keyed_app.test_request_context():
+        token = asyncio.run(fetch_request_token_async("http://localhost/callback"))
+        assert token["client_id"] == "bbb"
+
+        fake_flickr.rejected = {"bbb"}
+
+        with pytest.raises(FlickrRateLimited):
+            asyncio.run(fetch_request_token_async("http://localhost/callback"))
+
+    assert fake_flickr.client_ids == ["bbb", "bbb"]
+
+
+def test_users_api_calls_use_their_key(
+    keyed_app: Flask, fake_flickr: FakeFlickr
+) -> None:
+    """
+    We remember which key a user logged in with, and sign their API
+    calls with that key.
+    """
+    log_in(keyed_app)
+    log_in(keyed_app)
+
+    user = keyed_app.extensions["user_store"].repository.get("test@123")
+    assert user is not None
+    assert user.client_id == "bbb"
+
+    api: FlickrApi = keyed_app.extensions["flickr_api"]
+
+    with keyed_app.app_context():
+        api.get(user, "flickr.people.getInfo", user_id=user.user_nsid)
+
+    assert fake_flickr.client_ids[-1] == "bbb"
+
+
+def test_keys_file_is_reloaded_when_it_changes(
+    keys_file: pathlib.Path,
+    monkeypatch: pytest.MonkeyPatch,
+    caplog: pytest.LogCaptureFixture,
+) -> None:
+    """
+    If the keys file changes, we start using the new keys, and keep
+    using removed keys until they expire.
+    """
+    now = 1000.0
+    monkeypatch.setattr("time.monotonic", lambda: now)
+
+    keys = ApiKeyRing(
+        ApiKey("123", "456"),
+        path=str(keys_file),
+        reload_interval=10,
+        cooldown=60,
+        retired_ttl=300,
+    )
+
+    write_keys(keys_file, "bbb", "ccc")
+
+    # We don't notice the change until the reload interval has passed.
+    assert keys.get("ccc") is None
+
+    now += 10
+
+    with caplog.at_level(logging.INFO, logger="api_keys"):
+        assert sorted(keys.candidates()) == [
+            ApiKey("bbb", "bbb-secret"),
+            ApiKey("ccc", "ccc-secret"),
+        ]
+
+    assert "Reloaded 2 API keys" in caplog.text
+
+    # The removed key can still finish logins for a while ...
+    assert keys.get("aaa") == ApiKey("aaa", "aaa-secret")
+    assert keys.get("123") == ApiKey("123", "456")
+    assert keys.get(None) == ApiKey("123", "456")
+
+    # ... and if it comes back, it's no longer retired.
+    now += 10
+    write_keys(keys_file, "aaa", "bbb", "ccc")
+    keys.maybe_reload()
+    assert keys.get("aaa") == ApiKey("aaa", "aaa-secret")
+
+    # Once it's removed again, we forget it after it expires.
+    now += 10
+    write_keys(keys_file, "bbb", "ccc")
+    keys.maybe_reload()
+
+    now += 300
+    write_keys(keys_file, "ccc")
+    keys.maybe_reload()
+
+    assert keys.get("aaa") is None
+    assert keys.get("bbb") == ApiKey("bbb", "bbb-secret")
+
+    # If the file hasn't changed, we don't read it again.
+    now += 10
+    keys.maybe_reload()
+    assert keys.candidates() == [ApiKey("ccc", "ccc-secret")]
+
+
+def test_broken_keys_file_keeps_the_current_keys(
+    keys_file: pathlib.Path, caplog: pytest.LogCaptureFixture
+) -> None:
+    """
+    If the new keys file can't be read, we log a warning and keep using
+    the keys we have.
+    """
+    keys = ApiKeyRing(
+        ApiKey("123", "456"),
+        path=str(keys_file),
+        reload_interval=0,
+        cooldown=60,
+        retired_ttl=300,
+    )
+
+    keys_file.write_text("[{")
+    os.utime(keys_file, ns=(0, 0))
+
+    with caplog.at_level(logging.WARNING, logger="api_keys"):
+        keys.maybe_reload()
+
+    assert "Unable to reload API keys" in caplog.text
+    assert keys.get("aaa") == ApiKey("aaa", "aaa-secret")
+
+
+def test_empty_keys_file_is_an_error(tmp_path: pathlib.Path) -> None:
+    """
+    A keys file has to have at least one key.
+    """
+    path = tmp_path / "api_keys.json"
+    path.write_text("[]")
+
+    with pytest.raises(ValueError, match="No API keys"):
+        read_keys_file(str(path))
+
+
+def test_without_a_keys_file_we_use_the_default_key(app: Flask) -> None:
+    """
+    If there's no keys file, we only use the key from the credentials,
+    and we don't know any other keys.
+    """
+    keys: ApiKeyRing = app.extensions["flickr_api_keys"]
+
+    assert keys.candidates() == [ApiKey("123", "456")]
+    assert keys.get("aaa") is None
+
+
+def test_callback_fails_if_the_key_has_gone(
+    keyed_app: Flask, fake_flickr: FakeFlickr, keys_file: pathlib.Path
+) -> None:
+    """
+    If we've stopped using the key a login started with, we can't
+    finish the login.
+    """
+    keys: ApiKeyRing = keyed_app.extensions["flickr_api_keys"]
+    keys.retired_ttl = 0
+
+    with keyed_app.test_client() as client:
+        client.get("/authorize")
+
+        write_keys(keys_file, "bbb")
+        keys.maybe_reload()
+
+        resp = client.get("/callback?oauth_token=req123&oauth_verifier=ver456")
+        assert resp.status_code == 400
+
+
+def test_api_calls_fail_if_the_users_key_has_gone(
+    keyed_app: Flask, fake_flickr: FakeFlickr
+) -> None:
+    """
+    If we've stopped using the key a user logged in with, their access
+    token doesn't work any more.
+    """
+    user = FlickrUser(
+        "test@123", "Father Sword", "token", "secret", client_id="removed"
+    )
+    api: FlickrApi = keyed_app.extensions["flickr_api"]
+
+    with keyed_app.app_context(), pytest.raises(FlickrApiError) as exc:
+        api.get(user, "flickr.people.getInfo", user_id=user.user_nsid)
+
+    assert exc.value.code == 100
+    assert fake_flickr.client_ids == []
+
+
+def test_rate_limited_error_is_raised_if_every_key_is_limited(
+    keyed_app: Flask, fake_flickr: FakeFlickr
+) -> None:
+    """
+    If every key has used up its share of the rate limit, we raise
+    :class:`FlickrRateLimited`, so the caller can ask the user to wait.
+    """
+    limiter = MemoryRateLimiter(rate=0.001, capacity=1, reserve=0)
+    keyed_app.extensions["flickr_call_policy"].limiter = limiter
+
+    for bucket in ["aaa", "bbb"]:
+        assert limiter.acquire(urgent=False, bucket=bucket) == 0
+
+    with keyed_app.test_request_context():
+        with pytest.raises(FlickrRateLimited):
+            asyncio.run(fetch_request_token_async("http://localhost/callback"))
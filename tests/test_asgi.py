@@ -0,0 +1,531 @@
+"""
+Tests for serving the app with an ASGI server, using async login views.
+"""
+
+import asyncio
+import collections
+from collections.abc import Iterator, MutableMapping
+import pathlib
+import threading
+import typing
+
+import httpx
+from keyring.backend import KeyringBackend
+from nitrate.mock_keyring import *  # noqa: F403
+import pytest
+
+from asgi import AsgiApp, build_environ, create_asgi_app
+from token_pool import RequestTokenPool
+
+
+class FakeFlickr:
+    """
+    A fake Flickr OAuth server, which records requests and returns
+    canned tokens.
+    """
+
+    def __init__(self) -> None:
+        self.requests: list[httpx.Request] = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+        # If this is set, requests wait until this many are in flight
+        # at the same time before any of them get a response.
+        self.wait_for: int | None = None
+        self.release = asyncio.Event()
+
+        # The status code to return, e.g. to simulate an outage.
+        self.status_code = 200
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        """
+        Handle a request to the fake server.
+        """
+        self.requests.append(request)
+
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.wait_for is not None:
+                if self.in_flight == self.wait_for:
+                    self.release.set()
+                await asyncio.wait_for(self.release.wait(), timeout=5)
+        finally:
+            self.in_flight -= 1
+
+        if request.url.path == "/services/oauth/request_token":
+            body = "oauth_callback_confirmed=true&oauth_token=req123&oauth_token_secret=reqsecret"
+        else:
+            body = "fullname=Father%20Sword&oauth_token=acc123&oauth_token_secret=accsecret&user_nsid=test%40123&username=fathersword"
+
+        return httpx.Response(self.status_code, text=body)
+
+
+@pytest.fixture
+def fake_flickr(monkeypatch: pytest.MonkeyPatch) -> FakeFlickr:
+    """
+    Replace the async transport used to talk to Flickr with a fake.
+    """
+    fake = FakeFlickr()
+
+    monkeypatch.setattr(
+        "httpx.AsyncHTTPTransport",
+        lambda **kwargs: httpx.MockTransport(fake),
+    )
+
+    return fake
+
+
+@pytest.fixture
+def asgi_app(mock_keyring: KeyringBackend, tmp_path: pathlib.Path) -> Iterator[AsgiApp]:
+    """
+    Creates an ASGI app for testing.
+    """
+    mock_keyring.set_password("flickr_flask_login_demo", "key", "123")
+    mock_keyring.set_password("flickr_flask_login_demo", "secret", "456")
+
+    app = create_asgi_app(
+        config={
+            "TESTING": True,
+            "USER_STORE_PATH": str(tmp_path / "users.sqlite"),
+            "WARM_PROFILE_ON_LOGIN": False,
+        }
+    )
+    yield app
+    app.executor.shutdown()
+    app.app.extensions["background_jobs"].stop()
+
+
+def make_client(asgi_app: AsgiApp) -> httpx.AsyncClient:
+    """
+    Create an HTTP client which sends requests to the ASGI app.
+    """
+    return httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=asgi_app), base_url="http://localhost"
+    )
+
+
+def get(asgi_app: AsgiApp, url: str) -> httpx.Response:
+    """
+    Make a single GET request to the ASGI app.
+    """
+
+    async def run() -> httpx.Response:
+        """
+        Make the request.
+        """
+        async with make_client(asgi_app) as client:
+            return await client.get(url)
+
+    return asyncio.run(run())
+
+
+def test_login_flow(asgi_app: AsgiApp, fake_flickr: FakeFlickr) -> None:
+    """
+    A user can log in and out with the async views.
+    """
+
+    async def run() -> None:
+        """
+        Go through the login flow.
+        """
+        async with make_client(asgi_app) as client:
+            resp = await client.get("/")
+            assert "logged out" in resp.text
+
+            authorize_resp = await client.get("/authorize")
+            assert authorize_resp.status_code == 302
+            assert authorize_resp.headers["location"] == (
+                "https://www.flickr.com/services/oauth/authorize"
+                "?perms=read&oauth_token=req123"
+            )
+
+            callback_resp = await client.get(
+                "/callback?oauth_token=req123&oauth_verifier=ver456"
+            )
+            assert callback_resp.status_code == 302
+            assert callback_resp.headers["location"] == "/"
+
+            resp = await client.get("/")
+            assert "logged in" in resp.text
+            assert "fathersword (test@123)" in resp.text
+
+            resp = await client.get("/authorize")
+            assert resp.status_code == 302
+            assert resp.headers["location"] == "/"
+
+            resp = await client.get("/callback")
+            assert resp.status_code == 302
+            assert resp.headers["location"] == "/"
+
+            await client.get("/logout")
+            resp = await client.get("/")
+            assert "logged out" in resp.text
+
+    asyncio.run(run())
+
+    assert [req.url.path for req in fake_flickr.requests] == [
+        "/services/oauth/request_token",
+        "/services/oauth/access_token",
+    ]
+    assert 'oauth_verifier="ver456"' in fake_flickr.requests[1].headers["authorization"]
+
+
+def test_async_views_use_the_database_in_a_thread(
+    asgi_app: AsgiApp, fake_flickr: FakeFlickr, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    The async login views don't wait for the database on the event loop,
+    so a slow write doesn't hold up every other login.
+    """
+    app = asgi_app.app
+    threads: dict[str, set[int]] = collections.defaultdict(set)
+
+    def record(name: str, obj: typing.Any, attr: str) -> None:
+        """
+        Record which thread calls ``obj.attr``.
+        """
+        original = getattr(obj, attr)
+
+        def wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+            """
+            Record the current thread, then call the original method.
+            """
+            threads[name].add(threading.get_ident())
+            return original(*args, **kwargs)
+
+        monkeypatch.setattr(obj, attr, wrapper)
+
+    record("put", app.extensions["request_token_store"], "put")
+    record("pop", app.extensions["request_token_store"], "pop")
+    record("save", app.extensions["user_store"], "save")
+    record("acquire", app.extensions["flickr_rate_limiter"], "acquire")
+
+    async def run() -> None:
+        """
+        Log in.
+        """
+        async with make_client(asgi_app) as client:
+            await client.get("/authorize")
+            resp = await client.get(
+                "/callback?oauth_token=req123&oauth_verifier=ver456"
+            )
+            assert resp.status_code == 302
+
+    asyncio.run(run())
+
+    assert threads.keys() == {"put", "pop", "save", "acquire"}
+    assert all(threading.get_ident() not in idents for idents in threads.values())
+
+
+def test_authorize_is_503_if_flickr_is_down(
+    asgi_app: AsgiApp, fake_flickr: FakeFlickr
+) -> None:
+    """
+    If Flickr is down, the async /authorize view retries, then shows
+    a friendly error page.
+    """
+    fake_flickr.status_code = 503
+    asgi_app.app.extensions["flickr_call_policy"].backoff = 0
+
+    resp = get(asgi_app, "/authorize")
+
+    assert resp.status_code == 503
+    assert "we can't reach Flickr" in resp.text
+    assert len(fake_flickr.requests) == 3
+
+
+def test_authorize_uses_pooled_token(
+    asgi_app: AsgiApp, fake_flickr: FakeFlickr
+) -> None:
+    """
+    If there's a token in the request token pool, the async /authorize
+    view uses it without calling Flickr.
+    """
+    pool = RequestTokenPool(
+        asgi_app.app,
+        fetch=lambda callback_url: {
+            "oauth_token": "pooled123",
+            "oauth_token_secret": "pooledsecret",
+        },
+        size=1,
+        low_water=0,
+        ttl=60,
+        retry_interval=60,
+    )
+    pool.callback_url = "http://localhost/callback"
+    pool.refill()
+    asgi_app.app.extensions["request_token_pool"] = pool
+
+    resp = get(asgi_app, "/authorize")
+    pool.stop()
+
+    assert resp.status_code == 302
+    assert resp.headers["location"].endswith("oauth_token=pooled123")
+    assert fake_flickr.requests == []
+
+
+def test_callback_without_request_token_is_error(asgi_app: AsgiApp) -> None:
+    """
+    If you try to go through the async callback without a request token,
+    the login fails.
+    """
+    url = "/callback?oauth_token=123&oauth_verifier=456"
+    assert get(asgi_app, url).status_code == 400
+
+
+def test_logins_run_concurrently(asgi_app: AsgiApp, fake_flickr: FakeFlickr) -> None:
+    """
+    Lots of logins can be waiting for Flickr at the same time.
+    """
+    login_count = 50
+
+    async def run() -> list[httpx.Response]:
+        """
+        Start lots of logins, and only let Flickr reply once they're all
+        waiting for it.
+        """
+        fake_flickr.wait_for = login_count
+        fake_flickr.release = asyncio.Event()
+
+        async with make_client(asgi_app) as client:
+            return await asyncio.gather(
+                *(client.get("/authorize") for _ in range(login_count))
+            )
+
+    responses = asyncio.run(run())
+
+    assert all(resp.status_code == 302 for resp in responses)
+    assert fake_flickr.max_in_flight == login_count
+
+
+def test_repeated_logins_share_a_request_token(
+    asgi_app: AsgiApp, fake_flickr: FakeFlickr
+) -> None:
+    """
+    If the same browser visits /authorize several times, the async view
+    only asks Flickr for one request token -- whether the requests are
+    one after another, or at the same time.
+    """
+
+    async def run() -> list[httpx.Response]:
+        """
+        Click "log in" once, then several times at once.
+        """
+        async with make_client(asgi_app) as client:
+            first = await client.get("/authorize")
+            second = await client.get("/authorize")
+
+            # Turn off reuse, so we only see the effect of collapsing
+            # concurrent requests.
+            asgi_app.app.extensions["pending_logins"].window = 0
+
+            # Hold up Flickr for a moment, so the requests overlap.
+            fake_flickr.wait_for = 100
+            fake_flickr.release = asyncio.Event()
+            asyncio.get_running_loop().call_later(0.1, fake_flickr.release.set)
+
+            concurrent = await asyncio.gather(
+                *(client.get("/authorize") for _ in range(5))
+            )
+
+            return [first, second, *concurrent]
+
+    responses = asyncio.run(run())
+
+    assert all(resp.status_code == 302 for resp in responses)
+    assert [req.url.path for req in fake_flickr.requests] == [
+        "/services/oauth/request_token",
+        "/services/oauth/request_token",
+    ]
+
+
+def test_post_request_body_is_passed_to_flask(asgi_app: AsgiApp) -> None:
+    """
+    Requests handled in the thread pool get the request body and headers.
+    """
+
+    @asgi_app.app.post("/echo")
+    def echo() -> str:
+        """
+        Echo back the request body.
+        """
+        from flask import request
+
+        return f"{request.headers['X-Test']}: {request.get_data(as_text=True)}"
+
+    async def run() -> httpx.Response:
+        """
+        Send a POST request to the echo endpoint.
+        """
+        async with make_client(asgi_app) as client:
+            return await client.post(
+                "/echo", content=b"hello world", headers={"X-Test": "a"}
+            )
+
+    resp = asyncio.run(run())
+    assert resp.text == "a: hello world"
+
+
+def test_unknown_url_is_404(asgi_app: AsgiApp) -> None:
+    """
+    Requests for unknown URLs are handled by Flask.
+    """
+    assert get(asgi_app, "/does-not-exist").status_code == 404
+
+
+def test_lifespan_closes_connections(
+    asgi_app: AsgiApp, fake_flickr: FakeFlickr
+) -> None:
+    """
+    The server's lifespan events are acknowledged, and our connections to
+    Flickr are closed when the server shuts down.
+    """
+    sent: list[MutableMapping[str, typing.Any]] = []
+
+    async def run() -> None:
+        """
+        Send the startup and shutdown events to the app.
+        """
+        shared_transport = asgi_app.app.extensions["flickr_http_async"]
+        transport = shared_transport.get()
+
+        messages = iter([{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}])
+
+        async def receive() -> dict[str, typing.Any]:
+            """
+            Receive the next lifespan event.
+            """
+            return next(messages)
+
+        async def send(message: MutableMapping[str, typing.Any]) -> None:
+            """
+            Record a message sent by the app.
+            """
+            sent.append(message)
+
+        await asgi_app({"type": "lifespan"}, receive, send)
+
+        assert shared_transport.get() is not transport
+
+    asyncio.run(run())
+
+    assert sent == [
+        {"type": "lifespan.startup.complete"},
+        {"type": "lifespan.shutdown.complete"},
+    ]
+
+
+def test_websockets_are_not_supported(asgi_app: AsgiApp) -> None:
+    """
+    The app only handles HTTP requests.
+    """
+
+    async def receive() -> dict[str, typing.Any]:
+        """
+        Never called.
+        """
+        raise AssertionError  # pragma: no cover
+
+    async def send(message: MutableMapping[str, typing.Any]) -> None:
+        """
+        Never called.
+        """
+        raise AssertionError  # pragma: no cover
+
+    with pytest.raises(ValueError, match="Unsupported ASGI scope type"):
+        asyncio.run(asgi_app({"type": "websocket"}, receive, send))
+
+
+def test_before_request_hooks_run_for_async_views(asgi_app: AsgiApp) -> None:
+    """
+    A ``before_request`` hook can return a response instead of calling
+    an async view.
+    """
+
+    @asgi_app.app.before_request
+    def maintenance_mode() -> tuple[str, int]:
+        """
+        Reject every request.
+        """
+        return "down for maintenance", 503
+
+    resp = get(asgi_app, "/authorize")
+    assert resp.status_code == 503
+    assert resp.text == "down for maintenance"
+
+
+def test_errors_in_async_views_are_raised(asgi_app: AsgiApp) -> None:
+    """
+    If something goes wrong after an async view, the error is handled
+    by Flask, which re-raises it in testing mode.
+    """
+
+    @asgi_app.app.after_request
+    def broken_hook(resp: typing.Any) -> typing.Any:
+        """
+        Throw an error.
+        """
+        raise RuntimeError("BOOM")
+
+    with pytest.raises(RuntimeError, match="BOOM"):
+        get(asgi_app, "/callback")
+
+
+@pytest.mark.parametrize(
+    "scope, expected",
+    [
+        (
+            {"type": "http", "method": "GET", "path": "/"},
+            {"SCRIPT_NAME": "", "PATH_INFO": "/", "SERVER_NAME": "localhost"},
+        ),
+        (
+            {
+                "type": "http",
+                "method": "POST",
+                "path": "/demo/callback",
+                "root_path": "/demo",
+                "client": ("127.0.0.1", 1234),
+                "headers": [
+                    (b"content-type", b"text/plain"),
+                    (b"accept", b"text/html"),
+                    (b"accept", b"text/plain"),
+                ],
+            },
+            {
+                "SCRIPT_NAME": "/demo",
+                "PATH_INFO": "/callback",
+                "REMOTE_ADDR": "127.0.0.1",
+                "CONTENT_TYPE": "text/plain",
+                "HTTP_ACCEPT": "text/html,text/plain",
+            },
+        ),
+        (
+            {"type": "http", "method": "GET", "path": "/", "root_path": "/demo"},
+            {"SCRIPT_NAME": "/demo", "PATH_INFO": "/"},
+        ),
+    ],
+)
+def test_build_environ(
+    scope: dict[str, typing.Any], expected: dict[str, typing.Any]
+) -> None:
+    """
+    ASGI requests are converted to WSGI environ dicts.
+    """
+    messages: Iterator[dict[str, typing.Any]] = iter(
+        [
+            {"type": "http.request", "body": b"hello ", "more_body": True},
+            {"type": "http.request", "body": b"world"},
+        ]
+    )
+
+    async def receive() -> dict[str, typing.Any]:
+        """
+        Receive the next part of the request body.
+        """
+        return next(messages)
+
+    environ = asyncio.run(build_environ(scope, receive))
+
+    assert {key: environ.get(key) for key in expected} == expected
+    assert environ["wsgi.input"].read() == b"hello world"
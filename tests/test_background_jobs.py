@@ -0,0 +1,250 @@
+"""
+Tests for ``background_jobs.py``, which runs work after we've sent
+the response.
+"""
+
+from collections.abc import Iterator
+import logging
+import threading
+
+from flask import Flask, current_app
+from flask.testing import FlaskClient
+import httpx
+import pytest
+
+from background_jobs import JobRunner, stop_all
+
+
+@pytest.fixture
+def runner(app: Flask) -> Iterator[JobRunner]:
+    """
+    Creates a job runner with one thread and room for one waiting job.
+    """
+    runner = JobRunner(
+        app,
+        metrics=app.extensions["metrics"],
+        threads=1,
+        queue_size=1,
+        drain_timeout=5,
+    )
+    yield runner
+    runner.stop()
+
+
+def test_jobs_run_in_the_background_with_an_app_context(runner: JobRunner) -> None:
+    """
+    A job runs on a background thread, inside an app context, and we
+    record how long it took.
+    """
+    results: list[tuple[str, str, str]] = []
+
+    def job(greeting: str) -> None:
+        """
+        Record which thread and app we ran in.
+        """
+        results.append((greeting, threading.current_thread().name, current_app.name))
+
+    assert runner.submit("greet", job, "hello")
+    assert runner.stop()
+
+    assert results == [("hello", "background-job-0", "app")]
+
+    samples = runner.metrics.collect()
+    assert samples[("background_job_wait_seconds", (("job", "greet"),))][-1] == 1
+    assert (
+        samples[
+            (
+                "background_job_duration_seconds",
+                (("job", "greet"), ("outcome", "success")),
+            )
+        ][-1]
+        == 1
+    )
+
+
+def test_failed_jobs_are_logged(
+    runner: JobRunner, caplog: pytest.LogCaptureFixture
+) -> None:
+    """
+    If a job fails, we log the error and record it in the metrics.
+    """
+
+    def fail() -> None:
+        """
+        Fail.
+        """
+        raise ValueError("boom")
+
+    with caplog.at_level(logging.ERROR, logger="background_jobs"):
+        runner.submit("fail", fail)
+        assert runner.stop()
+
+    assert "Background job fail failed" in caplog.text
+
+    samples = runner.metrics.collect()
+    assert (
+        "background_job_duration_seconds",
+        (("job", "fail"), ("outcome", "error")),
+    ) in samples
+
+
+def test_jobs_are_dropped_when_the_queue_is_full(
+    runner: JobRunner, caplog: pytest.LogCaptureFixture
+) -> None:
+    """
+    If the queue is full, new jobs are dropped rather than waiting.
+    """
+    started = threading.Event()
+    release = threading.Event()
+
+    def block() -> None:
+        """
+        Wait until the test lets us finish.
+        """
+        started.set()
+        assert release.wait(timeout=5)
+
+    # The first job is running, the second is waiting, and there's
+    # no room for the third.
+    assert runner.submit("block", block)
+    assert started.wait(timeout=5)
+    assert runner.submit("block", block)
+
+    with caplog.at_level(logging.WARNING, logger="background_jobs"):
+        assert not runner.submit("block", block)
+
+    assert "Unable to queue background job block" in caplog.text
+
+    samples = runner.metrics.collect()
+    assert samples[("background_jobs_dropped_total", (("job", "block"),))] == [1]
+
+    release.set()
+    assert runner.stop()
+
+
+def test_stop_waits_for_queued_jobs(runner: JobRunner) -> None:
+    """
+    When we stop the runner, it finishes the jobs in the queue, and
+    doesn't take any more.
+    """
+    started = threading.Event()
+    release = threading.Event()
+    results: list[str] = []
+
+    def block() -> None:
+        """
+        Wait until the test lets us finish.
+        """
+        started.set()
+        assert release.wait(timeout=5)
+
+    runner.submit("block", block)
+    assert started.wait(timeout=5)
+    assert runner.submit("append", results.append, "queued")
+
+    stopper = threading.Thread(target=runner.stop)
+    stopper.start()
+
+    release.set()
+    stopper.join()
+
+    assert results == ["queued"]
+    assert not runner.submit("append", results.append, "too late")
+
+
+def test_stop_gives_up_after_the_timeout(
+    runner: JobRunner, caplog: pytest.LogCaptureFixture
+) -> None:
+    """
+    If the jobs don't finish in time, we stop waiting for them.
+    """
+    started = threading.Event()
+    release = threading.Event()
+
+    def block() -> None:
+        """
+        Wait until the test lets us finish.
+        """
+        started.set()
+        assert release.wait(timeout=5)
+
+    runner.submit("block", block)
+    assert started.wait(timeout=5)
+    assert runner.submit("block", block)
+
+    with caplog.at_level(logging.WARNING, logger="background_jobs"):
+        assert not runner.stop(timeout=0.05)
+
+    assert "Abandoning background jobs after 0.1s: 1 running" in caplog.text
+
+    release.set()
+    assert runner.stop()
+
+
+def test_stop_all_drains_every_runner(app: Flask, runner: JobRunner) -> None:
+    """
+    When the process exits, we drain every job runner.
+    """
+    results: list[str] = []
+
+    runner.submit("append", results.append, "done")
+    stop_all()
+
+    assert results == ["done"]
+
+
+def test_login_fetches_the_profile_in_the_background(
+    app: Flask,
+    logged_out_client: FlaskClient,
+    monkeypatch: pytest.MonkeyPatch,
+    caplog: pytest.LogCaptureFixture,
+) -> None:
+    """
+    When somebody logs in, we record it in the audit log and fetch their
+    Flickr profile in the background, so the next page doesn't have to.
+    """
+    app.config["WARM_PROFILE_ON_LOGIN"] = True
+
+    requests: list[httpx.Request] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        """
+        Return an access token, or the user's profile.
+        """
+        requests.append(request)
+
+        if request.url.path == "/services/oauth/access_token":
+            return httpx.Response(
+                200,
+                text="fullname=Father%20Sword&oauth_token=acc123&oauth_token_secret=accsecret&user_nsid=test%40123&username=fathersword",
+            )
+
+        return httpx.Response(
+            200,
+            json={"person": {"photos": {"count": {"_content": 7}}}, "stat": "ok"},
+        )
+
+    monkeypatch.setattr(
+        "httpx.HTTPTransport", lambda **kwargs: httpx.MockTransport(handler)
+    )
+
+    app.extensions["request_token_store"].put(
+        {"oauth_token": "123", "oauth_token_secret": "456"}
+    )
+
+    with caplog.at_level(logging.INFO):
+        resp = logged_out_client.get("/callback?oauth_token=123&oauth_verifier=789")
+        assert resp.status_code == 302
+
+        assert app.extensions["background_jobs"].stop()
+
+    assert "User test@123 logged in from 127.0.0.1" in caplog.text
+    assert [req.url.path for req in requests] == [
+        "/services/oauth/access_token",
+        "/services/rest/",
+    ]
+
+    # The secret page uses the profile we fetched in the background.
+    resp = logged_out_client.get("/secret")
+    assert "You have <strong>7</strong> photos on Flickr." in resp.text
+    assert len(requests) == 2
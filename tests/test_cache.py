@@ -0,0 +1,66 @@
+"""
+Tests for the in-memory TTL cache.
+"""
+
+import pytest
+
+from cache import TTLCache
+
+
+def test_can_get_and_set_values() -> None:
+    """
+    You can retrieve a value after you've cached it.
+    """
+    cache: TTLCache[str, int] = TTLCache(max_size=10, ttl=60)
+    assert cache.get("a") is None
+
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+
+    cache.set("a", 2)
+    assert cache.get("a") == 2
+    assert len(cache) == 1
+
+
+def test_values_expire(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    A value can't be retrieved after its TTL has passed.
+    """
+    cache: TTLCache[str, int] = TTLCache(max_size=10, ttl=60)
+    cache.set("a", 1)
+
+    monkeypatch.setattr("time.monotonic", lambda: float("inf"))
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_least_recently_used_value_is_discarded() -> None:
+    """
+    If the cache is full, it discards the value which was used least
+    recently.
+    """
+    cache: TTLCache[str, int] = TTLCache(max_size=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+
+    # Use "a", so "b" is now the least recently used
+    assert cache.get("a") == 1
+
+    cache.set("c", 3)
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+
+
+def test_can_invalidate_value() -> None:
+    """
+    You can remove a value from the cache.
+    """
+    cache: TTLCache[str, int] = TTLCache(max_size=10, ttl=60)
+    cache.set("a", 1)
+
+    cache.invalidate("a")
+    assert cache.get("a") is None
+
+    # Invalidating a missing value is a no-op
+    cache.invalidate("a")
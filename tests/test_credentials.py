@@ -0,0 +1,144 @@
+"""
+Tests for ``credentials.py``, which finds the Flickr API credentials.
+"""
+
+import json
+import os
+import pathlib
+import subprocess
+import sys
+
+from keyring.backend import KeyringBackend
+from nitrate.mock_keyring import *  # noqa: F403
+import pytest
+
+from app import create_app
+from credentials import Credentials, from_file, load_credentials
+
+
+ALL_SOURCES = ("environment", "file", "keyring")
+
+
+@pytest.fixture
+def credentials_file(tmp_path: pathlib.Path) -> str:
+    """
+    Create a credentials file, and return its path.
+    """
+    path = tmp_path / "credentials.json"
+    path.write_text(json.dumps({"key": "file-key", "secret": "file-secret"}))
+    return str(path)
+
+
+def test_environment_comes_first(
+    mock_keyring: KeyringBackend,
+    monkeypatch: pytest.MonkeyPatch,
+    credentials_file: str,
+) -> None:
+    """
+    Credentials in the environment are used in preference to any others.
+    """
+    mock_keyring.set_password("flickr_flask_login_demo", "key", "keyring-key")
+    mock_keyring.set_password("flickr_flask_login_demo", "secret", "keyring-secret")
+    monkeypatch.setenv("FLICKR_API_KEY", "env-key")
+    monkeypatch.setenv("FLICKR_API_SECRET", "env-secret")
+
+    assert load_credentials(ALL_SOURCES, credentials_file=credentials_file) == (
+        Credentials("env-key", "env-secret", source="environment")
+    )
+
+
+def test_file_comes_before_keyring(
+    mock_keyring: KeyringBackend, credentials_file: str
+) -> None:
+    """
+    Credentials in a file are used in preference to the keychain.
+    """
+    mock_keyring.set_password("flickr_flask_login_demo", "key", "keyring-key")
+    mock_keyring.set_password("flickr_flask_login_demo", "secret", "keyring-secret")
+
+    assert load_credentials(ALL_SOURCES, credentials_file=credentials_file) == (
+        Credentials("file-key", "file-secret", source=f"file:{credentials_file}")
+    )
+
+
+@pytest.mark.parametrize("credentials_file", [None, "doesnotexist.json"])
+def test_falls_back_to_keyring(
+    mock_keyring: KeyringBackend, credentials_file: str | None
+) -> None:
+    """
+    If there's no credentials file, we look in the keychain.
+    """
+    mock_keyring.set_password("flickr_flask_login_demo", "key", "keyring-key")
+    mock_keyring.set_password("flickr_flask_login_demo", "secret", "keyring-secret")
+
+    assert load_credentials(ALL_SOURCES, credentials_file=credentials_file) == (
+        Credentials("keyring-key", "keyring-secret", source="keyring")
+    )
+
+
+def test_incomplete_credentials_are_skipped(
+    mock_keyring: KeyringBackend, tmp_path: pathlib.Path
+) -> None:
+    """
+    If any source only has a key or a secret, but not both, we skip it.
+    """
+    path = tmp_path / "credentials.json"
+    path.write_text(json.dumps({"key": "file-key"}))
+    assert from_file(str(path)) is None
+
+    mock_keyring.set_password("flickr_flask_login_demo", "key", "keyring-key")
+
+    assert load_credentials(ALL_SOURCES, credentials_file=str(path)) is None
+
+
+def test_credentials_are_only_loaded_once(mock_keyring: KeyringBackend) -> None:
+    """
+    Once we've found the credentials, we don't look for them again.
+    """
+    mock_keyring.set_password("flickr_flask_login_demo", "key", "key-1")
+    mock_keyring.set_password("flickr_flask_login_demo", "secret", "secret-1")
+    assert load_credentials(("keyring",)) == ("key-1", "secret-1", "keyring")
+
+    mock_keyring.set_password("flickr_flask_login_demo", "key", "key-2")
+    assert load_credentials(("keyring",)) == ("key-1", "secret-1", "keyring")
+
+
+def test_unrecognised_source_is_error() -> None:
+    """
+    Asking for credentials from an unknown source is an error.
+    """
+    with pytest.raises(ValueError, match="Unrecognised credential source"):
+        load_credentials(("vault",))
+
+
+def test_app_uses_credentials_file(credentials_file: str) -> None:
+    """
+    You can configure the app to read its credentials from a file.
+    """
+    app = create_app(config={"FLICKR_CREDENTIALS_FILE": credentials_file})
+
+    assert app.config["CLIENT_ID"] == "file-key"
+    assert app.config["CLIENT_SECRET"] == "file-secret"
+
+
+def test_creating_the_app_does_not_import_oauth_libraries() -> None:
+    """
+    We don't import the OAuth libraries until the first login, so
+    worker processes start quickly.
+    """
+    code = (
+        "import sys; "
+        "from app import create_app; "
+        "create_app(); "
+        "print(sorted({'asyncio', 'authlib', 'httpx', 'keyring'} & set(sys.modules)))"
+    )
+
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        env={**os.environ, "FLICKR_API_KEY": "123", "FLICKR_API_SECRET": "456"},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    assert result.stdout.strip() == "[]"
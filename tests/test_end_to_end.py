@@ -74,7 +74,10 @@ def test_end_to_end(
 
     # Now pass the redirect URL in here, as if I had been redirected to
     # the running app.
-    callback_url = "http://localhost/callback?oauth_token=OAUTH_TOKEN&oauth_verifier=OAUTH_VERIFIER"
+    #
+    # Flickr sends the user back with the same ``oauth_token`` as the
+    # request token we got in the /authorize step.
+    callback_url = "http://localhost/callback?oauth_token=OAUTH_REQUEST_TOKEN&oauth_verifier=OAUTH_VERIFIER"
 
     # Now actually visit that URL, and check we complete the login
     # and get passed back to the homepage.
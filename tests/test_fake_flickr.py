@@ -0,0 +1,516 @@
+"""
+Tests for ``fake_flickr.py``, the fake Flickr OAuth server we use for
+load testing.
+"""
+
+from collections.abc import Iterator
+import threading
+import time
+
+from authlib.integrations.httpx_client import OAuth1Client
+from flask import Flask
+from flask.testing import FlaskClient
+import httpx
+from keyring.backend import KeyringBackend
+import pytest
+
+from fake_flickr import PHOTO_COUNT, FakeFlickr, FakeFlickrServer, main
+from flickr_api import FlickrApi, api_url_for
+
+
+@pytest.fixture
+def fake_flickr(app: Flask) -> FakeFlickr:
+    """
+    Create a fake Flickr which accepts the app's API key and secret.
+    """
+    return FakeFlickr(
+        consumer_key=app.config["CLIENT_ID"],
+        consumer_secret=app.config["CLIENT_SECRET"],
+    )
+
+
+@pytest.fixture
+def base_url(app: Flask, fake_flickr: FakeFlickr) -> Iterator[str]:
+    """
+    Run the fake Flickr in a background thread, point the app at it,
+    and return its URL.
+    """
+    with FakeFlickrServer(("localhost", 0), fake_flickr) as server:
+        thread = threading.Thread(
+            target=server.serve_forever, kwargs={"poll_interval": 0.01}
+        )
+        thread.start()
+
+        base_url = f"http://localhost:{server.server_port}"
+        app.config["FLICKR_BASE_URL"] = base_url
+        app.extensions["flickr_api"].api_url = api_url_for(base_url)
+
+        yield base_url
+
+        # Close any connections the app has open to the fake Flickr.
+        app.extensions["flickr_http"].close()
+
+        server.shutdown()
+        thread.join()
+
+
+def log_in(client: FlaskClient) -> str:
+    """
+    Go through the whole login flow, and return the homepage.
+    """
+    authorize_resp = client.get("/authorize")
+    assert authorize_resp.status_code == 302
+
+    flickr_resp = httpx.get(authorize_resp.headers["location"])
+    assert flickr_resp.status_code == 302
+
+    callback_resp = client.get(flickr_resp.headers["location"])
+    assert callback_resp.status_code == 302
+    assert callback_resp.headers["location"] == "/"
+
+    return client.get("/").text
+
+
+def test_login_flow(base_url: str, logged_out_client: FlaskClient) -> None:
+    """
+    You can log in to the app using the fake Flickr, and each login
+    is a new user.
+    """
+    assert "fakeuser1" in log_in(logged_out_client)
+
+    logged_out_client.get("/logout")
+
+    assert "fakeuser2" in log_in(logged_out_client)
+
+
+def test_authorize_goes_to_fake_flickr(
+    base_url: str, logged_out_client: FlaskClient
+) -> None:
+    """
+    If the app is configured with a different Flickr base URL, it sends
+    users there instead of flickr.com.
+    """
+    resp = logged_out_client.get("/authorize")
+
+    assert resp.headers["location"].startswith(
+        f"{base_url}/services/oauth/authorize?perms=read&oauth_token="
+    )
+
+
+def test_flickr_base_url_from_environment(
+    app: Flask, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    You can set the Flickr base URL with an environment variable.
+    """
+    from app import create_app
+
+    monkeypatch.setenv("FLASK_FLICKR_BASE_URL", "http://localhost:8009")
+
+    app = create_app()
+    assert app.config["FLICKR_BASE_URL"] == "http://localhost:8009"
+
+    # Unless you set ``FLICKR_API_URL``, API calls go to the same
+    # Flickr that we send users to.
+    assert app.config["FLICKR_API_URL"] == "http://localhost:8009/services/rest/"
+
+
+def test_api_calls_go_to_fake_flickr(
+    base_url: str, app: Flask, logged_out_client: FlaskClient
+) -> None:
+    """
+    If the app is pointed at a fake Flickr, its API calls go there too,
+    signed with the access token the fake Flickr gave out.
+    """
+    log_in(logged_out_client)
+
+    user = app.extensions["user_store"].load("1@N00")
+    api: FlickrApi = app.extensions["flickr_api"]
+
+    resp = api.get(user, "flickr.people.getInfo", user_id=user.user_nsid)
+
+    assert resp["person"]["username"]["_content"] == "fakeuser1"
+    assert resp["person"]["photos"]["count"]["_content"] == 100
+
+
+def test_check_token(base_url: str, app: Flask, logged_out_client: FlaskClient) -> None:
+    """
+    The fake Flickr says that an access token it gave out is valid.
+    """
+    log_in(logged_out_client)
+
+    user = app.extensions["user_store"].load("1@N00")
+    api: FlickrApi = app.extensions["flickr_api"]
+
+    resp = api.call(user, "flickr.auth.oauth.checkToken")
+
+    assert resp["oauth"]["token"]["_content"] == user.oauth_token
+    assert resp["oauth"]["user"]["nsid"] == "1@N00"
+
+
+def test_list_photos_pages(
+    base_url: str, app: Flask, logged_out_client: FlaskClient
+) -> None:
+    """
+    The fake Flickr returns a user's photos a page at a time, so the
+    app has to fetch several pages to get them all.
+    """
+    log_in(logged_out_client)
+
+    user = app.extensions["user_store"].load("1@N00")
+    api: FlickrApi = app.extensions["flickr_api"]
+    api.page_size = 30
+
+    photos = list(
+        api.paginate(
+            user,
+            "flickr.people.getPhotos",
+            container="photos",
+            item="photo",
+            user_id="me",
+        )
+    )
+
+    assert len(photos) == PHOTO_COUNT
+    assert len({photo["id"] for photo in photos}) == PHOTO_COUNT
+    assert [photo["title"] for photo in photos[:2]] == ["Photo 1", "Photo 2"]
+    assert photos[-1]["title"] == f"Photo {PHOTO_COUNT}"
+
+    assert f"Photo {PHOTO_COUNT}" in logged_out_client.get("/photos").text
+
+
+@pytest.mark.parametrize(
+    ["params", "page", "pages", "titles"],
+    [
+        pytest.param({}, 1, 1, ["Photo 1", "Photo 100"], id="default_page_size"),
+        pytest.param(
+            {"page": "2", "per_page": "40"}, 2, 3, ["Photo 41", "Photo 80"], id="middle"
+        ),
+        pytest.param(
+            {"page": "3", "per_page": "40"}, 3, 3, ["Photo 81", "Photo 100"], id="last"
+        ),
+        pytest.param({"page": "4", "per_page": "40"}, 4, 3, [], id="past_the_end"),
+    ],
+)
+def test_photos_page(
+    base_url: str,
+    app: Flask,
+    fake_flickr: FakeFlickr,
+    params: dict[str, str],
+    page: int,
+    pages: int,
+    titles: list[str],
+) -> None:
+    """
+    Each page of photos says where it is in the list, and a page past
+    the end is empty, like on the real Flickr.
+    """
+    fake_flickr.access_tokens.set("token", ("secret", 1))
+
+    with OAuth1Client(
+        client_id=app.config["CLIENT_ID"],
+        client_secret=app.config["CLIENT_SECRET"],
+        token="token",
+        token_secret="secret",
+    ) as client:
+        resp = client.get(
+            f"{base_url}/services/rest/",
+            params={
+                "method": "flickr.people.getPhotos",
+                "format": "json",
+                "nojsoncallback": "1",
+                **params,
+            },
+        )
+
+    photos = resp.json()["photos"]
+
+    assert photos["page"] == page
+    assert photos["pages"] == pages
+    assert photos["total"] == PHOTO_COUNT
+    assert [
+        photo["title"] for photo in photos["photo"][:1] + photos["photo"][-1:]
+    ] == titles
+
+
+@pytest.mark.parametrize(
+    ["token", "token_secret", "method", "code"],
+    [
+        pytest.param(
+            "doesnotexist", "secret", "flickr.people.getInfo", 98, id="unknown_token"
+        ),
+        pytest.param("token", "wrong", "flickr.people.getInfo", 96, id="wrong_secret"),
+        pytest.param(
+            "token", "secret", "flickr.photos.delete", 112, id="unknown_method"
+        ),
+    ],
+)
+def test_api_errors(
+    base_url: str,
+    app: Flask,
+    fake_flickr: FakeFlickr,
+    token: str,
+    token_secret: str,
+    method: str,
+    code: int,
+) -> None:
+    """
+    The fake Flickr only answers API calls which are signed with an
+    access token it gave out, and only for the methods it knows.
+    """
+    fake_flickr.access_tokens.set("token", ("secret", 1))
+
+    with OAuth1Client(
+        client_id=app.config["CLIENT_ID"],
+        client_secret=app.config["CLIENT_SECRET"],
+        token=token,
+        token_secret=token_secret,
+    ) as client:
+        resp = client.get(
+            f"{base_url}/services/rest/",
+            params={"method": method, "format": "json", "nojsoncallback": "1"},
+        )
+
+    assert resp.status_code == 200
+    assert resp.json()["stat"] == "fail"
+    assert resp.json()["code"] == code
+
+
+def test_rejects_wrong_consumer_key(base_url: str) -> None:
+    """
+    The fake Flickr rejects requests from an API key it doesn't know.
+    """
+    with OAuth1Client(client_id="wrong", client_secret="456") as client:
+        resp = client.post(f"{base_url}/services/oauth/request_token")
+
+    assert resp.status_code == 401
+    assert resp.text == "oauth_problem=consumer_key_unknown"
+
+
+def test_rejects_wrong_signature(base_url: str, app: Flask) -> None:
+    """
+    The fake Flickr rejects requests which are signed with the
+    wrong secret.
+    """
+    with OAuth1Client(
+        client_id=app.config["CLIENT_ID"], client_secret="wrong"
+    ) as client:
+        resp = client.post(f"{base_url}/services/oauth/request_token")
+
+    assert resp.status_code == 401
+    assert resp.text == "oauth_problem=signature_invalid"
+
+
+def test_accepts_params_in_body(base_url: str, app: Flask) -> None:
+    """
+    The fake Flickr accepts OAuth parameters in a form-encoded body,
+    as well as the query string and ``Authorization`` header.
+    """
+    with OAuth1Client(
+        client_id=app.config["CLIENT_ID"],
+        client_secret=app.config["CLIENT_SECRET"],
+        signature_type="BODY",
+    ) as client:
+        resp = client.post(
+            f"{base_url}/services/oauth/request_token",
+            data={"oauth_callback": "oob"},
+            headers={"Content-Type": "application/x-www-form-urlencoded"},
+        )
+
+    assert resp.status_code == 200
+    assert "oauth_token=" in resp.text
+
+
+def test_authorize_unknown_token_is_error(base_url: str) -> None:
+    """
+    Trying to approve a request token that doesn't exist is an error.
+    """
+    resp = httpx.get(f"{base_url}/services/oauth/authorize?oauth_token=doesnotexist")
+
+    assert resp.status_code == 400
+
+
+def test_authorize_keeps_callback_query(base_url: str, app: Flask) -> None:
+    """
+    If the callback URL already has a query string, the fake Flickr
+    adds the token and verifier to it.
+    """
+    with OAuth1Client(
+        client_id=app.config["CLIENT_ID"],
+        client_secret=app.config["CLIENT_SECRET"],
+        signature_type="QUERY",
+    ) as client:
+        request_token = client.fetch_request_token(
+            f"{base_url}/services/oauth/request_token",
+            params={"oauth_callback": "http://localhost/callback?next=secret"},
+        )
+
+    resp = httpx.get(
+        f"{base_url}/services/oauth/authorize",
+        params={"oauth_token": request_token["oauth_token"]},
+    )
+
+    assert resp.headers["location"].startswith(
+        "http://localhost/callback?next=secret&oauth_token="
+    )
+
+
+@pytest.mark.parametrize(
+    ["token", "authorize", "token_secret", "problem"],
+    [
+        pytest.param("doesnotexist", False, None, "token_rejected", id="unknown_token"),
+        pytest.param(None, False, None, "verifier_invalid", id="not_authorized"),
+        pytest.param(None, True, "wrong", "signature_invalid", id="wrong_secret"),
+    ],
+)
+def test_access_token_errors(
+    base_url: str,
+    app: Flask,
+    token: str | None,
+    authorize: bool,
+    token_secret: str | None,
+    problem: str,
+) -> None:
+    """
+    The fake Flickr won't give out an access token unless the request
+    token exists, has been approved, and the request is signed with
+    its secret.
+    """
+    with OAuth1Client(
+        client_id=app.config["CLIENT_ID"],
+        client_secret=app.config["CLIENT_SECRET"],
+        signature_type="QUERY",
+    ) as client:
+        request_token = client.fetch_request_token(
+            f"{base_url}/services/oauth/request_token",
+            params={"oauth_callback": "http://localhost/callback"},
+        )
+
+    verifier = "not-a-verifier"
+
+    if authorize:
+        resp = httpx.get(
+            f"{base_url}/services/oauth/authorize",
+            params={"oauth_token": request_token["oauth_token"]},
+        )
+        verifier = httpx.URL(resp.headers["location"]).params["oauth_verifier"]
+
+    with OAuth1Client(
+        client_id=app.config["CLIENT_ID"],
+        client_secret=app.config["CLIENT_SECRET"],
+        token=token or request_token["oauth_token"],
+        token_secret=token_secret or request_token["oauth_token_secret"],
+        verifier=verifier,
+    ) as client:
+        resp = client.post(f"{base_url}/services/oauth/access_token")
+
+    assert resp.status_code == 401
+    assert resp.text == f"oauth_problem={problem}"
+
+
+def test_unknown_path_is_404(base_url: str) -> None:
+    """
+    Any other URL is a 404.
+    """
+    resp = httpx.get(f"{base_url}/services/rest")
+
+    assert resp.status_code == 404
+
+
+def test_error_rate(base_url: str, fake_flickr: FakeFlickr) -> None:
+    """
+    You can make the fake Flickr fail some requests.
+    """
+    fake_flickr.error_rate = 1
+
+    resp = httpx.post(f"{base_url}/services/oauth/request_token")
+
+    assert resp.status_code == 503
+
+
+def test_latency(base_url: str, fake_flickr: FakeFlickr) -> None:
+    """
+    You can make the fake Flickr slow to respond.
+    """
+    fake_flickr.latency = 0.1
+    fake_flickr.jitter = 0.05
+
+    start = time.perf_counter()
+    httpx.get(f"{base_url}/services/rest")
+    elapsed = time.perf_counter() - start
+
+    assert elapsed >= 0.05
+
+
+def test_verbose_logging(
+    base_url: str, fake_flickr: FakeFlickr, capsys: pytest.CaptureFixture[str]
+) -> None:
+    """
+    In verbose mode, the fake Flickr logs every request.
+    """
+    with FakeFlickrServer(("localhost", 0), fake_flickr, verbose=True) as server:
+        thread = threading.Thread(target=server.handle_request)
+        thread.start()
+
+        httpx.get(f"http://localhost:{server.server_port}/services/rest")
+        thread.join()
+
+    assert '"GET /services/rest HTTP/1.1" 404' in capsys.readouterr().err
+
+
+def test_main(
+    app: Flask, monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str]
+) -> None:
+    """
+    You can run the fake Flickr from the command line, and stop it
+    with Ctrl+C.
+    """
+
+    def serve_forever(self: FakeFlickrServer) -> None:
+        """
+        Check the server was configured correctly, then pretend
+        the user pressed Ctrl+C.
+        """
+        assert self.flickr.consumer_key == app.config["CLIENT_ID"]
+        assert self.flickr.latency == 0.2
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(FakeFlickrServer, "serve_forever", serve_forever)
+
+    main(["--port", "0", "--latency", "0.2"])
+
+    assert "Fake Flickr running at http://localhost:" in capsys.readouterr().out
+
+
+def test_main_without_credentials(
+    mock_keyring: KeyringBackend, capsys: pytest.CaptureFixture[str]
+) -> None:
+    """
+    If there are no credentials in the keychain, you have to pass them
+    on the command line.
+    """
+    with pytest.raises(SystemExit):
+        main([])
+
+    assert "--consumer-key" in capsys.readouterr().err
+
+
+def test_main_with_explicit_credentials(
+    mock_keyring: KeyringBackend, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    You can tell the fake Flickr which API key and secret to accept.
+    """
+
+    def serve_forever(self: FakeFlickrServer) -> None:
+        """
+        Check the server was configured correctly, then pretend
+        the user pressed Ctrl+C.
+        """
+        assert self.flickr.consumer_key == "my-key"
+        assert self.flickr.consumer_secret == "my-secret"
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(FakeFlickrServer, "serve_forever", serve_forever)
+
+    main(["--port", "0", "--consumer-key", "my-key", "--consumer-secret", "my-secret"])
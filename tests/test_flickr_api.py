@@ -0,0 +1,544 @@
+"""
+Tests for ``flickr_api.py``, which makes cached Flickr API calls for
+a logged-in user.
+"""
+
+from collections.abc import Generator, Iterator
+import logging
+import threading
+import time
+import typing
+
+from flask import Flask
+from flask.testing import FlaskClient
+from flask_login import FlaskLoginClient
+import httpx
+import pytest
+
+from app import warm_profile
+from flickr_api import FlickrApi, FlickrApiError
+from flickr_calls import FlickrRateLimited
+from rate_limit import MemoryRateLimiter
+from users import FlickrUser
+
+
+class FakeFlickrApi:
+    """
+    A fake Flickr API, which returns a numbered response to every call,
+    so we can tell whether a response came from the cache.
+    """
+
+    def __init__(self) -> None:
+        self.requests: list[httpx.Request] = []
+
+        # This is set once we've received a request
+        self.called = threading.Event()
+
+        # If this is set, requests wait until it's set before they
+        # get a response.
+        self.release: threading.Event | None = None
+
+        # The response to return, instead of a numbered one
+        self.response: httpx.Response | None = None
+
+        # How many photos the user has, for ``flickr.people.getPhotos``
+        self.photos = 0
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        """
+        Handle an API call.
+        """
+        self.requests.append(request)
+        self.called.set()
+
+        if self.release is not None:
+            assert self.release.wait(timeout=5)
+
+        if self.response is not None:
+            return self.response
+
+        if request.url.params["method"] == "flickr.people.getPhotos":
+            return self.photos_page(request)
+
+        count = len(self.requests)
+
+        return httpx.Response(
+            200,
+            json={
+                "person": {"photos": {"count": {"_content": count}}},
+                "stat": "ok",
+            },
+        )
+
+    def photos_page(self, request: httpx.Request) -> httpx.Response:
+        """
+        Return a page of the user's photos.
+        """
+        page = int(request.url.params["page"])
+        per_page = int(request.url.params["per_page"])
+
+        start = (page - 1) * per_page
+        end = min(start + per_page, self.photos)
+
+        return httpx.Response(
+            200,
+            json={
+                "photos": {
+                    "page": page,
+                    "pages": max(1, -(-self.photos // per_page)),
+                    "photo": [
+                        {"id": str(i), "title": f"Photo {i}"} for i in range(start, end)
+                    ],
+                },
+                "stat": "ok",
+            },
+        )
+
+
+@pytest.fixture
+def fake_api(monkeypatch: pytest.MonkeyPatch) -> FakeFlickrApi:
+    """
+    Replace the Flickr API with a fake.
+    """
+    fake = FakeFlickrApi()
+
+    monkeypatch.setattr(
+        "httpx.HTTPTransport", lambda **kwargs: httpx.MockTransport(fake)
+    )
+
+    return fake
+
+
+@pytest.fixture
+def api(app: Flask, fake_api: FakeFlickrApi) -> Iterator[FlickrApi]:
+    """
+    Returns the app's Flickr API client, and waits for any background
+    refreshes to finish at the end of the test.
+    """
+    api: FlickrApi = app.extensions["flickr_api"]
+    api.policy.backoff = 0
+    yield api
+    api.close()
+
+
+@pytest.fixture
+def api_user() -> FlickrUser:
+    """
+    Returns a user with an OAuth access token.
+    """
+    return FlickrUser(
+        user_nsid="test@123",
+        name="Father Sword",
+        oauth_token="usertoken",
+        oauth_token_secret="usersecret",
+    )
+
+
+def photo_count(api: FlickrApi, user: FlickrUser) -> int:
+    """
+    Get the number of photos a user has, from the API.
+    """
+    resp = api.get(user, "flickr.people.getInfo", user_id=user.user_nsid)
+    count: int = resp["person"]["photos"]["count"]["_content"]
+    return count
+
+
+def test_calls_are_signed_with_the_users_token(
+    api: FlickrApi, fake_api: FakeFlickrApi, api_user: FlickrUser
+) -> None:
+    """
+    API calls are signed with the user's access token, and ask for JSON.
+    """
+    photo_count(api, api_user)
+
+    request = fake_api.requests[0]
+
+    assert request.url.host == "api.flickr.com"
+    assert request.url.params["method"] == "flickr.people.getInfo"
+    assert request.url.params["format"] == "json"
+    assert request.url.params["user_id"] == "test@123"
+    assert 'oauth_token="usertoken"' in request.headers["Authorization"]
+
+
+def test_responses_are_cached_per_user(
+    api: FlickrApi, fake_api: FakeFlickrApi, api_user: FlickrUser
+) -> None:
+    """
+    Repeating the same call for the same user uses the cache; a different
+    user gets their own response.
+    """
+    assert photo_count(api, api_user) == 1
+    assert photo_count(api, api_user) == 1
+
+    other_user = FlickrUser("other@123", "Other", "othertoken", "othersecret")
+    assert photo_count(api, other_user) == 2
+
+    assert len(fake_api.requests) == 2
+
+
+def test_stale_responses_are_refreshed_in_the_background(
+    api: FlickrApi, fake_api: FakeFlickrApi, api_user: FlickrUser
+) -> None:
+    """
+    Once a response is stale, we keep using it while we fetch a fresh
+    copy in the background.
+    """
+    api.cache_ttl = 0
+
+    assert photo_count(api, api_user) == 1
+
+    # This returns the stale response, and fetches a new one
+    assert photo_count(api, api_user) == 1
+
+    api.cache_ttl = 60
+
+    deadline = time.monotonic() + 5
+    while photo_count(api, api_user) != 2:
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+    assert len(fake_api.requests) == 2
+
+
+def test_failed_refresh_keeps_the_stale_response(
+    api: FlickrApi,
+    fake_api: FakeFlickrApi,
+    api_user: FlickrUser,
+    caplog: pytest.LogCaptureFixture,
+) -> None:
+    """
+    If we can't refresh a stale response, we log a warning and keep
+    using the stale one.
+    """
+    api.cache_ttl = 0
+    assert photo_count(api, api_user) == 1
+
+    fake_api.response = httpx.Response(401)
+
+    with caplog.at_level(logging.WARNING, logger="flickr_api"):
+        assert photo_count(api, api_user) == 1
+        assert photo_count(api, api_user) == 1
+        api.close()
+
+    assert "Unable to refresh flickr.people.getInfo for test@123" in caplog.text
+
+
+def test_identical_calls_are_collapsed(
+    api: FlickrApi, fake_api: FakeFlickrApi, api_user: FlickrUser
+) -> None:
+    """
+    If lots of requests make the same call at once, we only call
+    Flickr once.
+    """
+    fake_api.release = threading.Event()
+    results: list[int] = []
+
+    threads = [
+        threading.Thread(target=lambda: results.append(photo_count(api, api_user)))
+        for _ in range(5)
+    ]
+    for t in threads:
+        t.start()
+
+    # Wait for the first call to reach Flickr, give the other threads
+    # a moment to join it, then let it finish.
+    assert fake_api.called.wait(timeout=5)
+    time.sleep(0.05)
+    fake_api.release.set()
+
+    for t in threads:
+        t.join()
+
+    assert results == [1] * 5
+    assert len(fake_api.requests) == 1
+
+
+@pytest.mark.parametrize(
+    "response, code",
+    [
+        (
+            httpx.Response(
+                200, json={"stat": "fail", "code": 1, "message": "User not found"}
+            ),
+            1,
+        ),
+        (httpx.Response(401), 401),
+    ],
+)
+def test_errors_are_not_cached(
+    api: FlickrApi,
+    fake_api: FakeFlickrApi,
+    api_user: FlickrUser,
+    response: httpx.Response,
+    code: int,
+) -> None:
+    """
+    If Flickr returns an error, we raise it, and we don't cache it.
+    """
+    fake_api.response = response
+
+    for _ in range(2):
+        with pytest.raises(FlickrApiError) as exc_info:
+            photo_count(api, api_user)
+
+        assert exc_info.value.code == code
+
+    assert len(fake_api.requests) == 2
+
+
+def test_secret_page_shows_photo_count(
+    app: Flask, api: FlickrApi, fake_api: FakeFlickrApi, api_user: FlickrUser
+) -> None:
+    """
+    The secret page shows how many photos the user has on Flickr, once
+    we've fetched it -- it doesn't wait for Flickr.
+    """
+    fake_api.release = threading.Event()
+
+    app.extensions["user_store"].save(api_user)
+    app.test_client_class = FlaskLoginClient
+
+    with app.test_client(user=api_user) as client:
+        # The first time, we don't have the count yet, so we show the
+        # page without it, and fetch it in the background.
+        resp = client.get("/secret")
+        assert resp.status_code == 200
+        assert "photos on Flickr" not in resp.text
+
+        assert fake_api.called.wait(timeout=5)
+        fake_api.release.set()
+
+        deadline = time.monotonic() + 5
+        while "You have <strong>1</strong> photos on Flickr." not in resp.text:
+            assert time.monotonic() < deadline
+            time.sleep(0.001)
+            resp = client.get("/secret")
+
+    assert len(fake_api.requests) == 1
+
+
+def test_secret_page_works_if_flickr_is_down(
+    app: Flask,
+    api: FlickrApi,
+    fake_api: FakeFlickrApi,
+    api_user: FlickrUser,
+    caplog: pytest.LogCaptureFixture,
+) -> None:
+    """
+    If we can't get the user's profile from Flickr, we show the secret
+    page without it.
+    """
+    fake_api.response = httpx.Response(503)
+
+    app.extensions["user_store"].save(api_user)
+    app.test_client_class = FlaskLoginClient
+
+    with app.test_client(user=api_user) as client:
+        resp = client.get("/secret")
+
+    assert resp.status_code == 200
+    assert "photos on Flickr" not in resp.text
+
+    # If we can't fetch the profile after they log in, we log it.
+    with app.app_context(), caplog.at_level(logging.WARNING):
+        warm_profile(api_user)
+
+    assert "Unable to get Flickr profile for test@123" in caplog.text
+
+
+def test_secret_page_without_access_token(
+    logged_in_client: FlaskClient, fake_api: FakeFlickrApi
+) -> None:
+    """
+    If we don't have the user's access token, we don't call Flickr.
+    """
+    resp = logged_in_client.get("/secret")
+
+    assert resp.status_code == 200
+    assert fake_api.requests == []
+
+
+def list_photos(
+    api: FlickrApi, user: FlickrUser
+) -> Generator[dict[str, typing.Any], None, None]:
+    """
+    List all the user's photos, from the API.
+    """
+    return api.paginate(
+        user, "flickr.people.getPhotos", container="photos", item="photo", user_id="me"
+    )
+
+
+@pytest.mark.parametrize("photos", [0, 3, 10, 11])
+def test_paginate_yields_every_item_in_order(
+    api: FlickrApi, fake_api: FakeFlickrApi, api_user: FlickrUser, photos: int
+) -> None:
+    """
+    Paginating a list yields every item from every page, in order.
+    """
+    api.page_size = 5
+    fake_api.photos = photos
+
+    ids = [photo["id"] for photo in list_photos(api, api_user)]
+
+    assert ids == [str(i) for i in range(photos)]
+    assert len(fake_api.requests) == max(1, -(-photos // 5))
+
+
+def test_paginate_fetches_a_few_pages_at_once(
+    api: FlickrApi, fake_api: FakeFlickrApi, api_user: FlickrUser
+) -> None:
+    """
+    We fetch several pages at once, but no more than the concurrency
+    limit, and we don't fetch pages nobody's asked for yet.
+    """
+    api.page_size = 1
+    api.page_concurrency = 3
+    fake_api.photos = 100
+
+    photos = list_photos(api, api_user)
+
+    # Getting the first item only needs the first page.
+    assert next(photos)["id"] == "0"
+    assert len(fake_api.requests) == 1
+
+    # Getting the second item starts fetching the next three pages,
+    # and no more.
+    assert next(photos)["id"] == "1"
+    time.sleep(0.05)
+    assert len(fake_api.requests) == 4
+
+    # If we stop, we don't fetch any more pages.
+    photos.close()
+    time.sleep(0.05)
+    assert len(fake_api.requests) == 4
+
+
+def test_long_lists_wait_for_the_rate_limiter(
+    api: FlickrApi, fake_api: FakeFlickrApi, api_user: FlickrUser
+) -> None:
+    """
+    If a list has more pages than the rate limiter allows in a burst,
+    we wait for the bucket to refill, rather than stopping early.
+    """
+    api.policy.limiter = MemoryRateLimiter(rate=200, capacity=2, reserve=0)
+    api.page_size = 1
+    fake_api.photos = 10
+
+    ids = [photo["id"] for photo in list_photos(api, api_user)]
+
+    assert ids == [str(i) for i in range(10)]
+
+
+def test_waiting_page_gives_up_if_the_caller_stops(
+    api: FlickrApi, fake_api: FakeFlickrApi, api_user: FlickrUser
+) -> None:
+    """
+    If a page is waiting for the rate limiter when the caller stops,
+    it gives up rather than calling Flickr.
+    """
+    api.policy.limiter = MemoryRateLimiter(
+        rate=1, capacity=1, reserve=0, background_reserve=0.5
+    )
+
+    stopped = threading.Event()
+    stopped.set()
+
+    with pytest.raises(FlickrRateLimited):
+        api._fetch_page(api_user, "flickr.people.getPhotos", {}, stopped)
+
+    assert fake_api.requests == []
+
+
+def test_photos_page_says_if_the_list_is_incomplete(
+    app: Flask, fake_api: FakeFlickrApi, api_user: FlickrUser
+) -> None:
+    """
+    If we're rate limited for too long, the photos page stops the list
+    and says it's incomplete -- and it doesn't use up the calls we need
+    for new logins.
+    """
+    limiter = MemoryRateLimiter(rate=0.001, capacity=3, reserve=0, background_reserve=1)
+
+    api: FlickrApi = app.extensions["flickr_api"]
+    api.policy.limiter = limiter
+    api.page_size = 5
+    api.page_max_wait = 1
+    fake_api.photos = 12
+
+    app.extensions["user_store"].save(api_user)
+    app.test_client_class = FlaskLoginClient
+
+    with app.test_client(user=api_user) as client:
+        resp = client.get("/photos")
+
+    assert resp.status_code == 200
+    assert "Photo 9</a>" in resp.text
+    assert "Photo 10</a>" not in resp.text
+    assert "this list is incomplete -- it only has the first 10." in resp.text
+
+    assert limiter.acquire(urgent=False) == 0
+
+
+def test_photos_page_streams_every_photo(
+    app: Flask, fake_api: FakeFlickrApi, api_user: FlickrUser
+) -> None:
+    """
+    The photos page lists every photo the user has.
+    """
+    app.extensions["flickr_api"].page_size = 5
+    fake_api.photos = 12
+
+    app.extensions["user_store"].save(api_user)
+    app.test_client_class = FlaskLoginClient
+
+    with app.test_client(user=api_user) as client:
+        resp = client.get("/photos")
+
+    assert resp.status_code == 200
+    assert resp.is_streamed
+    assert resp.headers["Cache-Control"] == "private, no-store"
+
+    for i in range(12):
+        assert (
+            f'<li><a href="https://www.flickr.com/photos/test@123/{i}/">Photo {i}</a></li>'
+            in resp.text
+        )
+
+    assert "couldn't get all your photos" not in resp.text
+
+
+def test_photos_page_shows_an_error_if_flickr_fails(
+    app: Flask, fake_api: FakeFlickrApi, api_user: FlickrUser
+) -> None:
+    """
+    If Flickr fails partway through the list, the page ends with
+    an error message.
+    """
+    fake_api.response = httpx.Response(401)
+
+    app.extensions["user_store"].save(api_user)
+    app.test_client_class = FlaskLoginClient
+
+    with app.test_client(user=api_user) as client:
+        resp = client.get("/photos")
+
+    assert resp.status_code == 200
+    assert (
+        "We couldn&#39;t get all your photos from Flickr, "
+        "so this list is incomplete -- it only has the first 0." in resp.text
+    )
+
+
+def test_photos_page_without_access_token(
+    logged_in_client: FlaskClient, fake_api: FakeFlickrApi
+) -> None:
+    """
+    If we don't have the user's access token, we can't list their
+    photos, so we send them back to the secret page.
+    """
+    resp = logged_in_client.get("/photos")
+
+    assert resp.status_code == 302
+    assert resp.headers["location"] == "/secret"
+    assert fake_api.requests == []
@@ -0,0 +1,461 @@
+"""
+Tests for ``flickr_calls.py``, which adds timeouts, retries and
+a circuit breaker to our calls to Flickr.
+"""
+
+import asyncio
+from collections.abc import Callable
+
+from flask import Flask
+from flask.testing import FlaskClient
+import httpx
+import pytest
+
+from flickr_calls import (
+    CircuitBreaker,
+    FlickrCallPolicy,
+    FlickrRateLimited,
+    FlickrUnavailable,
+)
+from rate_limit import MemoryRateLimiter
+
+
+def create_policy(
+    *, failure_threshold: int = 5, reset_timeout: float = 30, deadline: float = 10
+) -> FlickrCallPolicy:
+    """
+    Create a call policy which retries twice, without waiting between
+    retries.
+    """
+    return FlickrCallPolicy(
+        breaker=CircuitBreaker(
+            failure_threshold=failure_threshold, reset_timeout=reset_timeout
+        ),
+        limiter=None,
+        deadline=deadline,
+        retries=2,
+        backoff=0,
+    )
+
+
+def flaky(failures: int) -> tuple[Callable[[float], str], list[float]]:
+    """
+    Create a function which fails ``failures`` times, then succeeds.
+
+    Returns the function, and a list of the timeouts it was called with.
+    """
+    timeouts: list[float] = []
+
+    def fn(timeout: float) -> str:
+        """
+        Pretend to call Flickr.
+        """
+        timeouts.append(timeout)
+        if len(timeouts) <= failures:
+            raise httpx.ConnectError("Flickr is down")
+        return "ok"
+
+    return fn, timeouts
+
+
+class TestCircuitBreaker:
+    """
+    Tests for the circuit breaker.
+    """
+
+    def test_opens_after_too_many_failures(self) -> None:
+        """
+        The breaker opens after enough failures in a row, and then
+        it stops calls going through.
+        """
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+
+        for _ in range(2):
+            breaker.record_failure()
+            assert breaker.allow()
+
+        breaker.record_failure()
+        assert not breaker.allow()
+
+        # Calls which were already in flight when it opened can still fail
+        breaker.record_failure()
+
+        snapshot = breaker.snapshot()
+        assert snapshot["state"] == "open"
+        assert snapshot["consecutive_failures"] == 4
+        assert 29 < snapshot["retry_after"] <= 30
+
+    def test_success_resets_the_count(self) -> None:
+        """
+        Failures only open the breaker if they happen in a row.
+        """
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+
+        assert breaker.snapshot() == {
+            "state": "closed",
+            "consecutive_failures": 1,
+            "retry_after": 0,
+        }
+
+    def test_half_open_lets_one_call_through(self) -> None:
+        """
+        After the reset timeout, the breaker lets a single call through
+        to test if Flickr has recovered.
+        """
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+
+        assert breaker.allow()
+        assert breaker.state == "half_open"
+        assert not breaker.allow()
+
+        breaker.record_success()
+        assert breaker.state == "closed"
+        assert breaker.allow()
+
+    def test_failure_when_half_open_reopens(self) -> None:
+        """
+        If the test call fails, the breaker opens again.
+        """
+        breaker = CircuitBreaker(failure_threshold=5, reset_timeout=0)
+        for _ in range(5):
+            breaker.record_failure()
+
+        assert breaker.allow()
+        breaker.record_failure()
+
+        assert breaker.state == "open"
+
+
+class TestFlickrCallPolicy:
+    """
+    Tests for the deadlines and retries.
+    """
+
+    def test_retries_until_success(self) -> None:
+        """
+        Failed calls are retried, and each attempt gets the time that's
+        left before the deadline.
+        """
+        policy = create_policy()
+        fn, timeouts = flaky(failures=2)
+
+        assert policy.call(fn, retry=True) == "ok"
+
+        assert len(timeouts) == 3
+        assert 0 < timeouts[2] <= timeouts[1] <= timeouts[0] <= 10
+        assert policy.breaker.state == "closed"
+
+    def test_gives_up_after_retries(self) -> None:
+        """
+        If every retry fails, the call fails with FlickrUnavailable.
+        """
+        policy = create_policy()
+        fn, timeouts = flaky(failures=3)
+
+        with pytest.raises(FlickrUnavailable) as exc_info:
+            policy.call(fn, retry=True)
+
+        assert len(timeouts) == 3
+        assert isinstance(exc_info.value.__cause__, httpx.ConnectError)
+
+    def test_does_not_retry_if_told_not_to(self) -> None:
+        """
+        Calls which aren't safe to repeat are only tried once.
+        """
+        policy = create_policy()
+        fn, timeouts = flaky(failures=1)
+
+        with pytest.raises(FlickrUnavailable):
+            policy.call(fn, retry=False)
+
+        assert len(timeouts) == 1
+
+    def test_does_not_retry_past_the_deadline(self) -> None:
+        """
+        If there isn't time to retry before the deadline, we give up.
+        """
+        policy = create_policy(deadline=0.01)
+        policy.backoff = 60
+        fn, timeouts = flaky(failures=1)
+
+        with pytest.raises(FlickrUnavailable):
+            policy.call(fn, retry=True)
+
+        assert len(timeouts) == 1
+
+    def test_other_errors_are_not_retried(self) -> None:
+        """
+        Other errors (e.g. a bad signature) are raised immediately, and
+        don't count against Flickr.
+        """
+        policy = create_policy()
+        policy.breaker.record_failure()
+
+        def fn(timeout: float) -> str:
+            """
+            Pretend Flickr rejected our request.
+            """
+            raise ValueError("signature_invalid")
+
+        with pytest.raises(ValueError):
+            policy.call(fn, retry=True)
+
+        assert policy.breaker.consecutive_failures == 0
+
+    def test_open_breaker_fails_fast(self) -> None:
+        """
+        If the breaker is open, we don't call Flickr at all.
+        """
+        policy = create_policy(failure_threshold=1)
+        fn, timeouts = flaky(failures=1)
+
+        with pytest.raises(FlickrUnavailable):
+            policy.call(fn, retry=True)
+
+        with pytest.raises(FlickrUnavailable) as exc_info:
+            policy.call(fn, retry=True)
+
+        assert len(timeouts) == 1
+        assert exc_info.value.retry_after > 29
+
+    def test_async_calls(self) -> None:
+        """
+        Async calls are retried in the same way.
+        """
+        policy = create_policy()
+
+        async def run() -> None:
+            """
+            Make some async calls to a flaky function.
+            """
+            fn, timeouts = flaky(failures=2)
+
+            async def async_fn(timeout: float) -> str:
+                """
+                An async version of the flaky function.
+                """
+                return fn(timeout)
+
+            assert await policy.call_async(async_fn, retry=True) == "ok"
+            assert len(timeouts) == 3
+
+            fn, timeouts = flaky(failures=1)
+            with pytest.raises(FlickrUnavailable):
+                await policy.call_async(async_fn, retry=False)
+            assert len(timeouts) == 1
+
+            async def bad_signature(timeout: float) -> str:
+                """
+                Pretend Flickr rejected our request.
+                """
+                raise ValueError("signature_invalid")
+
+            with pytest.raises(ValueError):
+                await policy.call_async(bad_signature, retry=True)
+
+            fn, timeouts = flaky(failures=100)
+            with pytest.raises(FlickrUnavailable):
+                await policy.call_async(async_fn, retry=True)
+
+            policy.breaker.state = "open"
+            policy.breaker.opened_at = float("inf")
+
+            with pytest.raises(FlickrUnavailable):
+                await policy.call_async(async_fn, retry=True)
+
+        asyncio.run(run())
+
+    def test_interrupted_trial_doesnt_wedge_the_breaker(self) -> None:
+        """
+        If the half-open trial is interrupted, the next call becomes
+        the trial instead.
+        """
+        policy = create_policy(failure_threshold=1, reset_timeout=0)
+        policy.breaker.record_failure()
+
+        def interrupted(timeout: float) -> str:
+            """
+            Pretend the user pressed Ctrl-C while we were calling Flickr.
+            """
+            raise KeyboardInterrupt
+
+        with pytest.raises(KeyboardInterrupt):
+            policy.call(interrupted, retry=True)
+
+        assert policy.breaker.state == "half_open"
+
+        fn, timeouts = flaky(failures=0)
+        assert policy.call(fn, retry=True) == "ok"
+        assert policy.breaker.state == "closed"
+
+    def test_rate_limited_trial_doesnt_wedge_the_breaker(
+        self, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        """
+        If the half-open trial is rate limited, we don't call Flickr,
+        and the next call once the bucket has refilled becomes the trial.
+        """
+        now = 1000.0
+        monkeypatch.setattr("time.monotonic", lambda: now)
+
+        policy = create_policy(failure_threshold=1, reset_timeout=0)
+        policy.limiter = MemoryRateLimiter(rate=1, capacity=1, reserve=0)
+        policy.breaker.record_failure()
+
+        fn, timeouts = flaky(failures=0)
+        policy.limiter.acquire(urgent=False)
+
+        with pytest.raises(FlickrRateLimited):
+            policy.call(fn, retry=True)
+
+        async def async_fn(timeout: float) -> str:
+            """
+            An async version of the function.
+            """
+            return fn(timeout)  # pragma: no cover
+
+        with pytest.raises(FlickrRateLimited):
+            asyncio.run(policy.call_async(async_fn, retry=True))
+
+        assert timeouts == []
+        assert policy.breaker.state == "half_open"
+
+        now += 1
+        assert policy.call(fn, retry=True) == "ok"
+        assert policy.breaker.state == "closed"
+
+    def test_cancelled_trial_doesnt_wedge_the_breaker(self) -> None:
+        """
+        If the half-open trial is cancelled, the next call becomes the
+        trial instead.
+        """
+        policy = create_policy(failure_threshold=1, reset_timeout=0)
+        policy.breaker.record_failure()
+
+        async def run() -> None:
+            """
+            Cancel the trial call, then make another one.
+            """
+            started = asyncio.Event()
+
+            async def slow(timeout: float) -> str:
+                """
+                Pretend to wait for Flickr.
+                """
+                started.set()
+                await asyncio.sleep(60)
+                return "slow"  # pragma: no cover
+
+            trial = asyncio.create_task(policy.call_async(slow, retry=True))
+            await started.wait()
+            trial.cancel()
+
+            with pytest.raises(asyncio.CancelledError):
+                await trial
+
+            assert policy.breaker.state == "half_open"
+
+            async def fast(timeout: float) -> str:
+                """
+                Pretend Flickr has recovered.
+                """
+                return "ok"
+
+            assert await policy.call_async(fast, retry=True) == "ok"
+            assert policy.breaker.state == "closed"
+
+        asyncio.run(run())
+
+
+@pytest.fixture
+def flickr_requests(app: Flask, monkeypatch: pytest.MonkeyPatch) -> list[httpx.Request]:
+    """
+    Replace Flickr with a fake that always returns a 503 error, and
+    return a list of the requests it receives.
+    """
+    requests: list[httpx.Request] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        """
+        Record the request, then fail.
+        """
+        requests.append(request)
+        return httpx.Response(503, text="Service Unavailable")
+
+    monkeypatch.setattr(
+        "httpx.HTTPTransport", lambda **kwargs: httpx.MockTransport(handler)
+    )
+
+    app.extensions["flickr_call_policy"].backoff = 0
+
+    return requests
+
+
+def test_authorize_is_friendly_503_if_flickr_is_down(
+    logged_out_client: FlaskClient, flickr_requests: list[httpx.Request]
+) -> None:
+    """
+    If we can't get a request token from Flickr, we try a few times
+    then show a friendly error page.
+    """
+    resp = logged_out_client.get("/authorize")
+
+    assert resp.status_code == 503
+    assert resp.headers["Retry-After"] == "1"
+    assert "we can't reach Flickr" in resp.text
+
+    assert len(flickr_requests) == 3
+
+
+def test_callback_is_not_retried(
+    app: Flask, logged_out_client: FlaskClient, flickr_requests: list[httpx.Request]
+) -> None:
+    """
+    If we can't get an access token from Flickr, we don't retry.
+    """
+    app.extensions["request_token_store"].put(
+        {"oauth_token": "123", "oauth_token_secret": "456"}
+    )
+
+    resp = logged_out_client.get("/callback?oauth_token=123&oauth_verifier=789")
+
+    assert resp.status_code == 503
+    assert len(flickr_requests) == 1
+
+
+def test_breaker_opens_when_flickr_is_down(
+    logged_out_client: FlaskClient, flickr_requests: list[httpx.Request]
+) -> None:
+    """
+    Once Flickr has failed enough times, we stop calling it, and the
+    breaker state is reported on the status page.
+    """
+    logged_out_client.get("/authorize")
+    logged_out_client.get("/authorize")
+
+    assert len(flickr_requests) == 5
+
+    resp = logged_out_client.get("/authorize")
+    assert resp.status_code == 503
+    assert int(resp.headers["Retry-After"]) == 30
+
+    assert len(flickr_requests) == 5
+
+    status = logged_out_client.get("/status/flickr").json
+    assert status is not None
+    assert status["state"] == "open"
+    assert status["consecutive_failures"] == 5
+
+
+def test_status_when_flickr_is_up(logged_out_client: FlaskClient) -> None:
+    """
+    The status page shows a closed breaker when everything is fine.
+    """
+    resp = logged_out_client.get("/status/flickr")
+
+    assert resp.json == {"state": "closed", "consecutive_failures": 0, "retry_after": 0}
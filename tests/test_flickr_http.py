@@ -0,0 +1,132 @@
+"""
+Tests for the shared, pooled HTTP transport.
+"""
+
+import asyncio
+import gc
+import weakref
+
+from flask import Flask
+import httpx
+import pytest
+
+from app import create_app, create_oauth_client
+from flickr_http import SharedAsyncTransport, SharedTransport, _instances, close_all
+
+
+def test_oauth_clients_share_a_transport(app: Flask) -> None:
+    """
+    Every OAuth client created in the same process uses the same
+    transport, so they can reuse open connections.
+    """
+    with app.test_request_context():
+        client_1 = create_oauth_client()
+        client_2 = create_oauth_client(token="123", token_secret="456")
+
+    assert client_1._transport is client_2._transport
+    assert client_1._transport is app.extensions["flickr_http"].get()
+
+
+def test_pool_limits_come_from_config(app: Flask) -> None:
+    """
+    The pool limits can be configured when the app is created.
+    """
+    # Note: we use the ``app`` fixture so the mock keyring has credentials.
+    configured_app = create_app(
+        config={
+            "FLICKR_HTTP_MAX_CONNECTIONS": 5,
+            "FLICKR_HTTP_MAX_KEEPALIVE_CONNECTIONS": 2,
+            "FLICKR_HTTP_KEEPALIVE_EXPIRY": 1.5,
+        }
+    )
+
+    shared_transport = configured_app.extensions["flickr_http"]
+    assert shared_transport.limits == httpx.Limits(
+        max_connections=5, max_keepalive_connections=2, keepalive_expiry=1.5
+    )
+    assert not shared_transport.http2
+
+
+def test_forked_process_gets_a_new_transport(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    If the process is forked, the child creates its own transport rather
+    than using (or closing) the connections it shares with its parent.
+    """
+    shared_transport = SharedTransport()
+    parent_transport = shared_transport.get()
+
+    monkeypatch.setattr("os.getpid", lambda: -1)
+    child_transport = shared_transport.get()
+
+    assert child_transport is not parent_transport
+    assert shared_transport.get() is child_transport
+
+
+def test_close_shuts_the_transport(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Closing the shared transport closes its connections, and a new
+    transport is created if it's needed again.
+    """
+    shared_transport = SharedTransport()
+    transport = shared_transport.get()
+
+    closed = []
+    monkeypatch.setattr(transport, "close", lambda: closed.append(True))
+
+    shared_transport.close()
+    assert closed == [True]
+
+    # Closing twice is a no-op
+    shared_transport.close()
+    assert closed == [True]
+
+    assert shared_transport.get() is not transport
+
+
+def test_close_all_closes_every_transport(app: Flask) -> None:
+    """
+    When the process exits, we close every shared transport -- but we
+    don't keep transports alive after their app has gone.
+    """
+    shared_transport = app.extensions["flickr_http"]
+    shared_transport.get()
+
+    other_app = create_app()
+    other_app.extensions["background_jobs"].stop()
+    other_transport = weakref.ref(other_app.extensions["flickr_http"])
+
+    del other_app
+    gc.collect()
+
+    assert other_transport() is None
+    assert shared_transport in _instances
+
+    close_all()
+    assert shared_transport._transport is None
+
+
+def test_async_transport_is_shared_per_event_loop() -> None:
+    """
+    Async transports are shared by everything on the same event loop,
+    and closed when we're done with the loop.
+    """
+    shared_transport = SharedAsyncTransport()
+
+    async def run() -> httpx.AsyncHTTPTransport:
+        """
+        Get the transport for this event loop, then close it.
+        """
+        transport = shared_transport.get()
+        assert shared_transport.get() is transport
+
+        await shared_transport.aclose()
+
+        # Closing twice is a no-op
+        await shared_transport.aclose()
+
+        return transport
+
+    transport_1 = asyncio.run(run())
+    transport_2 = asyncio.run(run())
+
+    assert transport_1 is not transport_2
@@ -3,8 +3,7 @@ Tests for edge cases in the login flow, e.g. trying to log in when
 you're already logged in.
 """
 
-import typing
-
+from flask import Flask
 from flask.testing import FlaskClient
 import pytest
 
@@ -41,21 +40,30 @@ def test_callback_without_request_token_is_error(
     assert resp.status_code == 400
 
 
-@pytest.mark.parametrize(
-    "request_token",
-    [None, "hello world", {}, {"oauth_token": "123"}, {"oauth_token_secret": "456"}],
-)
 def test_callback_with_malformed_request_token_is_error(
-    logged_out_client: FlaskClient, request_token: typing.Any
+    app: Flask, logged_out_client: FlaskClient
 ) -> None:
     """
     If you try to go through the callback flow and the request token
     exists but it's the wrong format, the login fails.
     """
+    app.extensions["request_token_store"].put({"oauth_token": "123"})
+
+    resp = logged_out_client.get("/callback?oauth_token=123&oauth_verifier=456")
+    assert resp.status_code == 400
+
+
+def test_callback_ignores_request_token_in_session(
+    logged_out_client: FlaskClient,
+) -> None:
+    """
+    The callback only uses request tokens from the server-side store,
+    not from the user's session.
+    """
     with logged_out_client.session_transaction() as session:
-        session["request_token"] = request_token
+        session["request_token"] = {"oauth_token": "123", "oauth_token_secret": "456"}
 
-    resp = logged_out_client.get("/callback")
+    resp = logged_out_client.get("/callback?oauth_token=123&oauth_verifier=456")
     assert resp.status_code == 400
 
 
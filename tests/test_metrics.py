@@ -0,0 +1,243 @@
+"""
+Tests for ``metrics.py``, which records metrics for ``/metrics``.
+"""
+
+from collections.abc import Iterator
+import pathlib
+import threading
+import time
+
+from flask import Flask, abort
+from flask.testing import FlaskClient
+import httpx
+import pytest
+
+from metrics import Metrics, render_prometheus, reset_after_fork
+
+
+@pytest.fixture
+def metrics(tmp_path: pathlib.Path) -> Iterator[Metrics]:
+    """
+    Create a Metrics object which writes to a temporary directory, and
+    stop its background thread at the end of the test.
+    """
+    m = Metrics(directory=str(tmp_path), flush_interval=0.01)
+    yield m
+    m.stop()
+
+
+def test_render_prometheus() -> None:
+    """
+    Counters and histograms are rendered in the Prometheus text format.
+    """
+    m = Metrics(directory=None, flush_interval=1)
+
+    m.increment("http_requests_total", (("route", "/"), ("status", "200")))
+    m.increment("http_requests_total", (("route", "/"), ("status", "200")))
+    m.observe("flickr_call_duration_seconds", (("step", "x"),), 0.003)
+    m.observe("flickr_call_duration_seconds", (("step", "x"),), 0.2)
+    m.observe("flickr_call_duration_seconds", (("step", "x"),), 60)
+
+    assert render_prometheus(m.gather()) == (
+        "# HELP http_requests_total The number of HTTP requests, by route, method and status code.\n"
+        "# TYPE http_requests_total counter\n"
+        'http_requests_total{route="/",status="200"} 2\n'
+        "# HELP flickr_call_duration_seconds How long each step of the login flow spent talking to Flickr.\n"
+        "# TYPE flickr_call_duration_seconds histogram\n"
+        'flickr_call_duration_seconds_bucket{step="x",le="0.005"} 1\n'
+        'flickr_call_duration_seconds_bucket{step="x",le="0.01"} 1\n'
+        'flickr_call_duration_seconds_bucket{step="x",le="0.025"} 1\n'
+        'flickr_call_duration_seconds_bucket{step="x",le="0.05"} 1\n'
+        'flickr_call_duration_seconds_bucket{step="x",le="0.1"} 1\n'
+        'flickr_call_duration_seconds_bucket{step="x",le="0.25"} 2\n'
+        'flickr_call_duration_seconds_bucket{step="x",le="0.5"} 2\n'
+        'flickr_call_duration_seconds_bucket{step="x",le="1.0"} 2\n'
+        'flickr_call_duration_seconds_bucket{step="x",le="2.5"} 2\n'
+        'flickr_call_duration_seconds_bucket{step="x",le="5.0"} 2\n'
+        'flickr_call_duration_seconds_bucket{step="x",le="10.0"} 2\n'
+        'flickr_call_duration_seconds_bucket{step="x",le="+Inf"} 3\n'
+        'flickr_call_duration_seconds_sum{step="x"} 60.203\n'
+        'flickr_call_duration_seconds_count{step="x"} 3\n'
+    )
+
+
+def test_label_values_are_escaped() -> None:
+    """
+    Quotes, backslashes and newlines in label values are escaped.
+    """
+    m = Metrics(directory=None, flush_interval=1)
+    m.increment("http_requests_total", (("route", 'a"b\\c\nd'),))
+
+    assert 'http_requests_total{route="a\\"b\\\\c\\nd"} 1' in render_prometheus(
+        m.gather()
+    )
+
+
+def test_adds_up_every_thread() -> None:
+    """
+    Each thread records its own samples, and we add them up -- including
+    threads which have finished.
+    """
+    m = Metrics(directory=None, flush_interval=1)
+
+    def record() -> None:
+        """
+        Record some requests.
+        """
+        for _ in range(100):
+            m.increment("http_requests_total", ())
+
+    threads = [threading.Thread(target=record) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    record()
+
+    assert m.collect() == {("http_requests_total", ()): [500]}
+    assert m.collect() == {("http_requests_total", ()): [500]}
+
+    assert "\nhttp_requests_total 500\n" in render_prometheus(m.gather())
+
+
+def test_adds_up_every_process(tmp_path: pathlib.Path) -> None:
+    """
+    If the workers share a directory, ``gather()`` adds up the samples
+    from every worker.
+    """
+    worker1 = Metrics(directory=str(tmp_path), flush_interval=60)
+    worker2 = Metrics(directory=str(tmp_path), flush_interval=60)
+
+    # We're pretending these are different processes
+    worker1.pid = 1
+    worker2.pid = 2
+
+    try:
+        worker1.increment("http_requests_total", (("route", "/"),))
+        worker2.increment("http_requests_total", (("route", "/"),))
+        worker2.flush()
+
+        assert worker1.gather() == {("http_requests_total", (("route", "/"),)): [2]}
+    finally:
+        worker1.stop()
+        worker2.stop()
+
+
+def test_writes_samples_in_the_background(
+    metrics: Metrics, tmp_path: pathlib.Path
+) -> None:
+    """
+    Once a process has recorded something, it writes its samples to
+    the shared directory in the background.
+    """
+    metrics.increment("http_requests_total", ())
+
+    deadline = time.monotonic() + 5
+
+    while not (tmp_path / f"metrics-{metrics.pid}.json").exists():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def test_forgets_samples_after_fork() -> None:
+    """
+    A newly forked worker doesn't count its parent's samples.
+    """
+    m = Metrics(directory=None, flush_interval=1)
+    m.increment("http_requests_total", ())
+
+    reset_after_fork()
+
+    assert m.collect() == {}
+    m.stop()
+
+
+def test_records_requests(logged_out_client: FlaskClient) -> None:
+    """
+    The app records every request, labelled with its route.
+    """
+    logged_out_client.get("/")
+    logged_out_client.get("/")
+    logged_out_client.get("/doesnotexist")
+
+    resp = logged_out_client.get("/metrics")
+
+    assert resp.status_code == 200
+    assert resp.content_type == "text/plain; version=0.0.4; charset=utf-8"
+    assert 'http_requests_total{method="GET",route="/",status="200"} 2' in resp.text
+    assert (
+        'http_requests_total{method="GET",route="unmatched",status="404"} 1'
+        in resp.text
+    )
+    assert 'http_request_duration_seconds_count{method="GET",route="/"} 2' in resp.text
+
+
+def test_unusual_methods_are_grouped(logged_out_client: FlaskClient) -> None:
+    """
+    Requests with an unusual HTTP method are labelled as "other".
+    """
+    logged_out_client.open("/", method="PROPFIND")
+
+    resp = logged_out_client.get("/metrics")
+
+    assert (
+        'http_requests_total{method="other",route="unmatched",status="405"} 1'
+        in resp.text
+    )
+
+
+def test_records_flickr_calls(
+    logged_out_client: FlaskClient, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    The app records how long each step of the login flow spent
+    talking to Flickr, and whether it succeeded.
+    """
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        """
+        Return a request token, but fail to return an access token.
+        """
+        if request.url.path == "/services/oauth/request_token":
+            return httpx.Response(200, text="oauth_token=123&oauth_token_secret=456")
+        else:
+            return httpx.Response(503)
+
+    monkeypatch.setattr(
+        "httpx.HTTPTransport", lambda **kwargs: httpx.MockTransport(handler)
+    )
+
+    logged_out_client.get("/authorize")
+    logged_out_client.get("/callback?oauth_token=123&oauth_verifier=789")
+
+    resp = logged_out_client.get("/metrics")
+
+    for step, outcome in [
+        ("fetch_request_token", "success"),
+        ("create_authorization_url", "success"),
+        ("fetch_access_token", "error"),
+    ]:
+        assert (
+            f'flickr_call_duration_seconds_count{{outcome="{outcome}",step="{step}"}} 1'
+            in resp.text
+        )
+
+
+def test_requests_without_a_start_time_are_skipped(app: Flask) -> None:
+    """
+    If a request fails before we note its start time, we don't record it.
+    """
+
+    def fail() -> None:
+        """
+        Reject every request.
+        """
+        abort(503)
+
+    app.before_request_funcs[None].insert(0, fail)
+
+    with app.test_client() as client:
+        assert client.get("/").status_code == 503
+
+    assert app.extensions["metrics"].collect() == {}
@@ -8,8 +8,15 @@ In a larger app with more complex pages, we might break these into
 separate test files, e.g. one file per route.
 """
 
+import gzip
+
+import brotli  # type: ignore[import-untyped]
+from flask import Flask
 from flask.testing import FlaskClient
-from app import FlickrUser
+from flask_login import FlaskLoginClient
+import pytest
+
+from users import FlickrUser
 
 
 def test_homepage_when_logged_out(logged_out_client: FlaskClient) -> None:
@@ -65,3 +72,122 @@ def test_secret_page_when_logged_in(logged_in_client: FlaskClient) -> None:
 
     # It has the correct message
     assert "<strong>secret page</strong>" in resp.text
+
+
+def test_unchanged_page_is_not_modified(logged_in_client: FlaskClient) -> None:
+    """
+    If the browser already has the latest version of a page, we send
+    ``304 Not Modified`` instead of the page.
+    """
+    resp_1 = logged_in_client.get("/secret")
+    etag = resp_1.headers["ETag"]
+
+    resp_2 = logged_in_client.get("/secret", headers={"If-None-Match": etag})
+    assert resp_2.status_code == 304
+    assert resp_2.headers["ETag"] == etag
+    assert resp_2.data == b""
+
+    resp_3 = logged_in_client.get("/secret", headers={"If-None-Match": '"outdated"'})
+    assert resp_3.status_code == 200
+
+
+def test_pages_must_be_revalidated(logged_out_client: FlaskClient) -> None:
+    """
+    Pages can only be cached by the browser, and it has to check with
+    us before reusing them.
+    """
+    resp = logged_out_client.get("/")
+
+    assert resp.headers["Cache-Control"] == "private, no-cache"
+    assert "Accept-Encoding" in resp.headers["Vary"]
+
+
+def test_etag_depends_on_the_user(app: Flask, logged_out_client: FlaskClient) -> None:
+    """
+    Different users get different ETags for the homepage.
+    """
+    etags = set()
+
+    for user in [
+        FlickrUser("1@N01", "Father Sword"),
+        FlickrUser("2@N02", "Mother Shield"),
+    ]:
+        app.test_client_class = FlaskLoginClient
+
+        with app.test_client(user=user) as client:
+            etags.add(client.get("/").headers["ETag"])
+
+    etags.add(logged_out_client.get("/").headers["ETag"])
+
+    assert len(etags) == 3
+
+
+def test_user_name_is_escaped(app: Flask) -> None:
+    """
+    The user's name is HTML-escaped on the homepage.
+    """
+    app.test_client_class = FlaskLoginClient
+
+    with app.test_client(user=FlickrUser("test@123", "<b>Bold</b>")) as client:
+        resp = client.get("/")
+
+    assert "&lt;b&gt;Bold&lt;/b&gt;" in resp.text
+
+
+def test_page_is_only_rendered_once(
+    app: Flask, logged_out_client: FlaskClient, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    The same page is only rendered once, then served from the cache.
+    """
+    logged_out_client.get("/")
+
+    template, _ = app.extensions["pages"].template("homepage_logged_out.html")
+    monkeypatch.setattr(template, "render", lambda **kwargs: pytest.fail("rendered"))
+
+    resp = logged_out_client.get("/")
+    assert "logged out" in resp.text
+
+
+@pytest.mark.parametrize(
+    "accept_encoding, content_encoding",
+    [("gzip", "gzip"), ("gzip, br", "br"), ("", None), ("deflate", None)],
+)
+def test_large_pages_are_compressed(
+    app: Flask,
+    logged_out_client: FlaskClient,
+    accept_encoding: str,
+    content_encoding: str | None,
+) -> None:
+    """
+    Large pages are compressed with the best encoding the browser accepts,
+    and each encoding gets its own ETag.
+    """
+    app.extensions["pages"].compress_min_size = 0
+
+    headers = {"Accept-Encoding": accept_encoding}
+    resp = logged_out_client.get("/", headers=headers)
+    assert resp.headers.get("Content-Encoding") == content_encoding
+
+    if content_encoding == "gzip":
+        assert b"logged out" in gzip.decompress(resp.data)
+    elif content_encoding == "br":
+        assert b"logged out" in brotli.decompress(resp.data)
+
+    if content_encoding is not None:
+        assert resp.headers["ETag"].endswith(f'-{content_encoding}"')
+
+    # The compressed page is served from the cache the second time,
+    # and the browser can revalidate it.
+    assert logged_out_client.get("/", headers=headers).data == resp.data
+
+    headers["If-None-Match"] = resp.headers["ETag"]
+    assert logged_out_client.get("/", headers=headers).status_code == 304
+
+
+def test_small_pages_are_not_compressed(logged_out_client: FlaskClient) -> None:
+    """
+    Pages which are too small to be worth compressing are sent as-is.
+    """
+    resp = logged_out_client.get("/", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in resp.headers
@@ -0,0 +1,172 @@
+"""
+Tests for ``pending_logins.py``, which reuses request tokens when
+somebody clicks "log in" more than once.
+"""
+
+import itertools
+import threading
+import time
+
+from flask import Flask
+from flask.testing import FlaskClient
+import pytest
+
+from token_store import RequestToken
+
+
+class FakeFetch:
+    """
+    A fake for ``fetch_request_token``, which counts how many tokens
+    we've asked Flickr for.
+    """
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.counter = itertools.count(start=1)
+
+        # If this is set, calls wait until it's set before they return
+        self.release: threading.Event | None = None
+
+        # This is set once we've been called
+        self.called = threading.Event()
+
+    def __call__(self, callback_url: str) -> RequestToken:
+        """
+        Return a new request token.
+        """
+        self.calls += 1
+        self.called.set()
+
+        if self.release is not None:
+            assert self.release.wait(timeout=5)
+
+        n = next(self.counter)
+        return {"oauth_token": f"token{n}", "oauth_token_secret": f"secret{n}"}
+
+
+@pytest.fixture
+def fetch(monkeypatch: pytest.MonkeyPatch) -> FakeFetch:
+    """
+    Replace the call to Flickr for a new request token.
+    """
+    fake = FakeFetch()
+    monkeypatch.setattr("app.fetch_request_token", fake)
+    return fake
+
+
+def authorize(client: FlaskClient) -> str:
+    """
+    Visit /authorize, and return the request token we were sent to
+    Flickr with.
+    """
+    resp = client.get("/authorize")
+    assert resp.status_code == 302
+    assert resp.location is not None
+    return resp.location.split("oauth_token=")[1]
+
+
+def test_repeated_clicks_reuse_the_request_token(
+    logged_out_client: FlaskClient, fetch: FakeFetch
+) -> None:
+    """
+    If the same browser visits /authorize twice, it gets the same
+    request token, and we only ask Flickr once.
+    """
+    assert authorize(logged_out_client) == "token1"
+    assert authorize(logged_out_client) == "token1"
+
+    assert fetch.calls == 1
+
+
+def test_different_browsers_get_different_tokens(app: Flask, fetch: FakeFetch) -> None:
+    """
+    Different browsers never share a request token.
+    """
+    assert authorize(app.test_client()) == "token1"
+    assert authorize(app.test_client()) == "token2"
+
+
+def test_request_token_is_only_reused_for_a_short_while(
+    app: Flask, logged_out_client: FlaskClient, fetch: FakeFetch
+) -> None:
+    """
+    Once the window has passed, we get a new request token.
+    """
+    app.extensions["pending_logins"].window = 0
+
+    assert authorize(logged_out_client) == "token1"
+    assert authorize(logged_out_client) == "token2"
+
+
+def test_request_token_is_not_reused_for_another_callback_url(
+    logged_out_client: FlaskClient, fetch: FakeFetch
+) -> None:
+    """
+    If the callback URL changes, e.g. the app is served on a different
+    hostname, we get a new request token.
+    """
+    assert authorize(logged_out_client) == "token1"
+
+    resp = logged_out_client.get("/authorize", base_url="http://example.net")
+    assert resp.location is not None
+    assert resp.location.endswith("oauth_token=token2")
+
+
+def test_callback_forgets_the_request_token(
+    app: Flask, logged_out_client: FlaskClient, fetch: FakeFetch
+) -> None:
+    """
+    A request token can only be used once, so after the callback, the
+    next login gets a new one -- even if the callback failed.
+    """
+    assert authorize(logged_out_client) == "token1"
+
+    app.extensions["request_token_store"].pop("token1")
+    resp = logged_out_client.get("/callback?oauth_token=token1")
+    assert resp.status_code == 400
+
+    assert authorize(logged_out_client) == "token2"
+
+
+def test_concurrent_requests_share_one_call_to_flickr(
+    app: Flask, logged_out_client: FlaskClient, fetch: FakeFetch
+) -> None:
+    """
+    If a browser with a session sends several requests to /authorize
+    at once, we only ask Flickr once.
+    """
+    # Get a session cookie, then turn off reuse, so we only see the
+    # effect of collapsing concurrent requests.
+    authorize(logged_out_client)
+    app.extensions["pending_logins"].window = 0
+
+    cookie = logged_out_client.get_cookie("session")
+    assert cookie is not None
+
+    fetch.called.clear()
+    fetch.release = threading.Event()
+    tokens: list[str] = []
+
+    def click() -> None:
+        """
+        Click "log in" in the same browser.
+        """
+        client = app.test_client()
+        client.set_cookie("session", cookie.value)
+        tokens.append(authorize(client))
+
+    threads = [threading.Thread(target=click) for _ in range(5)]
+    for t in threads:
+        t.start()
+
+    # Wait for the first call to reach Flickr, give the other threads
+    # a moment to join it, then let it finish.
+    assert fetch.called.wait(timeout=5)
+    time.sleep(0.05)
+    fetch.release.set()
+
+    for t in threads:
+        t.join()
+
+    assert tokens == ["token2"] * 5
+    assert fetch.calls == 2
@@ -0,0 +1,124 @@
+"""
+Tests for ``profiling.py``, which profiles a sample of live requests.
+"""
+
+import os
+import pathlib
+import pstats
+
+from flask import Flask
+from keyring.backend import KeyringBackend
+from nitrate.mock_keyring import *  # noqa: F403
+import pytest
+
+from app import create_app
+
+
+def create_profiled_app(
+    mock_keyring: KeyringBackend, tmp_path: pathlib.Path, **config: object
+) -> Flask:
+    """
+    Create an app which saves profiles to ``tmp_path / "profiles"``.
+    """
+    mock_keyring.set_password("flickr_flask_login_demo", "key", "123")
+    mock_keyring.set_password("flickr_flask_login_demo", "secret", "456")
+
+    return create_app(
+        config={
+            "TESTING": True,
+            "USER_STORE_PATH": str(tmp_path / "users.sqlite"),
+            "PROFILE_DIR": str(tmp_path / "profiles"),
+            **config,
+        }
+    )
+
+
+def test_profiling_is_off_by_default(app: Flask) -> None:
+    """
+    Unless you set ``PROFILE_DIR``, we don't profile anything, or add
+    any hooks to the request path.
+    """
+    assert app.extensions["profiler"] is None
+    assert all(f.__module__ != "profiling" for f in app.before_request_funcs[None])
+
+
+def test_profiles_sampled_requests(
+    mock_keyring: KeyringBackend, tmp_path: pathlib.Path
+) -> None:
+    """
+    With a sample rate of 1, every request is profiled, and the profile
+    is saved with the route and timing in its filename.
+    """
+    app = create_profiled_app(mock_keyring, tmp_path, PROFILE_SAMPLE_RATE=1)
+
+    with app.test_client() as client:
+        assert client.get("/").status_code == 200
+        assert client.get("/doesnotexist").status_code == 404
+
+    filenames = sorted(os.listdir(tmp_path / "profiles"))
+
+    assert len(filenames) == 2
+    assert filenames[0].split("-", 1)[1].startswith("GET-homepage-")
+    assert filenames[1].split("-", 1)[1].startswith("GET-unmatched-")
+    assert all(f.endswith("ms.prof") for f in filenames)
+
+    # The profile can be read by pstats, and includes our view
+    stats = pstats.Stats(str(tmp_path / "profiles" / filenames[0]))
+    assert any(func_name == "homepage" for (_, _, func_name) in stats.stats)  # type: ignore[attr-defined]
+
+
+@pytest.mark.parametrize(
+    "headers, is_profiled",
+    [
+        ({}, False),
+        ({"X-Profile-Request": "wrong"}, False),
+        ({"X-Profile-Request": "letmein"}, True),
+    ],
+)
+def test_profiles_requests_with_the_secret_header(
+    mock_keyring: KeyringBackend,
+    tmp_path: pathlib.Path,
+    headers: dict[str, str],
+    is_profiled: bool,
+) -> None:
+    """
+    A request with the secret header is always profiled.
+    """
+    app = create_profiled_app(
+        mock_keyring, tmp_path, PROFILE_SAMPLE_RATE=0, PROFILE_SECRET="letmein"
+    )
+
+    with app.test_client() as client:
+        client.get("/", headers=headers)
+
+    assert len(os.listdir(tmp_path / "profiles")) == int(is_profiled)
+
+
+def test_header_is_ignored_without_a_secret(
+    mock_keyring: KeyringBackend, tmp_path: pathlib.Path
+) -> None:
+    """
+    If there's no secret in the config, the header does nothing.
+    """
+    app = create_profiled_app(mock_keyring, tmp_path, PROFILE_SAMPLE_RATE=0)
+
+    with app.test_client() as client:
+        client.get("/", headers={"X-Profile-Request": ""})
+
+    assert os.listdir(tmp_path / "profiles") == []
+
+
+def test_only_profiles_one_request_at_a_time(
+    mock_keyring: KeyringBackend, tmp_path: pathlib.Path
+) -> None:
+    """
+    If another request is already being profiled, we skip this one.
+    """
+    app = create_profiled_app(mock_keyring, tmp_path, PROFILE_SAMPLE_RATE=1)
+    profiler = app.extensions["profiler"]
+
+    with profiler._lock:
+        with app.test_client() as client:
+            client.get("/")
+
+    assert os.listdir(tmp_path / "profiles") == []
@@ -0,0 +1,263 @@
+"""
+Tests for ``rate_limit.py``, which limits how often we call Flickr.
+"""
+
+from collections.abc import Iterator
+import pathlib
+
+from flask import Flask
+from flask.testing import FlaskClient
+import httpx
+import pytest
+
+from app import create_app
+from flickr_calls import CircuitBreaker, FlickrCallPolicy, FlickrRateLimited
+from rate_limit import MemoryRateLimiter, RateLimiter, SqliteRateLimiter
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def limiter(
+    request: pytest.FixtureRequest,
+    tmp_path: pathlib.Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> Iterator[RateLimiter]:
+    """
+    Creates a rate limiter with each of the backends, which allows
+    3 calls in a burst, keeps 1 back for urgent calls, and refills at
+    1 call per second.
+
+    The clock is frozen, so the bucket only refills if a test moves it.
+    """
+    monkeypatch.setattr("time.monotonic", lambda: 1000.0)
+    monkeypatch.setattr("time.time", lambda: 1000.0)
+
+    if request.param == "memory":
+        yield MemoryRateLimiter(rate=1, capacity=3, reserve=1)
+    else:
+        yield SqliteRateLimiter(
+            str(tmp_path / "rate_limit.sqlite"), rate=1, capacity=3, reserve=1
+        )
+
+
+def test_normal_calls_leave_the_reserve(limiter: RateLimiter) -> None:
+    """
+    Normal calls can use the bucket until only the reserve is left.
+    """
+    assert limiter.acquire(urgent=False) == 0
+    assert limiter.acquire(urgent=False) == 0
+    assert limiter.acquire(urgent=False) == 1
+
+
+def test_urgent_calls_can_use_the_reserve(limiter: RateLimiter) -> None:
+    """
+    Urgent calls can use the reserve, but not more than the bucket holds.
+    """
+    assert limiter.acquire(urgent=False) == 0
+    assert limiter.acquire(urgent=False) == 0
+    assert limiter.acquire(urgent=True) == 0
+    assert limiter.acquire(urgent=True) == 1
+
+
+def test_background_calls_leave_a_bigger_reserve(limiter: RateLimiter) -> None:
+    """
+    Background calls have to leave more in the bucket than normal
+    calls, so they can't use up the calls we need for new logins.
+    """
+    limiter.background_reserve = 2
+
+    assert limiter.acquire(urgent=False, background=True) == 0
+    assert limiter.acquire(urgent=False, background=True) == 1
+    assert limiter.acquire(urgent=False) == 0
+
+
+def test_bucket_refills_over_time(
+    limiter: RateLimiter, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    The bucket refills at a steady rate, up to its capacity.
+    """
+    for _ in range(3):
+        limiter.acquire(urgent=True)
+
+    assert limiter.acquire(urgent=False) == 2
+
+    monkeypatch.setattr("time.monotonic", lambda: 1001.5)
+    monkeypatch.setattr("time.time", lambda: 1001.5)
+
+    assert limiter.acquire(urgent=True) == 0
+    assert limiter.acquire(urgent=True) == pytest.approx(0.5)
+
+    # After a long wait, the bucket is full, but no fuller.
+    monkeypatch.setattr("time.monotonic", lambda: 5000.0)
+    monkeypatch.setattr("time.time", lambda: 5000.0)
+
+    assert [limiter.acquire(urgent=True) for _ in range(4)] == [0, 0, 0, 1]
+
+
+def test_sqlite_limiter_is_shared_between_processes(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    Two SQLite limiters using the same file share the same bucket, e.g.
+    in separate worker processes.
+    """
+    monkeypatch.setattr("time.time", lambda: 1000.0)
+
+    path = str(tmp_path / "rate_limit.sqlite")
+    limiter_1 = SqliteRateLimiter(path, rate=1, capacity=2, reserve=0)
+    limiter_2 = SqliteRateLimiter(path, rate=1, capacity=2, reserve=0)
+
+    assert limiter_1.acquire(urgent=False) == 0
+    assert limiter_2.acquire(urgent=False) == 0
+    assert limiter_1.acquire(urgent=False) == 1
+
+
+def test_sqlite_limiter_rolls_back_on_error(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    If something goes wrong while we're updating the bucket, we don't
+    leave the database locked.
+    """
+    limiter = SqliteRateLimiter(
+        str(tmp_path / "rate_limit.sqlite"), rate=1, capacity=2, reserve=0
+    )
+
+    with monkeypatch.context() as m:
+        m.setattr(limiter, "take", lambda *args, **kwargs: 1 / 0)
+
+        with pytest.raises(ZeroDivisionError):
+            limiter.acquire(urgent=False)
+
+    assert not limiter.db.connection().in_transaction
+    assert limiter.acquire(urgent=False) == 0
+
+
+def test_policy_fails_fast_when_rate_limited() -> None:
+    """
+    If the rate limiter has no tokens, the call policy doesn't call
+    Flickr, and raises an error which says when to try again.
+    """
+    policy = FlickrCallPolicy(
+        breaker=CircuitBreaker(failure_threshold=5, reset_timeout=30),
+        limiter=MemoryRateLimiter(rate=1, capacity=1, reserve=0),
+        deadline=10,
+        retries=2,
+        backoff=0,
+    )
+    calls: list[float] = []
+
+    assert policy.call(lambda timeout: calls.append(timeout), retry=False) is None
+
+    with pytest.raises(FlickrRateLimited) as exc_info:
+        policy.call(lambda timeout: calls.append(timeout), retry=False)
+
+    assert exc_info.value.retry_after == pytest.approx(1, abs=0.1)
+    assert len(calls) == 1
+
+
+@pytest.fixture
+def flickr_requests(app: Flask, monkeypatch: pytest.MonkeyPatch) -> list[httpx.Request]:
+    """
+    Replace Flickr with a fake that records every request, and give
+    the app a rate limit of one normal call, with one more in reserve.
+    """
+    requests: list[httpx.Request] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        """
+        Record the request, and return a token -- this works as both
+        a request token and an access token.
+        """
+        requests.append(request)
+        return httpx.Response(
+            200,
+            text=(
+                "oauth_callback_confirmed=true&oauth_token=abc&oauth_token_secret=def"
+                "&fullname=Father%20Sword&user_nsid=test%40123&username=sword"
+            ),
+        )
+
+    monkeypatch.setattr(
+        "httpx.HTTPTransport", lambda **kwargs: httpx.MockTransport(handler)
+    )
+
+    app.extensions["flickr_call_policy"].limiter = MemoryRateLimiter(
+        rate=0.01, capacity=2, reserve=1
+    )
+
+    return requests
+
+
+def test_logins_in_progress_take_priority(
+    app: Flask, logged_out_client: FlaskClient, flickr_requests: list[httpx.Request]
+) -> None:
+    """
+    When we've nearly used up the rate limit, we stop starting new
+    logins, but we can still finish the ones in progress.
+    """
+    resp = logged_out_client.get("/authorize")
+    assert resp.status_code == 302
+
+    resp = app.test_client().get("/authorize")
+    assert resp.status_code == 503
+    assert int(resp.headers["Retry-After"]) == 100
+
+    assert len(flickr_requests) == 1
+
+    resp = logged_out_client.get("/callback?oauth_token=abc&oauth_verifier=789")
+    assert resp.status_code == 302
+
+    assert len(flickr_requests) == 2
+
+
+@pytest.mark.parametrize("app_config", [{"FLICKR_RATE_LIMIT": None}])
+def test_rate_limit_can_be_turned_off(app: Flask) -> None:
+    """
+    If ``FLICKR_RATE_LIMIT`` is None, there's no rate limiter.
+    """
+    assert app.extensions["flickr_rate_limiter"] is None
+    assert app.extensions["flickr_call_policy"].limiter is None
+
+
+def test_app_shares_sqlite_limiter_by_default(app: Flask) -> None:
+    """
+    By default the app shares its rate limiter with other workers,
+    using SQLite, in the same database as the users.
+    """
+    limiter = app.extensions["flickr_rate_limiter"]
+    assert isinstance(limiter, SqliteRateLimiter)
+    assert limiter.db.path == app.config["USER_STORE_PATH"]
+    assert limiter.rate == 1
+    assert limiter.capacity == 100
+    assert limiter.reserve == 20
+
+
+@pytest.mark.parametrize("app_config", [{"FLICKR_RATE_LIMITER": "memory"}])
+def test_app_can_use_memory_limiter(app: Flask) -> None:
+    """
+    A single process can keep its rate limiter in memory instead.
+    """
+    limiter = app.extensions["flickr_rate_limiter"]
+    assert isinstance(limiter, MemoryRateLimiter)
+    assert limiter.capacity == 100
+
+
+def test_unknown_limiter_is_error(app: Flask) -> None:
+    """
+    Configuring an unrecognised rate limiter backend is an error.
+    """
+    with pytest.raises(ValueError, match="Unrecognised rate limiter"):
+        create_app(config={"FLICKR_RATE_LIMITER": "abacus"})
+
+
+def test_buckets_are_independent(limiter: RateLimiter) -> None:
+    """
+    Each bucket (e.g. each API key) has its own share of the limit.
+    """
+    assert limiter.acquire(urgent=True, bucket="aaa") == 0
+    assert limiter.acquire(urgent=True, bucket="aaa") == 0
+    assert limiter.acquire(urgent=True, bucket="aaa") == 0
+    assert limiter.acquire(urgent=True, bucket="aaa") == 1
+
+    assert limiter.acquire(urgent=True, bucket="bbb") == 0
@@ -0,0 +1,245 @@
+"""
+Tests for ``session_revocation.py``, which stops copies of a session
+cookie working after the user logs out.
+"""
+
+import pathlib
+import secrets
+
+from flask import Flask
+import httpx
+import pytest
+
+from session_revocation import BloomFilter, RevocationList
+
+
+@pytest.fixture
+def revocations(app: Flask, tmp_path: pathlib.Path) -> RevocationList:
+    """
+    Creates a revocation list which keeps revoked sessions for an hour.
+    """
+    return make_revocation_list(app, tmp_path)
+
+
+def make_revocation_list(app: Flask, tmp_path: pathlib.Path) -> RevocationList:
+    """
+    Create a revocation list, as if it was in another worker.
+    """
+    return RevocationList(
+        str(tmp_path / "sessions.sqlite"),
+        metrics=app.extensions["metrics"],
+        jobs=app.extensions["background_jobs"],
+        ttl=60 * 60,
+        refresh_interval=5,
+        compact_interval=60 * 60,
+        capacity=100,
+        error_rate=0.01,
+    )
+
+
+def test_bloom_filter_has_no_false_negatives() -> None:
+    """
+    Everything we add to a Bloom filter is in it, and only a few
+    things we didn't add appear to be.
+    """
+    bloom = BloomFilter.for_capacity(1000, error_rate=0.01)
+
+    assert (bloom.size, bloom.hashes) == (9586, 7)
+
+    added = [secrets.token_urlsafe(16) for _ in range(1000)]
+
+    for item in added:
+        bloom.add(item)
+
+    assert all(item in bloom for item in added)
+
+    false_positives = sum(secrets.token_urlsafe(16) in bloom for _ in range(10_000))
+    assert false_positives < 300
+
+
+def test_copied_cookie_stops_working_after_logout(
+    app: Flask, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    After a user logs out, a copy of their session cookie doesn't log
+    anybody in.
+    """
+    # We use two clients which don't keep the request context between
+    # requests, so they can't share Flask-Login's cached user.
+    client = app.test_client()
+    copied_client = app.test_client()
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        """
+        Return an access token, or the user's profile.
+        """
+        if request.url.path == "/services/oauth/access_token":
+            return httpx.Response(
+                200,
+                text="fullname=Father%20Sword&oauth_token=acc123&oauth_token_secret=accsecret&user_nsid=test%40123&username=fathersword",
+            )
+
+        return httpx.Response(
+            200,
+            json={"person": {"photos": {"count": {"_content": 7}}}, "stat": "ok"},
+        )
+
+    monkeypatch.setattr(
+        "httpx.HTTPTransport", lambda **kwargs: httpx.MockTransport(handler)
+    )
+
+    app.extensions["request_token_store"].put(
+        {"oauth_token": "123", "oauth_token_secret": "456"}
+    )
+
+    resp = client.get("/callback?oauth_token=123&oauth_verifier=789")
+    assert resp.status_code == 302
+
+    cookie = client.get_cookie("session")
+    assert cookie is not None
+
+    # Somebody copies the session cookie ...
+    copied_client.set_cookie("session", cookie.value)
+    assert copied_client.get("/secret").status_code == 200
+
+    # ... and the user logs out.
+    client.get("/logout")
+    assert client.get("/secret").status_code == 302
+
+    # The copied cookie doesn't work any more.
+    assert copied_client.get("/secret").status_code == 302
+
+    samples = app.extensions["metrics"].collect()
+    assert samples[("session_revocation_lookups_total", (("revoked", "true"),))] == [1]
+
+
+def test_sessions_not_in_the_filter_dont_touch_the_database(
+    revocations: RevocationList, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    If the Bloom filter says a session isn't revoked, we believe it.
+    """
+    revocations.revoke("revoked")
+    assert revocations.is_revoked("revoked")
+
+    def fail() -> None:
+        """
+        Fail if we use the database.
+        """
+        raise AssertionError("Unexpected database query")  # pragma: no cover
+
+    monkeypatch.setattr(revocations.db, "connection", fail)
+
+    assert not revocations.is_revoked("not-revoked")
+
+
+def test_false_positives_are_checked_in_the_database(
+    revocations: RevocationList,
+) -> None:
+    """
+    If the Bloom filter thinks a session might be revoked, but it
+    isn't, we find that out from the database.
+    """
+    revocations._filter = BloomFilter(size=1, hashes=1)
+    revocations.revoke("revoked")
+
+    assert "not-revoked" in revocations._filter
+    assert not revocations.is_revoked("not-revoked")
+
+    samples = revocations.metrics.collect()
+    assert samples[("session_revocation_lookups_total", (("revoked", "false"),))] == [1]
+
+
+def test_sessions_revoked_by_another_worker(
+    app: Flask,
+    tmp_path: pathlib.Path,
+    revocations: RevocationList,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """
+    A session revoked in one worker is refused by the others once
+    they've refreshed their filter.
+    """
+    now = 1000.0
+    monkeypatch.setattr("time.monotonic", lambda: now)
+
+    other_worker = make_revocation_list(app, tmp_path)
+    assert not other_worker.is_revoked("sid")
+
+    revocations.revoke("sid")
+    assert revocations.is_revoked("sid")
+    assert not other_worker.is_revoked("sid")
+
+    now += 5
+    assert other_worker.is_revoked("sid")
+
+
+def test_expired_sessions_are_compacted(
+    app: Flask, tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    Once revoked sessions have expired, they're deleted from the
+    database and the filter, in the background.
+    """
+    now = 1000.0
+    monkeypatch.setattr("time.monotonic", lambda: now)
+    monkeypatch.setattr("time.time", lambda: now)
+
+    revocations = make_revocation_list(app, tmp_path)
+    revocations.capacity = 1
+    revocations.revoke("old")
+
+    now += 30 * 60
+    revocations.revoke("new1")
+    revocations.revoke("new2")
+
+    # Compaction happens in the background, when it's due.
+    now += 30 * 60
+    assert not revocations.is_revoked("old")
+    assert app.extensions["background_jobs"].stop()
+
+    assert "old" not in revocations._filter
+    assert revocations.is_revoked("new1")
+    assert revocations.is_revoked("new2")
+
+    # The filter grew to fit the sessions that are left.
+    assert revocations._filter.size == BloomFilter.for_capacity(4, error_rate=0.01).size
+
+    # Sessions revoked by other workers while we were compacting are
+    # picked up straight away.
+    revocations.db.connection().execute(
+        "INSERT INTO revoked_sessions (sid, expires_at) VALUES ('other', ?)",
+        (now + 60,),
+    )
+    assert revocations.compact() == 0
+    assert revocations.is_revoked("other")
+
+
+def test_sessions_revoked_after_compaction_reach_other_workers(
+    app: Flask, tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    If compaction empties the table, sessions revoked afterwards still
+    get new IDs, so other workers don't mistake them for rows they've
+    already seen.
+    """
+    now = 1000.0
+    monkeypatch.setattr("time.monotonic", lambda: now)
+    monkeypatch.setattr("time.time", lambda: now)
+
+    revocations = make_revocation_list(app, tmp_path)
+    revocations.revoke("old1")
+    revocations.revoke("old2")
+
+    other_worker = make_revocation_list(app, tmp_path)
+    assert other_worker.is_revoked("old2")
+
+    # Both sessions expire, and compaction empties the table ...
+    now += 60 * 60
+    assert revocations.compact() == 2
+
+    # ... then another session is revoked.
+    revocations.revoke("new")
+
+    now += 5
+    assert other_worker.is_revoked("new")
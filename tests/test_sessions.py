@@ -0,0 +1,272 @@
+"""
+Tests for ``sessions.py``, which makes requests from anonymous
+visitors cheaper.
+"""
+
+import datetime
+import hashlib
+import typing
+
+from flask import Flask
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SecureCookieSessionInterface
+from flask.testing import FlaskClient
+from flask_login import FlaskLoginClient, LoginManager
+import pytest
+
+import sessions
+from users import FlickrUser
+
+
+@pytest.fixture
+def session_calls(monkeypatch: pytest.MonkeyPatch) -> list[str]:
+    """
+    Record any attempt to load the user or decode the session cookie.
+    """
+    calls: list[str] = []
+
+    def record(name: str, original: typing.Any) -> typing.Any:
+        """
+        Wrap a function so we record when it's called.
+        """
+
+        def wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+            """
+            Record the call, then call the original function.
+            """
+            calls.append(name)
+            return original(*args, **kwargs)
+
+        return wrapper
+
+    monkeypatch.setattr(
+        LoginManager, "_load_user", record("_load_user", LoginManager._load_user)
+    )
+    monkeypatch.setattr(
+        SecureCookieSessionInterface,
+        "get_signing_serializer",
+        record(
+            "get_signing_serializer",
+            SecureCookieSessionInterface.get_signing_serializer,
+        ),
+    )
+
+    return calls
+
+
+def test_anonymous_homepage_skips_the_session(
+    logged_out_client: FlaskClient, session_calls: list[str]
+) -> None:
+    """
+    If there's no session or remember cookie, the homepage doesn't load
+    the session or the user.
+    """
+    resp = logged_out_client.get("/")
+
+    assert resp.status_code == 200
+    assert "log in</a>" in resp.text
+    assert "Cookie" in resp.vary
+    assert "Set-Cookie" not in resp.headers
+
+    assert session_calls == []
+
+
+def test_homepage_with_a_session_cookie_loads_the_user(
+    logged_in_client: FlaskClient, session_calls: list[str]
+) -> None:
+    """
+    If there's a session cookie, we load the user as normal.
+    """
+    resp = logged_in_client.get("/")
+
+    assert resp.status_code == 200
+    assert "logged in</strong>" in resp.text
+
+    assert "_load_user" in session_calls
+
+
+@pytest.mark.parametrize("cookie_name", ["session", "remember_token"])
+def test_homepage_with_a_bad_cookie_is_logged_out(
+    logged_out_client: FlaskClient, cookie_name: str
+) -> None:
+    """
+    If there's a session or remember cookie which isn't valid, we go
+    through the normal path, and show the logged-out homepage.
+    """
+    logged_out_client.set_cookie(cookie_name, "not-a-real-cookie")
+
+    resp = logged_out_client.get("/")
+
+    assert resp.status_code == 200
+    assert "log in</a>" in resp.text
+
+
+def test_other_pages_work_without_a_session_cookie(
+    logged_out_client: FlaskClient,
+) -> None:
+    """
+    Pages which use the session still work when there's no session
+    cookie, e.g. /secret redirects logged-out visitors.
+    """
+    resp = logged_out_client.get("/secret")
+
+    assert resp.status_code == 302
+
+
+@pytest.fixture
+def compact_app(app: Flask) -> Flask:
+    """
+    Switch the app to the compact session serializer.
+    """
+    app.config["SESSION_SERIALIZER"] = "msgpack"
+    sessions.init_app(app)
+    return app
+
+
+LOGGED_IN_SESSION = {
+    "_fresh": True,
+    "_id": hashlib.sha512(b"session").hexdigest(),
+    "_user_id": "199258389@N04/Alex Chan",
+    "login_id": "k2Vd6PpVJ0s3vW3C2ub4AQ",
+    "pending_login": {
+        "oauth_token": "72157720912345678-0123456789abcdef",
+        "callback_url": "https://example.com/callback",
+        "fetched_at": 1740738448.123,
+    },
+}
+
+
+def test_compact_serializer_round_trip() -> None:
+    """
+    The compact serializer can read back the sessions it writes, and
+    they're smaller than JSON.
+    """
+    serializer = sessions.CompactSessionSerializer()
+
+    data = serializer.dumps(LOGGED_IN_SESSION)
+
+    assert serializer.loads(data) == LOGGED_IN_SESSION
+    assert len(data) < len(TaggedJSONSerializer().dumps(LOGGED_IN_SESSION)) * 0.6
+
+
+def test_compact_serializer_keeps_unknown_keys() -> None:
+    """
+    Keys without a short code are kept as they are, and tuples come
+    back as lists.
+    """
+    serializer = sessions.CompactSessionSerializer()
+
+    session = {"colour": "red", "_flashes": [("message", "Hello!")]}
+
+    assert serializer.loads(serializer.dumps(session)) == {
+        "colour": "red",
+        "_flashes": [["message", "Hello!"]],
+    }
+
+
+def test_compact_serializer_falls_back_to_json() -> None:
+    """
+    If the session has a value that MessagePack can't encode, the
+    session is stored as JSON.
+    """
+    serializer = sessions.CompactSessionSerializer()
+
+    session = {"last_seen": datetime.datetime(2025, 2, 28, 10, 27, 28)}
+    data = serializer.dumps(session)
+
+    assert data.startswith(b"{")
+    assert serializer.loads(data) == {
+        "last_seen": datetime.datetime(2025, 2, 28, 10, 27, 28, tzinfo=datetime.UTC)
+    }
+
+
+@pytest.mark.parametrize(
+    "session",
+    [
+        pytest.param({"_id": "not hex"}, id="not_hex"),
+        pytest.param({"_id": "abc"}, id="odd_length"),
+        pytest.param({"_id": "ABCD"}, id="uppercase"),
+        pytest.param({"_id": 123}, id="not_a_string"),
+        pytest.param({"form": {"_id": "not hex"}}, id="nested"),
+        pytest.param({"form": {"_id": "abcd"}}, id="nested_hex"),
+    ],
+)
+def test_compact_serializer_keeps_other_ids(session: dict[str, typing.Any]) -> None:
+    """
+    Only Flask-Login's top-level ``_id`` is stored as bytes, and only
+    if it's hex -- any other ``_id`` comes back exactly as it was.
+    """
+    serializer = sessions.CompactSessionSerializer()
+
+    data = serializer.dumps(session)
+
+    assert not data.startswith(b"{")
+    assert serializer.loads(data) == session
+
+
+def test_compact_serializer_falls_back_to_json_for_bad_strings() -> None:
+    """
+    If the session has a string that MessagePack can't encode, the
+    session is stored as JSON, rather than failing.
+    """
+    serializer = sessions.CompactSessionSerializer()
+
+    session = {"name": "\ud800"}
+    data = serializer.dumps(session)
+
+    assert data.startswith(b"{")
+    assert serializer.loads(data) == session
+
+
+def test_compact_session_logs_in(compact_app: Flask, user: FlickrUser) -> None:
+    """
+    A user can log in with the compact session cookie.
+    """
+    compact_app.test_client_class = FlaskLoginClient
+
+    with compact_app.test_client(user=user) as client:
+        resp = client.get("/")
+
+        cookie = client.get_cookie("session")
+        assert cookie is not None
+        assert "logged in</strong>" in resp.text
+
+
+def test_compact_session_reads_json_cookies(
+    app: Flask, logged_in_client: FlaskClient
+) -> None:
+    """
+    If we switch to the compact serializer, users who logged in with
+    a JSON session cookie are still logged in.
+    """
+    logged_in_client.get("/")
+    cookie = logged_in_client.get_cookie("session")
+    assert cookie is not None
+
+    app.config["SESSION_SERIALIZER"] = "msgpack"
+    sessions.init_app(app)
+
+    client = app.test_client()
+    client.set_cookie("session", cookie.value)
+    resp = client.get("/")
+
+    assert "logged in</strong>" in resp.text
+
+
+def test_compact_session_needs_a_secret_key() -> None:
+    """
+    Without a secret key, we can't sign the session.
+    """
+    app = Flask(__name__)
+
+    assert sessions.CompactSessionInterface().get_signing_serializer(app) is None
+
+
+def test_unknown_serializer_is_error(app: Flask) -> None:
+    """
+    Configuring an unrecognised session serializer is an error.
+    """
+    app.config["SESSION_SERIALIZER"] = "pickle"
+
+    with pytest.raises(ValueError, match="Unrecognised session serializer"):
+        sessions.init_app(app)
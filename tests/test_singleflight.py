@@ -0,0 +1,148 @@
+"""
+Tests for ``singleflight.py``, which collapses identical calls.
+"""
+
+import asyncio
+import concurrent.futures
+import threading
+import time
+
+import pytest
+
+from singleflight import AsyncSingleFlight, SingleFlight
+
+
+def test_waiters_get_the_same_exception() -> None:
+    """
+    If the call fails, everybody waiting for it gets the exception,
+    and the next call for the same key starts afresh.
+    """
+    flight: SingleFlight[str, int] = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls: list[str] = []
+
+    def fail() -> int:
+        """
+        Wait to be released, then fail.
+        """
+        calls.append("fail")
+        started.set()
+        assert release.wait(timeout=5)
+        raise ValueError("boom")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        leader = executor.submit(flight.do, "key", fail)
+        assert started.wait(timeout=5)
+        follower = executor.submit(flight.do, "key", fail)
+
+        # Give the follower a moment to join the call, then let it finish.
+        time.sleep(0.05)
+        release.set()
+
+        for future in (leader, follower):
+            with pytest.raises(ValueError, match="boom"):
+                future.result()
+
+    assert calls == ["fail"]
+    assert flight.do("key", lambda: 1) == 1
+
+
+def test_background_calls_are_collapsed() -> None:
+    """
+    If there's already a background call in flight for a key, we don't
+    start another one.
+    """
+    flight: SingleFlight[str, int] = SingleFlight()
+    release = threading.Event()
+    calls: list[str] = []
+
+    def slow() -> int:
+        """
+        Wait to be released, then return a value.
+        """
+        calls.append("slow")
+        assert release.wait(timeout=5)
+        return 1
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        flight.do_in_background("key", slow, executor)
+        flight.do_in_background("key", slow, executor)
+        release.set()
+
+    assert calls == ["slow"]
+
+
+def test_async_calls_are_collapsed() -> None:
+    """
+    Coroutines which ask for the same key at the same time share one
+    call, and get the same result or exception.
+    """
+    flight: AsyncSingleFlight[str, int] = AsyncSingleFlight()
+    calls: list[str] = []
+
+    async def slow(value: int) -> int:
+        """
+        Wait a moment, then return a value -- or fail, for 0.
+        """
+        calls.append(f"slow({value})")
+        await asyncio.sleep(0.01)
+        return 1 // value
+
+    async def run() -> None:
+        """
+        Make lots of calls at once.
+        """
+        results = await asyncio.gather(
+            *(flight.do("key", lambda: slow(1)) for _ in range(5)),
+            *(flight.do("bad", lambda: slow(0)) for _ in range(2)),
+            return_exceptions=True,
+        )
+
+        assert results[:5] == [1] * 5
+        assert all(isinstance(r, ZeroDivisionError) for r in results[5:])
+
+        # Once the call is finished, the next one starts afresh.
+        assert await flight.do("key", lambda: slow(2)) == 0
+
+    asyncio.run(run())
+
+    assert calls == ["slow(1)", "slow(0)", "slow(2)"]
+
+
+def test_cancelled_async_caller_does_not_cancel_the_call() -> None:
+    """
+    If a caller who's waiting for somebody else's call is cancelled,
+    the call carries on.  If the caller who started it is cancelled,
+    everybody else is cancelled too.
+    """
+    flight: AsyncSingleFlight[str, str] = AsyncSingleFlight()
+
+    async def slow() -> str:
+        """
+        Wait a moment, then return a value.
+        """
+        await asyncio.sleep(0.05)
+        return "done"
+
+    async def run() -> None:
+        """
+        Start some callers, and cancel them.
+        """
+        first = asyncio.ensure_future(flight.do("key", slow))
+        second = asyncio.ensure_future(flight.do("key", slow))
+        await asyncio.sleep(0.01)
+
+        second.cancel()
+        assert await first == "done"
+
+        first = asyncio.ensure_future(flight.do("key", slow))
+        second = asyncio.ensure_future(flight.do("key", slow))
+        await asyncio.sleep(0.01)
+
+        first.cancel()
+
+        with pytest.raises(asyncio.CancelledError):
+            await second
+
+    asyncio.run(run())
@@ -0,0 +1,69 @@
+"""
+Tests for the shared SQLite database helper.
+"""
+
+import pathlib
+import threading
+
+import pytest
+
+from sqlite_db import SqliteDatabase
+
+
+def test_connection_is_reused_in_the_same_thread(tmp_path: pathlib.Path) -> None:
+    """
+    A thread gets the same connection every time it asks for one.
+    """
+    db = SqliteDatabase(str(tmp_path / "db.sqlite"))
+
+    assert db.connection() is db.connection()
+
+
+def test_each_thread_gets_its_own_connection(tmp_path: pathlib.Path) -> None:
+    """
+    Different threads get different connections.
+    """
+    db = SqliteDatabase(str(tmp_path / "db.sqlite"))
+    connections = []
+
+    thread = threading.Thread(target=lambda: connections.append(db.connection()))
+    thread.start()
+    thread.join()
+
+    assert connections[0] is not db.connection()
+
+
+def test_database_uses_wal(tmp_path: pathlib.Path) -> None:
+    """
+    The database uses write-ahead logging.
+    """
+    db = SqliteDatabase(str(tmp_path / "db.sqlite"))
+
+    (journal_mode,) = db.connection().execute("PRAGMA journal_mode").fetchone()
+    assert journal_mode == "wal"
+
+
+def test_reconnects_after_fork(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    If the process is forked, the child opens its own connection to
+    the database.
+    """
+    db = SqliteDatabase(str(tmp_path / "db.sqlite"))
+    parent_connection = db.connection()
+
+    monkeypatch.setattr("os.getpid", lambda: -1)
+    assert db.connection() is not parent_connection
+
+
+def test_schema_is_created_on_first_use(tmp_path: pathlib.Path) -> None:
+    """
+    The schema is created when the database is first used, not before.
+    """
+    path = tmp_path / "db.sqlite"
+    db = SqliteDatabase(str(path), schema="CREATE TABLE IF NOT EXISTS t (x INTEGER);")
+    assert not path.exists()
+
+    db.connection().execute("INSERT INTO t VALUES (1)")
+    assert path.exists()
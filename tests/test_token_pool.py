@@ -0,0 +1,320 @@
+"""
+Tests for ``token_pool.py``, which fetches request tokens ahead of time.
+"""
+
+from collections.abc import Callable, Iterator
+import itertools
+import logging
+import pathlib
+import time
+import typing
+
+from flask import Flask
+import httpx
+from keyring.backend import KeyringBackend
+from nitrate.mock_keyring import *  # noqa: F403
+import pytest
+
+from app import create_app
+from token_pool import RequestTokenPool
+from token_store import RequestToken
+
+
+CALLBACK_URL = "http://localhost/callback"
+
+
+def wait_for(condition: Callable[[], bool]) -> None:
+    """
+    Wait for the background thread to do something.
+    """
+    deadline = time.monotonic() + 5
+
+    while not condition():
+        assert time.monotonic() < deadline, "Timed out waiting for the pool"
+        time.sleep(0.001)
+
+
+class FakeFetch:
+    """
+    A fake function for fetching request tokens, which records the
+    callback URLs it was called with.
+    """
+
+    def __init__(self) -> None:
+        self.callback_urls: list[str] = []
+        self.counter = itertools.count(start=1)
+
+    def __call__(self, callback_url: str) -> RequestToken:
+        """
+        Return a new request token.
+        """
+        self.callback_urls.append(callback_url)
+        n = next(self.counter)
+        return {"oauth_token": f"token{n}", "oauth_token_secret": f"secret{n}"}
+
+
+@pytest.fixture
+def fetch() -> FakeFetch:
+    """
+    Returns a fake function for fetching request tokens.
+    """
+    return FakeFetch()
+
+
+@pytest.fixture
+def create_pool(app: Flask) -> Iterator[Callable[..., RequestTokenPool]]:
+    """
+    Returns a function which creates a request token pool, and stops
+    the pool's background thread at the end of the test.
+    """
+    pools: list[RequestTokenPool] = []
+
+    def create(**kwargs: typing.Any) -> RequestTokenPool:
+        """
+        Create a request token pool.
+        """
+        kwargs = {
+            "size": 3,
+            "low_water": 2,
+            "ttl": 60,
+            "retry_interval": 0.01,
+            **kwargs,
+        }
+        pool = RequestTokenPool(app, **kwargs)
+        pools.append(pool)
+        return pool
+
+    yield create
+
+    for pool in pools:
+        pool.stop()
+
+
+def test_pool_fills_in_the_background(
+    create_pool: Callable[..., RequestTokenPool], fetch: FakeFetch
+) -> None:
+    """
+    The first time we ask for a token, the pool is empty, and it
+    starts filling in the background.
+    """
+    pool = create_pool(fetch=fetch)
+
+    assert pool.pop(CALLBACK_URL) is None
+
+    wait_for(lambda: len(pool) == 3)
+
+    assert pool.pop(CALLBACK_URL) == {
+        "oauth_token": "token1",
+        "oauth_token_secret": "secret1",
+    }
+    assert fetch.callback_urls == [CALLBACK_URL] * 3
+
+
+def test_pool_is_topped_up_below_low_water(
+    create_pool: Callable[..., RequestTokenPool], fetch: FakeFetch
+) -> None:
+    """
+    When the pool drops below the low-water mark, it's filled up again.
+    """
+    pool = create_pool(fetch=fetch)
+    pool.pop(CALLBACK_URL)
+    wait_for(lambda: len(pool) == 3)
+
+    # Taking one token leaves 2, which isn't below the low-water mark,
+    # so we don't fetch any more.
+    pool.pop(CALLBACK_URL)
+    time.sleep(0.05)
+    assert len(fetch.callback_urls) == 3
+
+    # Taking another leaves 1, so the pool is filled up again.
+    pool.pop(CALLBACK_URL)
+    wait_for(lambda: len(pool) == 3)
+    assert len(fetch.callback_urls) == 5
+
+
+def test_expired_tokens_are_discarded(
+    create_pool: Callable[..., RequestTokenPool], fetch: FakeFetch
+) -> None:
+    """
+    Tokens which have been in the pool longer than the TTL aren't used.
+    """
+    pool = create_pool(fetch=fetch, ttl=0)
+    pool.callback_url = CALLBACK_URL
+
+    pool.refill()
+
+    assert len(fetch.callback_urls) == 3
+    assert len(pool) == 0
+
+
+def test_refill_does_nothing_without_a_callback_url(
+    create_pool: Callable[..., RequestTokenPool], fetch: FakeFetch
+) -> None:
+    """
+    We can't fetch request tokens until we know the callback URL.
+    """
+    pool = create_pool(fetch=fetch)
+
+    pool.refill()
+
+    assert fetch.callback_urls == []
+
+
+def test_changing_the_callback_url_empties_the_pool(
+    create_pool: Callable[..., RequestTokenPool], fetch: FakeFetch
+) -> None:
+    """
+    If the callback URL changes, we don't use tokens for the old URL.
+    """
+    pool = create_pool(fetch=fetch)
+    pool.callback_url = CALLBACK_URL
+    pool.refill()
+
+    assert pool.pop("https://example.com/callback") is None
+
+
+def test_tokens_for_an_old_callback_url_are_dropped(
+    create_pool: Callable[..., RequestTokenPool],
+) -> None:
+    """
+    If the callback URL changes while we're fetching a token, we don't
+    put that token in the pool.
+    """
+
+    def fetch(callback_url: str) -> RequestToken:
+        """
+        Pretend the callback URL changed while we were talking to Flickr.
+        """
+        pool.callback_url = "https://example.com/callback"
+        return {"oauth_token": "token1", "oauth_token_secret": "secret1"}
+
+    pool = create_pool(fetch=fetch, size=1)
+    pool.callback_url = CALLBACK_URL
+    pool.refill()
+
+    assert len(pool) == 0
+
+
+def test_errors_are_retried(
+    create_pool: Callable[..., RequestTokenPool],
+    fetch: FakeFetch,
+    caplog: pytest.LogCaptureFixture,
+) -> None:
+    """
+    If we can't fetch a token, the background thread logs a warning,
+    and tries again later.
+    """
+    failures = iter([True])
+
+    def flaky_fetch(callback_url: str) -> RequestToken:
+        """
+        Fail the first time we're called, then succeed.
+        """
+        if next(failures, False):
+            raise httpx.ConnectError("Flickr is down")
+        return fetch(callback_url)
+
+    pool = create_pool(fetch=flaky_fetch)
+
+    with caplog.at_level(logging.WARNING, logger="token_pool"):
+        pool.pop(CALLBACK_URL)
+        wait_for(lambda: len(pool) == 3)
+
+    assert "Unable to fetch request tokens" in caplog.text
+
+
+def test_keeps_trying_if_tokens_expire_immediately(
+    create_pool: Callable[..., RequestTokenPool], fetch: FakeFetch
+) -> None:
+    """
+    If tokens expire as fast as we can fetch them, the background
+    thread keeps trying, but it doesn't loop forever.
+    """
+    pool = create_pool(fetch=fetch, ttl=0)
+    pool.pop(CALLBACK_URL)
+
+    wait_for(lambda: len(fetch.callback_urls) >= 6)
+
+
+@pytest.fixture
+def pooled_app(
+    mock_keyring: KeyringBackend,
+    monkeypatch: pytest.MonkeyPatch,
+    tmp_path: pathlib.Path,
+) -> Iterator[Flask]:
+    """
+    Creates a Flask app with a request token pool, which talks to a fake
+    Flickr that gives out numbered request tokens.
+    """
+    mock_keyring.set_password("flickr_flask_login_demo", "key", "123")
+    mock_keyring.set_password("flickr_flask_login_demo", "secret", "456")
+
+    counter = itertools.count(start=1)
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        """
+        Return a new request token.
+        """
+        n = next(counter)
+        return httpx.Response(
+            200,
+            text=f"oauth_callback_confirmed=true&oauth_token=token{n}&oauth_token_secret=secret{n}",
+        )
+
+    monkeypatch.setattr(
+        "httpx.HTTPTransport", lambda **kwargs: httpx.MockTransport(handler)
+    )
+
+    app = create_app(
+        config={
+            "TESTING": True,
+            "USER_STORE_PATH": str(tmp_path / "users.sqlite"),
+            "REQUEST_TOKEN_POOL_SIZE": 2,
+            "REQUEST_TOKEN_POOL_LOW_WATER": 1,
+        }
+    )
+
+    yield app
+
+    app.extensions["request_token_pool"].stop()
+
+
+def test_pool_is_off_by_default(app: Flask) -> None:
+    """
+    The app doesn't keep a request token pool unless you turn it on.
+    """
+    assert app.extensions["request_token_pool"] is None
+
+
+def test_authorize_uses_pooled_token(pooled_app: Flask) -> None:
+    """
+    If there's a token in the pool, /authorize uses it without waiting
+    for Flickr, and saves it for the callback.
+    """
+    pool = pooled_app.extensions["request_token_pool"]
+
+    with pooled_app.test_client() as client:
+        # The first login has to get a token from Flickr, and starts
+        # filling the pool.
+        resp = client.get("/authorize")
+        assert resp.status_code == 302
+        first_token = resp.location.split("oauth_token=")[1]
+
+        wait_for(lambda: len(pool) == 2)
+
+    # The next login (in another browser) gets a token from the pool.
+    with pooled_app.test_client() as client:
+        resp = client.get("/authorize")
+        assert resp.status_code == 302
+        assert resp.location.startswith(
+            "https://www.flickr.com/services/oauth/authorize?perms=read&oauth_token="
+        )
+        pooled_token = resp.location.split("oauth_token=")[1]
+
+    assert pooled_token != first_token
+    assert len(pool) == 1
+
+    store = pooled_app.extensions["request_token_store"]
+    assert store.pop(pooled_token)["oauth_token_secret"] == pooled_token.replace(
+        "token", "secret"
+    )
@@ -0,0 +1,192 @@
+"""
+Tests for the server-side request token stores.
+"""
+
+from collections.abc import Iterator
+import pathlib
+
+from flask import Flask, session
+from keyring.backend import KeyringBackend
+from nitrate.mock_keyring import *  # noqa: F403
+import pytest
+from werkzeug.exceptions import BadRequest
+
+from app import create_app, pop_request_token
+from token_store import (
+    MemoryRequestTokenStore,
+    RequestTokenStore,
+    SqliteRequestTokenStore,
+)
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(
+    request: pytest.FixtureRequest, tmp_path: pathlib.Path
+) -> Iterator[RequestTokenStore]:
+    """
+    Creates a request token store with each of the backends.
+    """
+    if request.param == "memory":
+        yield MemoryRequestTokenStore(ttl=60, max_size=100)
+    else:
+        yield SqliteRequestTokenStore(str(tmp_path / "tokens.sqlite"), ttl=60)
+
+
+def test_can_put_and_pop_token(store: RequestTokenStore) -> None:
+    """
+    You can retrieve a token after you've saved it, but only once.
+    """
+    token = {"oauth_token": "123", "oauth_token_secret": "456"}
+    store.put(token)
+
+    assert store.pop("123") == token
+    assert store.pop("123") is None
+
+
+def test_unknown_token_is_none(store: RequestTokenStore) -> None:
+    """
+    Looking up a token that was never saved returns None.
+    """
+    assert store.pop("doesnotexist") is None
+
+
+def test_expired_token_is_none(
+    store: RequestTokenStore, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    A token can't be retrieved after its TTL has passed.
+    """
+    store.put({"oauth_token": "123", "oauth_token_secret": "456"})
+
+    monkeypatch.setattr("time.monotonic", lambda: float("inf"))
+    monkeypatch.setattr("time.time", lambda: float("inf"))
+
+    assert store.pop("123") is None
+
+
+def test_expired_tokens_are_cleared_out(
+    store: RequestTokenStore, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    Saving a new token clears out any tokens which have expired.
+    """
+    store.put({"oauth_token": "1", "oauth_token_secret": "1"})
+    store.put({"oauth_token": "2", "oauth_token_secret": "2"})
+
+    # Wait (roughly) until the old tokens have expired, then add a
+    # new token.
+    monkeypatch.setattr("time.monotonic", lambda: 1e12)
+    monkeypatch.setattr("time.time", lambda: 1e12)
+    store.put({"oauth_token": "3", "oauth_token_secret": "3"})
+
+    if isinstance(store, MemoryRequestTokenStore):
+        assert list(store._tokens) == ["3"]
+    else:
+        assert isinstance(store, SqliteRequestTokenStore)
+        rows = store.db.connection().execute("SELECT oauth_token FROM request_tokens")
+        assert rows.fetchall() == [("3",)]
+
+
+def test_memory_store_discards_oldest_tokens_when_full() -> None:
+    """
+    If the memory store is full, it forgets the oldest tokens first.
+    """
+    store = MemoryRequestTokenStore(ttl=60, max_size=2)
+
+    for i in range(3):
+        store.put({"oauth_token": str(i), "oauth_token_secret": "secret"})
+
+    assert store.pop("0") is None
+    assert store.pop("1") is not None
+    assert store.pop("2") is not None
+
+
+def test_sqlite_store_is_shared_between_processes(tmp_path: pathlib.Path) -> None:
+    """
+    Two SQLite stores using the same file share the same tokens, e.g.
+    in separate worker processes.
+    """
+    path = str(tmp_path / "tokens.sqlite")
+    store_1 = SqliteRequestTokenStore(path, ttl=60)
+    store_2 = SqliteRequestTokenStore(path, ttl=60)
+
+    store_1.put({"oauth_token": "123", "oauth_token_secret": "456"})
+    assert store_2.pop("123") == {"oauth_token": "123", "oauth_token_secret": "456"}
+    assert store_1.pop("123") is None
+
+
+def test_callback_can_use_token_from_another_worker(
+    mock_keyring: KeyringBackend, tmp_path: pathlib.Path
+) -> None:
+    """
+    With the SQLite store, a callback can use a request token saved by
+    a different worker, without any session cookie.
+    """
+    mock_keyring.set_password("flickr_flask_login_demo", "key", "123")
+    mock_keyring.set_password("flickr_flask_login_demo", "secret", "456")
+
+    config = {
+        "REQUEST_TOKEN_STORE": "sqlite",
+        "REQUEST_TOKEN_STORE_PATH": str(tmp_path / "tokens.sqlite"),
+    }
+    worker_1 = create_app(config)
+    worker_2 = create_app(config)
+
+    worker_1.extensions["request_token_store"].put(
+        {"oauth_token": "abc", "oauth_token_secret": "def"}
+    )
+
+    with worker_2.test_request_context("/callback?oauth_token=abc"):
+        assert pop_request_token()[:2] == ("abc", "def")
+
+
+def test_sqlite_store_is_the_default(app: Flask, tmp_path: pathlib.Path) -> None:
+    """
+    By default, request tokens are kept in SQLite, so every worker can
+    see them, but you can choose to keep them in memory.
+    """
+    assert isinstance(app.extensions["request_token_store"], SqliteRequestTokenStore)
+
+    memory_app = create_app(
+        config={
+            "USER_STORE_PATH": str(tmp_path / "users.sqlite"),
+            "REQUEST_TOKEN_STORE": "memory",
+        }
+    )
+    assert isinstance(
+        memory_app.extensions["request_token_store"], MemoryRequestTokenStore
+    )
+
+
+def test_callback_must_come_from_the_browser_that_started_the_login(
+    app: Flask,
+) -> None:
+    """
+    A callback can only use a request token which was saved for the
+    same browser, unless that check is turned off.
+    """
+    store = app.extensions["request_token_store"]
+    request_token = {"oauth_token": "abc", "oauth_token_secret": "def"}
+
+    store.put({**request_token, "login_id": "alice"})
+
+    with app.test_request_context("/callback?oauth_token=abc"):
+        session["login_id"] = "mallory"
+
+        with pytest.raises(BadRequest):
+            pop_request_token()
+
+    app.config["REQUEST_TOKEN_CHECK_SESSION"] = False
+    store.put({**request_token, "login_id": "alice"})
+
+    with app.test_request_context("/callback?oauth_token=abc"):
+        session["login_id"] = "mallory"
+        assert pop_request_token()[:2] == ("abc", "def")
+
+
+def test_unknown_store_is_error(app: Flask) -> None:
+    """
+    Configuring an unrecognised store backend is an error.
+    """
+    with pytest.raises(ValueError, match="Unrecognised request token store"):
+        create_app(config={"REQUEST_TOKEN_STORE": "carrier-pigeon"})
@@ -0,0 +1,370 @@
+"""
+Tests for ``token_validator.py``, which checks in the background
+whether users' access tokens are still valid.
+"""
+
+import logging
+import os
+import threading
+
+from flask import Flask
+from flask_login import FlaskLoginClient
+import httpx
+import pytest
+
+from rate_limit import MemoryRateLimiter
+from token_validator import TokenValidator
+from users import FlickrUser, UserStore
+
+
+class FakeFlickr:
+    """
+    A fake Flickr API, which says whether an access token is valid.
+    """
+
+    def __init__(self) -> None:
+        self.checked: list[str] = []
+
+        # Tokens which have been revoked, and tokens we can't check
+        self.revoked: set[str] = set()
+        self.broken: set[str] = set()
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        """
+        Handle a call to ``flickr.auth.oauth.checkToken``, or return a
+        profile for the secret page.
+        """
+        if request.url.params["method"] != "flickr.auth.oauth.checkToken":
+            return httpx.Response(
+                200,
+                json={"person": {"photos": {"count": {"_content": 7}}}, "stat": "ok"},
+            )
+
+        token = request.headers["Authorization"].split('oauth_token="')[1]
+        token = token.split('"')[0]
+        self.checked.append(token)
+
+        if token in self.broken:
+            raise ValueError("boom")
+
+        if token in self.revoked:
+            return httpx.Response(
+                200, json={"stat": "fail", "code": 98, "message": "Invalid auth token"}
+            )
+
+        if token == "unavailable":
+            return httpx.Response(
+                200,
+                json={"stat": "fail", "code": 105, "message": "Service unavailable"},
+            )
+
+        return httpx.Response(200, json={"oauth": {"token": token}, "stat": "ok"})
+
+
+@pytest.fixture
+def fake_flickr(monkeypatch: pytest.MonkeyPatch) -> FakeFlickr:
+    """
+    Replace the Flickr API with a fake.
+    """
+    fake = FakeFlickr()
+
+    monkeypatch.setattr(
+        "httpx.HTTPTransport", lambda **kwargs: httpx.MockTransport(fake)
+    )
+
+    return fake
+
+
+@pytest.fixture
+def store(app: Flask) -> UserStore:
+    """
+    Returns the app's user store.
+    """
+    user_store: UserStore = app.extensions["user_store"]
+    return user_store
+
+
+@pytest.fixture
+def validator(app: Flask, store: UserStore, fake_flickr: FakeFlickr) -> TokenValidator:
+    """
+    Creates a token validator which checks every token every 10 minutes,
+    in batches every minute.
+    """
+    app.extensions["flickr_api"].policy.backoff = 0
+
+    return TokenValidator(
+        app,
+        store=store,
+        api=app.extensions["flickr_api"],
+        interval=600,
+        tick=60,
+        concurrency=2,
+        max_batch=100,
+    )
+
+
+def save_users(store: UserStore, count: int) -> list[FlickrUser]:
+    """
+    Save some users with access tokens.
+    """
+    users = [
+        FlickrUser(f"user{i}@N01", f"User {i}", f"token{i}", f"secret{i}")
+        for i in range(count)
+    ]
+
+    for user in users:
+        store.save(user)
+
+    return users
+
+
+def test_batches_are_spread_over_the_interval(
+    store: UserStore, validator: TokenValidator
+) -> None:
+    """
+    Each batch is big enough that every token is checked once per
+    interval, but no bigger than the maximum.
+    """
+    assert validator.batch_size() == 0
+
+    save_users(store, 25)
+    assert validator.batch_size() == 3
+
+    validator.max_batch = 2
+    assert validator.batch_size() == 2
+
+    # Users without a token aren't checked.
+    store.save(FlickrUser("notoken@N01", "No Token"))
+    validator.max_batch = 100
+    assert validator.batch_size() == 3
+
+
+def test_tokens_are_checked_oldest_first(
+    store: UserStore, validator: TokenValidator, fake_flickr: FakeFlickr
+) -> None:
+    """
+    Each batch checks the tokens we checked longest ago, so we go round
+    every token in turn.
+    """
+    save_users(store, 5)
+    validator.interval = validator.tick
+    validator.max_batch = 2
+
+    for _ in range(3):
+        assert validator.check_batch() == 0
+
+    assert sorted(fake_flickr.checked[:4]) == ["token0", "token1", "token2", "token3"]
+    assert len(fake_flickr.checked) == 6
+    assert "token4" in fake_flickr.checked[4:]
+
+
+def test_revoked_users_are_logged_out(
+    app: Flask,
+    store: UserStore,
+    validator: TokenValidator,
+    fake_flickr: FakeFlickr,
+    caplog: pytest.LogCaptureFixture,
+) -> None:
+    """
+    If Flickr says a token is invalid, we mark the user as revoked, and
+    they're logged out on their next request.
+    """
+    (user,) = save_users(store, 1)
+    fake_flickr.revoked = {"token0"}
+
+    app.test_client_class = FlaskLoginClient
+
+    with app.test_client(user=user) as client:
+        assert client.get("/secret").status_code == 200
+
+        with caplog.at_level(logging.INFO, logger="token_validator"):
+            assert validator.check_batch() == 1
+
+        assert "Access token for user0@N01 has been revoked" in caplog.text
+        assert "Checked 1 access tokens: 1 revoked" in caplog.text
+
+        assert "user0@N01" in store.revoked
+        assert store.load(user.id) is None
+        assert client.get("/secret").status_code == 302
+
+    # We don't check revoked users again.
+    assert validator.batch_size() == 0
+    assert validator.check_batch() == 0
+
+    # If they log in again, they aren't revoked any more.
+    store.save(FlickrUser("user0@N01", "User 0", "newtoken", "newsecret"))
+    assert "user0@N01" not in store.revoked
+    assert store.load(user.id) is not None
+
+
+def test_user_who_logs_in_again_during_a_check_isnt_revoked(
+    store: UserStore, validator: TokenValidator, fake_flickr: FakeFlickr
+) -> None:
+    """
+    If a user logs in again while we're checking their old token, we
+    don't revoke their new one.
+    """
+    (user,) = save_users(store, 1)
+    store.save(FlickrUser("user0@N01", "User 0", "newtoken", "newsecret"))
+
+    fake_flickr.revoked = {"token0"}
+    assert validator.check(user) == "revoked"
+
+    assert "user0@N01" not in store.revoked
+    assert store.load(user.id) is not None
+
+
+def test_users_revoked_by_another_worker(
+    app: Flask, store: UserStore, validator: TokenValidator
+) -> None:
+    """
+    We pick up users revoked by other workers before each batch, and
+    notice if a revoked user has logged in again on another worker.
+    """
+    (user,) = save_users(store, 1)
+
+    # Another worker revokes the user.
+    store.repository.mark_revoked(user)
+    assert "user0@N01" not in store.revoked
+
+    validator.check_batch()
+    assert "user0@N01" in store.revoked
+    assert store.load(user.id) is None
+
+    # The user logs in again on another worker.  We trust the set of
+    # revoked users until we reload it, before the next batch.
+    store.repository.save(user)
+    assert store.load(user.id) is None
+
+    validator.check_batch()
+    assert "user0@N01" not in store.revoked
+    assert store.load(user.id) is not None
+
+
+def test_tokens_we_cant_check_are_left_alone(
+    app: Flask,
+    store: UserStore,
+    validator: TokenValidator,
+    fake_flickr: FakeFlickr,
+    caplog: pytest.LogCaptureFixture,
+) -> None:
+    """
+    If we can't tell whether a token is valid, we don't revoke it.
+    """
+    store.save(FlickrUser("a@N01", "A", "unavailable", "secret"))
+    store.save(FlickrUser("b@N01", "B", "broken", "secret"))
+    fake_flickr.broken = {"broken"}
+    validator.interval = validator.tick
+
+    with caplog.at_level(logging.WARNING, logger="token_validator"):
+        assert validator.check_batch() == 0
+
+    assert "Unable to check access token for a@N01" in caplog.text
+    assert "Unable to check access token for b@N01" in caplog.text
+    assert store.revoked == set()
+
+    # If we've used up the rate limit, we skip the check.
+    limiter = MemoryRateLimiter(rate=0.001, capacity=1, reserve=1)
+    app.extensions["flickr_call_policy"].limiter = limiter
+
+    user = FlickrUser("c@N01", "C", "token", "secret")
+    assert validator.check(user) == "rate_limited"
+
+
+def test_checks_leave_the_background_reserve_for_logins(
+    app: Flask,
+    validator: TokenValidator,
+    fake_flickr: FakeFlickr,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """
+    Token checks are background calls, so they stop once the bucket
+    drops below the background reserve, and leave the rest for logins.
+    """
+    monkeypatch.setattr("time.monotonic", lambda: 1000.0)
+
+    limiter = app.extensions["flickr_rate_limiter"]
+    bucket = app.config["CLIENT_ID"]
+    user = FlickrUser("a@N01", "A", "token", "secret")
+
+    # Use calls until the bucket is just above the background reserve.
+    while limiter.acquire(urgent=False, bucket=bucket, background=True) == 0:
+        pass
+
+    assert validator.check(user) == "rate_limited"
+    assert fake_flickr.checked == []
+
+    # A login can still get a token.
+    assert limiter.acquire(urgent=False, bucket=bucket) == 0
+
+
+def test_validator_runs_in_the_background(
+    store: UserStore,
+    validator: TokenValidator,
+    fake_flickr: FakeFlickr,
+    monkeypatch: pytest.MonkeyPatch,
+    caplog: pytest.LogCaptureFixture,
+) -> None:
+    """
+    Once it's started, the validator checks a batch every tick, and
+    carries on if a batch fails.
+    """
+    save_users(store, 1)
+    fake_flickr.revoked = {"token0"}
+
+    validator.tick = 0.001
+    checked = threading.Event()
+    check_batch = validator.check_batch
+    calls = 0
+
+    def flaky_check_batch() -> int:
+        """
+        Fail the first batch, then check as normal.
+        """
+        nonlocal calls
+        calls += 1
+
+        if calls == 1:
+            raise ValueError("boom")
+
+        revoked = check_batch()
+        checked.set()
+        return revoked
+
+    monkeypatch.setattr(validator, "check_batch", flaky_check_batch)
+
+    with caplog.at_level(logging.ERROR, logger="token_validator"):
+        validator.start()
+        validator.start()
+        assert checked.wait(timeout=5)
+        validator.stop()
+
+    assert "Unable to check access tokens" in caplog.text
+    assert "user0@N01" in store.revoked
+
+    # If we're forked, the new worker starts its own thread.
+    validator.stop()
+    pid = os.getpid() + 1
+    monkeypatch.setattr("os.getpid", lambda: pid)
+
+    validator.start()
+    validator.stop()
+
+
+@pytest.mark.parametrize("app_config", [{"TOKEN_CHECK_INTERVAL": 24 * 60 * 60}])
+def test_validator_starts_on_the_first_request(app: Flask) -> None:
+    """
+    If it's turned on, the validator starts on the worker's first request.
+    """
+    validator: TokenValidator = app.extensions["token_validator"]
+    assert validator._pid is None
+
+    app.test_client().get("/")
+    assert validator._pid == os.getpid()
+
+
+def test_validator_is_off_by_default(app: Flask) -> None:
+    """
+    We don't check access tokens unless it's turned on.
+    """
+    assert app.extensions["token_validator"] is None
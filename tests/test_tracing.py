@@ -0,0 +1,173 @@
+"""
+Tests for ``tracing.py``, which traces a sample of logins from start
+to finish.
+"""
+
+import json
+import typing
+
+from flask import Flask
+from flask.testing import FlaskClient
+import httpx
+import pytest
+
+from tracing import Trace, Tracer
+
+
+@pytest.fixture
+def flickr_requests(monkeypatch: pytest.MonkeyPatch) -> list[httpx.Request]:
+    """
+    Replace Flickr's OAuth endpoints with a fake, and return a list of
+    the requests it receives.
+    """
+    requests: list[httpx.Request] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        """
+        Return a request token or an access token.
+        """
+        requests.append(request)
+
+        if request.url.path == "/services/oauth/request_token":
+            body = "oauth_callback_confirmed=true&oauth_token=req123&oauth_token_secret=reqsecret"
+        else:
+            body = "fullname=Father%20Sword&oauth_token=acc123&oauth_token_secret=accsecret&user_nsid=test%40123&username=fathersword"
+
+        return httpx.Response(200, text=body)
+
+    monkeypatch.setattr(
+        "httpx.HTTPTransport", lambda **kwargs: httpx.MockTransport(handler)
+    )
+
+    return requests
+
+
+def log_in(client: FlaskClient) -> None:
+    """
+    Go through the login flow.
+    """
+    resp = client.get("/authorize")
+    assert resp.status_code == 302
+
+    resp = client.get("/callback?oauth_token=req123&oauth_verifier=ver456")
+    assert resp.status_code == 302
+
+
+def get_spans(client: FlaskClient, query: str = "") -> list[dict[str, typing.Any]]:
+    """
+    Download the spans from /debug/traces.
+    """
+    resp = client.get("/debug/traces" + query)
+    assert resp.status_code == 200
+    assert resp.headers["Content-Type"] == "application/x-ndjson"
+
+    return [json.loads(line) for line in resp.text.splitlines()]
+
+
+def test_tracing_is_off_by_default(
+    app: Flask, flickr_requests: list[httpx.Request]
+) -> None:
+    """
+    If ``TRACE_SAMPLE_RATE`` isn't set, we don't trace anything, and
+    there's nothing to see at /debug/traces.
+    """
+    assert app.extensions["tracer"] is None
+
+    with app.test_client() as client:
+        log_in(client)
+        resp = client.get("/debug/traces")
+
+    assert resp.status_code == 404
+
+
+@pytest.mark.parametrize("app_config", [{"TRACE_SAMPLE_RATE": 1}])
+def test_login_is_traced_from_start_to_finish(
+    app: Flask, flickr_requests: list[httpx.Request]
+) -> None:
+    """
+    A traced login has one trace, which covers both of our views and
+    every step that talks to Flickr.
+    """
+    with app.test_client() as client:
+        log_in(client)
+        spans = get_spans(client)
+
+    assert [span["name"] for span in spans] == [
+        "flickr.fetch_request_token",
+        "flickr.create_authorization_url",
+        "authorize",
+        "flickr.fetch_access_token",
+        "callback",
+    ]
+
+    # Every span is in the same trace ...
+    trace_ids = {span["trace_id"] for span in spans}
+    assert len(trace_ids) == 1
+
+    # ... the calls to Flickr are children of their view ...
+    authorize_span, callback_span = spans[2], spans[4]
+
+    assert authorize_span["parent_id"] is None
+    assert authorize_span["attributes"] == {"status": 302}
+    assert spans[0]["parent_id"] == authorize_span["span_id"]
+    assert spans[1]["parent_id"] == authorize_span["span_id"]
+    assert spans[3]["parent_id"] == callback_span["span_id"]
+    assert spans[3]["attributes"] == {"outcome": "success"}
+
+    # ... and they're in the order they happened.
+    timestamps = [span["timestamp"] for span in spans]
+    assert timestamps[0] >= timestamps[2]
+    assert timestamps[3] >= timestamps[2]
+
+    # We can also download a single trace.
+    (trace_id,) = trace_ids
+    assert get_spans(app.test_client(), f"?trace_id={trace_id}") == spans
+    assert get_spans(app.test_client(), "?trace_id=doesnotexist") == []
+
+
+@pytest.mark.parametrize("app_config", [{"TRACE_SAMPLE_RATE": 1}])
+def test_logins_which_arent_sampled_arent_traced(
+    app: Flask,
+    flickr_requests: list[httpx.Request],
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """
+    If a login isn't chosen for tracing, we don't record anything, and
+    we don't save a trace ID with the request token.
+    """
+    app.extensions["tracer"].sample_rate = 0.5
+    monkeypatch.setattr("random.random", lambda: 0.9)
+
+    saved_tokens: list[dict[str, str]] = []
+    store = app.extensions["request_token_store"]
+    monkeypatch.setattr(store, "put", saved_tokens.append)
+
+    with app.test_client() as client:
+        client.get("/authorize")
+        assert get_spans(client) == []
+
+        with client.session_transaction() as session:
+            login_id = session["login_id"]
+
+    assert saved_tokens == [
+        {
+            "oauth_callback_confirmed": "true",
+            "oauth_token": "req123",
+            "oauth_token_secret": "reqsecret",
+            "client_id": "123",
+            "login_id": login_id,
+        }
+    ]
+
+
+def test_tracer_only_keeps_the_most_recent_spans() -> None:
+    """
+    The tracer keeps a fixed number of spans, and forgets the oldest.
+    """
+    tracer = Tracer(sample_rate=1, buffer_size=2)
+    trace = Trace(trace_id="abc")
+
+    for name in ["one", "two", "three"]:
+        tracer.record(trace, name, started_at=trace.started_at, duration=0)
+
+    assert [span["name"] for span in tracer.spans()] == ["two", "three"]
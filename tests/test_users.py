@@ -0,0 +1,168 @@
+"""
+Tests for the user class and the cached user store.
+"""
+
+import pathlib
+import sqlite3
+import sys
+
+from flask import Flask
+from flask.testing import FlaskClient
+import pytest
+
+from users import FlickrUser, UserRepository, UserStore
+
+
+@pytest.fixture
+def user_store(tmp_path: pathlib.Path) -> UserStore:
+    """
+    Creates a user store for testing.
+    """
+    return UserStore(
+        UserRepository(str(tmp_path / "users.sqlite")), cache_size=10, cache_ttl=60
+    )
+
+
+def test_user_has_no_dict() -> None:
+    """
+    Users use ``__slots__``, so they don't carry a per-instance dict.
+    """
+    user = FlickrUser(user_nsid="test@123", name="Father Sword")
+
+    assert not hasattr(user, "__dict__")
+    assert sys.getsizeof(user) < 100
+
+
+def test_can_save_and_load_user(user_store: UserStore) -> None:
+    """
+    A user and their access token can be saved and loaded again from
+    the database.
+    """
+    user_store.save(FlickrUser("test@123", "Father Sword", "token", "secret"))
+
+    user = user_store.repository.get("test@123")
+    assert user is not None
+    assert user.id == "test@123/Father Sword"
+    assert (user.oauth_token, user.oauth_token_secret) == ("token", "secret")
+
+
+def test_load_uses_the_cache(user_store: UserStore) -> None:
+    """
+    Loading the same user twice returns the cached user, without going
+    to the database.
+    """
+    user_store.save(FlickrUser("test@123", "Father Sword", "token", "secret"))
+    user_store.cache.invalidate("test@123")
+
+    user_1 = user_store.load("test@123/Father Sword")
+    assert user_1 is not None
+    assert user_1.oauth_token == "token"
+
+    user_store.repository.db.connection().execute("DELETE FROM users")
+
+    user_2 = user_store.load("test@123/Father Sword")
+    assert user_2 is user_1
+
+
+def test_unknown_user_is_loaded_from_id(user_store: UserStore) -> None:
+    """
+    If we don't know about a user, we create a basic user from their ID.
+    """
+    user = user_store.load("test@123/Father Sword")
+
+    assert user is not None
+    assert user.user_nsid == "test@123"
+    assert user.name == "Father Sword"
+    assert user.oauth_token is None
+
+
+def test_logout_removes_user_from_cache(
+    app: Flask, logged_in_client: FlaskClient, user: FlickrUser
+) -> None:
+    """
+    When a user logs out, they're removed from the cache.
+    """
+    user_store: UserStore = app.extensions["user_store"]
+
+    logged_in_client.get("/")
+    assert user_store.cache.get(user.user_nsid) is not None
+
+    logged_in_client.get("/logout")
+    assert user_store.cache.get(user.user_nsid) is None
+
+
+def test_users_api_key_is_saved(user_store: UserStore) -> None:
+    """
+    We save the API key for a user's access token, and forget it if
+    they log in again with the default key.
+    """
+    repository = user_store.repository
+
+    repository.save(FlickrUser("test@123", "Father Sword", "t", "s", "aaa"))
+    user = repository.get("test@123")
+    assert user is not None
+    assert user.client_id == "aaa"
+
+    repository.save(FlickrUser("test@123", "Father Sword", "t", "s"))
+    user = repository.get("test@123")
+    assert user is not None
+    assert user.client_id is None
+
+
+def test_failed_save_changes_nothing(user_store: UserStore) -> None:
+    """
+    If we can't save a user, a revoked user stays revoked.
+    """
+    repository = user_store.repository
+
+    user = FlickrUser("test@123", "Father Sword", "t", "s", "aaa")
+    repository.save(user)
+    assert repository.mark_revoked(user)
+
+    with pytest.raises(sqlite3.IntegrityError):
+        repository.save(FlickrUser("test@123", None, "t2", "s2", "aaa"))  # type: ignore[arg-type]
+
+    saved_user = repository.get("test@123")
+    assert saved_user is not None
+    assert saved_user.oauth_token == "t"
+    assert repository.revoked_user_nsids() == {"test@123"}
+
+
+def test_failed_claim_changes_nothing(
+    user_store: UserStore, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    If we can't record that we're checking a user's token, we don't
+    claim any of them.
+    """
+    repository = user_store.repository
+    repository.save(FlickrUser("test@123", "Father Sword", "t", "s"))
+
+    monkeypatch.setattr("time.time", lambda: object())
+
+    with pytest.raises(sqlite3.Error):
+        repository.claim_token_checks(limit=10)
+
+    conn = repository.db.connection()
+    assert not conn.in_transaction
+    assert conn.execute(
+        "SELECT COUNT(*) FROM users WHERE checked_at IS NOT NULL"
+    ).fetchone() == (0,)
+
+
+def test_logging_in_again_keeps_the_token_check_time(user_store: UserStore) -> None:
+    """
+    If a user logs in again, we remember when we last checked their
+    token, so they don't jump the queue of tokens to check.
+    """
+    repository = user_store.repository
+
+    repository.save(FlickrUser("test@123", "Father Sword", "t", "s"))
+    repository.save(FlickrUser("other@123", "Other", "t", "s"))
+
+    (checked,) = repository.claim_token_checks(limit=1)
+
+    repository.save(FlickrUser(checked.user_nsid, checked.name, "t2", "s2"))
+
+    (next_checked,) = repository.claim_token_checks(limit=1)
+    assert next_checked.user_nsid != checked.user_nsid
@@ -0,0 +1,193 @@
+"""
+Tests for ``warm_up.py``, which warms up each worker before it reports
+that it's ready.
+"""
+
+from collections.abc import Callable, Iterator
+import logging
+import os
+import threading
+import typing
+
+from flask import Flask
+import httpx
+import pytest
+
+from warm_up import WarmUp
+
+
+class FakeFlickr:
+    """
+    A fake Flickr, which records requests, and can be told to wait
+    before it replies, or to fail.
+    """
+
+    def __init__(self) -> None:
+        self.requests: list[httpx.Request] = []
+        self.release = threading.Event()
+        self.release.set()
+        self.error: Exception | None = None
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        """
+        Handle a request to the fake server.
+        """
+        self.requests.append(request)
+        assert self.release.wait(timeout=5)
+
+        if self.error is not None:
+            raise self.error
+
+        return httpx.Response(401, text="oauth_problem=parameter_absent")
+
+
+@pytest.fixture
+def fake_flickr(monkeypatch: pytest.MonkeyPatch) -> FakeFlickr:
+    """
+    Replace the transport used to talk to Flickr with a fake.
+    """
+    fake = FakeFlickr()
+
+    monkeypatch.setattr(
+        "httpx.HTTPTransport", lambda **kwargs: httpx.MockTransport(fake)
+    )
+
+    return fake
+
+
+@pytest.fixture
+def make_warm_app(
+    make_app: Callable[..., Flask], fake_flickr: FakeFlickr
+) -> Iterator[Callable[[], Flask]]:
+    """
+    Returns a function that creates an app which warms up on start.
+
+    At the end of the test, we let any warm-up that's still waiting for
+    Flickr finish, before the app is torn down.
+    """
+    apps: list[Flask] = []
+
+    def make_warm_app() -> Flask:
+        """
+        Create the app.
+        """
+        app = make_app(WARM_UP_ON_START=True)
+        apps.append(app)
+        return app
+
+    yield make_warm_app
+
+    fake_flickr.release.set()
+
+    for app in apps:
+        assert app.extensions["warm_up"].wait(timeout=5)
+
+
+def get_ready(app: Flask) -> tuple[int, dict[str, typing.Any], str | None]:
+    """
+    Ask /ready whether the app is ready, and return the status code,
+    the JSON body, and the ``Retry-After`` header.
+    """
+    resp = app.test_client().get("/ready")
+    assert resp.json is not None
+    return resp.status_code, resp.json, resp.headers.get("Retry-After")
+
+
+def test_ready_without_warm_up(app: Flask) -> None:
+    """
+    If warm-up is turned off, the app is always ready.
+    """
+    assert app.extensions["warm_up"] is None
+    assert get_ready(app) == (
+        200,
+        {"ready": True, "state": "disabled", "duration": None},
+        None,
+    )
+
+
+def test_not_ready_until_warmed_up(
+    make_warm_app: Callable[[], Flask], fake_flickr: FakeFlickr
+) -> None:
+    """
+    The app reports that it isn't ready until it's made a signed
+    request to Flickr, and then it's ready.
+    """
+    fake_flickr.release.clear()
+    app = make_warm_app()
+
+    status, body, retry_after = get_ready(app)
+    assert (status, body["state"], retry_after) == (503, "warming", "1")
+
+    fake_flickr.release.set()
+    assert app.extensions["warm_up"].wait(timeout=5)
+
+    status, body, retry_after = get_ready(app)
+    assert (status, body["state"], retry_after) == (200, "ready", None)
+    assert body["duration"] > 0
+
+    # We made one request to Flickr, and it was signed with our key.
+    (request,) = fake_flickr.requests
+    assert request.method == "HEAD"
+    assert request.url.path == "/services/oauth/request_token"
+    assert request.url.params["oauth_consumer_key"] == "123"
+    assert "oauth_signature" in request.url.params
+
+    samples = app.extensions["metrics"].collect()
+    assert (
+        "flickr_call_duration_seconds",
+        (("outcome", "success"), ("step", "warm_up")),
+    ) in samples
+
+
+def test_failed_warm_up_is_still_ready(
+    make_warm_app: Callable[[], Flask],
+    fake_flickr: FakeFlickr,
+    caplog: pytest.LogCaptureFixture,
+) -> None:
+    """
+    If we can't warm up, we log a warning, but the worker is ready
+    anyway -- it's up to the circuit breaker to cope with Flickr.
+    """
+    fake_flickr.error = ValueError("boom")
+
+    with caplog.at_level(logging.INFO, logger="warm_up"):
+        app = make_warm_app()
+        assert app.extensions["warm_up"].wait(timeout=5)
+
+    assert "Unable to warm up connection to Flickr" in caplog.text
+    assert "Warm-up finished in" in caplog.text
+
+    status, body, _ = get_ready(app)
+    assert (status, body["state"]) == (200, "failed")
+
+
+def test_forked_worker_warms_up_again(
+    make_warm_app: Callable[[], Flask],
+    fake_flickr: FakeFlickr,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """
+    If the app is created before the workers are forked, each worker
+    starts its own warm-up the first time it's asked if it's ready.
+    """
+    app = make_warm_app()
+    warm_up: WarmUp = app.extensions["warm_up"]
+    assert warm_up.wait(timeout=5)
+    assert warm_up.is_ready
+
+    # Pretend we're in a new process.
+    pid = os.getpid() + 1
+    monkeypatch.setattr("os.getpid", lambda: pid)
+
+    assert not warm_up.is_ready
+    assert warm_up.snapshot()["state"] == "cold"
+
+    fake_flickr.release.clear()
+
+    status, body, _ = get_ready(app)
+    assert (status, body["state"]) == (503, "warming")
+
+    fake_flickr.release.set()
+    assert warm_up.wait(timeout=5)
+    assert warm_up.is_ready
+    assert len(fake_flickr.requests) == 2
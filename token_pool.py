@@ -0,0 +1,243 @@
+"""
+A pool of request tokens which we fetch from Flickr ahead of time.
+
+The slowest part of /authorize is waiting for Flickr to give us a
+request token.  But every request token is the same, apart from its
+random value -- they're all for the same app with the same callback
+URL -- so we don't have to wait until a user clicks "log in" to get
+one.  Instead, a background thread keeps a small pool of fresh tokens,
+and /authorize takes one from the pool and redirects the user straight
+to Flickr.
+
+*   When the pool drops below a "low-water mark", the background thread
+    tops it up again.
+*   Tokens in the pool expire after a TTL, which should be well below
+    the time Flickr gives the user to approve our app.  (Once a token is
+    taken from the pool, it's saved in the request token store with its
+    own TTL -- see ``token_store.py``.)
+*   If the pool is empty -- e.g. lots of people logged in at once, or
+    Flickr is down -- /authorize gets a token from Flickr as normal.
+
+We don't know the callback URL until we see a request (it depends on
+the hostname), so the pool starts filling on the first /authorize.
+This also means the thread starts in the worker process, not in a
+parent process that forks the workers (e.g. ``gunicorn --preload``),
+where it would be lost in the fork.
+
+Each worker process has its own pool.  The pool is disabled by default;
+set ``REQUEST_TOKEN_POOL_SIZE`` to turn it on.
+"""
+
+from collections.abc import Callable
+import collections
+import logging
+import threading
+import time
+
+from flask import Flask
+
+from token_store import RequestToken
+
+
+logger = logging.getLogger(__name__)
+
+
+class RequestTokenPool:
+    """
+    Keeps up to ``size`` request tokens ready for /authorize, and fetches
+    more in a background thread when there are fewer than ``low_water``.
+
+    ``fetch`` takes a callback URL and returns a new request token.  It's
+    called inside an app context, so it can use the app config.
+    """
+
+    def __init__(
+        self,
+        app: Flask,
+        *,
+        fetch: Callable[[str], RequestToken],
+        size: int,
+        low_water: int,
+        ttl: float,
+        retry_interval: float,
+    ) -> None:
+        self.app = app
+        self.fetch = fetch
+        self.size = size
+        self.low_water = low_water
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+
+        self.callback_url: str | None = None
+
+        self._lock = threading.Lock()
+        self._tokens: collections.deque[tuple[float, RequestToken]] = (
+            collections.deque()
+        )
+        self._wake_up = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def __len__(self) -> int:
+        """
+        Returns the number of unexpired tokens in the pool.
+        """
+        with self._lock:
+            self._discard_expired()
+            return len(self._tokens)
+
+    def pop(self, callback_url: str) -> RequestToken | None:
+        """
+        Take a request token for ``callback_url`` from the pool, or return
+        None if there aren't any.
+
+        This starts the background thread if it isn't already running,
+        and wakes it up if the pool needs topping up.
+        """
+        with self._lock:
+            # If the callback URL has changed, the tokens we already
+            # have will send the user to the wrong place.
+            if callback_url != self.callback_url:
+                self.callback_url = callback_url
+                self._tokens.clear()
+
+            self._discard_expired()
+
+            request_token = self._tokens.popleft()[1] if self._tokens else None
+
+            if len(self._tokens) < self.low_water:
+                self._wake_up.set()
+
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="request-token-pool", daemon=True
+                )
+                self._thread.start()
+
+        return request_token
+
+    def refill(self) -> None:
+        """
+        Fetch tokens from Flickr until the pool is full.
+
+        We fetch at most ``size`` tokens each time, so we don't loop
+        forever if tokens expire faster than we can fetch them.
+
+        If Flickr returns an error, we stop and raise it -- the
+        background thread will try again later.
+        """
+        for _ in range(self.size):
+            with self._lock:
+                self._discard_expired()
+                callback_url = self.callback_url
+
+                if callback_url is None or len(self._tokens) >= self.size:
+                    return
+
+            with self.app.app_context():
+                request_token = self.fetch(callback_url)
+
+            with self._lock:
+                # Don't keep the token if the callback URL changed while
+                # we were waiting for Flickr.
+                if callback_url == self.callback_url:
+                    self._tokens.append((time.monotonic() + self.ttl, request_token))
+
+    def stop(self) -> None:
+        """
+        Stop the background thread.
+        """
+        self._stopped.set()
+        self._wake_up.set()
+
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self) -> None:
+        """
+        Top up the pool whenever it's woken up, or when the oldest token
+        expires, until the pool is stopped.
+        """
+        while not self._stopped.is_set():
+            self._wake_up.clear()
+
+            try:
+                self.refill()
+            except Exception:
+                logger.warning("Unable to fetch request tokens", exc_info=True)
+                timeout = self.retry_interval
+            else:
+                timeout = self._time_until_next_expiry()
+
+            self._wake_up.wait(timeout=timeout)
+
+    def _time_until_next_expiry(self) -> float:
+        """
+        How long (in seconds) until the oldest token in the pool expires.
+
+        If the pool is empty even though we just filled it, the tokens
+        are expiring as fast as we can fetch them, so we wait a while
+        before we try again.
+        """
+        with self._lock:
+            self._discard_expired()
+
+            if not self._tokens:
+                return self.retry_interval
+
+            return max(self._tokens[0][0] - time.monotonic(), 0)
+
+    def _discard_expired(self) -> None:
+        """
+        Remove any expired tokens from the pool.
+
+        Every token has the same TTL, so the oldest tokens are at the
+        front.  The caller must hold the lock.
+        """
+        now = time.monotonic()
+
+        while self._tokens and self._tokens[0][0] <= now:
+            self._tokens.popleft()
+
+
+def init_app(
+    app: Flask, *, fetch: Callable[[str], RequestToken]
+) -> RequestTokenPool | None:
+    """
+    Create the request token pool for an app, using the settings in
+    the app config, or return None if the pool is turned off.
+
+    The pool is saved in ``app.extensions["request_token_pool"]``.
+    """
+    # How many request tokens to keep ready.  If this is zero, we don't
+    # keep a pool, and /authorize always gets a token from Flickr.
+    app.config.setdefault("REQUEST_TOKEN_POOL_SIZE", 0)
+
+    # When the pool has fewer than this many tokens, fetch some more
+    app.config.setdefault("REQUEST_TOKEN_POOL_LOW_WATER", 5)
+
+    # How long (in seconds) to keep a token in the pool.  This should be
+    # well below the time Flickr allows for the user to approve our app.
+    app.config.setdefault("REQUEST_TOKEN_POOL_TTL", 5 * 60)
+
+    # How long (in seconds) to wait before trying again if we can't
+    # fetch tokens from Flickr
+    app.config.setdefault("REQUEST_TOKEN_POOL_RETRY_INTERVAL", 10.0)
+
+    pool: RequestTokenPool | None
+
+    if app.config["REQUEST_TOKEN_POOL_SIZE"] > 0:
+        pool = RequestTokenPool(
+            app,
+            fetch=fetch,
+            size=app.config["REQUEST_TOKEN_POOL_SIZE"],
+            low_water=app.config["REQUEST_TOKEN_POOL_LOW_WATER"],
+            ttl=app.config["REQUEST_TOKEN_POOL_TTL"],
+            retry_interval=app.config["REQUEST_TOKEN_POOL_RETRY_INTERVAL"],
+        )
+    else:
+        pool = None
+
+    app.extensions["request_token_pool"] = pool
+
+    return pool
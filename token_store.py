@@ -0,0 +1,231 @@
+"""
+Server-side storage for OAuth request tokens.
+
+Between the /authorize step and the /callback step, we need to remember
+the request token we got from Flickr -- in particular its secret, which
+we need to exchange it for an access token.
+
+We could put it in the user's session cookie, but that makes the cookie
+bigger on every request.  Instead, we store request tokens on the
+server, keyed by the ``oauth_token``.  Flickr includes that token in
+the query string when it sends the user back to /callback, so we can
+look it up without keeping the secret in the cookie.
+
+By default, the store is a SQLite database, so every worker on the
+machine can see it, and it doesn't matter which worker handles the
+callback.  The memory store only works if you run a single worker.
+
+We still check that the callback comes from the browser that started
+the login: we save the browser's ``login_id`` (see ``pending_logins.py``)
+with the request token, and /callback refuses a token that was saved
+for a different browser.  Otherwise, an attacker could start a login,
+approve it with their own Flickr account, and send the callback URL
+to somebody else, who'd be logged in as the attacker ("login CSRF").
+You can turn this off with ``REQUEST_TOKEN_CHECK_SESSION``, e.g. if
+users start logging in on one device and finish on another.
+
+Request tokens are only useful for a few minutes, so every token has
+a time-to-live (TTL), after which it's forgotten.
+"""
+
+import abc
+import collections
+import json
+import threading
+import time
+
+from flask import Flask
+
+from sqlite_db import SqliteDatabase
+
+
+RequestToken = dict[str, str]
+
+
+class RequestTokenStore(abc.ABC):
+    """
+    Somewhere to keep request tokens until the user returns from Flickr.
+    """
+
+    @abc.abstractmethod
+    def put(self, request_token: RequestToken) -> None:
+        """
+        Save a request token, keyed by its ``oauth_token``.
+        """
+
+    @abc.abstractmethod
+    def pop(self, oauth_token: str) -> RequestToken | None:
+        """
+        Retrieve and remove a request token, or return None if it
+        doesn't exist or has expired.
+        """
+
+
+class MemoryRequestTokenStore(RequestTokenStore):
+    """
+    Store request tokens in memory, in the current process.
+
+    This is fast, but it only works if the user's callback is handled
+    by the same process that handled their /authorize request -- e.g.
+    if you run a single worker.
+
+    The store holds at most ``max_size`` tokens; if it fills up, the
+    oldest tokens are discarded first.
+    """
+
+    def __init__(self, *, ttl: float, max_size: int) -> None:
+        self.ttl = ttl
+        self.max_size = max_size
+
+        self._lock = threading.Lock()
+        self._tokens: collections.OrderedDict[str, tuple[float, RequestToken]] = (
+            collections.OrderedDict()
+        )
+
+    def put(self, request_token: RequestToken) -> None:
+        """
+        Save a request token, keyed by its ``oauth_token``.
+        """
+        now = time.monotonic()
+
+        with self._lock:
+            # Every token has the same TTL, so the tokens are stored in
+            # order of expiry -- any expired tokens are at the front.
+            while self._tokens:
+                oldest_expiry, _ = next(iter(self._tokens.values()))
+                if oldest_expiry > now and len(self._tokens) < self.max_size:
+                    break
+                self._tokens.popitem(last=False)
+
+            self._tokens[request_token["oauth_token"]] = (
+                now + self.ttl,
+                request_token,
+            )
+
+    def pop(self, oauth_token: str) -> RequestToken | None:
+        """
+        Retrieve and remove a request token, or return None if it
+        doesn't exist or has expired.
+        """
+        with self._lock:
+            try:
+                expires_at, request_token = self._tokens.pop(oauth_token)
+            except KeyError:
+                return None
+
+        if expires_at <= time.monotonic():
+            return None
+
+        return request_token
+
+
+class SqliteRequestTokenStore(RequestTokenStore):
+    """
+    Store request tokens in a SQLite database.
+
+    Multiple worker processes on the same machine can share the same
+    database file, so it doesn't matter which worker handles the user's
+    callback.
+    """
+
+    def __init__(self, path: str, *, ttl: float) -> None:
+        self.db = SqliteDatabase(
+            path,
+            schema="""
+                CREATE TABLE IF NOT EXISTS request_tokens (
+                    oauth_token TEXT PRIMARY KEY,
+                    request_token TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                );
+
+                CREATE INDEX IF NOT EXISTS request_tokens_expires_at
+                ON request_tokens (expires_at);
+            """,
+        )
+        self.ttl = ttl
+
+    def put(self, request_token: RequestToken) -> None:
+        """
+        Save a request token, keyed by its ``oauth_token``.
+
+        This also clears out any expired tokens.
+        """
+        now = time.time()
+        conn = self.db.connection()
+
+        conn.execute("DELETE FROM request_tokens WHERE expires_at <= ?", (now,))
+        conn.execute(
+            "INSERT OR REPLACE INTO request_tokens VALUES (?, ?, ?)",
+            (request_token["oauth_token"], json.dumps(request_token), now + self.ttl),
+        )
+
+    def pop(self, oauth_token: str) -> RequestToken | None:
+        """
+        Retrieve and remove a request token, or return None if it
+        doesn't exist or has expired.
+        """
+        row = (
+            self.db.connection()
+            .execute(
+                """
+                DELETE FROM request_tokens
+                WHERE oauth_token = ? AND expires_at > ?
+                RETURNING request_token
+                """,
+                (oauth_token, time.time()),
+            )
+            .fetchone()
+        )
+
+        if row is None:
+            return None
+
+        request_token: RequestToken = json.loads(row[0])
+        return request_token
+
+
+def init_app(app: Flask) -> RequestTokenStore:
+    """
+    Create the request token store for an app, using the settings in
+    the app config.
+
+    The store is saved in ``app.extensions["request_token_store"]``.
+    """
+    # Which backend to use -- "sqlite", which every worker on the
+    # machine can share, or "memory", which only works with a single
+    # worker
+    app.config.setdefault("REQUEST_TOKEN_STORE", "sqlite")
+
+    # How long (in seconds) to remember a request token
+    app.config.setdefault("REQUEST_TOKEN_TTL", 15 * 60)
+
+    # The maximum number of tokens to keep in the memory backend
+    app.config.setdefault("REQUEST_TOKEN_STORE_MAX_SIZE", 10_000)
+
+    # Where to put the database for the SQLite backend.  By default
+    # it's the same database as the users (see ``users.py``).
+    app.config.setdefault("REQUEST_TOKEN_STORE_PATH", app.config["USER_STORE_PATH"])
+
+    # Whether /callback has to come from the browser that started the
+    # login
+    app.config.setdefault("REQUEST_TOKEN_CHECK_SESSION", True)
+
+    store: RequestTokenStore
+
+    if app.config["REQUEST_TOKEN_STORE"] == "memory":
+        store = MemoryRequestTokenStore(
+            ttl=app.config["REQUEST_TOKEN_TTL"],
+            max_size=app.config["REQUEST_TOKEN_STORE_MAX_SIZE"],
+        )
+    elif app.config["REQUEST_TOKEN_STORE"] == "sqlite":
+        store = SqliteRequestTokenStore(
+            app.config["REQUEST_TOKEN_STORE_PATH"], ttl=app.config["REQUEST_TOKEN_TTL"]
+        )
+    else:
+        raise ValueError(
+            f"Unrecognised request token store: {app.config['REQUEST_TOKEN_STORE']!r}"
+        )
+
+    app.extensions["request_token_store"] = store
+
+    return store
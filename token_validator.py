@@ -0,0 +1,234 @@
+"""
+Check in the background whether users' access tokens are still valid.
+
+Once somebody has logged in, Flask-Login trusts the user ID in their
+session cookie until it expires.  But they can revoke our app's access
+on Flickr at any time, and we'd never know -- we'd carry on showing
+them as logged in, and any API calls we made for them would fail.
+
+We could ask Flickr (``flickr.auth.oauth.checkToken``) on every request,
+but that would make every page as slow as a round trip to Flickr, and
+use up our rate limit.  Instead, a background thread checks every token
+once per ``TOKEN_CHECK_INTERVAL``:
+
+*   Every ``TOKEN_CHECK_TICK`` seconds, it checks a batch of the tokens
+    we checked longest ago.  The batches are sized so every token gets
+    checked once per interval, which spreads the calls evenly rather
+    than checking everybody at once.
+*   The tokens in a batch are checked a few at a time, in parallel.
+    The calls go through the same rate limiter as everything else, as
+    background calls: they stop while the bucket is below the bigger
+    reserve we keep for background work, so a batch can't use up the
+    calls that new logins need -- see ``rate_limit.py``.  A check that's
+    rate limited is skipped until the next interval.
+*   If Flickr says a token is invalid, we mark the user as revoked in
+    the database, and add them to the set of revoked users in memory
+    (see ``users.py``).  The user loader looks them up in that set, and
+    logs them out on their next request.
+
+If there are several workers, they share the work: each batch is
+chosen and claimed in a single database transaction, so two workers
+don't check the same token.  Each worker reloads the set of revoked
+users before each batch, so it picks up users revoked by the others --
+and notices users who've logged in again on another worker.  Until
+then, those users are logged out on this worker, because the user
+loader trusts the set rather than asking the database on every request.
+
+Like the other background threads, this starts in the worker process,
+on its first request.  It's turned off by default; set
+``TOKEN_CHECK_INTERVAL`` to turn it on.
+"""
+
+import concurrent.futures
+import logging
+import math
+import os
+import threading
+
+from flask import Flask
+
+from flickr_api import FlickrApi, FlickrApiError
+from flickr_calls import FlickrRateLimited
+from users import FlickrUser, UserStore
+
+
+logger = logging.getLogger(__name__)
+
+# The error code Flickr returns for an access token which is invalid,
+# e.g. because the user revoked it.
+#
+# See https://www.flickr.com/services/api/flickr.auth.oauth.checkToken.html
+INVALID_TOKEN = 98
+
+
+class TokenValidator:
+    """
+    Checks every user's access token once per ``interval`` seconds, in
+    batches every ``tick`` seconds, with up to ``concurrency`` checks
+    at once and at most ``max_batch`` checks per batch.
+    """
+
+    def __init__(
+        self,
+        app: Flask,
+        *,
+        store: UserStore,
+        api: FlickrApi,
+        interval: float,
+        tick: float,
+        concurrency: int,
+        max_batch: int,
+    ) -> None:
+        self.app = app
+        self.store = store
+        self.api = api
+        self.interval = interval
+        self.tick = tick
+        self.concurrency = concurrency
+        self.max_batch = max_batch
+
+        self._lock = threading.Lock()
+        self._pid: int | None = None
+        self._stopped = threading.Event()
+
+    def start(self) -> None:
+        """
+        Start checking tokens in this worker, unless we already are.
+
+        This is called before every request, so it's cheap if we've
+        already started -- just a lock and a comparison.
+        """
+        pid = os.getpid()
+
+        with self._lock:
+            if self._pid == pid:
+                return
+
+            self._pid = pid
+            self._stopped.clear()
+
+            threading.Thread(
+                target=self._run, name="token-validator", daemon=True
+            ).start()
+
+    def stop(self) -> None:
+        """
+        Stop checking tokens.  Any batch which is running will finish.
+        """
+        self._stopped.set()
+
+    def batch_size(self) -> int:
+        """
+        Return how many tokens to check in the next batch, so every
+        token gets checked once per interval.
+        """
+        count = self.store.repository.count_tokens()
+        return min(math.ceil(count * self.tick / self.interval), self.max_batch)
+
+    def check_batch(self) -> int:
+        """
+        Check the next batch of tokens, and return how many of them
+        had been revoked.
+        """
+        self.store.refresh_revoked()
+
+        users = self.store.repository.claim_token_checks(self.batch_size())
+
+        if not users:
+            return 0
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.concurrency, thread_name_prefix="token-validator-check"
+        ) as executor:
+            results = list(executor.map(self.check, users))
+
+        revoked = sum(result == "revoked" for result in results)
+        rate_limited = sum(result == "rate_limited" for result in results)
+
+        logger.info(
+            "Checked %d access tokens: %d revoked, %d skipped (rate limited)",
+            len(users),
+            revoked,
+            rate_limited,
+        )
+
+        return revoked
+
+    def check(self, user: FlickrUser) -> str:
+        """
+        Ask Flickr if a user's access token is still valid, and mark
+        them as revoked if it isn't.
+
+        Returns ``valid``, ``revoked``, ``rate_limited`` or ``error``.
+        If we can't tell, we leave the user alone, and check them again
+        in the next interval.
+        """
+        try:
+            with self.app.app_context():
+                self.api.call(user, "flickr.auth.oauth.checkToken", background=True)
+        except FlickrApiError as err:
+            if err.code != INVALID_TOKEN:
+                logger.warning(
+                    "Unable to check access token for %s", user.user_nsid, exc_info=True
+                )
+                return "error"
+
+            logger.info("Access token for %s has been revoked", user.user_nsid)
+            self.store.revoke(user)
+            return "revoked"
+        except FlickrRateLimited:
+            return "rate_limited"
+        except Exception:
+            logger.warning(
+                "Unable to check access token for %s", user.user_nsid, exc_info=True
+            )
+            return "error"
+        else:
+            return "valid"
+
+    def _run(self) -> None:
+        """
+        Check a batch of tokens every tick, until we're stopped.
+        """
+        while not self._stopped.wait(self.tick):
+            try:
+                self.check_batch()
+            except Exception:
+                logger.exception("Unable to check access tokens")
+
+
+def init_app(app: Flask) -> TokenValidator | None:
+    """
+    Create the token validator for an app, using the settings in the
+    app config, or return None if it's turned off.
+
+    The validator is saved in ``app.extensions["token_validator"]``.
+    """
+    # How often (in seconds) to check each user's access token, or None
+    # to never check them
+    app.config.setdefault("TOKEN_CHECK_INTERVAL", None)
+
+    # How often (in seconds) to check a batch of tokens, how many to
+    # check at once, and the most to check in one batch
+    app.config.setdefault("TOKEN_CHECK_TICK", 60.0)
+    app.config.setdefault("TOKEN_CHECK_CONCURRENCY", 4)
+    app.config.setdefault("TOKEN_CHECK_MAX_BATCH", 100)
+
+    if app.config["TOKEN_CHECK_INTERVAL"] is None:
+        app.extensions["token_validator"] = None
+        return None
+
+    validator = TokenValidator(
+        app,
+        store=app.extensions["user_store"],
+        api=app.extensions["flickr_api"],
+        interval=app.config["TOKEN_CHECK_INTERVAL"],
+        tick=app.config["TOKEN_CHECK_TICK"],
+        concurrency=app.config["TOKEN_CHECK_CONCURRENCY"],
+        max_batch=app.config["TOKEN_CHECK_MAX_BATCH"],
+    )
+
+    app.extensions["token_validator"] = validator
+    app.before_request(validator.start)
+
+    return validator
@@ -0,0 +1,246 @@
+"""
+Trace a sample of logins, from /authorize to Flickr and back to /callback.
+
+A single login is spread over two of our requests -- /authorize and
+/callback, which might be handled by different workers, minutes apart --
+and the calls we make to Flickr in each of them.  If logins are slow,
+the metrics (see ``metrics.py``) tell us which step is slow on average,
+but not what happened to a particular login.
+
+When a login is traced, we give it a random trace ID in /authorize, and
+save it with the request token (see ``token_store.py``).  When the user
+comes back to /callback, we find the trace ID with the request token,
+and carry on the same trace.  Along the way we record a "span" for each
+view, and for each call to Flickr, e.g.
+
+    {"trace_id": "5f0c…", "span_id": "9a1e…", "parent_id": "c3d2…",
+     "name": "flickr.fetch_request_token", "timestamp": 1740738448.123,
+     "duration_ms": 212.4, "attributes": {"outcome": "success"}}
+
+The most recent spans are kept in memory, in a ring buffer, and you can
+download them as JSON lines from ``/debug/traces`` (optionally with
+``?trace_id=…``).  Each worker process only has the spans it recorded
+itself, so with several workers, you may need to ask more than once.
+
+Tracing is off unless you set ``TRACE_SAMPLE_RATE``.  When it's off, we
+don't add anything to the request path, and when a login isn't sampled,
+the only cost is looking for a trace in ``g``.
+
+This is deliberately small.  In a bigger app, you'd use OpenTelemetry
+(https://opentelemetry.io/) and send the spans somewhere like Jaeger.
+"""
+
+import collections
+import json
+import random
+import secrets
+import threading
+import time
+import typing
+
+from flask import Flask, Response, current_app, g, request
+
+from token_store import RequestToken
+
+
+Span = dict[str, typing.Any]
+
+
+class Trace:
+    """
+    The part of a trace that's happening in the current request.
+
+    We record when the request's span started on both clocks: the wall
+    clock, so we can compare spans from different requests, and the
+    monotonic clock, so we can time things accurately.
+    """
+
+    __slots__ = ("trace_id", "span_id", "timestamp", "started_at")
+
+    def __init__(self, trace_id: str) -> None:
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.timestamp = time.time()
+        self.started_at = time.perf_counter()
+
+
+class Tracer:
+    """
+    Decides which logins to trace, and keeps the most recent
+    ``buffer_size`` spans.
+    """
+
+    def __init__(self, *, sample_rate: float, buffer_size: int) -> None:
+        self.sample_rate = sample_rate
+
+        self._lock = threading.Lock()
+        self._spans: collections.deque[Span] = collections.deque(maxlen=buffer_size)
+
+    def should_sample(self) -> bool:
+        """
+        Returns True if we should trace a new login.
+        """
+        return random.random() < self.sample_rate
+
+    def record(
+        self,
+        trace: Trace,
+        name: str,
+        *,
+        started_at: float,
+        duration: float,
+        is_root: bool = False,
+        **attributes: typing.Any,
+    ) -> None:
+        """
+        Record a span in a trace.
+
+        ``started_at`` is a time from :func:`time.perf_counter`.  The root
+        span is the view; every other span is a child of the view.
+        """
+        span: Span = {
+            "trace_id": trace.trace_id,
+            "span_id": trace.span_id if is_root else secrets.token_hex(8),
+            "parent_id": None if is_root else trace.span_id,
+            "name": name,
+            "timestamp": trace.timestamp + (started_at - trace.started_at),
+            "duration_ms": round(duration * 1000, 3),
+            "attributes": attributes,
+        }
+
+        with self._lock:
+            self._spans.append(span)
+
+    def spans(self, trace_id: str | None = None) -> list[Span]:
+        """
+        Return the spans we've kept, oldest first -- either every span,
+        or just the spans in one trace.
+        """
+        with self._lock:
+            spans = list(self._spans)
+
+        if trace_id is None:
+            return spans
+
+        return [span for span in spans if span["trace_id"] == trace_id]
+
+    def export(self, trace_id: str | None = None) -> str:
+        """
+        Return the spans we've kept as JSON lines, one span per line.
+        """
+        return "".join(json.dumps(span) + "\n" for span in self.spans(trace_id))
+
+
+def current_tracer() -> Tracer | None:
+    """
+    Return the app's tracer, or None if tracing is turned off.
+    """
+    tracer: Tracer | None = current_app.extensions["tracer"]
+    return tracer
+
+
+def start_trace() -> None:
+    """
+    Start a new trace for the current request, if tracing is turned on
+    and this request is chosen.
+
+    This is called in /authorize, at the start of a login.
+    """
+    tracer = current_tracer()
+
+    if tracer is not None and tracer.should_sample():
+        g._trace = Trace(trace_id=secrets.token_hex(16))
+
+
+def resume_trace(trace_id: str | None) -> None:
+    """
+    Carry on a trace that was started in an earlier request.
+
+    This is called in /callback, with the trace ID we saved with the
+    request token.  We've already decided to trace this login, so we
+    don't sample it again.
+    """
+    if trace_id is not None and current_tracer() is not None:
+        g._trace = Trace(trace_id=trace_id)
+
+
+def with_trace_id(request_token: RequestToken) -> RequestToken:
+    """
+    Add the current trace ID to a request token, if we're tracing this
+    login, so /callback can carry on the same trace.
+    """
+    trace: Trace | None = g.get("_trace")
+
+    if trace is None:
+        return request_token
+
+    return {**request_token, "trace_id": trace.trace_id}
+
+
+def record_span(
+    name: str, *, started_at: float, duration: float, **attributes: typing.Any
+) -> None:
+    """
+    Record a span in the current trace, if there is one, e.g. for a call
+    to Flickr.
+
+    The caller has already timed the work (e.g. for the metrics), so
+    this costs almost nothing if we're not tracing.
+    """
+    trace: Trace | None = g.get("_trace")
+
+    if trace is not None:
+        tracer = current_tracer()
+        assert tracer is not None
+        tracer.record(
+            trace, name, started_at=started_at, duration=duration, **attributes
+        )
+
+
+def finish_trace(response: Response) -> Response:
+    """
+    Record the span for the view, if we traced this request.
+    """
+    trace: Trace | None = g.pop("_trace", None)
+
+    if trace is not None:
+        tracer = current_tracer()
+        assert tracer is not None
+        tracer.record(
+            trace,
+            request.endpoint or "unmatched",
+            started_at=trace.started_at,
+            duration=time.perf_counter() - trace.started_at,
+            is_root=True,
+            status=response.status_code,
+        )
+
+    return response
+
+
+def init_app(app: Flask) -> Tracer | None:
+    """
+    Set up tracing for an app, using the settings in the app config,
+    or return None if tracing is turned off.
+
+    The tracer is saved in ``app.extensions["tracer"]``.
+    """
+    # The fraction of logins to trace, from 0 (none) to 1 (all)
+    app.config.setdefault("TRACE_SAMPLE_RATE", 0.0)
+
+    # How many spans to keep in memory.  A login has about five spans.
+    app.config.setdefault("TRACE_BUFFER_SIZE", 10_000)
+
+    if app.config["TRACE_SAMPLE_RATE"] <= 0:
+        app.extensions["tracer"] = None
+        return None
+
+    tracer = Tracer(
+        sample_rate=app.config["TRACE_SAMPLE_RATE"],
+        buffer_size=app.config["TRACE_BUFFER_SIZE"],
+    )
+
+    app.extensions["tracer"] = tracer
+    app.after_request(finish_trace)
+
+    return tracer
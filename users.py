@@ -0,0 +1,386 @@
+"""
+Users who've logged in with Flickr, and somewhere to keep them.
+
+Flask-Login looks up the current user on every request, so we want
+that to be fast.  Users are saved in a SQLite database, but we keep
+recently-seen users in an in-memory cache, so most requests don't need
+to touch the database at all.
+
+If a user revokes our app's access on Flickr, we find out in the
+background (see ``token_validator.py``) and record it in the database.
+Each worker keeps the NSIDs of revoked users in a set, so checking
+whether a user has been revoked doesn't touch the database either.
+"""
+
+import time
+
+from flask import Flask
+
+from cache import TTLCache
+from sqlite_db import SqliteDatabase
+
+
+class FlickrUser:
+    """
+    A user who's logged in to the app with Flickr.
+
+    This provides the properties and methods that Flask-Login expects;
+    we don't inherit from ``UserMixin`` because it would give every user
+    a per-instance ``__dict__``.  Instead we use ``__slots__``, so each
+    user is a small, fixed-size object -- which matters when we have
+    thousands of them in the cache.
+
+    See https://flask-login.readthedocs.io/en/latest/#your-user-class
+    """
+
+    __slots__ = (
+        "user_nsid",
+        "name",
+        "id",
+        "oauth_token",
+        "oauth_token_secret",
+        "client_id",
+    )
+
+    # Every FlickrUser is a real, logged-in user -- logged-out users are
+    # represented by Flask-Login's ``AnonymousUserMixin``.
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
+    def __init__(
+        self,
+        user_nsid: str,
+        name: str,
+        oauth_token: str | None = None,
+        oauth_token_secret: str | None = None,
+        client_id: str | None = None,
+    ):
+        self.user_nsid = user_nsid
+        self.name = name
+
+        # The access token for making Flickr API calls on behalf of
+        # this user, if we have one, and the API key it belongs to.
+        # If we don't know the key, it's the app's default key -- see
+        # ``api_keys.py``.
+        self.oauth_token = oauth_token
+        self.oauth_token_secret = oauth_token_secret
+        self.client_id = client_id
+
+        # This will store an ID like ``197130754@N07/Flickr Foundation``
+        self.id = f"{user_nsid}/{name}"
+
+    def get_id(self) -> str:
+        """
+        Returns the ID that Flask-Login stores in the session.
+        """
+        return self.id
+
+
+class UserRepository:
+    """
+    Users saved in a SQLite database, indexed by their NSID.
+
+    The database can be shared by multiple worker processes.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.db = SqliteDatabase(
+            path,
+            schema="""
+                -- ``client_id`` is the API key for the user's access
+                -- token, or NULL for the app's default key.
+                --
+                -- ``checked_at`` is when we last asked Flickr if their
+                -- access token was still valid, or NULL if we never
+                -- have -- see ``token_validator.py``.
+                CREATE TABLE IF NOT EXISTS users (
+                    user_nsid TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    oauth_token TEXT,
+                    oauth_token_secret TEXT,
+                    client_id TEXT,
+                    updated_at REAL NOT NULL,
+                    checked_at REAL
+                ) WITHOUT ROWID;
+
+                -- Users whose access token has been revoked.  They stay
+                -- here until they log in again.
+                CREATE TABLE IF NOT EXISTS revoked_users (
+                    user_nsid TEXT PRIMARY KEY,
+                    revoked_at REAL NOT NULL
+                ) WITHOUT ROWID;
+            """,
+        )
+
+    def save(self, user: FlickrUser) -> None:
+        """
+        Save a user, replacing any existing user with the same NSID.
+
+        If the user was revoked, they've logged in again with a new
+        access token, so they aren't revoked any more.  We keep the
+        time we last checked their token, so logging in doesn't move
+        them to the front of the queue of tokens to check.
+        """
+        conn = self.db.connection()
+
+        conn.execute("BEGIN IMMEDIATE")
+
+        try:
+            conn.execute(
+                """
+                INSERT INTO users (
+                    user_nsid,
+                    name,
+                    oauth_token,
+                    oauth_token_secret,
+                    client_id,
+                    updated_at
+                )
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (user_nsid) DO UPDATE SET
+                    name = excluded.name,
+                    oauth_token = excluded.oauth_token,
+                    oauth_token_secret = excluded.oauth_token_secret,
+                    client_id = excluded.client_id,
+                    updated_at = excluded.updated_at
+                """,
+                (
+                    user.user_nsid,
+                    user.name,
+                    user.oauth_token,
+                    user.oauth_token_secret,
+                    user.client_id,
+                    time.time(),
+                ),
+            )
+
+            conn.execute(
+                "DELETE FROM revoked_users WHERE user_nsid = ?", (user.user_nsid,)
+            )
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+
+    def get(self, user_nsid: str) -> FlickrUser | None:
+        """
+        Look up a user by their NSID, or return None if we don't know
+        about them.
+        """
+        row = (
+            self.db.connection()
+            .execute(
+                """
+                SELECT user_nsid, name, oauth_token, oauth_token_secret, client_id
+                FROM users
+                WHERE user_nsid = ?
+                """,
+                (user_nsid,),
+            )
+            .fetchone()
+        )
+
+        if row is None:
+            return None
+
+        return FlickrUser(*row)
+
+    def count_tokens(self) -> int:
+        """
+        Return how many users have an access token we could check.
+        """
+        (count,) = (
+            self.db.connection()
+            .execute(
+                """
+                SELECT COUNT(*) FROM users
+                WHERE oauth_token IS NOT NULL
+                AND user_nsid NOT IN (SELECT user_nsid FROM revoked_users)
+                """
+            )
+            .fetchone()
+        )
+        return int(count)
+
+    def claim_token_checks(self, limit: int) -> list[FlickrUser]:
+        """
+        Choose up to ``limit`` users whose access tokens we checked the
+        longest time ago (or never), and record that we're checking
+        them now.
+
+        This happens in a single transaction, so if several workers are
+        checking tokens, they don't choose the same users.
+        """
+        conn = self.db.connection()
+
+        conn.execute("BEGIN IMMEDIATE")
+
+        try:
+            rows = conn.execute(
+                """
+                SELECT user_nsid, name, oauth_token, oauth_token_secret, client_id
+                FROM users
+                WHERE oauth_token IS NOT NULL
+                AND user_nsid NOT IN (SELECT user_nsid FROM revoked_users)
+                ORDER BY COALESCE(checked_at, 0)
+                LIMIT ?
+                """,
+                (limit,),
+            ).fetchall()
+
+            now = time.time()
+
+            conn.executemany(
+                "UPDATE users SET checked_at = ? WHERE user_nsid = ?",
+                [(now, row[0]) for row in rows],
+            )
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+
+        return [FlickrUser(*row) for row in rows]
+
+    def mark_revoked(self, user: FlickrUser) -> bool:
+        """
+        Record that a user's access token has been revoked, and return
+        True if we did.
+
+        If the user has logged in again since we checked their token,
+        they have a new token, so we don't mark them as revoked.
+        """
+        cursor = self.db.connection().execute(
+            """
+            INSERT OR REPLACE INTO revoked_users
+            SELECT user_nsid, ? FROM users
+            WHERE user_nsid = ? AND oauth_token = ?
+            """,
+            (time.time(), user.user_nsid, user.oauth_token),
+        )
+        return cursor.rowcount > 0
+
+    def revoked_user_nsids(self) -> set[str]:
+        """
+        Return the NSIDs of every user whose access token has been revoked.
+        """
+        return {
+            user_nsid
+            for (user_nsid,) in self.db.connection().execute(
+                "SELECT user_nsid FROM revoked_users"
+            )
+        }
+
+
+class UserStore:
+    """
+    A :class:`UserRepository` with an in-memory cache in front of it.
+
+    Cached users expire after a while, so changes made by other worker
+    processes are picked up eventually.
+
+    We also keep the set of revoked users in memory, so we can reject
+    them without a database query.  We don't load it until we first
+    need it, so we don't touch the database in a parent process that
+    forks the workers.
+    """
+
+    def __init__(
+        self, repository: UserRepository, *, cache_size: int, cache_ttl: float
+    ) -> None:
+        self.repository = repository
+        self.cache: TTLCache[str, FlickrUser] = TTLCache(
+            max_size=cache_size, ttl=cache_ttl
+        )
+        self._revoked: set[str] | None = None
+
+    @property
+    def revoked(self) -> set[str]:
+        """
+        The NSIDs of users whose access tokens have been revoked.
+        """
+        if self._revoked is None:
+            self._revoked = self.repository.revoked_user_nsids()
+
+        return self._revoked
+
+    def refresh_revoked(self) -> None:
+        """
+        Reload the set of revoked users, to pick up any that were
+        revoked by other worker processes.
+        """
+        self._revoked = self.repository.revoked_user_nsids()
+
+    def load(self, user_id: str) -> FlickrUser | None:
+        """
+        Find the user with this ID, as stored by Flask-Login in the
+        session, e.g. ``197130754@N07/Flickr Foundation``.
+
+        If we don't have this user in the database, we return a basic
+        user based on their ID.  If the user has revoked our access on
+        Flickr, we return None, which logs them out.
+        """
+        user_nsid, _, name = user_id.partition("/")
+
+        # This is a set lookup, so it doesn't touch the database.  If
+        # a revoked user logs in again on another worker, we'll notice
+        # when we next reload the set -- see ``token_validator.py``.
+        if user_nsid in self.revoked:
+            return None
+
+        user = self.cache.get(user_nsid)
+
+        if user is None:
+            user = self.repository.get(user_nsid) or FlickrUser(user_nsid, name)
+            self.cache.set(user_nsid, user)
+
+        return user
+
+    def save(self, user: FlickrUser) -> None:
+        """
+        Save a user to the database and the cache.
+        """
+        self.repository.save(user)
+        self.cache.set(user.user_nsid, user)
+        self.revoked.discard(user.user_nsid)
+
+    def revoke(self, user: FlickrUser) -> None:
+        """
+        Record that a user's access token has been revoked, so they're
+        logged out on their next request.
+        """
+        if self.repository.mark_revoked(user):
+            self.revoked.add(user.user_nsid)
+            self.cache.invalidate(user.user_nsid)
+
+    def invalidate(self, user_nsid: str) -> None:
+        """
+        Remove a user from the cache, e.g. when they log out.
+        """
+        self.cache.invalidate(user_nsid)
+
+
+def init_app(app: Flask) -> UserStore:
+    """
+    Create the user store for an app, using the settings in the app config.
+
+    The store is saved in ``app.extensions["user_store"]``.
+    """
+    # Where to put the user database
+    app.config.setdefault("USER_STORE_PATH", "users.sqlite")
+
+    # How many users to keep in memory, and for how long (in seconds)
+    app.config.setdefault("USER_CACHE_SIZE", 10_000)
+    app.config.setdefault("USER_CACHE_TTL", 5 * 60)
+
+    store = UserStore(
+        UserRepository(app.config["USER_STORE_PATH"]),
+        cache_size=app.config["USER_CACHE_SIZE"],
+        cache_ttl=app.config["USER_CACHE_TTL"],
+    )
+
+    app.extensions["user_store"] = store
+
+    return store
@@ -0,0 +1,157 @@
+"""
+Warm up each worker before it gets any logins, and tell the load
+balancer when it's ready.
+
+The first login in a new worker process is much slower than the rest.
+It has to import the OAuth libraries (see ``app.py``), create the HTTP
+transport (see ``flickr_http.py``), look up Flickr's address in DNS,
+and do a TLS handshake with Flickr -- and that happens on every worker,
+after every deploy.
+
+If warm-up is turned on, each worker does all that in a background
+thread as soon as it starts, by making one signed request to Flickr's
+OAuth endpoint.  The connection stays open in the worker's pool, so the
+first real login can reuse it.
+
+Meanwhile, ``/ready`` returns 503 Service Unavailable until the warm-up
+has finished, so a load balancer which uses it as a readiness check
+won't send any traffic to a cold worker.
+
+*   If warm-up fails (e.g. Flickr is down), we log a warning and report
+    that we're ready anyway.  Readiness is about whether this worker is
+    warm, not whether Flickr is up -- ``/status/flickr`` tells you that.
+*   Like the other background threads in this app, the warm-up runs in
+    the worker process.  If the app is created in a parent process that
+    forks the workers (e.g. ``gunicorn --preload``), the thread is lost
+    in the fork, so each worker starts it again the first time it's
+    asked whether it's ready.  You can also call
+    ``app.extensions["warm_up"].start()`` from gunicorn's ``post_fork``
+    hook, so workers don't wait for the first readiness check.
+
+Warm-up is turned off by default; set ``WARM_UP_ON_START`` to turn it on.
+"""
+
+from collections.abc import Callable
+import logging
+import os
+import threading
+import time
+import typing
+
+from flask import Flask
+
+
+logger = logging.getLogger(__name__)
+
+
+class WarmUp:
+    """
+    Runs ``warm`` once in each worker process, in a background thread,
+    and tracks whether it's finished.
+
+    ``warm`` is called inside an app context, so it can use the app
+    config.  If it raises an exception, the warm-up has failed, but the
+    worker is still ready.
+    """
+
+    def __init__(self, app: Flask, *, warm: Callable[[], None]) -> None:
+        self.app = app
+        self.warm = warm
+
+        self._lock = threading.Lock()
+        self._pid: int | None = None
+        self._done = threading.Event()
+        self._state = "cold"
+        self._duration: float | None = None
+
+    def start(self) -> None:
+        """
+        Start warming up this worker, unless it's already started.
+
+        This is cheap to call more than once.
+        """
+        pid = os.getpid()
+
+        with self._lock:
+            # If we've been forked, any warm-up belongs to our parent,
+            # and it didn't warm up anything in this process.
+            if self._pid == pid:
+                return
+
+            self._pid = pid
+            self._done = threading.Event()
+            self._state = "warming"
+            self._duration = None
+
+            threading.Thread(target=self._run, name="warm-up", daemon=True).start()
+
+    def wait(self, timeout: float | None = None) -> bool:
+        """
+        Wait for the warm-up to finish, and return True if it did.
+        """
+        return self._done.wait(timeout)
+
+    @property
+    def is_ready(self) -> bool:
+        """
+        Returns True if this worker has finished warming up.
+        """
+        return self._pid == os.getpid() and self._done.is_set()
+
+    def snapshot(self) -> dict[str, typing.Any]:
+        """
+        Return the state of the warm-up, e.g. for ``/ready``.
+        """
+        with self._lock:
+            state = self._state if self._pid == os.getpid() else "cold"
+
+            return {
+                "ready": state in {"ready", "failed"},
+                "state": state,
+                "duration": self._duration,
+            }
+
+    def _run(self) -> None:
+        """
+        Warm up, and record how it went.
+        """
+        start = time.perf_counter()
+
+        try:
+            with self.app.app_context():
+                self.warm()
+        except Exception:
+            logger.warning("Unable to warm up connection to Flickr", exc_info=True)
+            state = "failed"
+        else:
+            state = "ready"
+
+        duration = time.perf_counter() - start
+
+        logger.info("Warm-up finished in %.2fs: %s", duration, state)
+
+        with self._lock:
+            self._state = state
+            self._duration = duration
+            self._done.set()
+
+
+def init_app(app: Flask, *, warm: Callable[[], None]) -> WarmUp | None:
+    """
+    Start warming up the app, if it's turned on in the config, or
+    return None if it isn't.
+
+    The warm-up is saved in ``app.extensions["warm_up"]``.
+    """
+    # Whether to warm up each worker before it reports that it's ready
+    app.config.setdefault("WARM_UP_ON_START", False)
+
+    if not app.config["WARM_UP_ON_START"]:
+        app.extensions["warm_up"] = None
+        return None
+
+    warm_up = WarmUp(app, warm=warm)
+    app.extensions["warm_up"] = warm_up
+    warm_up.start()
+
+    return warm_up